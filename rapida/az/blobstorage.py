@@ -1,10 +1,10 @@
 import asyncio
 import logging
 import os
-import aiofiles
 
-from rapida.session import Session
-from rapida.util.chunker import chunker
+from rapida.az.storage import get_container_client
+from rapida.az.transfer import TransferEngine
+from rapida.util.dataset_cache import get_dataset_cache
 from azure.storage.blob import BlobType
 from azure.storage.blob.aio import BlobClient
 from typing import Iterable
@@ -17,36 +17,16 @@ logger = logging.getLogger(__name__)
 
 async def download(blob_client:BlobClient = None, dst_path:str=None, progress=None, downloads_task=None):
 
-    if not await blob_client.exists():
-        raise ValueError(f"Blob {blob_client.blob_name} does not exist")
     try:
         logger.debug(f"Going to download {blob_client.blob_name} to {dst_path}")
-        blob_props = await blob_client.get_blob_properties()
-        blob_size = blob_props.size  # Total bytes to download
-        if os.path.exists(dst_path) and os.path.getsize(dst_path) == blob_size:
-            return dst_path
-        blob = await blob_client.download_blob()
-        task = None
-        name = os.path.split(blob_props.name)[-1]
-        if progress is not None:
-            task = progress.add_task(description=f'Downloading {name} ', total=blob_size)
-        async with aiofiles.open(dst_path, "wb") as f:
-            async for chunk in blob.chunks():
-                await f.write(chunk)
-                if progress is not None and task is not None:
-                    progress.update(task, advance=len(chunk))
-                if progress is not None and downloads_task is not None:
-                    progress.update(downloads_task, description=f'[blue]Downloading {name}',)
-            if progress is not None and task is not None:
-                progress.remove_task(task)
-
+        engine = TransferEngine(progress=progress, cache=get_dataset_cache())
+        await engine.download(blob_client=blob_client, dst_path=dst_path)
         if progress is not None and downloads_task is not None:
             progress.update(downloads_task, advance=1)
     except Exception as e:
         logger.error(f"Failed to download the blob from {blob_client.blob_name}: {e}")
         raise
     else:
-        logger.debug(f"Downloaded blob {blob_client.blob_name} to {dst_path}")
         return dst_path
 
 
@@ -73,10 +53,9 @@ async def download_blob(src_path: str = None, dst_path: str = None, progress=Non
     proto, account_name, src_blob_path = src_path.split(':')
     container_name, *src_path_parts = src_blob_path.split(os.path.sep)
     rel_src_blob_path = os.path.sep.join(src_path_parts)
-    async with Session() as session:
-        async with session.get_blob_container_client(account_name=account_name,container_name=container_name) as cc:
-            blob_client = cc.get_blob_client(blob=rel_src_blob_path)
-            return await download(blob_client=blob_client, dst_path=dst_path, progress=progress )
+    async with get_container_client(account_name=account_name,container_name=container_name) as cc:
+        blob_client = cc.get_blob_client(blob=rel_src_blob_path)
+        return await download(blob_client=blob_client, dst_path=dst_path, progress=progress )
 
 
 async def upload(src_path, dst_path, blob_client:BlobClient = None, blob_type:BlobType =  BlobType.BLOCKBLOB, overwrite=True):
@@ -93,13 +72,8 @@ async def upload(src_path, dst_path, blob_client:BlobClient = None, blob_type:Bl
         raise ValueError(f"File {src_path} does not exist")
     try:
         logger.debug(f"Uploading {src_path} to {dst_path}")
-        with open(src_path, mode="rb") as data:
-            await blob_client.upload_blob(
-                data=data,
-                overwrite=overwrite,
-                blob_type = blob_type,
-                #max_concurrency=8
-            )
+        await TransferEngine().upload(src_path=src_path, blob_client=blob_client, overwrite=overwrite,
+                                      blob_type=blob_type)
     except Exception as e:
         logger.error(f"Failed to upload {dst_path} from {src_path}: {e}")
     else:
@@ -122,10 +96,9 @@ async def check_blob_exists( dst_path: str):
     proto, account_name, dst_blob_path = parts
     container_name, *dst_path_parts = dst_blob_path.split(os.path.sep)
     rel_dst_blob_path = os.path.sep.join(dst_path_parts)
-    async with Session() as session:
-        async with session.get_blob_container_client(account_name=account_name, container_name=container_name) as cc:
-            blob_client = cc.get_blob_client(blob=rel_dst_blob_path)
-            return await blob_client.exists()
+    async with get_container_client(account_name=account_name, container_name=container_name) as cc:
+        blob_client = cc.get_blob_client(blob=rel_dst_blob_path)
+        return await blob_client.exists()
 
 
 async def delete_blob(src_path: str):
@@ -143,12 +116,11 @@ async def delete_blob(src_path: str):
     proto, account_name, src_blob_path = parts
     container_name, *src_path_parts = src_blob_path.split(os.path.sep)
     rel_src_blob_path = os.path.sep.join(src_path_parts)
-    async with Session() as session:
-       async with session.get_blob_container_client(account_name=account_name,container_name=container_name) as cc:
-           blob_client = cc.get_blob_client(blob=rel_src_blob_path)
-           if await blob_client.exists():
-               await cc.delete_blob(blob=rel_src_blob_path, delete_snapshots="include")
-               deleted=True
+    async with get_container_client(account_name=account_name,container_name=container_name) as cc:
+        blob_client = cc.get_blob_client(blob=rel_src_blob_path)
+        if await blob_client.exists():
+            await cc.delete_blob(blob=rel_src_blob_path, delete_snapshots="include")
+            deleted=True
     return deleted
 
 
@@ -169,84 +141,40 @@ async def upload_blob(src_path: str = None, dst_path: str = None, overwrite=True
     proto, account_name, dst_blob_path = parts
     container_name, *dst_path_parts = dst_blob_path.split(os.path.sep)
     rel_dst_blob_path = os.path.sep.join(dst_path_parts)
-    async with Session() as session:
-       async with session.get_blob_container_client(account_name=account_name,container_name=container_name) as cc:
-            blob_client = cc.get_blob_client(blob=rel_dst_blob_path)
-            return await upload(src_path=src_path, dst_path=dst_path, blob_client=blob_client, overwrite=overwrite)
+    async with get_container_client(account_name=account_name,container_name=container_name) as cc:
+        blob_client = cc.get_blob_client(blob=rel_dst_blob_path)
+        return await upload(src_path=src_path, dst_path=dst_path, blob_client=blob_client, overwrite=overwrite)
 
 
 async def download_blobs(src_blobs:Iterable[str] = None, dst_folder:str = None, max_at_once=10, progress=None):
-
-
+    """
+    Download blobs from the same container into a local folder. At most max_at_once blobs are downloaded at the
+    same time and a new download starts as soon as any of the running ones finishes
+    :param src_blobs: iterable of fully qualified paths to blobs in format az:{account}:{container}/path.ext
+    :param dst_folder: str, local folder
+    :param max_at_once: int, max number of blobs downloaded at the same time
+    :param progress: rich progress instance
+    :return: list of the downloaded local files
+    """
 
     proto, account_name, src_blob_path = src_blobs[0].split(':')
     container_name, *src_blob_path_parts = src_blob_path.split(os.path.sep)
-    downloaded_files = list()
-    download_task = None
-    async with Session() as session:
-        async with session.get_blob_container_client(account_name=account_name,container_name=container_name) as cc:
-                if progress:
-                    download_task = progress.add_task(
-                        description=f'[blue]Preparing to download...', total=len(src_blobs))
-
-                for i, blobs in enumerate(chunker(src_blobs, size=max_at_once), start=1):
-                    download_tasks = dict()
-                    try:
-
-                        for src_blob in blobs:
-
-                            *_, src_blob_path = src_blob.split(':')
-                            _, *src_blob_path_parts = src_blob_path.split(os.path.sep)
-                            rel_src_blob_path = os.path.sep.join(src_blob_path_parts)
-                            src_blob_name = src_blob_path_parts[-1]
-                            blob_client = cc.get_blob_client(blob=rel_src_blob_path)
-                            dst_path = os.path.join(dst_folder, src_blob_name)
-                            task = asyncio.create_task(
-                                download(blob_client=blob_client, dst_path=dst_path, progress=progress, downloads_task=download_task),
-                                name=src_blob_name
-                            )
-                            download_tasks[src_blob_name] = task
-
-                        if not download_tasks: continue
-                        done, pending = await asyncio.wait(download_tasks.values(),
-                                                           timeout=90 * len(download_tasks),
-                                                           return_when=asyncio.ALL_COMPLETED)
-                        failed_tasks = []
-                        for done_task in done:
-                            try:
-                                downloaded_file_name = task.get_name()
-                                downloaded_file_path = await done_task
-                                assert os.path.exists(downloaded_file_path), f'{downloaded_file_path} does not exist'
-                                downloaded_files.append(downloaded_file_path)
-                            except Exception as e:
-                                logger.error(f'Failed to download  {downloaded_file_name}. {e}')
-                                failed_tasks.append((downloaded_file_name, e))
-                        # handle pending
-                        for pending_task in pending:
-                            try:
-                                filename_to_download = pending_task.get_name()
-                                pending_task.cancel()
-                                await pending_task
-                                failed_tasks.append((downloaded_file_name, asyncio.Timeout))
-                            except Exception as e:
-                                logger.error(f'Failed to download {filename_to_download}. {e}')
-                                failed_tasks.append((filename_to_download, e))
-                    except (asyncio.CancelledError, KeyboardInterrupt) as de:
-                        logger.error(f'Cancelling download tasks')
-                        for filename_to_download, t in download_tasks.items():
-                            if t.done(): continue
-                            if not t.cancelled():
-                                try:
-                                    t.cancel()
-                                    await t
-                                except asyncio.CancelledError:
-                                    logger.debug(f'Download {filename_to_download} was cancelled')
-                        if de.__class__ == KeyboardInterrupt:
-                            raise de
-                        else:
-                            break
-    if progress and download_task:
-        progress.remove_task(download_task)
+    engine = TransferEngine(window=max_at_once, progress=progress, cache=get_dataset_cache())
+    async with get_container_client(account_name=account_name,container_name=container_name) as cc:
+        transfers = list()
+        for src_blob in src_blobs:
+            *_, src_blob_path = src_blob.split(':')
+            _, *src_blob_path_parts = src_blob_path.split(os.path.sep)
+            rel_src_blob_path = os.path.sep.join(src_blob_path_parts)
+            blob_client = cc.get_blob_client(blob=rel_src_blob_path)
+            transfers.append((blob_client, os.path.join(dst_folder, src_blob_path_parts[-1])))
+        try:
+            downloaded_files, failed = await engine.download_many(transfers=transfers)
+        except asyncio.CancelledError:
+            logger.error(f'Cancelling download tasks')
+            return []
+    for (blob_client, dst_path), e in failed:
+        logger.error(f'Failed to download {blob_client.blob_name}. {e}')
     return downloaded_files
 
 # if __name__ == '__main__':
@@ -0,0 +1,446 @@
+import asyncio
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import threading
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.fileshare import ShareClient
+
+from rapida.session import Session
+from rapida.util.validate_azure_storage_path import validate_azure_storage_path
+
+logger = logging.getLogger(__name__)
+
+STORAGE_ROOT_ENV_VAR = 'RAPIDA_STORAGE_ROOT'  # local folder mirroring the Azure storage accounts
+STORAGE_ROOT_CONFIG_KEY = 'storage_root'
+READ_CHUNK_SIZE = 4 * 2 ** 20
+
+
+def storage_root():
+    """
+    The local folder that replaces Azure storage, set through the RAPIDA_STORAGE_ROOT environment variable or
+    the storage_root key in the rapida config. The blobs are read from and written to
+    {root}/blob/{account}/{container}/{path} and the file share to {root}/share/{account}/{share}/{path}
+
+    :return: str or None if Azure storage is used
+    """
+    root = os.environ.get(STORAGE_ROOT_ENV_VAR)
+    if root is None:
+        with Session() as session:
+            root = session.get_config_value_by_key(STORAGE_ROOT_CONFIG_KEY, None)
+    return os.path.abspath(os.path.expanduser(root)) if root else None
+
+
+def parse_az_path(a_path: str = None):
+    """
+    Split a path in az:{account}:{container}/path.ext format
+
+    :return: tuple (account_name, container_name, blob path relative to the container)
+    """
+    validate_azure_storage_path(a_path=a_path)
+    proto, account_name, blob_path = a_path.split(':', 2)
+    container_name, *path_parts = blob_path.split('/')
+    return account_name, container_name, '/'.join(path_parts)
+
+
+def _etag_(st: os.stat_result = None):
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _write_atomic_(path: str = None, data=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as dst:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            dst.write(data)
+        else:
+            shutil.copyfileobj(data, dst, READ_CHUNK_SIZE)
+    os.replace(tmp_path, path)
+
+
+class _LocalDownloader_:
+    """
+    Mimics the StorageStreamDownloader returned by download_blob/download_file
+    """
+
+    def __init__(self, path: str = None, offset: int = None, length: int = None):
+        self.path = path
+        self.offset = offset or 0
+        size = os.path.getsize(path)
+        self.size = max(0, min(size - self.offset, length if length is not None else size))
+
+    def _read_(self):
+        with open(self.path, 'rb') as src:
+            src.seek(self.offset)
+            remaining = self.size
+            while remaining > 0:
+                chunk = src.read(min(READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def readinto(self, stream=None):
+        n = 0
+        for chunk in self._read_():
+            stream.write(chunk)
+            n += len(chunk)
+        return n
+
+
+class _AsyncLocalDownloader_(_LocalDownloader_):
+
+    async def readall(self):
+        return await asyncio.to_thread(lambda: b''.join(self._read_()))
+
+    async def chunks(self):
+        for chunk in self._read_():
+            yield chunk
+
+
+class _SyncLocalDownloader_(_LocalDownloader_):
+
+    def readall(self):
+        return b''.join(self._read_())
+
+    def chunks(self):
+        return self._read_()
+
+
+class LocalBlobClient:
+    """
+    A blob stored as a local file, exposing the subset of azure.storage.blob.aio.BlobClient used in rapida
+    """
+
+    def __init__(self, container_folder: str = None, container_name: str = None, blob_name: str = None):
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.path = os.path.join(container_folder, *blob_name.split('/'))
+        self.url = pathlib.Path(self.path).as_uri()
+        self._staging_folder_ = os.path.join(container_folder, '.staging')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    async def exists(self, **kwargs):
+        return os.path.isfile(self.path)
+
+    async def get_blob_properties(self, **kwargs):
+        if not os.path.isfile(self.path):
+            raise ResourceNotFoundError(f'{self.blob_name} does not exist')
+        st = os.stat(self.path)
+        return SimpleNamespace(name=self.blob_name, container=self.container_name, size=st.st_size, etag=_etag_(st),
+                               last_modified=datetime.fromtimestamp(st.st_mtime, tz=timezone.utc),
+                               content_settings=SimpleNamespace(content_md5=None))
+
+    async def download_blob(self, offset: int = None, length: int = None, **kwargs):
+        if not os.path.isfile(self.path):
+            raise ResourceNotFoundError(f'{self.blob_name} does not exist')
+        return _AsyncLocalDownloader_(path=self.path, offset=offset, length=length)
+
+    async def upload_blob(self, data=None, overwrite: bool = False, **kwargs):
+        if not overwrite and os.path.exists(self.path):
+            raise ResourceExistsError(f'{self.blob_name} already exists')
+        await asyncio.to_thread(_write_atomic_, self.path, data)
+        return dict(etag=_etag_(os.stat(self.path)))
+
+    def _block_path_(self, block_id: str = None):
+        key = hashlib.sha1(f'{self.path}|{block_id}'.encode('utf-8')).hexdigest()
+        return os.path.join(self._staging_folder_, key)
+
+    async def stage_block(self, block_id: str = None, data=None, length: int = None, **kwargs):
+        await asyncio.to_thread(_write_atomic_, self._block_path_(block_id), data)
+
+    async def commit_block_list(self, block_list=None, **kwargs):
+        block_paths = [self._block_path_(getattr(b, 'id', b)) for b in block_list]
+
+        def commit():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as dst:
+                for block_path in block_paths:
+                    with open(block_path, 'rb') as src:
+                        shutil.copyfileobj(src, dst, READ_CHUNK_SIZE)
+            os.replace(tmp_path, self.path)
+            for block_path in block_paths:
+                os.remove(block_path)
+
+        await asyncio.to_thread(commit)
+        return dict(etag=_etag_(os.stat(self.path)))
+
+    async def delete_blob(self, **kwargs):
+        if not os.path.isfile(self.path):
+            raise ResourceNotFoundError(f'{self.blob_name} does not exist')
+        os.remove(self.path)
+
+
+class LocalContainerClient:
+    """
+    A container stored as a local folder, exposing the subset of azure.storage.blob.aio.ContainerClient used in
+    rapida
+    """
+
+    def __init__(self, root: str = None, account_name: str = None, container_name: str = None):
+        self.account_name = account_name
+        self.container_name = container_name
+        self.folder = os.path.join(root, 'blob', account_name, container_name)
+        self.url = pathlib.Path(self.folder).as_uri()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    async def exists(self, **kwargs):
+        return os.path.isdir(self.folder)
+
+    def get_blob_client(self, blob: str = None):
+        return LocalBlobClient(container_folder=self.folder, container_name=self.container_name, blob_name=blob)
+
+    async def list_blobs(self, name_starts_with: str = None, **kwargs):
+        for root, dirs, files in os.walk(self.folder):
+            dirs[:] = sorted(d for d in dirs if d != '.staging')
+            for name in sorted(files):
+                blob_name = os.path.relpath(os.path.join(root, name), self.folder).replace(os.path.sep, '/')
+                if name_starts_with and not blob_name.startswith(name_starts_with):
+                    continue
+                yield await self.get_blob_client(blob_name).get_blob_properties()
+
+    async def delete_blob(self, blob: str = None, **kwargs):
+        await self.get_blob_client(blob).delete_blob()
+
+
+class LocalShareFileClient:
+    """
+    A file share file stored as a local file, exposing the subset of azure.storage.fileshare.ShareFileClient used
+    in rapida
+    """
+
+    def __init__(self, share_folder: str = None, file_path: str = None):
+        self.file_path = file_path
+        self.path = os.path.join(share_folder, *file_path.split('/'))
+        self.url = pathlib.Path(self.path).as_uri()
+
+    def exists(self, **kwargs):
+        return os.path.isfile(self.path)
+
+    def upload_file(self, data=None, length: int = None, **kwargs):
+        _write_atomic_(self.path, data)
+
+    def download_file(self, offset: int = None, length: int = None, **kwargs):
+        if not os.path.isfile(self.path):
+            raise ResourceNotFoundError(f'{self.file_path} does not exist')
+        return _SyncLocalDownloader_(path=self.path, offset=offset, length=length)
+
+    def delete_file(self, **kwargs):
+        if not os.path.isfile(self.path):
+            raise ResourceNotFoundError(f'{self.file_path} does not exist')
+        os.remove(self.path)
+
+
+class LocalShareDirectoryClient:
+    """
+    A file share directory stored as a local folder, exposing the subset of
+    azure.storage.fileshare.ShareDirectoryClient used in rapida
+    """
+
+    def __init__(self, share_folder: str = None, directory_path: str = ''):
+        self.share_folder = share_folder
+        self.directory_path = directory_path.strip('/')
+        self.path = os.path.join(share_folder, *self.directory_path.split('/')) if self.directory_path \
+            else share_folder
+        self.url = pathlib.Path(self.path).as_uri()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def _join_(self, name: str = None):
+        return f'{self.directory_path}/{name}' if self.directory_path else name
+
+    def exists(self, **kwargs):
+        return os.path.isdir(self.path)
+
+    def create_directory(self, **kwargs):
+        if os.path.isdir(self.path):
+            raise ResourceExistsError(f'{self.directory_path} already exists')
+        os.makedirs(self.path)
+
+    def delete_directory(self, **kwargs):
+        os.rmdir(self.path)
+
+    def get_subdirectory_client(self, directory_name: str = None, **kwargs):
+        return LocalShareDirectoryClient(share_folder=self.share_folder, directory_path=self._join_(directory_name))
+
+    def get_file_client(self, file_name: str = None, **kwargs):
+        return LocalShareFileClient(share_folder=self.share_folder, file_path=self._join_(file_name))
+
+    def upload_file(self, file_name: str = None, data=None, **kwargs):
+        self.get_file_client(file_name).upload_file(data)
+
+    def list_directories_and_files(self, name_starts_with: str = None, **kwargs):
+        if not os.path.isdir(self.path):
+            raise ResourceNotFoundError(f'{self.directory_path} does not exist')
+        for entry in sorted(os.scandir(self.path), key=lambda e: e.name):
+            if name_starts_with and not entry.name.startswith(name_starts_with):
+                continue
+            is_directory = entry.is_dir()
+            yield SimpleNamespace(name=entry.name, is_directory=is_directory,
+                                  size=None if is_directory else entry.stat().st_size)
+
+
+class LocalShareClient:
+    """
+    A file share stored as a local folder, exposing the subset of azure.storage.fileshare.ShareClient used in
+    rapida
+    """
+
+    def __init__(self, root: str = None, account_name: str = None, share_name: str = None):
+        self.share_name = share_name
+        self.folder = os.path.join(root, 'share', account_name, share_name)
+        os.makedirs(self.folder, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def get_directory_client(self, directory_path: str = None):
+        return LocalShareDirectoryClient(share_folder=self.folder, directory_path=directory_path or '')
+
+    def list_directories_and_files(self, directory_name: str = None, name_starts_with: str = None, **kwargs):
+        return self.get_directory_client(directory_name).list_directories_and_files(
+            name_starts_with=name_starts_with)
+
+
+def get_container_client(account_name: str = None, container_name: str = None):
+    """
+    The client of a blob container, an Azure ContainerClient or, when a storage root is configured, a
+    LocalContainerClient. Both are used as async context managers
+
+        async with get_container_client(account_name='undpgeohub', container_name='stacdata') as cc:
+            blob_client = cc.get_blob_client(blob='worldpop/2020/MDA/aggregate/MDA_total.tif')
+    """
+    root = storage_root()
+    if root is not None:
+        with Session() as session:
+            account_name = account_name or session.get_account_name()
+            container_name = container_name or session.get_stac_container_name()
+        return LocalContainerClient(root=root, account_name=account_name, container_name=container_name)
+    with Session() as session:
+        return session.get_blob_container_client(account_name=account_name, container_name=container_name)
+
+
+def get_share_client(account_name: str = None, share_name: str = None):
+    """
+    The client of the file share the projects are uploaded to, an Azure ShareClient or, when a storage root is
+    configured, a LocalShareClient. Both are used as context managers
+    """
+    with Session() as session:
+        account_name = account_name or session.get_account_name()
+        share_name = share_name or session.get_file_share_name()
+        root = storage_root()
+        if root is not None:
+            return LocalShareClient(root=root, account_name=account_name, share_name=share_name)
+        return ShareClient(account_url=session.get_file_share_account_url(account_name=account_name),
+                           share_name=share_name, credential=session.get_credential(), token_intent='backup')
+
+
+def gdal_blob_path(account_name: str = None, blob_path: str = None):
+    """
+    The path GDAL reads a blob from: the https URL of the blob or, when a storage root is configured, the local
+    file
+
+    :param account_name: str, the storage account, defaults to the account set through rapida init
+    :param blob_path: str, {container}/path.ext
+    :return: str
+    """
+    with Session() as session:
+        account_name = account_name or session.get_account_name()
+        root = storage_root()
+        if root is not None:
+            return os.path.join(root, 'blob', account_name, *blob_path.split('/'))
+        return f'{session.get_blob_service_account_url(account_name=account_name)}/{blob_path}'
+
+
+class Storage:
+    """
+    Minimal object storage interface (list, exists, stat, ranged read, write, delete) over a blob container,
+    backed by Azure Blob Storage or by a local folder (see storage_root)
+
+        async with Storage(account_name='undpgeohub', container_name='stacdata') as storage:
+            size = (await storage.stat('worldpop/2020/MDA/aggregate/MDA_total.tif')).size
+            header = await storage.read('worldpop/2020/MDA/aggregate/MDA_total.tif', offset=0, length=16384)
+    """
+
+    def __init__(self, account_name: str = None, container_name: str = None, container_client=None):
+        """
+        :param account_name: str, the storage account
+        :param container_name: str, the container
+        :param container_client: optional container client, overrides account_name and container_name
+        """
+        self.container_client = container_client or get_container_client(account_name=account_name,
+                                                                          container_name=container_name)
+
+    async def __aenter__(self):
+        await self.container_client.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.container_client.__aexit__(exc_type, exc_value, traceback)
+
+    async def list(self, prefix: str = None):
+        """
+        :return: list of the names of the blobs starting with prefix
+        """
+        return [props.name async for props in self.container_client.list_blobs(name_starts_with=prefix)]
+
+    async def stat(self, path: str = None):
+        """
+        :return: the properties (name, size, etag, last_modified, content_settings) of a blob or None if it does
+        not exist
+        """
+        try:
+            return await self.container_client.get_blob_client(path).get_blob_properties()
+        except ResourceNotFoundError:
+            return
+
+    async def exists(self, path: str = None):
+        return await self.stat(path) is not None
+
+    async def read(self, path: str = None, offset: int = None, length: int = None) -> bytes:
+        """
+        Read a blob or, if offset and/or length are supplied, a range of it
+        """
+        stream = await self.container_client.get_blob_client(path).download_blob(offset=offset, length=length)
+        return await stream.readall()
+
+    async def write(self, path: str = None, data=None, overwrite: bool = True):
+        """
+        Write bytes, str or a binary file object into a blob
+        """
+        await self.container_client.get_blob_client(path).upload_blob(data=data, overwrite=overwrite)
+
+    async def delete(self, path: str = None) -> bool:
+        """
+        :return: bool, False if the blob did not exist
+        """
+        try:
+            await self.container_client.get_blob_client(path).delete_blob(delete_snapshots='include')
+        except ResourceNotFoundError:
+            return False
+        return True
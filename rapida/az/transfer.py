@@ -0,0 +1,296 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+from typing import Iterable, Tuple
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobType, ContentSettings
+
+logger = logging.getLogger(__name__)
+
+TRANSFER_BLOCK_SIZE = 8 * 2 ** 20  # bytes, the size of the ranges/blocks large blobs are transferred in
+TRANSFER_WINDOW = 10  # max number of blobs transferred at the same time
+TRANSFER_BLOCK_CONCURRENCY = 4  # max number of ranges/blocks of one blob transferred at the same time
+MD5_READ_SIZE = 2 ** 20
+
+
+def file_md5(path: str = None) -> bytes:
+    """
+    The MD5 digest of a local file, same format like the content_md5 of a blob
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as src:
+        for chunk in iter(lambda: src.read(MD5_READ_SIZE), b''):
+            md5.update(chunk)
+    return md5.digest()
+
+
+def _blob_md5_(props=None):
+    content_settings = getattr(props, 'content_settings', None)
+    md5 = getattr(content_settings, 'content_md5', None)
+    return bytes(md5) if md5 else None
+
+
+def same_content(path: str = None, props=None) -> bool:
+    """
+    Check a local file holds the same content like a blob. The size is compared first and the MD5 only if the
+    blob has one and the sizes are equal
+    """
+    if not os.path.exists(path) or os.path.getsize(path) != props.size:
+        return False
+    blob_md5 = _blob_md5_(props)
+    return blob_md5 is None or blob_md5 == file_md5(path)
+
+
+def _ranges_(size: int = None, block_size: int = None):
+    return [(offset, min(block_size, size - offset)) for offset in range(0, size, block_size)]
+
+
+def _write_at_(path: str = None, offset: int = None, data: bytes = None):
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, offset)
+    finally:
+        os.close(fd)
+
+
+class TransferEngine:
+    """
+    Concurrent transfer of blobs between Azure Blob Storage and local files.
+
+    The blobs are transferred in a sliding window: at most `window` blobs are in flight and a new one starts
+    as soon as any of them finishes, so a slow blob does not stall the others. Blobs larger than `block_size`
+    are downloaded in ranges and uploaded in staged blocks, `block_concurrency` at a time. A download is written
+    into a .part file next to the destination together with the list of the completed ranges, so an interrupted
+    download resumes where it stopped as long as the blob did not change (same ETag). Transfers are skipped when
+    the local file and the blob have the same size and MD5. When a cache is supplied the blobs already in the
+    cache (same blob and ETag) are linked from there and the downloaded ones are added to it.
+
+    The blob clients are used through the methods of azure.storage.blob.aio.BlobClient: get_blob_properties,
+    download_blob, upload_blob, stage_block and commit_block_list.
+
+        engine = TransferEngine(window=10)
+        downloaded, failed = await engine.download_many(transfers=[(blob_client, dst_path), ...])
+    """
+
+    def __init__(self, window: int = TRANSFER_WINDOW, block_size: int = TRANSFER_BLOCK_SIZE,
+                 block_concurrency: int = TRANSFER_BLOCK_CONCURRENCY, progress=None, cache=None):
+        """
+        :param window: int, max number of blobs transferred at the same time
+        :param block_size: int, the size in bytes of the ranges/blocks
+        :param block_concurrency: int, max number of ranges/blocks of one blob transferred at the same time
+        :param progress: rich progress instance
+        :param cache: optional DatasetCache instance the downloaded blobs are served from and added to
+        """
+        self.window = window
+        self.block_size = block_size
+        self.block_concurrency = block_concurrency
+        self.progress = progress
+        self.cache = cache
+
+    def _add_task_(self, description: str = None, total: int = None):
+        if self.progress is not None:
+            return self.progress.add_task(description=description, total=total)
+
+    def _advance_(self, task=None, advance: int = None):
+        if self.progress is not None and task is not None:
+            self.progress.update(task, advance=advance)
+
+    def _remove_task_(self, task=None):
+        if self.progress is not None and task is not None:
+            self.progress.remove_task(task)
+
+    async def _map_blocks_(self, func=None, items: Iterable = None):
+        semaphore = asyncio.Semaphore(self.block_concurrency)
+
+        async def bounded(item):
+            async with semaphore:
+                return await func(item)
+
+        return await asyncio.gather(*[bounded(item) for item in items])
+
+    async def download(self, blob_client=None, dst_path: str = None) -> str:
+        """
+        Download a blob into dst_path
+
+        :param blob_client: BlobClient
+        :param dst_path: str, local path
+        :return: str, dst_path
+        """
+        try:
+            props = await blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            raise ValueError(f"Blob {blob_client.blob_name} does not exist")
+        if same_content(path=dst_path, props=props):
+            logger.debug(f'{dst_path} is up to date with {blob_client.blob_name}')
+            return dst_path
+        source = getattr(blob_client, 'url', None) or blob_client.blob_name
+        if self.cache is not None and self.cache.get(source=source, etag=props.etag, dst_path=dst_path):
+            logger.debug(f'{blob_client.blob_name} was served from the cache')
+            return dst_path
+        name = os.path.split(blob_client.blob_name)[-1]
+        part_path = f'{dst_path}.part'
+        state_path = f'{part_path}.json'
+        ranges = _ranges_(size=props.size, block_size=self.block_size)
+        done = set()
+        if os.path.exists(part_path) and os.path.exists(state_path):
+            with open(state_path) as src:
+                state = json.load(src)
+            if (state.get('etag'), state.get('size'), state.get('block_size')) == \
+                    (props.etag, props.size, self.block_size) and os.path.getsize(part_path) == props.size:
+                done = set(state['done'])
+                logger.debug(f'Resuming download of {blob_client.blob_name} from {len(done)}/{len(ranges)} ranges')
+        if not done:
+            with open(part_path, 'wb') as dst:
+                dst.truncate(props.size)
+
+        def save_state():
+            tmp_path = f'{state_path}.tmp'
+            with open(tmp_path, 'w') as dst:
+                json.dump(dict(etag=props.etag, size=props.size, block_size=self.block_size, done=sorted(done)), dst)
+            os.replace(tmp_path, state_path)
+
+        task = self._add_task_(description=f'Downloading {name}', total=props.size)
+        self._advance_(task=task, advance=sum(ranges[i][1] for i in done))
+
+        async def download_range(i):
+            offset, length = ranges[i]
+            stream = await blob_client.download_blob(offset=offset, length=length)
+            data = await stream.readall()
+            assert len(data) == length, f'Received {len(data)} bytes instead of {length} from {blob_client.blob_name}'
+            await asyncio.to_thread(_write_at_, part_path, offset, data)
+            done.add(i)
+            save_state()
+            self._advance_(task=task, advance=length)
+
+        try:
+            await self._map_blocks_(func=download_range, items=[i for i in range(len(ranges)) if i not in done])
+            blob_md5 = _blob_md5_(props)
+            if blob_md5 is not None and blob_md5 != await asyncio.to_thread(file_md5, part_path):
+                os.remove(part_path)
+                os.remove(state_path)
+                raise ValueError(f'The MD5 of the downloaded {blob_client.blob_name} does not match')
+            os.replace(part_path, dst_path)
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            if self.cache is not None:
+                self.cache.put(source=source, etag=props.etag, path=dst_path)
+        finally:
+            self._remove_task_(task=task)
+        logger.debug(f"Downloaded blob {blob_client.blob_name} to {dst_path}")
+        return dst_path
+
+    async def upload(self, src_path: str = None, blob_client=None, overwrite: bool = True, **kwargs) -> str:
+        """
+        Upload a local file into a blob. Block blobs larger than block_size are uploaded as staged blocks, the
+        other blob types are uploaded with upload_blob
+
+        :param src_path: str, local path
+        :param blob_client: BlobClient
+        :param overwrite: bool, if the blob will be overwritten. ResourceExistsError is raised if the blob exists,
+        is not up to date and overwrite is False
+        :param kwargs: passed to upload_blob or, for the staged blocks, to commit_block_list (ex: blob_type, metadata)
+        :return: str, the name of the blob
+        """
+        if not os.path.exists(src_path):
+            raise ValueError(f"File {src_path} does not exist")
+        md5 = await asyncio.to_thread(file_md5, src_path)
+        size = os.path.getsize(src_path)
+        try:
+            props = await blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            pass
+        else:
+            if props.size == size and _blob_md5_(props) == md5:
+                logger.debug(f'{blob_client.blob_name} is up to date with {src_path}')
+                return blob_client.blob_name
+            if not overwrite:
+                raise ResourceExistsError(f'Blob {blob_client.blob_name} already exists')
+        content_settings = ContentSettings(content_md5=bytearray(md5))
+        name = os.path.split(src_path)[-1]
+        blob_type = kwargs.pop('blob_type', BlobType.BLOCKBLOB)
+        if size <= self.block_size or blob_type != BlobType.BLOCKBLOB:
+            # only block blobs can be staged, the SDK uploads the append and page blobs in its own chunks
+            kwargs['blob_type'] = blob_type
+            with open(src_path, 'rb') as data:
+                await blob_client.upload_blob(data=data, overwrite=overwrite, content_settings=content_settings,
+                                              **kwargs)
+            return blob_client.blob_name
+
+        ranges = _ranges_(size=size, block_size=self.block_size)
+        block_ids = [base64.b64encode(f'{i:08d}'.encode()).decode() for i in range(len(ranges))]
+        task = self._add_task_(description=f'Uploading {name}', total=size)
+
+        def read_range(offset, length):
+            with open(src_path, 'rb') as src:
+                src.seek(offset)
+                return src.read(length)
+
+        async def stage(i):
+            offset, length = ranges[i]
+            data = await asyncio.to_thread(read_range, offset, length)
+            await blob_client.stage_block(block_id=block_ids[i], data=data, length=length)
+            self._advance_(task=task, advance=length)
+
+        try:
+            await self._map_blocks_(func=stage, items=range(len(ranges)))
+            await blob_client.commit_block_list(block_ids, content_settings=content_settings, **kwargs)
+        finally:
+            self._remove_task_(task=task)
+        logger.debug(f"{src_path} was uploaded to {blob_client.blob_name} in {len(ranges)} blocks")
+        return blob_client.blob_name
+
+    async def _many_(self, func=None, transfers: Iterable[Tuple] = None, description: str = None):
+        transfers = list(transfers)
+        semaphore = asyncio.Semaphore(self.window)
+        total_task = self._add_task_(description=description, total=len(transfers))
+
+        async def slot(args):
+            async with semaphore:
+                try:
+                    return await func(*args)
+                finally:
+                    self._advance_(task=total_task, advance=1)
+
+        tasks = [asyncio.create_task(slot(args)) for args in transfers]
+        try:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            logger.info('Cancelling transfers')
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            self._remove_task_(task=total_task)
+        done, failed = list(), list()
+        for args, result in zip(transfers, results):
+            if isinstance(result, BaseException):
+                failed.append((args, result))
+            else:
+                done.append(result)
+        return done, failed
+
+    async def download_many(self, transfers: Iterable[Tuple] = None):
+        """
+        Download blobs in a sliding window
+
+        :param transfers: iterable of (blob_client, dst_path) tuples
+        :return: tuple (list of downloaded paths, list of ((blob_client, dst_path), exception) that failed)
+        """
+        return await self._many_(func=lambda bc, path: self.download(blob_client=bc, dst_path=path),
+                                 transfers=transfers, description='[blue]Downloading blobs')
+
+    async def upload_many(self, transfers: Iterable[Tuple] = None, overwrite: bool = True):
+        """
+        Upload local files in a sliding window
+
+        :param transfers: iterable of (src_path, blob_client) tuples
+        :param overwrite: bool, if the blobs will be overwritten
+        :return: tuple (list of uploaded blob names, list of ((src_path, blob_client), exception) that failed)
+        """
+        return await self._many_(func=lambda path, bc: self.upload(src_path=path, blob_client=bc, overwrite=overwrite),
+                                 transfers=transfers, description='[blue]Uploading blobs')
@@ -9,6 +9,7 @@ from rapida.cli.list import list
 from rapida.cli.upload import upload
 from rapida.cli.download import download
 from rapida.cli.publish import publish
+from rapida.cli.cache import cache
 import click
 import nest_asyncio
 nest_asyncio.apply()
@@ -41,6 +42,7 @@ cli.add_command(download)
 cli.add_command(upload)
 cli.add_command(publish)
 cli.add_command(delete)
+cli.add_command(cache)
 
 
 if __name__ == '__main__':
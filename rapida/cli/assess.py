@@ -175,13 +175,19 @@ def build_variable_help():
               help="Optional. A project folder with rapida.json can be specified. If not, current directory is considered as a project folder.")
 @click.option('--force', '-f', default=False, show_default=True,is_flag=True,
               help=f'Force assess components. Downloaded data or computed data will be ignored and recomputed.')
+@click.option('--workers', '-w', required=False, type=click.IntRange(min=1), default=1, show_default=True,
+              help=f'Number of processes used to compute zonal statistics. If larger than 1, the polygons are split '
+                   f'into spatially compact shards that are processed in parallel.')
+@click.option('--export-affected', is_flag=True, default=False, show_default=True,
+              help=f'Write the affected version (masked by the project mask) of the raster variables to disk. '
+                   f'The affected statistics are computed from the mask and do not need it.')
 @click.option('--debug',
               is_flag=True,
               default=False,
               help="Set log level to debug"
               )
 @click.pass_context
-def assess(ctx, all=False, components=None,  variables=None, year=None, datetime_range=None, cloud_cover=None, project: str = None, force=False, debug=False):
+def assess(ctx, all=False, components=None,  variables=None, year=None, datetime_range=None, cloud_cover=None, project: str = None, force=False, workers=1, export_affected=False, debug=False):
     """
     Assess/evaluate a specific geospatial exposure components/variables
 
@@ -193,6 +199,10 @@ def assess(ctx, all=False, components=None,  variables=None, year=None, datetime
 
     `-p/--project` to assess in a specific project folder other than current directory.
 
+    `-w/--workers` to compute zonal statistics in parallel using several processes.
+
+    `--export-affected` to write the affected version of the raster variables next to them.
+
     As default, this command tries to avoid download/compute again if they already exist. If you wish to redownload or recompute by force, use `-f/--force` flag explicitly.
 
     Usage:
@@ -266,7 +276,9 @@ def assess(ctx, all=False, components=None,  variables=None, year=None, datetime
                           target_year=year,
                           datetime_range=datetime_range,
                           cloud_cover=cloud_cover,
-                          force=force)
+                          force=force,
+                          workers=workers,
+                          export_affected=export_affected)
 
 
 
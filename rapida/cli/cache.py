@@ -0,0 +1,94 @@
+import datetime
+import logging
+import os
+
+import click
+
+from rapida.util.dataset_cache import DatasetCache, DATASET_CACHE_FOLDER, get_dataset_cache
+from rapida.util.http_cache import RangeCache, HTTP_CACHE_FOLDER
+from rapida.util.setup_logger import setup_logger
+
+logger = logging.getLogger(__name__)
+
+
+def _gb_(nbytes=None):
+    return f'{nbytes / 2 ** 30:.2f} GB'
+
+
+def _caches_():
+    dataset_cache = get_dataset_cache() or DatasetCache(folder=DATASET_CACHE_FOLDER)
+    range_cache = RangeCache(folder=HTTP_CACHE_FOLDER) if os.path.exists(HTTP_CACHE_FOLDER) else None
+    return dataset_cache, range_cache
+
+
+@click.group(short_help=f'inspect and prune the local cache of downloaded source datasets')
+def cache():
+    pass
+
+
+@cache.command(short_help='show the content of the local cache')
+@click.option('-l', '--list', 'list_entries', is_flag=True, default=False,
+              help='List the cached datasets, most recently used first')
+@click.option('--debug', is_flag=True, default=False, help="Set log level to debug")
+def info(list_entries=False, debug=False):
+    """
+    Show the size and content of the machine wide cache of source datasets (~/.rapida/cache)
+    and of the HTTP byte range cache (~/.rapida/http_cache).
+
+    Usage:
+
+        rapida cache info
+
+        rapida cache info --list
+    """
+    setup_logger(name='rapida', level=logging.DEBUG if debug else logging.INFO)
+    dataset_cache, range_cache = _caches_()
+    entries = dataset_cache.entries()
+    click.echo(f'Datasets: {len(entries)} in {dataset_cache.folder}, '
+               f'{_gb_(dataset_cache.size())} of {_gb_(dataset_cache.max_bytes)}')
+    if list_entries:
+        for entry in entries:
+            accessed = datetime.datetime.fromtimestamp(entry['accessed']).strftime('%Y-%m-%d %H:%M')
+            crop = ' (cropped)' if entry['crop'] else ''
+            click.echo(f'  {_gb_(entry["size"]):>10}  {accessed}  {entry["hits"]:>4} hits  {entry["source"]}{crop}')
+    if range_cache is not None:
+        stats = range_cache.stats()
+        click.echo(f'HTTP ranges: {stats["ranges"]} in {range_cache.folder}, {_gb_(stats["size"])}, '
+                   f'{stats["hits"]} hits, {stats["misses"]} misses')
+
+
+@cache.command(short_help='remove datasets from the local cache')
+@click.option('-s', '--max-size', type=float, default=None,
+              help='Remove the least recently used datasets until the cache is smaller than this size in GB')
+@click.option('-d', '--older-than', type=float, default=None,
+              help='Remove the datasets that were not used in this many days')
+@click.option('--all', 'remove_all', is_flag=True, default=False, help='Empty the cache')
+@click.option('--debug', is_flag=True, default=False, help="Set log level to debug")
+def prune(max_size=None, older_than=None, remove_all=False, debug=False):
+    """
+    Remove datasets from the local cache. Without options the cache is trimmed to its configured
+    max size (RAPIDA_CACHE_GB environment variable). The datasets already linked into projects stay in the projects.
+
+    Usage:
+
+        rapida cache prune --older-than 30
+
+        rapida cache prune --max-size 10
+
+        rapida cache prune --all
+    """
+    setup_logger(name='rapida', level=logging.DEBUG if debug else logging.INFO)
+    dataset_cache, range_cache = _caches_()
+    before = dataset_cache.size()
+    if remove_all:
+        dataset_cache.clear()
+        if range_cache is not None:
+            range_cache.clear()
+        click.echo(f'Removed {_gb_(before)} from the cache')
+        return
+    removed = dataset_cache.prune(older_than=older_than * 86400 if older_than is not None else None,
+                                  max_bytes=int(max_size * 2 ** 30) if max_size is not None else None)
+    if range_cache is not None and max_size is not None:
+        range_cache.max_bytes = int(max_size * 2 ** 30)
+        range_cache.evict()
+    click.echo(f'Removed {removed} datasets, {_gb_(before - dataset_cache.size())} from the cache')
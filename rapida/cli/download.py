@@ -6,6 +6,7 @@ from rich.progress import Progress
 
 from rapida.session import is_rapida_initialized
 from rapida.util.setup_logger import setup_logger
+from rapida.project.manifest import SYNC_PARALLEL
 from rapida.project.project import Project
 
 logger = logging.getLogger(__name__)
@@ -20,6 +21,11 @@ logger = logging.getLogger(__name__)
               show_default=True,
               type=int,
               help=f'The number of threads to use when downloading a file')
+@click.option('--parallel', '-j',
+              default=SYNC_PARALLEL,
+              show_default=True,
+              type=int,
+              help=f'The number of files to download at the same time')
 @click.option('--force','-f',
               is_flag=True,
               default=False,
@@ -28,7 +34,7 @@ logger = logging.getLogger(__name__)
               is_flag=True,
               default=False,
               help="Set log level to debug")
-def download(project_name=None, destination_folder=None, max_concurrency=None,force=None, debug: bool =False ):
+def download(project_name=None, destination_folder=None, max_concurrency=None, parallel=SYNC_PARALLEL, force=None, debug: bool =False ):
     """
     Download a project from Azure File Share.
 
@@ -48,7 +54,8 @@ def download(project_name=None, destination_folder=None, max_concurrency=None,fo
 
 
 
-    To use `-f/--force`, project data will be overwritten if it already exists in local storage.
+    To use `-f/--force`, project data will be overwritten if it already exists in local storage. Only the files
+    changed since the last download are transferred, `-j/--parallel` files at a time.
 
     """
     setup_logger(name='rapida', level=logging.DEBUG if debug else logging.INFO)
@@ -87,5 +94,6 @@ def download(project_name=None, destination_folder=None, max_concurrency=None,fo
                          dst_folder=project_path,
                          progress=progress,
                          overwrite=force,
-                         max_concurrency=max_concurrency)
+                         max_concurrency=max_concurrency,
+                         parallel=parallel)
     logger.info(f'Project "{project_name}" was downloaded successfully to {project_path}')
\ No newline at end of file
@@ -4,6 +4,7 @@ import logging
 from rich.progress import Progress
 from rapida.session import is_rapida_initialized
 from rapida.util.setup_logger import setup_logger
+from rapida.project.manifest import SYNC_PARALLEL
 from rapida.project.project import Project
 
 
@@ -20,6 +21,11 @@ logger = logging.getLogger(__name__)
               show_default=True,
               type=int,
               help=f'The number of threads to use when uploading a file')
+@click.option('--parallel', '-j',
+              default=SYNC_PARALLEL,
+              show_default=True,
+              type=int,
+              help=f'The number of files to upload at the same time')
 @click.option('--force','-f',
               is_flag=True,
               default=False,
@@ -32,7 +38,7 @@ logger = logging.getLogger(__name__)
               is_flag=True,
               default=False,
               help="Set log level to debug")
-def upload(project=None, max_concurrency=4, force=False, no_input: bool = False, debug: bool =False):
+def upload(project=None, max_concurrency=4, parallel=SYNC_PARALLEL, force=False, no_input: bool = False, debug: bool =False):
     """
     Upload an entire project folder to Azure File Share
 
@@ -42,6 +48,8 @@ def upload(project=None, max_concurrency=4, force=False, no_input: bool = False,
 
         rapida upload --project=<project folder path>: If you are not in a project folder
 
+    Only the files changed since the last upload are transferred, `-j/--parallel` files at a time.
+
     To use `-f/--force`, project data will be overwritten if it already exists in Azure File Share.
 
     Use `--no-input` to disable prompting. Default is False.
@@ -72,5 +80,5 @@ def upload(project=None, max_concurrency=4, force=False, no_input: bool = False,
 
     click.echo(f'Going to upload {project} to Azure')
     with Progress() as progress:
-        prj.upload(progress=progress, overwrite=force, max_concurrency=max_concurrency)
+        prj.upload(progress=progress, overwrite=force, max_concurrency=max_concurrency, parallel=parallel)
     click.echo(f'Rapida project "{project}" was uploaded successfully to Azure')
\ No newline at end of file
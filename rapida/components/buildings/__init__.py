@@ -3,12 +3,17 @@ from rapida.core.variable import Variable
 from rapida.util.download_geodata import download_vector
 from rapida.project.project import  Project
 from rapida.session import Session
+from rapida.stats.store import StatsStore
 import os
 import logging
+import pandas as pd
 import pyogrio
 from osgeo import gdal, osr
 import shapely
 from rapida.components.buildings.preprocessing import mask_buildings
+from rapida.components.buildings.sidecar import build_sidecar, sidecar_aggregates, sidecar_is_valid, sidecar_path
+from rapida.constants import POLYGONS_ID_COLUMN, POLYGONS_LAYER_NAME
+from rapida.stats.vector_zonal_stats import polygon_aggregates
 from rapida.util.proj_are_equal import proj_are_equal
 import geopandas as gpd
 
@@ -29,7 +34,8 @@ class BuildingsComponent(Component):
 
         project = Project(path=os.getcwd())
         logger.info(f'Assessing component "{self.component_name}" in  {", ".join(project.countries)}')
-        with Session() as ses:
+        stats_store = StatsStore(dataset_path=project.geopackage_file_path, layer_name=f'stats.{self.component_name}')
+        with Session() as ses, stats_store:
             variables_data = ses.get_component(self.component_name)
 
             for var_name in variables:
@@ -43,7 +49,7 @@ class BuildingsComponent(Component):
 
 
                 # assess
-                v(**kwargs)
+                v(stats_store=stats_store, **kwargs)
 
 class BuildingsVariable(Variable):
 
@@ -156,6 +162,7 @@ class BuildingsVariable(Variable):
                 lyr.SetAttributeFilter(None)
                 lyr.ResetReading()
         self.local_path = f'{project.geopackage_file_path}::{self.component}'
+        build_sidecar(dataset_path=project.geopackage_file_path, layer_name=self.component)
         self._compute_affected_(progress=progress )
         return self.local_path
 
@@ -172,8 +179,6 @@ class BuildingsVariable(Variable):
                 mask_ds_path=project.raster_mask,
                 masked_buildings_dataset=project.geopackage_file_path,
                 masked_buildings_layer_name=affected_layer_name,
-                horizontal_chunks=10,
-                vertical_chunks=10,
                 workers=4,
                 progress=progress,
 
@@ -186,6 +191,36 @@ class BuildingsVariable(Variable):
         return self.download(force=force, **kwargs)
 
 
+    def _aggregate_layers_(self, dataset_path=None, layer_name=None):
+        """
+        Aggregate the buildings and the affected buildings layers per polygon by streaming their geometries.
+        Used for the buildings layers without a polygon id, the others are aggregated from their sidecar
+        """
+        project = Project(os.getcwd())
+        affected_var_name = f'{self.name}_affected'
+        polygons_gdf = gpd.read_file(dataset_path, layer=POLYGONS_LAYER_NAME, columns=[POLYGONS_ID_COLUMN])
+        keys = polygons_gdf[POLYGONS_ID_COLUMN].to_numpy()
+        polygons = polygons_gdf.geometry.to_numpy()
+        layer_names = pyogrio.list_layers(dataset_path)[:, 0]
+
+        def aggregate(layer=None):
+            id_column = 'polyid' if 'polyid' in pyogrio.read_info(dataset_path, layer=layer)['fields'] else None
+            counts, areas = polygon_aggregates(dataset_path=dataset_path, layer_name=layer, keys=keys,
+                                               polygons=polygons, id_column=id_column,
+                                               area=self.name != 'nbuildings')
+            return counts, counts if self.name == 'nbuildings' else areas
+
+        counts, values = aggregate(layer=layer_name)
+        var_gdf = pd.DataFrame({'polyid': keys, self.name: values})
+        has_buildings = counts > 0
+        if project.raster_mask is not None:
+            affected_layer_name = f'{self.component}.affected'
+            if affected_layer_name in layer_names:
+                affected_counts, var_gdf[affected_var_name] = aggregate(layer=affected_layer_name)
+                has_buildings &= affected_counts > 0
+                var_gdf[f'{affected_var_name}_percentage'] = (var_gdf[affected_var_name] / var_gdf[self.name]) * 100
+        return var_gdf[has_buildings]
+
     def evaluate(self, **kwargs):
         destination_layer = f'stats.{self.component}'
         affected_var_name = f'{self.name}_affected'
@@ -196,54 +231,35 @@ class BuildingsVariable(Variable):
 
         dataset_path, layer_name = self.local_path.split('::')
 
-        # Read only necessary columns (avoid loading full geometries if not needed)
-        buildings_gdf = gpd.read_file(dataset_path, layer=layer_name, columns=['polyid', 'geometry'])
-
-        # List layers once to avoid repeated I/O operations
-        layers = pyogrio.list_layers(dataset_path)
-        layer_names = layers[:, 0]
-
-        polygons_layer = destination_layer if destination_layer in layer_names else project.polygons_layer_name
-
-        # Read only necessary columns for polygons
-        polygons_gdf = gpd.read_file(project.geopackage_file_path, layer=polygons_layer, columns=['h3id', 'geometry'])
-        polygons_gdf = polygons_gdf.rename(columns={'h3id': 'polyid'})
-
-        # **Efficient Building Count Calculation**
-        if self.name == 'nbuildings':
-            var_gdf = buildings_gdf['polyid'].value_counts().reset_index()
-            var_gdf.columns = ['polyid', self.name]
-        else:
-            buildings_gdf[self.name] = buildings_gdf.geometry.area
-            var_gdf = buildings_gdf.groupby('polyid', as_index=False)[self.name].sum()
-
-        # **Handle Affected Buildings**
-        if project.raster_mask is not None:
-            affected_layer_name = f'{self.component}.affected'
-            if affected_layer_name in layer_names:
-                affected_buildings_gdf = gpd.read_file(dataset_path, layer=affected_layer_name,
-                                                       columns=['polyid', 'geometry'])
-
-                if self.name == 'nbuildings':
-                    affected_var_gdf = affected_buildings_gdf['polyid'].value_counts().reset_index()
-                    affected_var_gdf.columns = ['polyid', affected_var_name]
-                else:
-                    affected_buildings_gdf[affected_var_name] = affected_buildings_gdf.geometry.area
-                    affected_var_gdf = affected_buildings_gdf.groupby('polyid', as_index=False)[affected_var_name].sum()
-
-                # Merge affected data
-                var_gdf = var_gdf.merge(affected_var_gdf, on='polyid', how='inner')
+        # the buildings are aggregated per polygon so the memory does not grow with their number
+        keys = pyogrio.read_dataframe(dataset_path, layer=POLYGONS_LAYER_NAME, columns=[POLYGONS_ID_COLUMN],
+                                      read_geometry=False)[POLYGONS_ID_COLUMN].to_numpy()
+
+        has_polyid = 'polyid' in pyogrio.read_info(dataset_path, layer=layer_name)['fields']
+        if has_polyid and not sidecar_is_valid(dataset_path=dataset_path, layer_name=layer_name):
+            build_sidecar(dataset_path=dataset_path, layer_name=layer_name)
+
+        if has_polyid:
+            # the counts, areas and affected buildings come from the sidecar without reading any geometry
+            aggregates = sidecar_aggregates(path=sidecar_path(dataset_path=dataset_path, layer_name=layer_name),
+                                            keys=keys, mask_path=project.raster_mask)
+            column = 'count' if self.name == 'nbuildings' else 'area'
+            var_gdf = pd.DataFrame({'polyid': keys, self.name: aggregates[column].to_numpy()})
+            has_buildings = aggregates['count'].to_numpy() > 0
+            if project.raster_mask is not None:
+                var_gdf[affected_var_name] = aggregates[f'affected_{column}'].to_numpy()
+                has_buildings &= aggregates['affected_count'].to_numpy() > 0
                 var_gdf[affected_var_percentage_name] = (var_gdf[affected_var_name] / var_gdf[self.name]) * 100
-
-        # **Remove old columns before merging**
-        polygons_gdf.drop(columns=[col for col in [self.name, affected_var_name, affected_var_percentage_name] if
-                                   col in polygons_gdf.columns], inplace=True)
-
-        # **Final Merge and Save**
-        out_gdf = polygons_gdf.merge(var_gdf, on='polyid', how='left')
-        out_gdf = out_gdf.rename(columns={'polyid': 'h3id'})
-
-        out_gdf.to_file(dataset_path, layer=destination_layer, driver='GPKG', mode='w')
+            var_gdf = var_gdf[has_buildings]
+        else:
+            var_gdf = self._aggregate_layers_(dataset_path=dataset_path, layer_name=layer_name)
+
+        # **Add/replace the columns in the stats layer**
+        var_gdf = var_gdf.rename(columns={'polyid': 'h3id'})
+        store = kwargs.get('stats_store', None) or StatsStore(dataset_path=dataset_path,
+                                                              layer_name=destination_layer)
+        with store:
+            store.update(var_gdf)
 
     def resolve(self, **kwargs):
         pass
\ No newline at end of file
@@ -1,28 +1,24 @@
 
-import random
 import threading
-from collections import deque
 from rapida.components.buildings.fgbgdal import OVERPASS_API_URL, GMOSM_BUILDINGS_ROOT
 from pyogrio.raw import open_arrow
-from rapida.components.buildings.pmt import WEB_MERCATOR_TMS
 from rapida.constants import ARROWTYPE2OGRTYPE
-import morecantile as m
 import logging
 import time
-from pyogrio.core import read_info
 from osgeo import ogr, osr, gdal
 from shapely.geometry import box
 from shapely import bounds
 import shapely
 from pyproj import Geod
 import math
-import concurrent
 from pyarrow import compute as pc
 from rich.progress import Progress, TaskProgressColumn,BarColumn, TimeRemainingColumn, TextColumn
 import httpx
 from osm2geojson import json2geojson
 
-from rapida.util.generator_length import generator_length
+from rapida.components.buildings.tile_planner import plan_work_units, read_fgb_index_cells
+from rapida.util.http_cache import vsicurl
+from rapida.util.pipeline import Pipeline
 from rapida.util.http_post_json import http_post_json
 
 ogr.UseExceptions()
@@ -44,25 +40,10 @@ progress_cols = [
             TimeRemainingColumn()
             ]
 
-ZOOMLEVEL_TILE_AREA =  {
-                        2: 60224669.5145855,
-                        3: 21481830.870408278,
-                        4: 4503416.3860813165,
-                        5: 1008900.4679667788,
-                        6: 237646.3339020322,
-                        7: 57605.0263498855,
-                        8: 14626.724809430663,
-                        9: 3628.474442154846,
-                        10: 903.5978962598876,
-                        11: 225.4597166695404,
-                        12: 56.309980584472655,
-                        13: 14.084363345584869,
-                        14: 3.5202322880802153,
-                        15: 0.8799507586660384
-
-                    }
 logger = logging.getLogger(__name__)
 
+# the number of batches of buildings in a planned download work unit
+PLANNER_TARGET_BATCHES = 16
 
 
 def country_info(bbox=None, overpass_url=OVERPASS_API_URL):
@@ -168,48 +149,30 @@ def read_bbox(src_path=None, bbox=None, mask=None, batch_size=None, signal_event
 
 
 
-def downloader(work=None, result=None, finished=None):
-
-
-    logger.debug(f'starting building downloader thread {threading.current_thread().name}')
-    while True:
-
-        job = None
-        try:
-            job = work.pop()
-        except IndexError as ie:
-            pass
-        if job is None:
-            if finished.is_set():
-                logger.debug(f'worker is finishing  in {threading.current_thread().name}')
-                break
-            continue
-
-        if finished.is_set():
-            break
-        logger.debug(f'Starting job  {job["name"]}')
-        result.append(read_bbox(**job))
-
-
-def download_bbox(bbox=None, out_path=None, batch_size=5000, NWORKERS=4):
+def download_bbox(bbox=None, out_path=None, batch_size=5000, NWORKERS=4, countries=None,
+                  target_batches=PLANNER_TARGET_BATCHES):
     """
-    Download building from Google+Microsoft+OSM VIDA dataset based on bounds provided by
-    equally sized blocks of space generated automatically in 3857 projection.
+    Download building from Google+Microsoft+OSM VIDA dataset based on work units planned from the
+    density of the buildings in the spatial index of every country dataset.
 
 
     :param out_path: str, abs path to buildings dataset
     :param bbox: iterable of floats, xmin, ymin, xmax,ymax
     :param batch_size: int, defaults to 5000, the number of buildings to download in one batch
     :param NWORKERS, int, defaults to 4. The number of threads to use for parallel download.
+    :param countries: iterable of ISO3 country codes intersecting the bbox. If not supplied they are
+    retrieved from OSM
+    :param target_batches: int, the number of batches of buildings in a work unit
     :return:
 
     The implementation features several optimisations as to reduce the download:
-        the number of countries that intersect the bbox are retrieved first from OSM
-        a 3857 zoom level is computed from where tiles will ge generated in such a way that
-        the average number of buildings in a tile would be roughly downloaded in one batch
-        max NWORKERS tiles are downloaded in parallel
+        the upper levels of the packed R-tree of every country dataset are read to estimate the
+        density of the buildings inside the bbox
+        the bbox is split into work units holding about target_batches * batch_size buildings each,
+        small in cities and large in the countryside, see tile_planner.plan_work_units
+        max NWORKERS units are downloaded in parallel, largest first so no large unit is left for the end
 
-    the batch size can be used to control the size of a tile and the number of tiles used to download the
+    the batch size can be used to control the size of a unit and the number of units used to download the
     buildings
 
     """
@@ -218,7 +181,10 @@ def download_bbox(bbox=None, out_path=None, batch_size=5000, NWORKERS=4):
     bb_poly = box(*bbox)
 
     ndownloaded = 0
-    countries = country_info(bbox=bbox)
+    if countries is None:
+        countries = country_info(bbox=bbox)
+    else:
+        countries = {country_iso3: (None, None) for country_iso3 in countries}
     assert len(
         countries) > 0, f'The bounding box {bbox} does not intersect any country. Please make sure it makes sense!'
     cancelled = False
@@ -226,120 +192,91 @@ def download_bbox(bbox=None, out_path=None, batch_size=5000, NWORKERS=4):
     with ogr.GetDriverByName('FlatGeobuf').CreateDataSource(out_path) as dst_ds:
         for country_iso3, country_data in countries.items():
             country_area_km2, country_geom = country_data
-            remote_country_fgb_url = f'/vsicurl/{GMOSM_BUILDINGS_ROOT}/country_iso={country_iso3}/{country_iso3}.fgb'
-            info = read_info(remote_country_fgb_url)
-            nfeatures_in_country = info['features']
+            remote_country_fgb_url = vsicurl(f'{GMOSM_BUILDINGS_ROOT}/country_iso={country_iso3}/{country_iso3}.fgb')
 
-            if not bb_poly.intersects(country_geom): #being paranoic
+            if country_geom is not None and not bb_poly.intersects(country_geom): #being paranoic
                 logger.debug(f'{bbox} does not intersect {country_iso3}')
                 continue
-            country_bbox_buildings_density_km2 = nfeatures_in_country//country_area_km2
-            sel_zom_level = None
-            inters_pol =  bb_poly.intersection(country_geom)
+            inters_pol = bb_poly.intersection(country_geom) if country_geom is not None else bb_poly
             intersection_bbox = bounds(inters_pol)
-            intersection_bb = m.BoundingBox(*intersection_bbox)
-            intersection_area, _ = geod.geometry_area_perimeter(geometry=inters_pol)
-
-            batch_km2 = batch_size//country_bbox_buildings_density_km2
-            for zoom_level, tile_area in ZOOMLEVEL_TILE_AREA.items():
-                if tile_area<batch_km2:
-                    sel_zom_level = zoom_level - 2 if zoom_level>2 else zoom_level
-                    break
-
-            all_tiles = WEB_MERCATOR_TMS.tiles( west=intersection_bb.left, south=intersection_bb.bottom,
-                                                east=intersection_bb.right, north=intersection_bb.top,
-                                                zooms=[sel_zom_level]
-                                               )
-
-            ntiles, all_tiles = generator_length(all_tiles)
+            cells = read_fgb_index_cells(src_path=remote_country_fgb_url)
+            if cells is None:
+                units = [(tuple(intersection_bbox), None)]
+            else:
+                cell_bounds, cell_counts = cells
+                units = plan_work_units(cell_bounds=cell_bounds, cell_counts=cell_counts, bbox=intersection_bbox,
+                                        target_features=batch_size * target_batches)
+
+            ntiles = len(units)
             stop = threading.Event()
-            jobs = deque()
-            results = deque()
-
-            logger.info(f'Downloading buildings from {country_iso3} in {ntiles} tiles/chunks generated in bbox {intersection_bbox} at zoom level {sel_zom_level} ')
-            nworkers = ntiles if NWORKERS > ntiles else NWORKERS
-            with concurrent.futures.ThreadPoolExecutor(max_workers=nworkers) as executor:
-                [executor.submit(downloader, jobs, results, stop) for i in range(nworkers)]
-                with Progress(*progress_cols) as progress:
-                    total_task = progress.add_task(
-                        description=f'[red]Going to download buildings from {ntiles} tiles',
-                        total=ntiles)
-
-                    for tile in all_tiles:
-                        tile_name = f'{tile.z}/{tile.x}/{tile.y}'
-                        tile_bounds = WEB_MERCATOR_TMS.bounds(tile)
-                        tile_bbox = tile_bounds.left,tile_bounds.bottom, tile_bounds.right, tile_bounds.top
-                        tile_bb = box(*tile_bbox)
-                        tile_intersection = tile_bb.intersection(inters_pol)
-                        #tile_intersection_bbox = bounds(tile_intersection)
-
-                        job = dict(
-                            src_path=remote_country_fgb_url,
-                            mask=tile_intersection,
-                            batch_size=batch_size,
-                            signal_event=stop,
-                            name=tile_name,
-                            progress=progress
-
-                        )
-                        jobs.append(job)
-
-                    while True:
+            jobs = list()
+
+            logger.info(f'Downloading buildings from {country_iso3} in {ntiles} units/chunks planned in bbox {intersection_bbox}')
+            with Progress(*progress_cols) as progress:
+                total_task = progress.add_task(
+                    description=f'[red]Going to download buildings from {ntiles} units',
+                    total=ntiles)
+
+                for unit_id, (unit_bbox, nestimated) in enumerate(units):
+                    unit_intersection = box(*unit_bbox).intersection(inters_pol)
+                    if unit_intersection.is_empty:
+                        continue
+
+                    job = dict(
+                        src_path=remote_country_fgb_url,
+                        mask=unit_intersection,
+                        batch_size=batch_size,
+                        signal_event=stop,
+                        name=f'unit::{unit_id}',
+                        progress=progress
+
+                    )
+                    jobs.append(job)
+
+                pipeline = Pipeline(job=read_bbox, jobs=jobs, workers=NWORKERS, results_arg=None, stop=stop,
+                                    id_prop_name='name')
+                try:
+                    for uname, meta, batches in pipeline:
                         try:
-                            try:
-                                uname, meta, batches  = results.pop()
-                                if batches is None:
-                                    raise meta
-                                logger.debug(f'{uname} was processed')
-                                for batch in batches:
-                                    if dst_ds.GetLayerCount() == 0:
-                                        src_epsg = int(meta['crs'].split(':')[-1])
-                                        src_srs = osr.SpatialReference()
-                                        src_srs.ImportFromEPSG(src_epsg)
-                                        dst_lyr = dst_ds.CreateLayer('buildings', geom_type=ogr.wkbPolygon, srs=src_srs)
-                                        for name in batch.schema.names:
-                                            if 'wkb' in name or 'geometry' in name: continue
-                                            field = batch.schema.field(name)
-                                            field_type = ARROWTYPE2OGRTYPE[field.type]
-                                            dst_lyr.CreateField(ogr.FieldDefn(name, field_type))
-                                    #logger.info(f'Going to write {batch.num_rows} features from  {au_name} admin unit')
-                                    # filter out empty/invalid
-                                    lengths = pc.binary_length(batch.column("wkb_geometry"))
-                                    mask = pc.greater(lengths, 0)
-                                    should_filter = pc.any(pc.invert(mask)).as_py()
-                                    if should_filter:
-                                        batch = batch.filter(mask)
-                                    if batch.num_rows == 0:
-                                        logger.debug('skipping batch')
-                                        continue
-                                    try:
-                                        dst_lyr.WritePyArrow(batch)
-                                    except Exception as e:
-                                        logger.info(f'batch with {batch.num_rows} rows from {uname} failed with error {e} and will be ignored')
-
-                                dst_lyr.SyncToDisk()
-                                ndownloaded += 1
-                                progress.update(total_task,
-                                                description=f'[red]Downloaded buildings from {ndownloaded} out of {ntiles} tiles',
-                                                advance=1)
-                            except IndexError as ie:
-                                if not jobs and progress.finished:
-                                    stop.set()
-                                    break
-                                s = random.random() # this one is necessary for ^C/KeyboardInterrupt
-                                time.sleep(s)
-                                continue
+                            if batches is None:
+                                raise meta
+                            logger.debug(f'{uname} was processed')
+                            for batch in batches:
+                                if dst_ds.GetLayerCount() == 0:
+                                    src_epsg = int(meta['crs'].split(':')[-1])
+                                    src_srs = osr.SpatialReference()
+                                    src_srs.ImportFromEPSG(src_epsg)
+                                    dst_lyr = dst_ds.CreateLayer('buildings', geom_type=ogr.wkbPolygon, srs=src_srs)
+                                    for name in batch.schema.names:
+                                        if 'wkb' in name or 'geometry' in name: continue
+                                        field = batch.schema.field(name)
+                                        field_type = ARROWTYPE2OGRTYPE[field.type]
+                                        dst_lyr.CreateField(ogr.FieldDefn(name, field_type))
+                                #logger.info(f'Going to write {batch.num_rows} features from  {au_name} admin unit')
+                                # filter out empty/invalid
+                                lengths = pc.binary_length(batch.column("wkb_geometry"))
+                                mask = pc.greater(lengths, 0)
+                                should_filter = pc.any(pc.invert(mask)).as_py()
+                                if should_filter:
+                                    batch = batch.filter(mask)
+                                if batch.num_rows == 0:
+                                    logger.debug('skipping batch')
+                                    continue
+                                try:
+                                    dst_lyr.WritePyArrow(batch)
+                                except Exception as e:
+                                    logger.info(f'batch with {batch.num_rows} rows from {uname} failed with error {e} and will be ignored')
+
+                            dst_lyr.SyncToDisk()
+                            ndownloaded += 1
                         except Exception as e:
                             failed.append(f'Downloading {uname} failed: {e.__class__.__name__}("{e}")')
-                            progress.update(total_task,
-                                            description=f'[red]Downloaded buildings from {ndownloaded} out of {ntiles} tiles',
-                                            advance=1)
-
-                        except KeyboardInterrupt:
-                            logger.info(f'Cancelling download. Please wait/allow for a graceful shutdown')
-                            stop.set()
-                            cancelled = True
-                            break
+                        progress.update(total_task,
+                                        description=f'[red]Downloaded buildings from {ndownloaded} out of {ntiles} units',
+                                        advance=1)
+                except KeyboardInterrupt:
+                    logger.info(f'Cancelling download. Please wait/allow for a graceful shutdown')
+                    cancelled = True
 
             if cancelled:
                 break
@@ -366,7 +303,7 @@ def download_admin(admin_path=None, out_path=None, country_col_name=None, admin_
     :return: None
 
     The buildings are downloaded in batches from country level disaggregated buildings dataset using  OGR Arrow protocol
-    The buildings are downloaded in parallel using threads and double ended queues.
+    The buildings are downloaded in parallel using threads and a bounded pipeline.
     NWORKERS specifies how many admin units are downloaded at the same time.
 
     """
@@ -378,89 +315,72 @@ def download_admin(admin_path=None, out_path=None, country_col_name=None, admin_
             adm_lyr = adm_ds.GetLayer(0)
             all_features = [e for e in adm_lyr]
             stop = threading.Event()
-            jobs = deque()
-            results = deque()
-            with concurrent.futures.ThreadPoolExecutor(max_workers=NWORKERS) as executor:
-                with Progress() as progress:
-                    for feature in all_features:
-                        au_geom = feature.GetGeometryRef()
-                        au_poly = shapely.wkb.loads(bytes(au_geom.ExportToIsoWkb()))
-                        props = feature.items()
-                        country_iso3 = props[country_col_name]
-                        au_name = props[admin_col_name]
-                        remote_country_fgb_url = f'/vsicurl/{GMOSM_BUILDINGS_ROOT}/country_iso={country_iso3}/{country_iso3}.fgb'
-                        job = dict(
-                            src_path=remote_country_fgb_url,
-                            mask=au_poly,
-                            batch_size=batch_size,
-                            signal_event=stop,
-                            name=au_name,
-                            progress=progress
-
-                        )
-                        jobs.append(job)
-                    njobs = len(jobs)
-                    total_task = progress.add_task(
-                        description=f'[red]Going to download buildings from {njobs} admin units', total=njobs)
-                    nworkers = njobs if njobs < NWORKERS else NWORKERS
-                    [executor.submit(downloader, jobs, results, stop) for i in range(nworkers)]
-                    while True:
+            jobs = list()
+            with Progress() as progress:
+                for feature in all_features:
+                    au_geom = feature.GetGeometryRef()
+                    au_poly = shapely.wkb.loads(bytes(au_geom.ExportToIsoWkb()))
+                    props = feature.items()
+                    country_iso3 = props[country_col_name]
+                    au_name = props[admin_col_name]
+                    remote_country_fgb_url = vsicurl(f'{GMOSM_BUILDINGS_ROOT}/country_iso={country_iso3}/{country_iso3}.fgb')
+                    job = dict(
+                        src_path=remote_country_fgb_url,
+                        mask=au_poly,
+                        batch_size=batch_size,
+                        signal_event=stop,
+                        name=au_name,
+                        progress=progress
+
+                    )
+                    jobs.append(job)
+                njobs = len(jobs)
+                total_task = progress.add_task(
+                    description=f'[red]Going to download buildings from {njobs} admin units', total=njobs)
+                pipeline = Pipeline(job=read_bbox, jobs=jobs, workers=NWORKERS, results_arg=None, stop=stop,
+                                    id_prop_name='name')
+                try:
+                    for au_name, meta, batches in pipeline:
                         try:
-                            try:
-                                au_name, meta, batches  = results.pop()
-                                if batches is None:
-                                    raise meta
-                                logger.debug(f'{au_name} was processed')
-                                for batch in batches:
-                                    if dst_ds.GetLayerCount() == 0:
-                                        src_epsg = int(meta['crs'].split(':')[-1])
-                                        src_srs = osr.SpatialReference()
-                                        src_srs.ImportFromEPSG(src_epsg)
-                                        dst_lyr = dst_ds.CreateLayer('buildings', geom_type=ogr.wkbPolygon, srs=src_srs)
-                                        for name in batch.schema.names:
-                                            if 'wkb' in name or 'geometry' in name: continue
-                                            field = batch.schema.field(name)
-                                            field_type = ARROWTYPE2OGRTYPE[field.type]
-                                            dst_lyr.CreateField(ogr.FieldDefn(name, field_type))
-                                    #logger.info(f'Going to write {batch.num_rows} features from  {au_name} admin unit')
-
-                                    lengths = pc.binary_length(batch.column("wkb_geometry"))
-                                    mask = pc.greater(lengths, 0)
-                                    should_filter = pc.any(pc.invert(mask)).as_py()
-                                    if should_filter:
-                                        batch = batch.filter(mask)
-                                    if batch.num_rows ==0:
-                                        logger.debug('skipping batch')
-                                        continue
-                                    try:
-                                        dst_lyr.WritePyArrow(batch)
-                                    except Exception as e:
-                                        logger.info(f'batch with {batch.num_rows} rows from {au_name} failed with error {e} and will be ignored')
-
-
-                                dst_lyr.SyncToDisk()
-                                ndownloaded += 1
-                                progress.update(total_task,
-                                                description=f'[red]Downloaded buildings from {ndownloaded} out of {njobs} admin units',
-                                                advance=1)
-                            except IndexError as ie:
-                                if not jobs and progress.finished:
-                                    stop.set()
-                                    break
-                                s = random.random() # this one is necessary for ^C/KeyboardInterrupt
-                                time.sleep(s)
-                                continue
-
+                            if batches is None:
+                                raise meta
+                            logger.debug(f'{au_name} was processed')
+                            for batch in batches:
+                                if dst_ds.GetLayerCount() == 0:
+                                    src_epsg = int(meta['crs'].split(':')[-1])
+                                    src_srs = osr.SpatialReference()
+                                    src_srs.ImportFromEPSG(src_epsg)
+                                    dst_lyr = dst_ds.CreateLayer('buildings', geom_type=ogr.wkbPolygon, srs=src_srs)
+                                    for name in batch.schema.names:
+                                        if 'wkb' in name or 'geometry' in name: continue
+                                        field = batch.schema.field(name)
+                                        field_type = ARROWTYPE2OGRTYPE[field.type]
+                                        dst_lyr.CreateField(ogr.FieldDefn(name, field_type))
+                                #logger.info(f'Going to write {batch.num_rows} features from  {au_name} admin unit')
+
+                                lengths = pc.binary_length(batch.column("wkb_geometry"))
+                                mask = pc.greater(lengths, 0)
+                                should_filter = pc.any(pc.invert(mask)).as_py()
+                                if should_filter:
+                                    batch = batch.filter(mask)
+                                if batch.num_rows ==0:
+                                    logger.debug('skipping batch')
+                                    continue
+                                try:
+                                    dst_lyr.WritePyArrow(batch)
+                                except Exception as e:
+                                    logger.info(f'batch with {batch.num_rows} rows from {au_name} failed with error {e} and will be ignored')
+
+
+                            dst_lyr.SyncToDisk()
                         except Exception as e:
                             failed.append(f'Downloading {au_name} failed: {e.__class__.__name__}("{e}")')
-                            ndownloaded += 1
-                            progress.update(total_task,
-                                            description=f'[red]Downloaded buildings from {ndownloaded} out of {njobs} admin units',
-                                            advance=1)
-                        except KeyboardInterrupt:
-                            logger.info(f'Cancelling download. Please wait/allow for a graceful shutdown')
-                            stop.set()
-                            break
+                        ndownloaded += 1
+                        progress.update(total_task,
+                                        description=f'[red]Downloaded buildings from {ndownloaded} out of {njobs} admin units',
+                                        advance=1)
+                except KeyboardInterrupt:
+                    logger.info(f'Cancelling download. Please wait/allow for a graceful shutdown')
 
 
     if failed:
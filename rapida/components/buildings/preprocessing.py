@@ -1,10 +1,11 @@
-import concurrent
 import logging
 import os.path
-import random
+import tempfile
 import threading
-from collections import deque
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pyarrow as pa
 # from pyogrio.raw import open_arrow, read_arrow
@@ -14,7 +15,8 @@ from osgeo.ogr import wkbPolygon
 from pyogrio import read_dataframe, open_arrow
 from rasterio.windows import Window
 from rich.progress import Progress
-from rapida.util.worker import worker as genworker
+import shapely
+from rapida.util.pipeline import Pipeline
 from rapida.constants import ARROWTYPE2OGRTYPE
 from rapida.util.gen_blocks import gen_blocks
 from rapida.util.generator_length import generator_length
@@ -23,6 +25,14 @@ from rich.progress import TimeElapsedColumn
 logger = logging.getLogger(__name__)
 gdal.UseExceptions()
 
+# the number of features in a masking work unit is kept between these bounds
+MASK_MIN_BATCH_SIZE = 10_000
+MASK_MAX_BATCH_SIZE = 250_000
+# masks larger than this (one byte per pixel) are memory mapped instead of held in RAM
+MASK_MAX_IN_MEMORY_BYTES = 2 * 1024 ** 3
+# the size of the row blocks a memory mapped mask is read in
+MASK_READ_BLOCK_BYTES = 64 * 1024 ** 2
+
 def cb(complete, message, stop_event):
     #logger.info(f'{complete * 100:.2f}%')
     if stop_event and stop_event.is_set():
@@ -186,31 +196,6 @@ def filter_buildings_in_block(buildings_ds_path=None,  mask_ds=None,
 
 
 
-def worker(work=None, result=None, finished=None):
-
-
-    logger.debug(f'starting building filter thread {threading.current_thread().name}')
-    while True:
-
-        job = None
-        try:
-            job = work.pop()
-        except IndexError as ie:
-            pass
-        if job is None:
-            if finished.is_set():
-                logger.debug(f'worker is finishing  in {threading.current_thread().name}')
-                break
-            continue
-
-        if finished.is_set():
-            break
-        logger.debug(f'Starting job in block {job["block_id"]}')
-
-        result.append(filter_buildings_in_block(**job))
-
-
-
 def filter_buildings(buildings_path=None, mask_path=None, mask_pixel_value=None,
                      horizontal_chunks=None, vertical_chunks=None, nworkers=1,
                      out_path=None):
@@ -247,221 +232,294 @@ def filter_buildings(buildings_path=None, mask_path=None, mask_pixel_value=None,
             blocks = gen_blocks(blockxsize=block_xsize, blockysize=block_ysize, width=width, height=height)
             nblocks, blocks = generator_length(blocks)
             stop_event = threading.Event()
-            jobs = deque()
-            results = deque()
-            nworkers = nblocks if nworkers > nblocks else nworkers
-            print(nworkers)
-            with concurrent.futures.ThreadPoolExecutor(max_workers=nworkers) as executor:
-                [executor.submit(worker, jobs, results, stop_event) for i in range(nworkers)]
-                with Progress() as progress:
-                    total_task = progress.add_task(
-                        description=f'[red]Going to filter buildings from {nblocks} blocks/chunks',
-                        total=nblocks)
-                    for block_id, block in enumerate(blocks):
-                        job = dict(
-                            buildings_ds_path=buildings_path,
-                            mask_ds=mask_ds,
-                            block=block,
-                            block_id=block_id,
-
-                        )
-                        jobs.append(job)
+            jobs = list()
+            with Progress() as progress:
+                total_task = progress.add_task(
+                    description=f'[red]Going to filter buildings from {nblocks} blocks/chunks',
+                    total=nblocks)
+                for block_id, block in enumerate(blocks):
+                    job = dict(
+                        buildings_ds_path=buildings_path,
+                        mask_ds=mask_ds,
+                        block=block,
+                        block_id=block_id,
 
+                    )
+                    jobs.append(job)
 
-                    while True:
+                pipeline = Pipeline(job=filter_buildings_in_block, jobs=jobs, workers=nworkers, results_arg=None,
+                                    stop=stop_event, id_prop_name='block_id')
+                try:
+                    for block_id, table, dst_srs in pipeline:
                         try:
+                            if table is None:
+                                continue
+
+                            if dst_ds.GetLayerCount() == 0:
+
+                                dst_lyr = dst_ds.CreateLayer('buildings_filtered', geom_type=ogr.wkbPolygon, srs=dst_srs,
+                                                             )
+                                for name in table.schema.names:
+                                    if 'wkb' in name or 'geometry' in name: continue
+
+                                    field = table.schema.field(name)
+                                    field_type = ARROWTYPE2OGRTYPE[field.type]
+                                    logger.debug(f'Creating field {name}: {field.type}: {field_type}')
+                                    dst_lyr.CreateField(ogr.FieldDefn(name, field_type))
+
+
                             try:
-                                block_id, table, dst_srs = results.pop()
-
-                                if table is None:
-                                    nfiltered += 1
-                                    progress.update(total_task,
-                                                    description=f'[red]Filtered buildings from {nfiltered} out of {nblocks} blocks',
-                                                    advance=1)
-                                    continue
-
-                                if dst_ds.GetLayerCount() == 0:
-
-                                    dst_lyr = dst_ds.CreateLayer('buildings_filtered', geom_type=ogr.wkbPolygon, srs=dst_srs,
-                                                                 )
-                                    for name in table.schema.names:
-                                        if 'wkb' in name or 'geometry' in name: continue
-
-                                        field = table.schema.field(name)
-                                        field_type = ARROWTYPE2OGRTYPE[field.type]
-                                        logger.debug(f'Creating field {name}: {field.type}: {field_type}')
-                                        dst_lyr.CreateField(ogr.FieldDefn(name, field_type))
-
-
-                                try:
-
-                                    dst_lyr.WritePyArrow(table)
-                                except Exception as e:
-                                    logger.error(
-                                        f'Failed to write {table.num_rows} features/rows in block id {block_id} because {e}. Skipping')
-
-                                dst_lyr.SyncToDisk()
-                                nfiltered += 1
-                                progress.update(total_task,
-                                                description=f'[red]Filtered buildings from {nfiltered} out of {nblocks} blocks',
-                                                advance=1)
-                                logger.debug(f'{block_id} was processed')
-                            except IndexError as ie:
-                                if not jobs and progress.finished:
-                                    stop_event.set()
-                                    break
-                                s = random.random()  # this one is necessary for ^C/KeyboardInterrupt
-                                time.sleep(s)
 
-                                continue
+                                dst_lyr.WritePyArrow(table)
+                            except Exception as e:
+                                logger.error(
+                                    f'Failed to write {table.num_rows} features/rows in block id {block_id} because {e}. Skipping')
+
+                            dst_lyr.SyncToDisk()
+                            logger.debug(f'{block_id} was processed')
                         except Exception as e:
                             failed.append(f'Error in block_id {block_id} failed: {e.__class__.__name__}("{e}")')
+                        finally:
+                            nfiltered += 1
                             progress.update(total_task,
-                                            description=f'[red]Filtered  buildings from {nfiltered} out of {nblocks} blocks',
+                                            description=f'[red]Filtered buildings from {nfiltered} out of {nblocks} blocks',
                                             advance=1)
-                            nfiltered+=1
-
-                        except KeyboardInterrupt:
-                            logger.info(f'Cancelling jobs. Please wait/allow for a graceful shutdown')
-                            stop_event.set()
-                            break
+                except KeyboardInterrupt:
+                    logger.info(f'Cancelling jobs. Please wait/allow for a graceful shutdown')
         logger.info(f'{dst_lyr.GetFeatureCount()} feature were written to {out_path} ')
     if failed:
         for msg in failed:
             logger.error(msg)
 
 
-def mask_buildings( buildings_dataset=None, buildings_layer_name=None,mask_ds_path=None,
-                    masked_buildings_dataset=None, masked_buildings_layer_name=None,
-                    horizontal_chunks=None, vertical_chunks=None, workers=4, progress=None
-                   ):
+def load_mask(mask_ds_path=None, band=1, max_in_memory_bytes=MASK_MAX_IN_MEMORY_BYTES, temp_dir=None):
     """
-    Filter buildings based on a raster mask
-    :param buildings_dataset:
-    :param buildings_layer_name:
-    :param mask_ds_path:
-    :param masked_buildings_dataset:
-    :param masked_buildings_layer_name:
-    :param horizontal_chunks:
-    :param vertical_chunks:
-    :param workers:
-    :param progress:
-    :return:
+    Read a raster mask as a boolean array (True where the pixel value is 1). Masks larger than
+    max_in_memory_bytes are read row block by row block into a memory mapped file in temp_dir so the
+    centroid lookup does not need the whole mask in RAM
+    :param mask_ds_path: str, path to the single band mask raster
+    :param band: int, the band
+    :param max_in_memory_bytes: int, the size above which the mask is memory mapped
+    :param temp_dir: str, the folder for the memory mapped file, the system temporary folder by default
+    :return: tuple, the boolean mask array and the affine transform of the mask
+    """
+    with rasterio.open(mask_ds_path) as mask_ds:
+        assert mask_ds.count == 1, f'The mask dataset {mask_ds_path} contains more than one band'
+        shape = mask_ds.height, mask_ds.width
+        if shape[0] * shape[1] <= max_in_memory_bytes:
+            return mask_ds.read(band) == 1, mask_ds.transform
+        mmap_file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix='.mask')
+        mask = np.memmap(mmap_file, dtype=bool, mode='w+', shape=shape)
+        block_height = max(1, MASK_READ_BLOCK_BYTES // shape[1])
+        for row in range(0, shape[0], block_height):
+            height = min(block_height, shape[0] - row)
+            mask[row:row + height] = mask_ds.read(band, window=Window(0, row, shape[1], height)) == 1
+        return mask, mask_ds.transform
+
+
+def lookup_mask(x: np.ndarray = None, y: np.ndarray = None, mask=None, transform=None) -> np.ndarray:
+    """
+    Look up the mask pixel of every point
+    :param x: array of point x coordinates in the mask SRS
+    :param y: array of point y coordinates in the mask SRS
+    :param mask: 2D boolean numpy array (or memmap)
+    :param transform: affine transform of the mask
+    :return: boolean array, True for the points in a True pixel. Points outside the mask or with NaN
+    coordinates are False
+    """
+    cols, rows = ~transform * (x, y)
+    with np.errstate(invalid='ignore'):
+        cols, rows = np.floor(cols), np.floor(rows)
+        inside = (rows >= 0) & (rows < mask.shape[0]) & (cols >= 0) & (cols < mask.shape[1])
+    selected = np.zeros(len(x), dtype=bool)
+    selected[inside] = mask[rows[inside].astype('i8'), cols[inside].astype('i8')]
+    return selected
+
+
+def mask_batch(batch: pa.RecordBatch = None, geometry_name=None, mask=None, transform=None):
+    """
+    Select the features of an Arrow batch whose centroid falls in a True pixel of the mask
+    :param batch: pyarrow RecordBatch with a WKB geometry column
+    :param geometry_name: str, the name of the geometry column
+    :param mask: 2D boolean numpy array (or memmap)
+    :param transform: affine transform of the mask
+    :return: pyarrow RecordBatch with the selected features
+    """
+    geoms = shapely.from_wkb(batch.column(geometry_name).to_numpy(zero_copy_only=False))
+    centroids = shapely.centroid(geoms)
+    selected = lookup_mask(x=shapely.get_x(centroids), y=shapely.get_y(centroids), mask=mask, transform=transform)
+    return batch.filter(pa.array(selected))
+
+
+def mask_buildings(buildings_dataset=None, buildings_layer_name=None, mask_ds_path=None,
+                   masked_buildings_dataset=None, masked_buildings_layer_name=None,
+                   batch_size=None, workers=4, progress=None):
+    """
+    Filter buildings based on a raster mask. The buildings layer is read in one sequential Arrow stream in
+    batches of batch_size features. The batches are the work units, so dense urban areas and empty
+    countryside cost the same per feature. Every batch is masked in a thread pool by looking up the pixel of
+    the building centroids in the mask, which is held in memory (or memory mapped, see load_mask). The
+    selected buildings are written to masked_buildings_layer_name in one transaction.
+    :param buildings_dataset: str, path to the buildings GeoPackage
+    :param buildings_layer_name: str, the buildings layer
+    :param mask_ds_path: str, path to the raster mask
+    :param masked_buildings_dataset: str, path to the GeoPackage the selected buildings are written to
+    :param masked_buildings_layer_name: str, the layer the selected buildings are written to. It is replaced if
+    it exists
+    :param batch_size: int, the number of features in a work unit. By default it is derived from the feature
+    count and the number of workers
+    :param workers: int, number of threads masking the batches
+    :param progress: rich progress instance
+    :return: int, the number of selected buildings
     """
     total_task = None
+    cols = None
     if progress:
         cols = progress.columns
         progress.columns = [e for e in cols] + [TimeElapsedColumn()]
+    nselected = 0
     try:
-
-        with rasterio.open(mask_ds_path) as mask_ds:
-            assert mask_ds.count == 1, f'The mask dataset {mask_ds_path} contains more than one band'
-            width = mask_ds.width
-            height = mask_ds.height
-            block_xsize = width // horizontal_chunks
-            block_ysize = height // vertical_chunks
-            blocks = gen_blocks(blockxsize=block_xsize, blockysize=block_ysize, width=width, height=height)
-            nblocks, blocks = generator_length(blocks)
-            stop_event = threading.Event()
-            jobs = deque()
-            results = deque()
-            workers = nblocks if workers > nblocks else workers
-            folder_path, _ = os.path.split(masked_buildings_dataset)
-            out_path = os.path.join(folder_path, f'{masked_buildings_layer_name}.fgb')
-            with ogr.GetDriverByName('FlatGeobuf').CreateDataSource(out_path) as dst_ds:
-                with gdal.OpenEx(buildings_dataset, gdal.OF_VECTOR) as bldgs_ds:
-                    bldgs_layer = bldgs_ds.GetLayerByName(buildings_layer_name)
-                    bldgs_layer_defn = bldgs_layer.GetLayerDefn()
-
-                    destination_layer = dst_ds.CreateLayer(
-                        masked_buildings_layer_name,
-                        srs=bldgs_layer.GetSpatialRef(),
-                        geom_type=bldgs_layer_defn.GetGeomType(),
-                    )
-                    # Copy fields
-                    for i in range(bldgs_layer_defn.GetFieldCount()):
-                        field_defn = bldgs_layer_defn.GetFieldDefn(i)
-                        destination_layer.CreateField(field_defn)
-                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-
-                    if progress:
-                        total_task = progress.add_task(
-                            description=f'[red]Going to mask buildings in {nblocks} blocks/chunks',
-                            total=nblocks)
-                    for block_id, block in enumerate(blocks):
-                        job = dict(
-                            buildings_dataset=buildings_dataset,
-                            buildings_layer_name=buildings_layer_name,
-                            mask_ds=mask_ds,
-                            block=block,
-                            name=f'block::{block_id}',
-                            results=results,
-                            progress=progress
-
-                        )
-
-                        jobs.append(job)
-                    futures = [executor.submit(genworker, job=mask_buildings_in_block, jobs=jobs, stop=stop_event, task=total_task, id_prop_name='name') for i in range(workers)]
-                    while True:
-                        try:
-                            try:
-                                block_id, table = results.pop()
-                                table = table.rename_columns({'geometry':'wkb_geometry'})
-                                try:
-                                    destination_layer.WritePyArrow(table)
-                                    destination_layer.SyncToDisk()
-                                except Exception as e:
-                                    logger.error(
-                                        f'Failed to write {table.num_rows} features/rows in block id {block_id} because {e}. Skipping')
-
-                            except IndexError as ie:
-                                done = [f.done() for f in futures]
-                                if nblocks == 0 or all(done):
-                                    stop_event.set()
-                                    break
-                                s = random.random()  # this one is necessary for ^C/KeyboardInterrupt
-                                time.sleep(s)
-                                continue
-                        except KeyboardInterrupt:
-                            logger.info(f'Cancelling. Please wait/allow for a graceful shutdown')
-                            stop_event.set()
-                            raise
-
-            #with gdal.config_option(key="OGR2OGR_USE_ARROW_API", value="NO"):
-                # ogr Arrow is used in translate > 3.8 and it has some issue with OGC_FID col
-            with gdal.VectorTranslate(destNameOrDestDS=masked_buildings_dataset,srcDS=out_path, accessMode='append') as ds:
-                pass
-            os.remove(out_path)
+        mask, transform = load_mask(mask_ds_path=mask_ds_path)
+        same_dataset = os.path.abspath(buildings_dataset) == os.path.abspath(masked_buildings_dataset)
+        with gdal.OpenEx(masked_buildings_dataset, gdal.OF_VECTOR | gdal.OF_UPDATE) as dst_ds:
+            src_ds = dst_ds if same_dataset else gdal.OpenEx(buildings_dataset, gdal.OF_VECTOR)
+            try:
+                src_layer = src_ds.GetLayerByName(buildings_layer_name)
+                assert src_layer is not None, f'Layer {buildings_layer_name} does not exist in {buildings_dataset}'
+                src_layer_defn = src_layer.GetLayerDefn()
+                geometry_name = src_layer.GetGeometryColumn() or 'wkb_geometry'
+                nfeatures = src_layer.GetFeatureCount()
+                if batch_size is None:
+                    batch_size = int(np.clip(nfeatures // (workers * 16 or 1), MASK_MIN_BATCH_SIZE,
+                                             MASK_MAX_BATCH_SIZE))
+                if dst_ds.GetLayerByName(masked_buildings_layer_name) is not None:
+                    dst_ds.DeleteLayer(masked_buildings_layer_name)
+                dst_layer = dst_ds.CreateLayer(
+                    masked_buildings_layer_name,
+                    srs=src_layer.GetSpatialRef(),
+                    geom_type=src_layer_defn.GetGeomType(),
+                    options=[f'GEOMETRY_NAME={geometry_name}'],
+                )
+                for i in range(src_layer_defn.GetFieldCount()):
+                    dst_layer.CreateField(src_layer_defn.GetFieldDefn(i))
+                if progress:
+                    total_task = progress.add_task(
+                        description=f'[red]Going to mask {nfeatures} buildings in batches of {batch_size}',
+                        total=nfeatures)
+                stream = src_layer.GetArrowStreamAsPyArrow(
+                    ['INCLUDE_FID=NO', f'MAX_FEATURES_IN_BATCH={batch_size}'])
+                pending = deque()
+
+                def write(future=None):
+                    nonlocal nselected
+                    nrows, selected = future.result()
+                    if selected.num_rows > 0:
+                        dst_layer.WritePyArrow(selected)
+                        nselected += selected.num_rows
+                    if progress and total_task is not None:
+                        progress.update(total_task, advance=nrows)
+
+                dst_ds.StartTransaction()
+                try:
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        for batch in stream:
+                            pending.append(executor.submit(
+                                lambda b: (b.num_rows, mask_batch(batch=b, geometry_name=geometry_name,
+                                                                  mask=mask, transform=transform)), batch))
+                            while len(pending) > 2 * workers:
+                                write(future=pending.popleft())
+                        while pending:
+                            write(future=pending.popleft())
+                    dst_ds.CommitTransaction()
+                except BaseException:
+                    for future in pending:
+                        future.cancel()
+                    dst_ds.RollbackTransaction()
+                    raise
+            finally:
+                if not same_dataset:
+                    src_ds = None
+        logger.info(f'{nselected} buildings were written to {masked_buildings_dataset}:{masked_buildings_layer_name}')
+        return nselected
+    except KeyboardInterrupt:
+        logger.info(f'Cancelling. Please wait/allow for a graceful shutdown')
+        raise
     except Exception as e:
         logger.error(f'Error masking {buildings_dataset} with error {e}')
         raise
-
     finally:
-        if progress and total_task:
+        if progress and total_task is not None:
             progress.remove_task(total_task)
+        if progress and cols is not None:
             progress.columns = cols
-if __name__ == '__main__':
-    import time
 
-    logger = setup_logger(name='rapida', level=logging.INFO, make_root=True)
 
+if __name__ == '__main__':
+    import sys
 
-    src_path = '/data/surge/buildings_eqar.fgb'
-    dst_path = '/data/surge/bldgs1c.fgb'
-    mask = '/data/surge/surge/stats/floods_mask.tif'
-    filtered_buildings_path = '/data/surge/bldgs1_filtered.fgb'
-
-    start = time.time()
-
-    #create_centroid(src_path=src_path, src_layer_name='buildings', dst_path=dst_path, dst_srs='ESRI:54034')
-    filter_buildings(
-        buildings_path=src_path,
-        mask_path=mask,
-        mask_pixel_value=1,
-        horizontal_chunks=10,
-        vertical_chunks=20,
-        out_path=filtered_buildings_path
-    )
+    logger = setup_logger(name='rapida', level=logging.INFO, make_root=True)
 
-    end = time.time()
-    print((end-start))
\ No newline at end of file
+    def legacy_mask_buildings(buildings_dataset=None, buildings_layer_name=None, mask_ds_path=None,
+                              out_path=None, horizontal_chunks=10, vertical_chunks=10, workers=4):
+        """
+        The block grid masking used before mask_buildings: bbox queries per block written through a FlatGeobuf
+        """
+        with rasterio.open(mask_ds_path) as mask_ds:
+            blocks = gen_blocks(blockxsize=mask_ds.width // horizontal_chunks,
+                                blockysize=mask_ds.height // vertical_chunks,
+                                width=mask_ds.width, height=mask_ds.height)
+            jobs = [dict(buildings_dataset=buildings_dataset, buildings_layer_name=buildings_layer_name,
+                         mask_ds=mask_ds, block=block, name=f'block::{block_id}')
+                    for block_id, block in enumerate(blocks)]
+            with ogr.GetDriverByName('FlatGeobuf').CreateDataSource(out_path) as dst_ds:
+                dst_layer = None
+                for block_id, table in Pipeline(job=mask_buildings_in_block, jobs=jobs, workers=workers,
+                                                id_prop_name='name'):
+                    if dst_layer is None:
+                        dst_layer = dst_ds.CreateLayer('masked', geom_type=ogr.wkbPolygon)
+                    dst_layer.WritePyArrow(table.rename_columns({'geometry': 'wkb_geometry'}))
+                    dst_layer.SyncToDisk()
+
+    # synthetic buildings, 10m squares scattered with clusters (cities) over a 2 x 2 degrees mask where
+    # the middle third is "affected"
+    sizes = [int(float(a)) for a in sys.argv[1:]] or [1_000_000, 10_000_000, 50_000_000]
+    rng = np.random.default_rng(0)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    for nbuildings in sizes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            gpkg_path = os.path.join(temp_dir, 'project.gpkg')
+            mask_path = os.path.join(temp_dir, 'mask.tif')
+            with rasterio.open(mask_path, 'w', driver='GTiff', width=2000, height=2000, count=1, dtype='uint8',
+                               crs='EPSG:4326',
+                               transform=rasterio.transform.from_origin(30, 2, .001, .001)) as dst:
+                mask = np.zeros((2000, 2000), dtype='uint8')
+                mask[:, 666:1333] = 1
+                dst.write(mask, 1)
+            with ogr.GetDriverByName('GPKG').CreateDataSource(gpkg_path) as ds:
+                lyr = ds.CreateLayer('buildings', srs=srs, geom_type=ogr.wkbPolygon,
+                                     options=['GEOMETRY_NAME=geom'])
+                lyr.CreateField(ogr.FieldDefn('height', ogr.OFTReal))
+                ds.StartTransaction()
+                for chunk in range(0, nbuildings, 1_000_000):
+                    n = min(1_000_000, nbuildings - chunk)
+                    centers = rng.normal(loc=(31, 1), scale=(.3, .3), size=(n, 2)).clip((30, 0), (31.999, 1.999))
+                    boxes = shapely.box(centers[:, 0], centers[:, 1], centers[:, 0] + 1e-4, centers[:, 1] + 1e-4)
+                    schema = pa.schema([pa.field('height', pa.float64()),
+                                        pa.field('geom', pa.binary(),
+                                                 metadata={'ARROW:extension:name': 'ogc.wkb'})])
+                    lyr.WritePyArrow(pa.record_batch([pa.array(rng.uniform(3, 30, n)),
+                                                      pa.array(shapely.to_wkb(boxes))], schema=schema))
+                ds.CommitTransaction()
+
+            start = time.time()
+            legacy_mask_buildings(buildings_dataset=gpkg_path, buildings_layer_name='buildings',
+                                  mask_ds_path=mask_path, out_path=os.path.join(temp_dir, 'legacy.fgb'))
+            legacy = time.time() - start
+            start = time.time()
+            nselected = mask_buildings(buildings_dataset=gpkg_path, buildings_layer_name='buildings',
+                                       mask_ds_path=mask_path, masked_buildings_dataset=gpkg_path,
+                                       masked_buildings_layer_name='buildings.affected')
+            new = time.time() - start
+            logger.info(f'{nbuildings} buildings ({nselected} affected): block grid {legacy:.2f}s, '
+                        f'streaming {new:.2f}s ({legacy / new:.1f}x)')
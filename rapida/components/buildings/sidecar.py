@@ -0,0 +1,132 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+from pyogrio import open_arrow
+
+from rapida.components.buildings.preprocessing import load_mask, lookup_mask
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_BATCH_SIZE = 65536
+SIDECAR_SCHEMA = pa.schema([
+    pa.field('fid', pa.int64()),
+    pa.field('area_in_meters', pa.float64()),
+    pa.field('x', pa.float64()),
+    pa.field('y', pa.float64()),
+    pa.field('h3id', pa.string()),
+])
+# the sidecar records the number of features and the SRS of the layer it was built from to detect stale sidecars
+SIDECAR_FEATURES_KEY = b'rapida:features'
+SIDECAR_CRS_KEY = b'rapida:crs'
+
+
+def sidecar_path(dataset_path: str = None, layer_name: str = None) -> str:
+    """
+    The path of the Parquet sidecar of a buildings layer, next to the dataset
+    :param dataset_path: str, path to the GeoPackage
+    :param layer_name: str, the buildings layer
+    :return: str
+    """
+    folder, _ = os.path.split(os.path.abspath(dataset_path))
+    return os.path.join(folder, f'{layer_name}.parquet')
+
+
+def _layer_signature_(dataset_path: str = None, layer_name: str = None) -> dict:
+    info = pyogrio.read_info(dataset_path, layer=layer_name)
+    return {SIDECAR_FEATURES_KEY: str(info['features']).encode(), SIDECAR_CRS_KEY: str(info['crs']).encode()}
+
+
+def sidecar_is_valid(dataset_path: str = None, layer_name: str = None) -> bool:
+    """
+    Check the sidecar of a buildings layer exists and was built from the current content of the layer
+    """
+    path = sidecar_path(dataset_path=dataset_path, layer_name=layer_name)
+    if not os.path.exists(path):
+        return False
+    try:
+        metadata = pq.read_schema(path).metadata or {}
+    except Exception as e:
+        logger.debug(f'Invalid sidecar {path}: {e}')
+        return False
+    signature = _layer_signature_(dataset_path=dataset_path, layer_name=layer_name)
+    return all(metadata.get(k) == v for k, v in signature.items())
+
+
+def build_sidecar(dataset_path: str = None, layer_name: str = None, id_column: str = 'polyid',
+                  batch_size: int = SIDECAR_BATCH_SIZE) -> str:
+    """
+    Persist the attributes of a buildings layer the assessment needs in a Parquet sidecar: the fid, the
+    footprint area, the centroid x/y in the layer (project) SRS and the h3id of the polygon the building was
+    downloaded for. The layer is streamed so the geometries are decoded only here, once per download.
+    :param dataset_path: str, path to the GeoPackage
+    :param layer_name: str, the buildings layer
+    :param id_column: str, the column holding the polygon id of every building
+    :param batch_size: int, the number of features in a batch
+    :return: str, the path of the sidecar
+    """
+    path = sidecar_path(dataset_path=dataset_path, layer_name=layer_name)
+    tmp_path = f'{path}.part'
+    schema = SIDECAR_SCHEMA.with_metadata(_layer_signature_(dataset_path=dataset_path, layer_name=layer_name))
+    nfeatures = 0
+    with open_arrow(dataset_path, layer=layer_name, columns=[id_column], use_pyarrow=True, return_fids=True,
+                    batch_size=batch_size) as (meta, reader):
+        geometry_name = meta['geometry_name'] or 'wkb_geometry'
+        fid_name = meta.get('fid_column') or 'OGC_FID'
+        with pq.ParquetWriter(tmp_path, schema=schema, compression='zstd') as writer:
+            for batch in reader:
+                if batch.num_rows == 0:
+                    continue
+                geoms = shapely.from_wkb(batch.column(geometry_name).to_numpy(zero_copy_only=False))
+                centroids = shapely.centroid(geoms)
+                writer.write_batch(pa.record_batch([
+                    batch.column(fid_name).cast(pa.int64()),
+                    pa.array(shapely.area(geoms)),
+                    pa.array(shapely.get_x(centroids)),
+                    pa.array(shapely.get_y(centroids)),
+                    batch.column(id_column).cast(pa.string()),
+                ], schema=schema))
+                nfeatures += batch.num_rows
+    os.replace(tmp_path, path)
+    logger.info(f'Wrote the attributes of {nfeatures} buildings to {path}')
+    return path
+
+
+def sidecar_aggregates(path: str = None, keys: np.ndarray = None, mask_path: str = None,
+                       batch_size: int = SIDECAR_BATCH_SIZE) -> pd.DataFrame:
+    """
+    Count the buildings and sum their area inside every polygon from a sidecar, without touching the
+    geometries. When a mask is supplied the buildings whose centroid is in a masked pixel are counted and summed
+    separately as the affected buildings.
+    :param path: str, path to the sidecar
+    :param keys: array with the h3id of every polygon
+    :param mask_path: str, path to the project raster mask, optional
+    :param batch_size: int, the number of rows read at once
+    :return: pandas DataFrame indexed by h3id with count and area columns and, with a mask, affected_count and
+    affected_area columns
+    """
+    n = len(keys)
+    index = pd.Index(keys)
+    sums = dict(count=np.zeros(n, dtype='i8'), area=np.zeros(n, dtype='f8'))
+    if mask_path is not None:
+        mask, transform = load_mask(mask_ds_path=mask_path)
+        sums.update(affected_count=np.zeros(n, dtype='i8'), affected_area=np.zeros(n, dtype='f8'))
+    columns = ['h3id', 'area_in_meters'] + (['x', 'y'] if mask_path is not None else [])
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns):
+        idx = index.get_indexer(batch.column('h3id').to_numpy(zero_copy_only=False))
+        located = idx >= 0
+        idx = idx[located]
+        area = batch.column('area_in_meters').to_numpy()[located]
+        sums['count'] += np.bincount(idx, minlength=n)
+        sums['area'] += np.bincount(idx, weights=area, minlength=n)
+        if mask_path is not None:
+            affected = lookup_mask(x=batch.column('x').to_numpy()[located], y=batch.column('y').to_numpy()[located],
+                                   mask=mask, transform=transform)
+            sums['affected_count'] += np.bincount(idx[affected], minlength=n)
+            sums['affected_area'] += np.bincount(idx[affected], weights=area[affected], minlength=n)
+    return pd.DataFrame(sums, index=index.rename('h3id'))
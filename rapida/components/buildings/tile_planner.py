@@ -0,0 +1,212 @@
+"""
+Plan the work units used to download buildings from a FlatGeobuf dataset.
+
+The feature density is estimated from the packed Hilbert R-tree stored at the start of every indexed
+FlatGeobuf file. The nodes of one tree level are bounding boxes that cover a known number of consecutive
+features, so a level with a few thousand nodes is a cheap density map that only costs a range read of the index.
+The area of interest is then split k-d tree style at the weighted median of the density until every work unit
+holds about the same number of features, and the units are scheduled largest first.
+"""
+import heapq
+import logging
+import math
+import struct
+import typing
+
+import numpy as np
+from osgeo import gdal
+
+logger = logging.getLogger(__name__)
+gdal.UseExceptions()
+
+FGB_MAGIC_BYTES = b'fgb'
+NODE_ITEM_SIZE = 40  # minx, miny, maxx, maxy as doubles and the byte offset as uint64
+DEFAULT_NODE_SIZE = 16
+# the deepest index level with at most this many nodes is used as density map, ~2.6MB of index
+PLANNER_MAX_INDEX_NODES = 65536
+# a unit is not split further after this many splits, e.g. all its features are in one tiny spot
+PLANNER_MAX_DEPTH = 32
+
+
+def _read_bytes_(src_path: str = None, offset: int = 0, size: int = 0) -> bytes:
+    f = gdal.VSIFOpenL(src_path, 'rb')
+    try:
+        gdal.VSIFSeekL(f, offset, 0)
+        return gdal.VSIFReadL(1, size, f)
+    finally:
+        gdal.VSIFCloseL(f)
+
+
+def parse_fgb_header(buf: bytes = None) -> dict:
+    """
+    Read the feature count and the index node size from the FlatBuffers encoded FlatGeobuf header
+    :param buf: bytes, the header without the magic bytes and the header size prefix
+    :return: dict with features_count and index_node_size keys
+    """
+    table = struct.unpack_from('<I', buf, 0)[0]
+    vtable = table - struct.unpack_from('<i', buf, table)[0]
+    vtable_size = struct.unpack_from('<H', buf, vtable)[0]
+
+    def field(index=None, fmt=None, default=None):
+        slot = 4 + 2 * index
+        if slot >= vtable_size:
+            return default
+        offset = struct.unpack_from('<H', buf, vtable + slot)[0]
+        return struct.unpack_from(fmt, buf, table + offset)[0] if offset else default
+
+    # fields 8 and 9 of the Header table in header.fbs
+    return dict(features_count=field(index=8, fmt='<Q', default=0),
+                index_node_size=field(index=9, fmt='<H', default=DEFAULT_NODE_SIZE))
+
+
+def level_bounds(num_items: int = None, node_size: int = None) -> typing.List[typing.Tuple[int, int]]:
+    """
+    The node range of every level of a packed R-tree, leaves first, like in the FlatGeobuf reference implementation
+    :param num_items: int, the number of features
+    :param node_size: int, the index node size
+    :return: list of (start, end) node indices, the first is the leaves level and the last is the root
+    """
+    n = num_items
+    level_num_nodes = [n]
+    num_nodes = n
+    while True:
+        n = math.ceil(n / node_size)
+        num_nodes += n
+        level_num_nodes.append(n)
+        if n == 1:
+            break
+    bounds = list()
+    offset = num_nodes
+    for size in level_num_nodes:
+        offset -= size
+        bounds.append((offset, offset + size))
+    return bounds
+
+
+def index_cells(index: bytes = None, num_items: int = None, node_size: int = None, level: int = None):
+    """
+    Decode the nodes of one level of a packed R-tree into density cells
+    :param index: bytes, the index or the part of the index up to the end of level
+    :param num_items: int, the number of features
+    :param node_size: int, the index node size
+    :param level: int, the level, 0 is the leaves level
+    :return: tuple of a float64 array (n, 4) with the bounds of every cell and an int64 array with the number of
+    features in every cell
+    """
+    start, end = level_bounds(num_items=num_items, node_size=node_size)[level]
+    nodes = np.frombuffer(index, dtype=np.dtype([('bounds', '<f8', 4), ('offset', '<u8')]),
+                          count=end - start, offset=start * NODE_ITEM_SIZE)
+    per_node = node_size ** level
+    first = np.arange(end - start, dtype='i8') * per_node
+    counts = np.minimum(first + per_node, num_items) - first
+    return nodes['bounds'].astype('f8'), counts
+
+
+def read_fgb_index_cells(src_path: str = None, max_nodes: int = PLANNER_MAX_INDEX_NODES):
+    """
+    Estimate the feature density of a FlatGeobuf dataset from its spatial index. Only the header and the
+    upper levels of the index are read, so remote (vsicurl) datasets cost a couple of range requests
+    :param src_path: str, GDAL path of the FlatGeobuf file
+    :param max_nodes: int, the deepest index level with at most this number of nodes is read
+    :return: tuple of a float64 array (n, 4) with the bounds of every cell and an int64 array with the number of
+    features in every cell, or None if the dataset has no spatial index
+    """
+    prefix = _read_bytes_(src_path=src_path, offset=0, size=12)
+    assert prefix[:3] == FGB_MAGIC_BYTES and prefix[4:7] == FGB_MAGIC_BYTES, f'{src_path} is not a FlatGeobuf file'
+    header_size = struct.unpack_from('<I', prefix, 8)[0]
+    header = parse_fgb_header(_read_bytes_(src_path=src_path, offset=12, size=header_size))
+    num_items, node_size = header['features_count'], header['index_node_size']
+    if node_size == 0 or num_items == 0:
+        logger.debug(f'{src_path} has no spatial index')
+        return None
+    levels = level_bounds(num_items=num_items, node_size=node_size)
+    level = next(i for i, (start, end) in enumerate(levels) if end - start <= max_nodes)
+    _, end = levels[level]
+    index = _read_bytes_(src_path=src_path, offset=12 + header_size, size=end * NODE_ITEM_SIZE)
+    return index_cells(index=index, num_items=num_items, node_size=node_size, level=level)
+
+
+def estimate_features(cell_bounds: np.ndarray = None, cell_counts: np.ndarray = None, bbox=None):
+    """
+    Estimate the number of features of every cell inside a bounding box assuming the features are spread
+    uniformly inside the cell
+    :param cell_bounds: float64 array (n, 4), the bounds of the cells
+    :param cell_counts: int64 array, the number of features in every cell
+    :param bbox: iterable of floats, xmin, ymin, xmax, ymax
+    :return: float64 array with the estimated number of features of every cell inside bbox
+    """
+    xmin, ymin, xmax, ymax = bbox
+    fractions = np.ones(len(cell_counts), dtype='f8')
+    for lo, hi, bmin, bmax in ((0, 2, xmin, xmax), (1, 3, ymin, ymax)):
+        size = cell_bounds[:, hi] - cell_bounds[:, lo]
+        overlap = np.minimum(cell_bounds[:, hi], bmax) - np.maximum(cell_bounds[:, lo], bmin)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # cells without extent along an axis are either in or out
+            fraction = np.where(size > 0, overlap / size, (cell_bounds[:, lo] >= bmin) & (cell_bounds[:, lo] < bmax))
+        fractions *= np.clip(fraction, 0, 1)
+    return cell_counts * fractions
+
+
+def plan_work_units(cell_bounds: np.ndarray = None, cell_counts: np.ndarray = None, bbox=None,
+                    target_features: int = None, max_depth: int = PLANNER_MAX_DEPTH):
+    """
+    Split a bounding box into disjoint work units holding about target_features features each. A unit with more
+    features is split along its longer side at the weighted median of the cells it overlaps, so dense areas end
+    up in small units and sparse areas in large ones. Units without features are dropped
+    :param cell_bounds: float64 array (n, 4), the bounds of the density cells
+    :param cell_counts: int64 array, the number of features in every cell
+    :param bbox: iterable of floats, xmin, ymin, xmax, ymax, the area of interest
+    :param target_features: int, the number of features in a unit
+    :param max_depth: int, the max number of times a unit is split
+    :return: list of (bbox, estimated features) tuples sorted by the estimated features, largest first
+    """
+    assert target_features > 0, f'invalid target_features={target_features}'
+    units = list()
+    pending = [(tuple(map(float, bbox)), 0)]
+    while pending:
+        box, depth = pending.pop()
+        estimates = estimate_features(cell_bounds=cell_bounds, cell_counts=cell_counts, bbox=box)
+        total = estimates.sum()
+        if total <= 0:
+            continue
+        if total <= target_features or depth >= max_depth:
+            units.append((box, float(total)))
+            continue
+        xmin, ymin, xmax, ymax = box
+        axis = 0 if xmax - xmin >= ymax - ymin else 1
+        lo, hi = (xmin, xmax) if axis == 0 else (ymin, ymax)
+        selected = estimates > 0
+        # the centres of the cells clipped to the unit
+        centres = (np.clip(cell_bounds[selected, axis], lo, hi) + np.clip(cell_bounds[selected, axis + 2], lo, hi)) / 2
+        weights = estimates[selected]
+        order = np.argsort(centres, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        split = centres[order][np.searchsorted(cumulative, total / 2)]
+        if not lo < split < hi:
+            split = (lo + hi) / 2
+        if axis == 0:
+            pending.extend([((xmin, ymin, split, ymax), depth + 1), ((split, ymin, xmax, ymax), depth + 1)])
+        else:
+            pending.extend([((xmin, ymin, xmax, split), depth + 1), ((xmin, split, xmax, ymax), depth + 1)])
+    return schedule_largest_first(units=units)
+
+
+def schedule_largest_first(units: typing.List[typing.Tuple[tuple, float]] = None):
+    """
+    Order the work units by their estimated size, largest first. Workers taking the next unit from this list
+    as soon as they are free (like the Pipeline does) keep the longest units from starting last
+    """
+    return sorted(units, key=lambda unit: unit[1], reverse=True)
+
+
+def makespan(costs: typing.Iterable[float] = None, workers: int = None) -> float:
+    """
+    The time it takes a pool of workers to process jobs taken in order by the first free worker
+    :param costs: iterable of numbers, the duration of every job in the order the jobs are taken
+    :param workers: int, the number of workers
+    :return: float, the time the last worker finishes
+    """
+    loads = [0.] * workers
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
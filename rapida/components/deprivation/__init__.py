@@ -1,16 +1,13 @@
 import os
 import logging
 from typing import List
-from osgeo import gdal
 from rapida.core.component import Component
 from rapida.components.rwi import RwiVariable
 from rapida.project.project import Project
 from rapida.session import Session
-from rapida.util import geo
+from rapida.stats.store import StatsStore
 from rapida.util.download_geodata import download_raster
 from rapida.util.resolve_url import resolve_geohub_url
-from osgeo_utils.gdal_calc import Calc
-from rapida.constants import GTIFF_CREATION_OPTIONS
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +30,9 @@ class DeprivationComponent(Component):
                     logger.error(msg)
                     return
         multiple_vars = len(variables) > 1
-        with Session() as ses:
+        project = Project(path=os.getcwd())
+        stats_store = StatsStore(dataset_path=project.geopackage_file_path, layer_name=f'stats.{self.component_name}')
+        with Session() as ses, stats_store:
             variables_data = ses.get_component(self.component_name)
 
             for var_index, var_name in enumerate(variables):
@@ -47,7 +46,7 @@ class DeprivationComponent(Component):
                     if var_index > 0:
                         kwargs['force'] = False
 
-                v(**kwargs)
+                v(stats_store=stats_store, **kwargs)
 
 
 
@@ -64,26 +63,9 @@ class DeprivationVariable(RwiVariable):
 
 
 
-    def _compute_affected_(self):
-        project = Project(os.getcwd())
-        if geo.is_raster(self.local_path) and project.raster_mask is not None:
-
-
-            affected_local_path = self.affected_path
-            ds = Calc(calc='local_path*mask', outfile=affected_local_path, projectionCheck=True, format='GTiff',
-                      creation_options=GTIFF_CREATION_OPTIONS, quiet=False, overwrite=True,
-                      NoDataValue=None,
-                      local_path=self.local_path, mask=project.raster_mask)
-            ds = None
-            assert os.path.exists(self.affected_path), f'Failed to compute {self.affected_path}'
-            return affected_local_path
-
     def download(self, force=False, **kwargs):
         project = Project(os.getcwd())
         if os.path.exists(self.local_path) and not force:
-            if project.raster_mask is not None:
-                assert os.path.exists(self.affected_path), (f'The affected version of {self.component} force not exist.'
-                                                            f'Consider assessing using --force flag')
             return self.local_path
 
         logger.info(f'Downloading {self.component}')
@@ -93,34 +75,17 @@ class DeprivationVariable(RwiVariable):
             os.makedirs(out_folder)
 
         progress = kwargs.pop('progress', None)
-        local_path = os.path.join(project.data_folder, self.component, f'{self.component}_downloaded.tif')
         download_raster(
             src_dataset_path=self.source,
             src_band=1,
-            dst_dataset_path=local_path,
+            dst_dataset_path=self.local_path,
             polygons_dataset_path=project.geopackage_file_path,
             polygons_layer_name=project.polygons_layer_name,
+            target_srs=project.target_srs,
             progress=progress
 
         )
 
-        with gdal.config_options({
-            'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES':'YES',
-            'GDAL_CACHEMAX':'512',
-            'GDAL_NUMTHREADS':'4'
-        }):
-            geo.import_raster(
-                source=local_path, dst=self.local_path, target_srs=project.target_srs,
-                crop_ds=project.geopackage_file_path, crop_layer_name=project.polygons_layer_name,
-                return_handle=False,
-                ## warpOptions come now
-                warpMemoryLimit=1024,
-
-            )
-        if os.path.exists(local_path):
-            os.remove(local_path)
-        self._compute_affected_()
-
 
     def compute(self, force=True, **kwargs):
         assert force, f'invalid force={force}'
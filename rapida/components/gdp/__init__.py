@@ -5,17 +5,17 @@ import math
 import shutil
 from typing import List
 from rich.progress import Progress
-import geopandas as gpd
-from osgeo import gdal, ogr
+from osgeo import ogr
 from osgeo_utils.gdal_calc import Calc
-from rapida import constants
 from rapida.constants import GTIFF_CREATION_OPTIONS
+from rapida.az.storage import gdal_blob_path
 from rapida.core.component import Component
 from rapida.core.variable import Variable
 from rapida.project.project import Project
 from rapida.session import Session
-from rapida.stats.raster_zonal_stats import zst
-from rapida.util import geo
+from rapida.stats.coverage_index import CoverageIndex
+from rapida.stats.raster_zonal_stats import zonal_table
+from rapida.stats.store import StatsStore
 from rapida.util.download_geodata import download_raster
 logger = logging.getLogger(__name__)
 
@@ -53,28 +53,27 @@ class GdpComponent(Component):
                 if layer_index is not None:
                     ds.DeleteLayer(dst_layer)
 
-            for var_name in variables:
-                var_data = variables_data[var_name]
-                sources = self.interpolate_data_url(var_data['source'], target_year=target_year)
-
-                # create instance
-                v = GdpVariable(name=var_name,
-                                component=self.component_name,
-                                sources=sources,
-                                target_year=target_year,
-                                **var_data)
-                # assess
-                v(**kwargs)
+            with StatsStore(dataset_path=geopackage_path, layer_name=dst_layer) as stats_store:
+                for var_name in variables:
+                    var_data = variables_data[var_name]
+                    sources = self.interpolate_data_url(var_data['source'], target_year=target_year)
+
+                    # create instance
+                    v = GdpVariable(name=var_name,
+                                    component=self.component_name,
+                                    sources=sources,
+                                    target_year=target_year,
+                                    **var_data)
+                    # assess
+                    v(stats_store=stats_store, **kwargs)
 
     def interpolate_data_url(self, source: str, target_year: int):
         """
         Interpolate data from source to target year.
         """
-        with Session() as session:
-            hostname = session.get_blob_service_account_url()
-            parts = source.split(":", 2)
-            pathname = parts[2]
-            source = f"{hostname}/{pathname}"
+        parts = source.split(":", 2)
+        pathname = parts[2]
+        source = gdal_blob_path(blob_path=pathname)
 
         if 2000 <= target_year <= 2020:
             return [source.replace("{year}", str(target_year))]
@@ -113,12 +112,6 @@ class GdpVariable(Variable):
     def affected_percentage_variable(self) -> str:
         return f"{self.affected_variable}_percentage"
 
-    @property
-    def affected_path(self):
-        path, file_name = os.path.split(self.local_path)
-        fname, ext = os.path.splitext(file_name)
-        return os.path.join(path, f'{fname}_affected{ext}')
-
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -164,8 +157,6 @@ class GdpVariable(Variable):
                 description=f'[red] Downloading {self.name}', total=None)
 
         if force == False and os.path.exists(self.local_path):
-            if not os.path.exists(self.affected_path):
-                self._compute_affected_()
             if progress is not None and download_task is not None:
                 progress.update(download_task, description=f'[red] File: {self.local_path} exists. Downloading was skipped')
                 progress.remove_task(download_task)
@@ -179,36 +170,21 @@ class GdpVariable(Variable):
             src_path = source
             hostname, pathname = src_path.split('/gdp/', 1)
             local_path = os.path.join(project.data_folder, self.component, pathname)
-            tmp_local_path = f"{local_path}.tmp"
-            source_folder = os.path.dirname(tmp_local_path)
+            source_folder = os.path.dirname(local_path)
             if not os.path.exists(source_folder):
                 os.makedirs(source_folder)
-            logger.debug(f'Going to download {src_path} to {tmp_local_path}')
+            logger.debug(f'Going to download {src_path} to {local_path}')
 
             download_raster(
                 src_dataset_path=src_path,
                 src_band=1,
-                dst_dataset_path=tmp_local_path,
+                dst_dataset_path=local_path,
                 polygons_dataset_path=project.geopackage_file_path,
                 polygons_layer_name=project.polygons_layer_name,
+                target_srs=project.target_srs,
                 progress=progress
             )
 
-            with gdal.config_options({
-                'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
-                'GDAL_CACHEMAX': '512',
-                'GDAL_NUMTHREADS': '4'
-            }):
-                geo.import_raster(
-                    source=tmp_local_path, dst=local_path, target_srs=project.target_srs,
-                    crop_ds=project.geopackage_file_path, crop_layer_name=project.polygons_layer_name,
-                    return_handle=False,
-                    ## warpOptions come now
-                    warpMemoryLimit=1024,
-                )
-            if os.path.exists(tmp_local_path):
-                os.remove(tmp_local_path)
-
             local_sources.append(local_path)
 
             if progress is not None and download_task is not None:
@@ -230,33 +206,6 @@ class GdpVariable(Variable):
         if progress and download_task:
             progress.remove_task(download_task)
 
-        self._compute_affected_(**kwargs)
-
-    def _compute_affected_(self, **kwargs):
-        if geo.is_raster(self.local_path):
-            project = Project(os.getcwd())
-            if project.raster_mask:
-                progress: Progress = kwargs.get('progress', Progress())
-
-                affect_task = None
-                if progress is not None:
-                    affect_task = progress.add_task(
-                        description=f'[red] masking downloaded data by affected area', total=None)
-
-
-                affected_local_path = self.affected_path
-                ds = Calc(calc='local_path*mask', outfile=affected_local_path, projectionCheck=True, format='GTiff',
-                          creation_options=GTIFF_CREATION_OPTIONS, quiet=False, overwrite=True,
-                          NoDataValue=None,
-                          local_path=self.local_path, mask=project.raster_mask)
-                ds = None
-                assert os.path.exists(self.affected_path), f'Failed to compute {self.affected_path}'
-
-                if progress is not None and affect_task is not None:
-                    progress.update(affect_task, description=f'[red] computed masked data for affected area')
-                    progress.remove_task(affect_task)
-                return affected_local_path
-
     def interpolate_target_year(self, local_sources: List[str]):
         target_year = self.target_year
 
@@ -309,12 +258,8 @@ class GdpVariable(Variable):
 
         dst_layer = f'stats.{self.component}'
         project = Project(path=os.getcwd())
-        layers = gpd.list_layers(project.geopackage_file_path)
-        lnames = layers.name.tolist()
-        if dst_layer in lnames:
-            polygons_layer = dst_layer
-        else:
-            polygons_layer = constants.POLYGONS_LAYER_NAME
+        store = kwargs.get('stats_store', None) or StatsStore(dataset_path=project.geopackage_file_path,
+                                                              layer_name=dst_layer)
 
         if self.operator:
             assert os.path.exists(self.local_path), f'{self.local_path} does not exist'
@@ -322,31 +267,30 @@ class GdpVariable(Variable):
             if progress is not None and evaluate_task is not None:
                 progress.update(evaluate_task, description=f'[red] Evaluating variable {self.variable_name} using zonal stats')
 
-            # raster variable, run zonal stats
-            src_rasters = [self.local_path]
-            var_ops = [(self.variable_name, self.operator)]
-
-            if project.raster_mask is not None:
-                affected_local_path = self.affected_path
-                src_rasters.append(affected_local_path)
-                var_ops.append((self.affected_variable, self.operator))
-
-            gdf = zst(src_rasters=src_rasters,
-                      polygon_ds=project.geopackage_file_path,
-                      polygon_layer=polygons_layer, vars_ops=var_ops
-                      )
+            # raster variable, run zonal stats. The affected version is computed from the mask in the same pass
+            coverage_index = CoverageIndex.for_project(project=project, template_raster=self.local_path,
+                                                       progress=progress)
+            df = zonal_table(src_rasters=[self.local_path],
+                             polygon_ds=project.geopackage_file_path,
+                             polygon_layer=project.polygons_layer_name, vars_ops=[(self.variable_name, self.operator)],
+                             coverage_index=coverage_index, mask=project.raster_mask,
+                             workers=kwargs.get('workers')
+                             )
+            if kwargs.get('export_affected', False):
+                self.export_affected(progress=progress)
 
             if project.raster_mask:
                 percentage = self.percentage
                 if percentage:
-                    gdf.eval(f"{self.affected_percentage_variable}={self.affected_variable}/{self.variable_name}*100",
-                                   inplace=True)
+                    df.eval(f"{self.affected_percentage_variable}={self.affected_variable}/{self.variable_name}*100",
+                            inplace=True)
 
             if progress is not None and evaluate_task is not None:
                 progress.update(evaluate_task,
                                 description=f'[red] Writing {self.variable_name} to {project.geopackage_file_path}:{dst_layer}')
 
-            gdf.to_file(project.geopackage_file_path, layer=dst_layer, driver="GPKG", overwrite=True)
+            with store:
+                store.update(df)
         else:
             progress.update(evaluate_task,
                             description=f'[red] {self.variable_name} was skipped because of lack of operator definition.')
@@ -3,20 +3,17 @@ import logging
 import os
 from typing import List
 
-from osgeo import gdal
 from osgeo_utils.gdal_calc import Calc
 from rich.progress import Progress
-import geopandas as gpd
 
 from rapida.components.landuse.download import download_stac
 from rapida.components.landuse.constants import STAC_MAP
-from rapida.constants import GTIFF_CREATION_OPTIONS, POLYGONS_LAYER_NAME
 from rapida.core.component import Component
 from rapida.core.variable import Variable
 from rapida.project.project import Project
 from rapida.session import Session
-from rapida.stats.raster_zonal_stats import zst
-from rapida.util import geo
+from rapida.stats.raster_zonal_stats import zonal_table
+from rapida.stats.store import StatsStore
 
 
 logger = logging.getLogger('rapida')
@@ -32,7 +29,9 @@ class LanduseComponent(Component):
                     logger.error(f'variable "{var_name}" is invalid. Valid options are "{", ".join(self.variables)}"')
                     return
 
-        with Session() as session:
+        project = Project(path=os.getcwd())
+        stats_store = StatsStore(dataset_path=project.geopackage_file_path, layer_name=f'stats.{self.component_name}')
+        with Session() as session, stats_store:
             variable_data = session.get_component(self.component_name)
 
             for var_name in variables:
@@ -45,7 +44,7 @@ class LanduseComponent(Component):
                     cloud_cover=cloud_cover,
                     **var_data
                 )
-                v(**kwargs)
+                v(stats_store=stats_store, **kwargs)
 
 
 
@@ -69,13 +68,6 @@ class LanduseVariable(Variable):
         collection = self._interpolate_stac_source(self.source)['collection']
         return collection
 
-    @property
-    def affected_path(self):
-        path, file_name = os.path.split(self.local_path)
-        fname, ext = os.path.splitext(file_name)
-        return os.path.join(path, f'{fname}_affected{ext}')
-
-
     @property
     def target_band_value(self)->int:
         """
@@ -144,73 +136,6 @@ class LanduseVariable(Variable):
                           progress=progress))
 
 
-    def _compute_affected_(self, **kwargs):
-        if geo.is_raster(self.local_path):
-            project = Project(os.getcwd())
-            if project.raster_mask:
-
-                affected_local_path = self.affected_path
-                # create a temporary mask with resolution 10 by 10
-
-                # get resolution from local_path
-                with gdal.Open(self.local_path, gdal.GA_ReadOnly) as ds:
-
-                    if ds is not None:
-                        geotransform = ds.GetGeoTransform()
-                        x_res = geotransform[1]
-                        y_res = abs(geotransform[5])
-
-
-                    vrt_path = '/vsimem/warped_project_mask.vrt'
-
-                    options = gdal.BuildVRTOptions(
-                        outputBounds=(geotransform[0], geotransform[3] + ds.RasterYSize * geotransform[5],
-                                      geotransform[0] + ds.RasterXSize * geotransform[1], geotransform[3]),
-                        xRes=x_res,
-                        yRes=y_res,
-
-                    )
-                    with gdal.BuildVRT(vrt_path, [project.raster_mask], options=options) as vrt:
-                        warp_options = dict(
-                            format='GTiff',
-                            xRes=x_res,
-                            yRes=y_res,
-                            creationOptions=GTIFF_CREATION_OPTIONS,
-                            outputBounds=(geotransform[0], geotransform[3] + ds.RasterYSize * geotransform[5],
-                                          geotransform[0] + ds.RasterXSize * geotransform[1], geotransform[3]),
-                        )
-
-
-                        warped_project_mask = project.raster_mask.replace('mask.tif', 'warped_mask.tif')
-                        temp_mask_ds = gdal.Warp(
-                            destNameOrDestDS=warped_project_mask,
-                            srcDSOrSrcDSTab=project.raster_mask,
-                            options=gdal.WarpOptions(**warp_options),
-                            outputType=gdal.GDT_Byte,
-                            outputSRS=project.target_srs,
-                            targetAlignedPixels=True,
-                            multiThread=True,
-                        )
-                        temp_mask_ds = None
-
-
-                    calc_ds = Calc(calc='A*B',
-                              outfile=affected_local_path,
-                              projectionCheck=True,
-                              format='GTiff',
-                              creation_options=GTIFF_CREATION_OPTIONS,
-                              quiet=False,
-                              A=self.local_path,
-                              B=warped_project_mask,
-                              overwrite=True,
-                              NoDataValue=None,
-                            )
-                    calc_ds = None
-                assert os.path.exists(self.affected_path), f'Failed to compute {self.affected_path}'
-
-                return affected_local_path
-
-
     def compute(self, **kwargs):
         progress = kwargs.get('progress', None)
         variable_task = None
@@ -250,9 +175,6 @@ class LanduseVariable(Variable):
 
         ds = None
 
-        # Then, compute affected area for land use
-        self._compute_affected_(**kwargs)
-
         if variable_task is not None:
             progress.remove_task(variable_task)
 
@@ -265,31 +187,23 @@ class LanduseVariable(Variable):
         dst_layer = f'stats.{self.component}'
 
         project = Project(path=os.getcwd())
-        layers = gpd.list_layers(project.geopackage_file_path)
-        lnames = layers.name.tolist()
-        if dst_layer in lnames:
-            polygons_layer = dst_layer
-        else:
-            polygons_layer = POLYGONS_LAYER_NAME
+        store = kwargs.get('stats_store', None) or StatsStore(dataset_path=project.geopackage_file_path,
+                                                              layer_name=dst_layer)
         if self.operator:
             assert os.path.exists(self.local_path), f'{self.local_path} does not exist'
 
             if progress is not None and evaluate_task is not None:
                 progress.update(evaluate_task, description=f'[red] Evaluating variable {self.name} using zonal stats')
 
-            # raster variable, run zonal stats
-            src_rasters = [self.local_path]
-            var_ops = [(self.name, self.operator)]
-
-            if project.raster_mask is not None:
-                affected_local_path = self.affected_path
-                src_rasters.append(affected_local_path)
-                var_ops.append((f'{self.name}_affected', self.operator))
-
-            gdf = zst(src_rasters=src_rasters,
-                      polygon_ds=project.geopackage_file_path,
-                      polygon_layer=polygons_layer, vars_ops=var_ops
-                      )
+            # raster variable, run zonal stats. The affected version is computed from the mask
+            # (warped on the fly to the 10m grid) in the same pass
+            df = zonal_table(src_rasters=[self.local_path],
+                             polygon_ds=project.geopackage_file_path,
+                             polygon_layer=project.polygons_layer_name, vars_ops=[(self.name, self.operator)],
+                             mask=project.raster_mask, workers=kwargs.get('workers')
+                             )
+            if kwargs.get('export_affected', False):
+                self.export_affected(progress=progress)
 
             if progress is not None and evaluate_task is not None:
                 progress.update(evaluate_task, description=f'[red] Evaluated variable {self.name} using zonal stats')
@@ -298,14 +212,15 @@ class LanduseVariable(Variable):
                 progress.update(evaluate_task,
                                 description=f'[red] Writing {self.name} to {project.geopackage_file_path}:{dst_layer}')
 
-            if project.raster_mask and os.path.exists(self.affected_path) and self.percentage:
+            if project.raster_mask and self.percentage:
                 affected_var_name = f'{self.name}_affected'
                 affected_var_percentage_name = f'{affected_var_name}_percentage'
-                gdf[affected_var_name] = gdf[affected_var_name].fillna(0)
-                gdf[affected_var_percentage_name] = gdf[affected_var_name] / gdf[self.name] * 100
-                gdf[affected_var_percentage_name] = gdf[affected_var_percentage_name].fillna(0)
+                df[affected_var_name] = df[affected_var_name].fillna(0)
+                df[affected_var_percentage_name] = df[affected_var_name] / df[self.name] * 100
+                df[affected_var_percentage_name] = df[affected_var_percentage_name].fillna(0)
 
-            gdf.to_file(project.geopackage_file_path, layer=dst_layer, driver="GPKG", overwrite=True)
+            with store:
+                store.update(df)
         else:
             progress.update(evaluate_task,
                             description=f'[red] {self.name} was skipped because of lack of operator definition.')
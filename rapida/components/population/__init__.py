@@ -1,32 +1,34 @@
 import asyncio
-import io
+import functools
 import os
 from typing import List
 import logging
 import pycountry
 import rasterio
-from pyogrio import write_dataframe
 from pyproj import Transformer
 from rasterio.windows import from_bounds
 
-from rapida.constants import POLYGONS_LAYER_NAME,GTIFF_CREATION_OPTIONS
+from rapida.constants import POLYGONS_LAYER_NAME
 from rapida.util import geo
 from rapida.core.component import Component
 from rapida.project.project import Project
 from rapida.session import Session
+from rapida.core.expression import ExpressionGraph
+from rapida.core.planner import Planner
 from rapida.core.variable import Variable
-from osgeo_utils.gdal_calc import Calc
 from osgeo import gdal
 import click
 from rapida.components.population.worldpop import population_sync, process_aggregates, run_download
-from rapida.stats.raster_zonal_stats import sumup, zst
-import geopandas
-from rapida.components.population.pop_coefficient import get_pop_coeff
+from rapida.stats.coverage_index import CoverageIndex
+from rapida.stats.raster_zonal_stats import sumup, zonal_table
+from rapida.stats.store import StatsStore
+from rapida.components.population.pop_coefficient import get_pop_coeffs
 from rapida.az import blobstorage
 from urllib.parse import urlencode
 import re
 
 from rapida.util.geo import gdal_callback
+from rapida.util.raster_calc import calc_many
 
 COUNTRY_CODES = set([c.alpha_3 for c in pycountry.countries])
 logger = logging.getLogger('rapida')
@@ -158,26 +160,75 @@ class PopulationComponent(Component):
                     logger.error(f'variable "{var_name}" is invalid. Valid options are "{", ".join(self.variables)}"')
                     return
 
-        #progress = kwargs.get('progress', None)
-        kwargs['computed'] = set([])
+        progress = kwargs.get('progress', None)
         project = Project(path=os.getcwd())
         logger.debug(f'Assessing component "{self.component_name}" in  {", ".join(project.countries)}')
-        with Session() as ses:
-            variables_data = ses.get_component(self.component_name)
-            for var_name in variables:
-                var_data = variables_data[var_name]
-                #create instance
-                v = PopulationVariable(
-                    name=var_name,
-                    component=self.component_name,
-                    **var_data
-                )
+        stats_store = StatsStore(dataset_path=project.geopackage_file_path, layer_name=f'stats.{self.component_name}')
+        with stats_store:
+            planner = self.plan(variables=variables, year=self.base_year, stats_store=stats_store, **kwargs)
+            task = None
+            if progress is not None:
+                task = progress.add_task(description=f'[blue]Assessing {self.component_name}', total=len(planner))
+            planner.run(progress=progress, task=task)
+            if progress is not None:
+                progress.remove_task(task)
+
+    def plan(self, variables: List[str] = None, **kwargs) -> Planner:
+        """
+        Build the DAG of the stages required to assess the variables.
 
-                #assess
-                v(year=self.base_year,**kwargs)
-                kwargs['computed'] |= set([var_name] + (v.dep_vars or []))
+        Raster variables are prepared (downloaded or computed) and then evaluated (zonal stats). Variables
+        defined as an expression of other variables without an operator are evaluated from the stats of their
+        dependencies so they depend on the evaluation of their dependencies. When force is True, the derived
+        raster variables are computed together in one fused pass over the leaf rasters they depend on.
+        Every stage of every variable is added once, no matter how many variables depend on it.
 
+        :param variables: list of variable names
+        :param kwargs: the assessment kwargs
+        :return: Planner
+        """
+        force = kwargs.get('force', False)
+        with Session() as ses:
+            variables_data = ses.get_component(self.component_name)
+        graph = ExpressionGraph.from_component(variables_data)
+        planner = Planner()
+        instances = dict()
+        fused = list()
+        fused_key = ('*', 'compute')
+
+        def instance(name):
+            if name not in instances:
+                instances[name] = PopulationVariable(name=name, component=self.component_name, **variables_data[name])
+            return instances[name]
+
+        def compute_fused():
+            sources = {leaf: instances[leaf].local_path for leaf in graph.leaves(names=fused)}
+            PopulationVariable.compute_many(variables=[instances[n] for n in fused], sources=sources, **kwargs)
+
+        def require(name, stage):
+            v = instance(name)
+            if stage == 'prepare':
+                if force and v.operator and v.dep_vars:
+                    leaves = graph.leaves(names=[name])
+                    if name not in fused:
+                        fused.append(name)
+                    planner.add(key=fused_key, func=compute_fused, deps=[require(leaf, 'prepare') for leaf in leaves])
+                    return fused_key
+                key = (name, stage)
+                planner.add(key=key, func=functools.partial(v.prepare, **kwargs))
+                return key
+            key = (name, stage)
+            if key not in planner:
+                if v.operator or not v.dep_vars:
+                    deps = [require(name, 'prepare')]
+                else:
+                    deps = [require(dep, 'evaluate') for dep in graph.dependencies(name)]
+                planner.add(key=key, func=functools.partial(v.evaluate, **kwargs), deps=deps)
+            return key
 
+        for var_name in variables:
+            require(var_name, 'evaluate')
+        return planner
 
 
 class PopulationVariable(Variable):
@@ -202,33 +253,14 @@ class PopulationVariable(Variable):
             variable_task = progress.add_task(
                 description=f'[blue]Assessing {self.component}->{self.name}', total=None)
 
-        if not self.dep_vars:  # simple variable,
-            if not force:
-                # logger.debug(f'Downloading {self.name} source')
-                self.download(**kwargs)
-                if progress is not None and variable_task is not None:
-                    progress.update(variable_task, description=f'[blue]Downloaded {self.component}->{self.name}')
-            else:
-                # logger.debug(f'Computing {self.name} using gdal_calc from sources')
-                self.compute(**kwargs)
-                if progress is not None and variable_task is not None:
-                    progress.update(variable_task, description=f'[blue]Computed {self.component}->{self.name}', )
-
+        if self.operator or not self.dep_vars:  # raster variable
+            self.prepare(**kwargs)
+            if progress is not None and variable_task is not None:
+                action = 'Computed' if force else 'Downloaded'
+                progress.update(variable_task, description=f'[blue]{action} {self.component}->{self.name}')
         else:
-            if self.operator:
-                if not force:
-                    # logger.debug(f'Downloading {self.name} from  source')
-                    self.download(**kwargs)
-                    if progress is not None and variable_task is not None:
-                        progress.update(variable_task, description=f'[blue]Downloaded {self.component}->{self.name}')
-                else:
-                    # logger.info(f'Computing {self.name}={self.sources} using GDAL')
-                    self.compute(**kwargs)
-                    if progress is not None and variable_task is not None:
-                        progress.update(variable_task, description=f'[blue]Computed {self.component}->{self.name}')
-            else:
-                logger.debug(f'Resolving {self.name}={self.sources}')
-                sources = self.resolve(**kwargs)
+            logger.debug(f'Resolving {self.name}={self.sources}')
+            self.resolve(**kwargs)
 
         self.evaluate(**kwargs)
 
@@ -282,87 +314,113 @@ class PopulationVariable(Variable):
 
 
         else:
-            logger.debug(f'Going to compute {self.name}={self.sources}')
-            if not os.path.exists(self._source_folder_):
-                os.makedirs(self._source_folder_)
-            sources = self.resolve( **kwargs)
-            ds = Calc(calc=self.sources, outfile=var_path,  projectionCheck=True, format='GTiff',
-                      creation_options=GTIFF_CREATION_OPTIONS, quiet=True, overwrite=True,  **sources)
-            ds = None
-            assert os.path.exists(var_path), f'The computed file: {var_path} does not exists'
+            self.compute_many(variables=[self], **kwargs)
+            return
 
-
-        # import and compute affected version
+        # import
         imported_file_path = self.import_raster(source=var_path)
         assert imported_file_path == var_path, f'var_path differs from {imported_file_path}'
         self.local_path = var_path
-        self._compute_affected_()
 
-    def resolve(self,  **kwargs):
-        already_done = kwargs.get('computed', None)
-        force_compute = kwargs.get('force', False)
+    def prepare(self, **kwargs):
+        """
+        Materialize the raster of the variable by downloading or, if force is True, computing it.
+
+        :return: str, the local path of the raster
+        """
+        if kwargs.get('force', False):
+            self.compute(**kwargs)
+        else:
+            self.download(**kwargs)
+        return self.local_path
+
+    @classmethod
+    def compute_many(cls, variables: List['PopulationVariable'] = None, sources: dict = None, **kwargs):
+        """
+        Compute derived raster variables (whose sources are an expression of other variables) in one fused
+        pass. The expressions are expanded down to the leaf variables, the leaf rasters are materialized
+        and every block of the leaf rasters is read once to compute all variables. The intermediate variables
+        stay in memory and only the rasters of the variables in the list are written.
+
+        :param variables: list of PopulationVariable instances from the same component
+        :param sources: optional dict of leaf variable name: local path of the already materialized leaf rasters.
+        The missing leaf rasters are materialized here
+        :param kwargs: the assessment kwargs
+        """
+        progress = kwargs.get('progress', None)
+        component = variables[0].component
         with Session() as s:
-            sources = dict()
-            for var_name in self.dep_vars:
-                var_dict = s.get_variable(component=self.component, variable=var_name)
-                var = self.__class__(name=var_name, component=self.component, **var_dict)
-                if already_done and var_name in already_done and force_compute:
-                    logger.debug(f'Skipping {var_name} because it was already computed') # this will skip download by removing  force arg
-                    force = kwargs.pop('force')
-                var_local_path = var(**kwargs) # assess
-                if already_done and var_name in already_done and force_compute:
-                    kwargs['force'] = force
-                sources[var_name] = var_local_path or var.local_path
-            return sources
+            component_data = s.get_component(component)
+        graph = ExpressionGraph.from_component(component_data)
+
+        sources = dict(sources or {})
+        for leaf_name in graph.leaves(names=[v.name for v in variables]):
+            if not sources.get(leaf_name):
+                leaf = cls(name=leaf_name, component=component, **component_data[leaf_name])
+                sources[leaf_name] = leaf.prepare(**kwargs)
+            assert sources[leaf_name] and os.path.exists(sources[leaf_name]), f'Failed to materialize {leaf_name}'
+
+        expressions = dict()
+        for var in variables:
+            os.makedirs(var._source_folder_, exist_ok=True)
+            var_path = os.path.join(var._source_folder_, f'{var.name}.tif')
+            expressions[var_path] = graph.expand(var.name)
+            logger.debug(f'Going to compute {var.name}={expressions[var_path]}')
+        # the leaf rasters were already imported into the project grid so the outputs are aligned as well
+        calc_many(expressions=expressions, sources=sources, progress=progress)
+
+        for var, var_path in zip(variables, expressions):
+            assert os.path.exists(var_path), f'The computed file: {var_path} does not exists'
+            var.local_path = var_path
 
+    def resolve(self,  **kwargs):
+        """
+        Assess the dependencies of the variable. Shared dependencies are assessed once
+        """
+        PopulationComponent().plan(variables=self.dep_vars, **kwargs).run()
 
     def evaluate(self, **kwargs):
 
         dst_layer = f'stats.{self.component}'
         progress = kwargs.get('progress', None)
-        with Session() as s:
-            project = Project(path=os.getcwd())
-            layers = geopandas.list_layers(project.geopackage_file_path)
-            lnames = layers.name.tolist()
-            if dst_layer in lnames:
-                polygons_layer = dst_layer
-            else:
-                polygons_layer='polygons'
+        project = Project(path=os.getcwd())
+        store = kwargs.get('stats_store', None) or StatsStore(dataset_path=project.geopackage_file_path,
+                                                              layer_name=dst_layer)
+        with store:
             if self.operator:
                 assert os.path.exists(self.local_path), f'{self.local_path} does not exist'
                 logger.debug(f'Evaluating variable {self.name} using zonal stats')
 
-                # raster variable, run zonal stats
-                src_rasters = [self.local_path]
-                var_ops = [(self.name, self.operator)]
-                if project.raster_mask is not None:
-                    path, file_name = os.path.split(self.local_path)
-                    fname, ext = os.path.splitext(file_name)
-                    affected_local_path = os.path.join(path, f'{fname}_affected{ext}')
-
-                    src_rasters.append(affected_local_path)
-                    var_ops.append((f'{self.name}_affected', self.operator))
-
-                gdf = zst(src_rasters=src_rasters,
-                                  polygon_ds=project.geopackage_file_path,
-                                  polygon_layer=polygons_layer, vars_ops=var_ops, progress=progress
-                                  )
+                # raster variable, run zonal stats. The affected version is computed from the mask in the same pass
+                coverage_index = CoverageIndex.for_project(project=project, template_raster=self.local_path,
+                                                           progress=progress)
+                df = zonal_table(src_rasters=[self.local_path],
+                                 polygon_ds=project.geopackage_file_path,
+                                 polygon_layer=project.polygons_layer_name, vars_ops=[(self.name, self.operator)],
+                                 coverage_index=coverage_index, mask=project.raster_mask,
+                                 workers=kwargs.get('workers'), progress=progress
+                                 )
+                if kwargs.get('export_affected', False):
+                    self.export_affected(progress=progress)
                 assert 'year' in kwargs, f'Need year kword to compute pop coeff'
                 assert 'target_year' in kwargs, f'Need target_year kword to compute pop coeff'
                 year = kwargs.get('year')
                 target_year = kwargs.get('target_year')
-                countries = set(gdf['iso3'])
-                for country in countries:
-                    coeff = get_pop_coeff(base_year=year, target_year=target_year, country_code=country)
-                    gdf.loc[gdf['iso3'] == country, self.name] *= coeff
-                    if project.raster_mask is not None:
-                        gdf.loc[gdf['iso3'] == country, f'{self.name}_affected'] *= coeff
+                iso3 = store.read(columns=['iso3'])['iso3'].reindex(df.index)
+                coeffs = get_pop_coeffs(base_year=year, target_year=target_year, country_codes=set(iso3.dropna()))
+                factor = iso3.map(coeffs).fillna(1.)
+                df[self.name] *= factor
+                if project.raster_mask is not None:
+                    df[f'{self.name}_affected'] *= factor
             else:
-                # we eval inside GeoDataFrame
-                logger.debug(f'Evaluating variable {self.name} using GeoPandas eval')
-                gdf = geopandas.read_file(filename=project.geopackage_file_path,layer=dst_layer)
+                # we eval inside a DataFrame holding the dependencies
+                logger.debug(f'Evaluating variable {self.name} using pandas eval')
+                columns = list(self.dep_vars)
+                if project.raster_mask is not None:
+                    columns += [f'{vname}_affected' for vname in self.dep_vars]
+                df = store.read(columns=columns)
                 expr = f'{self.name}={self.sources}'
-                gdf.eval(expr, inplace=True)
+                df.eval(expr, inplace=True)
                 # affected
                 if project.raster_mask is not None:
                     affected_sources = ''
@@ -371,27 +429,11 @@ class PopulationVariable(Variable):
                         affected_sources = v.replace(vname, f'{vname}_affected')
 
                     expr = f'{self.name}_affected={affected_sources}'
-                    gdf.eval(expr, inplace=True)
-
-
+                    df.eval(expr, inplace=True)
+                df = df.drop(columns=columns)
 
-            # merge into stats layer for component
-            # Here we rely on OGR append flag. With GPKG format and because zonal_stats
-            logger.debug(f'Writing columns "{", ".join(gdf.columns.tolist())}" to {project.geopackage_file_path}:{dst_layer}' )
-
-            with io.BytesIO() as bio:
-
-                fpath = f'/vsimem/{dst_layer}.fgb'
-                write_dataframe(df=gdf,path=bio, layer=dst_layer, driver='FlatGeobuf')
-                gdal.FileFromMemBuffer(fpath, bio.getbuffer())
-                bio.seek(0)
-                with gdal.OpenEx(fpath) as src:
-                    options = gdal.VectorTranslateOptions(format='GPKG', accessMode='overwrite', layerName=dst_layer,
-                                                           makeValid=True)
-                    ds = gdal.VectorTranslate(destNameOrDestDS=project.geopackage_file_path,
-                                              srcDS=src,options=options)
-
-                gdal.Unlink(fpath)
+            # add/replace the columns in the stats layer for component
+            store.update(df)
 
     def download(self, **kwargs):
         logger.debug(f'Downloading {self.name}')
@@ -400,8 +442,6 @@ class PopulationVariable(Variable):
         self.local_path = os.path.join(self._source_folder_, f'{self.name}.tif')
 
         if os.path.exists(self.local_path):
-            if project.raster_mask is not None:
-                assert os.path.exists(self.affected_path), f'{self.affected_path} does not exist'
             return self.local_path
 
         sources = []
@@ -453,7 +493,6 @@ class PopulationVariable(Variable):
         ds = None
         imported_file_path = self.import_raster(source=self.local_path, progress=progress)
         assert imported_file_path == self.local_path, f'The local_path differs from {imported_file_path}'
-        self._compute_affected_(progress=progress)
 
 
     def import_raster(self, source=None, **kwargs):
@@ -475,28 +514,6 @@ class PopulationVariable(Variable):
         os.rename(imported_local_path, source)
         return source
 
-    def _compute_affected_(self, progress=None):
-
-
-
-        project = Project(os.getcwd())
-        if geo.is_raster(self.local_path) and project.raster_mask is not None:
-            task = progress.add_task(description="Computing affected version using GDAL calc")
-
-            def progress_callback(complete, message, data, progress=progress, task=task):
-                if progress is not None and task is not None:
-                    progress.update(task, completed=int(complete * 100))
-
-            affected_local_path = self.affected_path
-
-            ds = Calc(calc='local_path*mask', outfile=affected_local_path, projectionCheck=True, format='GTiff',
-                      creation_options=GTIFF_CREATION_OPTIONS, quiet=False, overwrite=True,
-                      NoDataValue=None,
-                      local_path=self.local_path, mask=project.raster_mask, progress_callback=progress_callback)
-            ds = None
-            progress.remove_task(task)
-            return affected_local_path
-
     def interpolate_template(self, template=None, **kwargs):
         """
         Interpolate values from kwargs into template
@@ -512,12 +529,6 @@ class PopulationVariable(Variable):
             return template.format(**kwargs)
         else:
             return template
-    @property
-    def affected_path(self):
-        path, file_name = os.path.split(self.local_path)
-        fname, ext = os.path.splitext(file_name)
-        return os.path.join(path, f'{fname}_affected{ext}')
-
     def alter(self, **kwargs):
         return f'vrt://{self.local_path}?{urlencode(kwargs)}'
 
@@ -1,3 +1,11 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, Iterable
+
 import requests
 import logging
 import numpy as np
@@ -5,16 +13,23 @@ import pycountry
 
 
 COUNTRY_CODES = set([c.alpha_3 for c in pycountry.countries])
-
+# fitted population series are cached on disk for 30 days
+POP_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.rapida', 'worldbank_population.json')
+POP_CACHE_TTL = 30 * 24 * 3600
+# optional snapshot of the World Bank population series shipped with the package and used when offline
+POP_SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), 'worldbank_population.json')
 
 logger = logging.getLogger(__name__)
+_cache_lock_ = threading.Lock()
+# one lock per country, the threads missing the same country at the same time fetch it only once
+_country_locks_ = defaultdict(threading.Lock)
 
 
 def fetch_population(country_code=None):
 
     """Fetch population data from World Bank API for a given country and year range."""
     url = f"https://api.worldbank.org/v2/country/{country_code}/indicator/SP.POP.TOTL?format=json"
-    response = requests.get(url)
+    response = requests.get(url, timeout=30)
 
     if response.status_code != 200:
         raise Exception(f"Failed to fetch data: {response.status_code}")
@@ -35,11 +50,89 @@ def fetch_population(country_code=None):
     return population_data
 
 
+def _read_json_(path=None) -> dict:
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_cache_entry_(country_code=None, entry=None, path=POP_CACHE_PATH):
+    with _cache_lock_:
+        cache = _read_json_(path)
+        cache[country_code] = entry
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, path)
+
+
+def _make_entry_(population_data: dict = None) -> dict:
+    years = sorted(population_data)
+    pops = [population_data[y] for y in years]
+    return dict(fetched=time.time(), series={str(y): p for y, p in zip(years, pops)},
+                growth_rate=float(estimate_growth_rate(years, pops)))
+
+
+@lru_cache(maxsize=None)
+def population_series(country_code: str = None):
+    """
+    Get the population series of a country and its fitted annual growth rate.
+
+    The series is fetched once per country from the World Bank API and cached in memory and on disk
+    (POP_CACHE_PATH) for POP_CACHE_TTL seconds. If the API can not be reached an expired cache entry or the
+    bundled snapshot (POP_SNAPSHOT_PATH) is used instead.
+
+    :param country_code: str, ISO3 country code
+    :return: tuple(dict year: population sorted by year, float growth rate)
+    """
+    assert country_code in COUNTRY_CODES, f'Invalid country_code={country_code}'
+    with _cache_lock_:
+        country_lock = _country_locks_[country_code]
+    with country_lock:
+        # read after the lock is acquired so a thread that waited finds the entry written by the other one
+        entry = _read_json_(POP_CACHE_PATH).get(country_code)
+        if entry is None or time.time() - entry['fetched'] > POP_CACHE_TTL:
+            try:
+                entry = _make_entry_(fetch_population(country_code=country_code))
+                _write_cache_entry_(country_code=country_code, entry=entry, path=POP_CACHE_PATH)
+            except Exception as e:
+                fallback = entry or _read_json_(POP_SNAPSHOT_PATH).get(country_code)
+                if fallback is None:
+                    raise
+                logger.warning(f'Failed to fetch population for {country_code} ({e}). Using cached data from '
+                               f'{time.strftime("%Y-%m-%d", time.localtime(fallback["fetched"]))}')
+                entry = fallback
+    population_data = {int(y): p for y, p in entry['series'].items()}
+    return dict(sorted(population_data.items())), entry['growth_rate']
+
+
+def write_snapshot(country_codes: Iterable[str] = None, path: str = POP_SNAPSHOT_PATH):
+    """
+    Fetch the population series of the countries and write them into a snapshot file
+    that can be shipped with the package and used offline
+
+    :param country_codes: iterable of ISO3 country codes, defaults to all countries
+    :param path: str, path to the snapshot file
+    """
+    snapshot = dict()
+    for country_code in sorted(country_codes or COUNTRY_CODES):
+        try:
+            snapshot[country_code] = _make_entry_(fetch_population(country_code=country_code))
+        except Exception as e:
+            logger.warning(f'Skipping {country_code}: {e}')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    return path
+
+
 def get_population_linear(year:int=None, country_code:str=None):
     """Predict future population using NumPy least squares regression."""
     assert country_code in COUNTRY_CODES, f'Invalid country_code={country_code}'
 
-    population_data = fetch_population(country_code=country_code)
+    population_data, _ = population_series(country_code=country_code)
     years, pop = zip(*population_data.items())
     min_year = min(years)
 
@@ -58,8 +151,8 @@ def get_population(year: int, country_code: str = None):
     """Estimate population for a given year using dynamic growth rate."""
     assert country_code in COUNTRY_CODES, f'Invalid country_code={country_code}'
 
-    # Fetch population data
-    population_data = fetch_population(country_code=country_code)
+    # Fetch population data and its growth rate
+    population_data, growth_rate = population_series(country_code=country_code)
     years, pop = zip(*population_data.items())
     years = np.array(years)
     pop = np.array(pop)
@@ -71,9 +164,6 @@ def get_population(year: int, country_code: str = None):
     if year in population_data:
         return population_data[year]
 
-    # Estimate growth rate dynamically
-    growth_rate = estimate_growth_rate(years, pop)
-
     # Find the most recent data point
     latest_year = years[-1]
     latest_population = pop[-1]
@@ -102,6 +192,7 @@ def estimate_growth_rate(years, populations):
 
     return slope  # This is equivalent to the estimated annual growth rate
 
+@lru_cache(maxsize=None)
 def get_pop_coeff(base_year=None, target_year=None, country_code=None):
     """
     Compute the coeff between population of a country in two different years
@@ -117,6 +208,16 @@ def get_pop_coeff(base_year=None, target_year=None, country_code=None):
     return target_year_pop/base_year_pop
 
 
+def get_pop_coeffs(base_year=None, target_year=None, country_codes: Iterable[str] = None) -> Dict[str, float]:
+    """
+    Compute the population coeff of several countries, see get_pop_coeff
+
+    :return: dict of ISO3 country code: coeff, to be applied with pandas.Series.map
+    """
+    return {country_code: get_pop_coeff(base_year=base_year, target_year=target_year, country_code=country_code)
+            for country_code in country_codes}
+
+
 
 
 if __name__ == '__main__':
@@ -3,27 +3,46 @@ import logging
 import os
 import shutil
 import tempfile
-from asyncio import subprocess
-from html.parser import HTMLParser
 from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
 from typing import List, Optional
 
 
 import aiofiles
 import httpx
-import rasterio
-from rasterio.windows import Window
-import numpy as np
+from osgeo import gdal
+from rio_cogeo.cogeo import cog_validate
 from tqdm.asyncio import tqdm_asyncio
 
 from rapida.components.population.constants import AZ_ROOT_FILE_PATH, WORLDPOP_AGE_MAPPING, DATA_YEAR, \
     AGESEX_STRUCTURE_COMBINATIONS, SEX_MAPPING
+from rapida.az.storage import get_container_client
+from rapida.az.transfer import TransferEngine
 from rapida.session import Session
-from rapida.util.chunker import chunker
+from rapida.util.raster_calc import sum_rasters
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logging.getLogger("azure").setLevel(logging.WARNING)
-
+gdal.UseExceptions()
+
+# max number of files downloaded from WorldPop at the same time
+SYNC_DOWNLOADS = 4
+# max number of files converted to COG at the same time, the conversion runs on a thread pool
+SYNC_CONVERSIONS = os.cpu_count() or 4
+# max number of COGs uploaded at the same time
+SYNC_UPLOADS = 4
+# the size of the chunks the WorldPop files are streamed in
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+COG_CREATION_OPTIONS = [
+    "OVERVIEW_RESAMPLING=NEAREST",
+    "TARGET_SRS=EPSG:3857",
+    "COMPRESS=ZSTD",
+    "BLOCKSIZE=256",
+    "BIGTIFF=YES",
+    "WARP_RESAMPLING=NEAREST",
+    "RESAMPLING=NEAREST",
+    "STATISTICS=YES",
+]
 
 
 
@@ -63,14 +82,6 @@ class LinkExtractor(HTMLParser):
         if tag == 'td':
             self.in_td = False
 
-# def chunker_function(iterable, chunk_size=4):
-#     """
-#     Split an iterable into chunks of the specified size.
-#     """
-#     for i in range(0, len(iterable), chunk_size):
-#         yield iterable[i:i + chunk_size]
-
-
 async def get_available_data(country_code=None, year=DATA_YEAR):
     """
     Return the Country Codes and IDs of the pages in worldpop where the Age-Sex structures are
@@ -111,35 +122,22 @@ async def extract_links_from_table(html_text: str):
     return parser.links
 
 
-async def convert_to_cog(input_file=None, output_file=None):
+def convert_to_cog(input_file=None, output_file=None):
     """
-    Convert a GeoTIFF file to a COG.
+    Convert a GeoTIFF file to a COG in process using the GDAL COG driver.
     Args:
         input_file: Input file path
         output_file: Output file path
     """
-
-    cmd = ["gdal_translate",
-           "-of", "COG",
-           "-co", "OVERVIEW_RESAMPLING=NEAREST",
-           "-co", "TARGET_SRS=EPSG:3857",
-           "-co", "COMPRESS=ZSTD",
-           "-co", "BLOCKSIZE=256",
-           "-co", "BIGTIFF=YES",
-           "-co", "WARP_RESAMPLING=NEAREST",
-           "-co", "RESAMPLING=NEAREST",
-           "-co", "STATISTICS=YES",
-           input_file, output_file]
-
-    proc = await subprocess.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    await proc.communicate()
+    options = gdal.TranslateOptions(format='COG', creationOptions=COG_CREATION_OPTIONS)
+    with gdal.Translate(destName=output_file, srcDS=input_file, options=options):
+        pass
     return output_file
 
 
-async def validate_cog(file_path=None):
+def validate_cog(file_path=None):
     """
-    Validate a COG file using the `rio cogeo validate` command.
+    Validate a COG file using the rio-cogeo API.
     Args:
         file_path:(str) Path to the COG file
 
@@ -147,15 +145,11 @@ async def validate_cog(file_path=None):
 
     """
     logging.info("Validating COG: %s", file_path)
-    cmd = ["rio", "cogeo", "validate", file_path]
-    proc = await subprocess.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = await proc.communicate()
-    if stderr:
-        logging.error("Error validating COG: %s", stderr)
-        raise Exception(f"Error validating COG: {stderr}")
-    else:
-        logging.info("COG validation successful: %s", stdout)
-
+    is_valid, errors, warnings = cog_validate(file_path, quiet=True)
+    if not is_valid:
+        logging.error("Error validating COG: %s", errors)
+        raise Exception(f"Error validating COG: {errors}")
+    logging.info("COG validation successful: %s", file_path)
 
 
 async def check_cog_exists(container_client=None, blob_path=None):
@@ -173,87 +167,164 @@ async def check_cog_exists(container_client=None, blob_path=None):
     return await blob_client.exists()
 
 
-
-async def process_single_file(file_url=None, container_client=None, country_code=None, year=None, force_reprocessing=False, download_path=None):
+def _target_path_(file_name=None, country_code=None, year=None):
     """
-    Download a single file, convert the file to a COG and upload it to Azure Blob Storage.
-    Args:
-        force_reprocessing: Force reprocessing of the file even if it already exists in Azure
-        year: The year for which the file is being processed
-        country_code: The country code for which the file is being processed
-        file_url: URL to download the file from
-        download_path: (Path) The local path to download the COG files to. It will upload to Azure if not provided.
-        container_client: azure.storage.blob.ContainerClient instance
-    Returns: None
-
+    The path of a WorldPop age/sex structure file relative to the worldpop root: {year}/{country}/{sex}/{age}/{file}
     """
-    assert file_url is not None, "file_url is required"
-    assert container_client is not None, "container client is required"
-    assert file_url.endswith(".tif"), "Only .tif files are supported"
+    age = file_name.split("_")[2]
+    sex = SEX_MAPPING[file_name.split("_")[1].upper()]
+    for age_group, age_range in WORLDPOP_AGE_MAPPING.items():
+        if age_range[0] <= int(age) <= age_range[1]:
+            age = age_group
+            break
+    return f"{year}/{country_code}/{sex}/{age}/{file_name}"
 
-    file_name = file_url.split("/")[-1]
 
-    try:
-        async with httpx.AsyncClient() as client:
-            age = file_name.split("_")[2]
-            sex = SEX_MAPPING[file_name.split("_")[1].upper()]
-
-            for age_group, age_range in WORLDPOP_AGE_MAPPING.items():
-                if age_range[0] <= int(age) <= age_range[1]:
-                    age = age_group
-                    break
-            cog_exists = await check_cog_exists(container_client=container_client,
-                                            blob_path=f"{AZ_ROOT_FILE_PATH}/{year}/{country_code}/{sex}/{age}/{file_name}")
-            if cog_exists and not force_reprocessing:
-                logging.info("COG already exists in Azure, skipping upload: %s", file_name)
-                return
-            async with client.stream("GET", file_url, timeout=600) as response:
-                if response.status_code != 200:
-                    logging.error("Failed to download file: %s, status: %s", file_url, response.status_code)
-                    return
-                total_size = int(response.headers.get("content-length", 0))
-                with tqdm_asyncio(total=total_size, unit="B", unit_scale=True, desc=f"Downloading {file_name}") as progress:
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        temp_file_path = f"{temp_dir}/{file_name}"
-                        logging.debug("Temporary file path: %s", temp_file_path)
-                        async with aiofiles.open(temp_file_path, 'wb') as f:
-                            async for chunk in response.aiter_bytes(chunk_size=1024):
-                                await f.write(chunk)
-                                progress.update(len(chunk))
-                            await f.close()
-                            cog_path = f"{temp_dir}/{file_name.replace('.tif', '_cog.tif')}"
-                            logging.info("Converting file to COG: %s", cog_path)
-                            await convert_to_cog(input_file=temp_file_path, output_file=cog_path)
-                            await validate_cog(file_path=cog_path)
-
-                            if download_path:
-                                try:
-                                    if not os.path.exists(download_path):
-                                        logging.info("Download path does not exist. Creating download path: %s", download_path)
-                                        os.makedirs(download_path, exist_ok=True)
-                                    logging.info("Copying COG file locally: %s", cog_path)
-                                    os.makedirs(f"{download_path}/{year}/{country_code}/{sex}/{age}", exist_ok=True)
-                                    shutil.move(cog_path, f"{download_path}/{year}/{country_code}/{sex}/{age}/{file_name}")
-                                    logging.info("Successfully copied COG file: %s", f"{download_path}/{year}/{country_code}/{sex}/{age}/{file_name}")
-                                except Exception as e:
-                                    raise Exception(f"Error copying COG file: {e}")
-                            else:
-                                logging.info("Uploading COG file to Azure: %s", cog_path)
-                                blob_name = f"{AZ_ROOT_FILE_PATH}/{year}/{country_code}/{sex}/{age}/{file_name}"
-                                blob_client = container_client.get_blob_client(blob=blob_name)
-                                file_size = os.path.getsize(cog_path)
-
-                                async def __progress__(current, total):
-                                    logging.info("Progress: %s/%s", current, total)
-                                async with aiofiles.open(cog_path, "rb") as data:
-                                    await blob_client.upload_blob(data, overwrite=True, max_concurrency=4,
-                                                                  blob_type="BlockBlob", length=file_size,
-                                                                  progress_hook=__progress__)
-
-
-        logging.info("Successfully processed file: %s", file_name)
-    except Exception as e:
-        logging.error("Error processing file %s: %s", file_name, e)
+async def _run_stage_(worker=None, inbox: asyncio.Queue = None, outbox: asyncio.Queue = None, workers: int = None,
+                      consumers: int = None):
+    """
+    Run `workers` copies of a pipeline stage. Every copy takes items from the inbox until it receives the
+    sentinel (None), calls worker on them and forwards the non None results to the outbox. When all copies are
+    done one sentinel for each of the `consumers` of the next stage is put in the outbox.
+    """
+    async def run():
+        while True:
+            item = await inbox.get()
+            if item is None:
+                break
+            result = await worker(item)
+            if result is not None and outbox is not None:
+                await outbox.put(result)
+
+    await asyncio.gather(*[run() for _ in range(workers)])
+    if outbox is not None:
+        for _ in range(consumers):
+            await outbox.put(None)
+
+
+async def sync_files(file_urls: List[str] = None, container_client=None, country_code=None, year=DATA_YEAR,
+                     force_reprocessing=False, download_path=None, downloads=SYNC_DOWNLOADS,
+                     conversions=SYNC_CONVERSIONS, uploads=SYNC_UPLOADS, temp_dir=None):
+    """
+    Download WorldPop files, convert them to COG and upload them to Azure Blob Storage (or copy them to a local
+    folder) in a staged pipeline. The download, conversion/validation and upload stages run at the same time
+    with independent concurrency limits and are connected by bounded queues, so a file is converted while the
+    next ones are downloaded and the previous ones uploaded, and no more than a few files wait on disk between
+    stages. The conversion and validation run in process on a thread pool.
+
+    Args:
+        file_urls: The URLs of the WorldPop files
+        container_client: azure.storage.blob.aio.ContainerClient (or the local stand-in) the COGs are uploaded to
+        country_code: The country code for which the files are being processed
+        year: The year for which the files are being processed
+        force_reprocessing: Force reprocessing of the files even if they already exist
+        download_path: (Path) The local path to save the COG files to. They are uploaded to Azure if not provided.
+        downloads: max number of files downloaded at the same time
+        conversions: max number of files converted at the same time
+        uploads: max number of files uploaded at the same time
+        temp_dir: the folder where the files are staged, a temporary folder by default
+
+    Returns: dict with the processed, skipped and failed file URLs
+    """
+    stats = dict(processed=[], skipped=[], failed=[])
+    engine = TransferEngine(window=uploads)
+    download_queue = asyncio.Queue(maxsize=downloads)
+    convert_queue = asyncio.Queue(maxsize=conversions)
+    upload_queue = asyncio.Queue(maxsize=uploads)
+
+    with tempfile.TemporaryDirectory(dir=temp_dir) as stage_dir, \
+            ThreadPoolExecutor(max_workers=conversions, thread_name_prefix='cog') as executor, \
+            tqdm_asyncio(total=len(file_urls), desc=f"Syncing {country_code}") as progress:
+        loop = asyncio.get_running_loop()
+        client = httpx.AsyncClient(timeout=600, follow_redirects=True)
+
+        def done(url=None, status=None):
+            stats[status].append(url)
+            progress.update(1)
+
+        async def download(file_url):
+            assert file_url.endswith(".tif"), "Only .tif files are supported"
+            file_name = file_url.split("/")[-1]
+            try:
+                rel_path = _target_path_(file_name=file_name, country_code=country_code, year=year)
+                if download_path:
+                    exists = os.path.exists(os.path.join(download_path, *rel_path.split('/')))
+                else:
+                    exists = await check_cog_exists(container_client=container_client,
+                                                    blob_path=f"{AZ_ROOT_FILE_PATH}/{rel_path}")
+                if exists and not force_reprocessing:
+                    logging.info("COG already exists, skipping: %s", file_name)
+                    return done(url=file_url, status='skipped')
+                src_path = os.path.join(stage_dir, file_name)
+                async with client.stream("GET", file_url) as response:
+                    if response.status_code != 200:
+                        raise Exception(f"Failed to download file: {file_url}, status: {response.status_code}")
+                    with open(src_path, 'wb') as dst:
+                        async for chunk in response.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            dst.write(chunk)
+                return dict(url=file_url, file_name=file_name, rel_path=rel_path, path=src_path)
+            except Exception as e:
+                logging.error("Error downloading file %s: %s", file_name, e)
+                done(url=file_url, status='failed')
+
+        def convert_and_validate(src_path=None, cog_path=None):
+            try:
+                convert_to_cog(input_file=src_path, output_file=cog_path)
+                validate_cog(file_path=cog_path)
+            finally:
+                os.remove(src_path)
+            return cog_path
+
+        async def convert(item):
+            cog_path = item['path'].replace('.tif', '_cog.tif')
+            try:
+                logging.info("Converting file to COG: %s", cog_path)
+                await loop.run_in_executor(executor, convert_and_validate, item['path'], cog_path)
+                return dict(item, path=cog_path)
+            except Exception as e:
+                logging.error("Error converting file %s: %s", item['file_name'], e)
+                if os.path.exists(cog_path):
+                    os.remove(cog_path)
+                done(url=item['url'], status='failed')
+
+        async def upload(item):
+            try:
+                if download_path:
+                    dst_path = os.path.join(download_path, *item['rel_path'].split('/'))
+                    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                    await asyncio.to_thread(shutil.move, item['path'], dst_path)
+                    logging.info("Successfully copied COG file: %s", dst_path)
+                else:
+                    blob_client = container_client.get_blob_client(blob=f"{AZ_ROOT_FILE_PATH}/{item['rel_path']}")
+                    await engine.upload(src_path=item['path'], blob_client=blob_client, overwrite=True)
+                done(url=item['url'], status='processed')
+            except Exception as e:
+                logging.error("Error uploading file %s: %s", item['file_name'], e)
+                done(url=item['url'], status='failed')
+            finally:
+                if os.path.exists(item['path']):
+                    os.remove(item['path'])
+
+        async def feed():
+            for file_url in file_urls:
+                await download_queue.put(file_url)
+            for _ in range(downloads):
+                await download_queue.put(None)
+
+        try:
+            await asyncio.gather(
+                feed(),
+                _run_stage_(worker=download, inbox=download_queue, outbox=convert_queue, workers=downloads,
+                            consumers=conversions),
+                _run_stage_(worker=convert, inbox=convert_queue, outbox=upload_queue, workers=conversions,
+                            consumers=uploads),
+                _run_stage_(worker=upload, inbox=upload_queue, workers=uploads),
+            )
+        finally:
+            await client.aclose()
+    logging.info("Synced %d files: %d processed, %d skipped, %d failed", len(file_urls),
+                 len(stats['processed']), len(stats['skipped']), len(stats['failed']))
+    return stats
 
 
 async def get_links_from_table(data_id=None):
@@ -337,8 +408,8 @@ async def run_download(country_code=None, year=DATA_YEAR, download_path=None, se
 
     logging.info("Starting data download from azure")
     session = Session()
-    async with session.get_blob_service_client(account_name=session.get_account_name()) as blob_service_client:
-        container_client = blob_service_client.get_container_client(container=session.get_stac_container_name())
+    async with get_container_client(account_name=session.get_account_name(),
+                                    container_name=session.get_stac_container_name()) as container_client:
 
         blobs_path_list = await _get_blobs_list(c_client=container_client, age_group=age_group, sex=sex)
 
@@ -375,28 +446,18 @@ async def population_sync(country_code=None, year=DATA_YEAR, force_reprocessing=
     logging.info("Starting data download")
     available_data = await get_available_data(country_code=country_code, year=year)
     session = Session()
-    async with session.get_blob_service_client(account_name=session.get_account_name()) as blob_service_client:
-        container_client = blob_service_client.get_container_client(container=session.get_stac_container_name())
+    async with get_container_client(account_name=session.get_account_name(),
+                                    container_name=session.get_stac_container_name()) as container_client:
         for country_code, country_id in available_data.items():
             if country_code == "RUS":
                 continue
             logging.info("Processing country: %s", country_code)
             file_links = await get_links_from_table(data_id=country_id)
-            for i, file_urls_chunk in enumerate(chunker(iterable=file_links, size=4)):
-                logging.info("Processing chunk %d for country: %s", i + 1, country_code)
-                # Create a fresh list of tasks for each file chunk
-                tasks = [process_single_file(file_url=url,
-                                             container_client=container_client,
-                                             year=year,
-                                             country_code=country_code,
-                                             force_reprocessing=force_reprocessing,
-                                             download_path=download_path) for url in file_urls_chunk]
-
-                # Gather tasks and process results
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-                for result in results:
-                    if isinstance(result, Exception):
-                        logging.error("Error processing file: %s", result)
+            stats = await sync_files(file_urls=file_links, container_client=container_client,
+                                     country_code=country_code, year=year, force_reprocessing=force_reprocessing,
+                                     download_path=download_path)
+            for file_url in stats['failed']:
+                logging.error("Error processing file: %s", file_url)
             logging.info("Data download complete for country: %s", country_code)
             logging.info("Starting aggregate processing for country: %s", country_code)
 
@@ -428,78 +489,21 @@ async def check_aggregates_exist(container_client, country_code=None):
     logging.info("All aggregate files exist for country: %s", country_code)
     return True
 
-def create_sum(input_file_paths, output_file_path, block_size=(256, 256)):
+def create_sum(input_file_paths, output_file_path, block_size=None):
     """
-    Sum multiple raster files and save the result to an output file, processing in blocks.
-    If the data is not blocked, create blocks within the function.
+    Sum multiple raster files and save the result to an output file. The nodata pixels are
+    treated as zero and the output uses 0 as nodata.
 
     Args:
         input_file_paths (list of str): Paths to input raster files.
         output_file_path (str): Path to save the summed raster file.
-        block_size (tuple): Tuple representing the block size (rows, cols). Default is (256, 256).
+        block_size (tuple): Not used anymore, the rasters are streamed by rows of output blocks.
 
     Returns:
-        None
+        str: the output file path
     """
-    logging.info("Starting create_sum function")
-    logging.info("Input files: %s", input_file_paths)
-    logging.info("Output file: %s", output_file_path)
-    logging.info("Block size: %s", block_size)
-    # Open all input files
-    try:
-        datasets = [rasterio.open(file_path) for file_path in input_file_paths]
-    except Exception as e:
-        logging.error("Error opening input files: %s", e)
-        return
-
-    logging.info("Successfully opened input raster files")
-
-    # Use the first dataset as reference for metadata
-    ref_meta = datasets[0].meta.copy()
-    ref_meta.update(count=1, dtype="float32", nodata=0, compress="ZSTD")
-
-    rows, cols = datasets[0].shape
-
-    logging.info("Raster dimensions: %d rows x %d cols", rows, cols)
-
-    # Create the output file
-    try:
-        with rasterio.open(output_file_path, "w", **ref_meta) as dst:
-            logging.info("Output file created successfully")
-
-            # Process raster in blocks
-            for i in range(0, rows, block_size[0]):
-                for j in range(0, cols, block_size[1]):
-                    window = Window(j, i, min(block_size[1], cols - j), min(block_size[0], rows - i))
-                    logging.info("Processing block: row %d to %d, col %d to %d", i, i + block_size[0], j,
-                                 j + block_size[1])
-
-                    output_data = np.zeros((window.height, window.width), dtype=np.float32)
-
-                    for idx, src in enumerate(datasets):
-                        try:
-                            input_data = src.read(1, window=window)
-
-                            input_data = np.where(input_data == src.nodata, 0, input_data)
-
-                            output_data += input_data
-
-                            logging.debug("Added data from raster %d", idx + 1)
-                        except Exception as e:
-                            logging.error("Error reading block from raster %d: %s", idx + 1, e)
-
-                    dst.write(output_data, window=window, indexes=1)
-            logging.info("Finished processing all blocks")
-    except Exception as e:
-        logging.error("Error creating or writing to output file: %s", e)
-    finally:
-        # Close all input datasets
-        for src in datasets:
-            src.close()
-        logging.info("Closed all input raster files")
-
-    logging.info("create_sum function completed successfully")
-
+    logging.info("Summing %s into %s", input_file_paths, output_file_path)
+    return sum_rasters(src_rasters=input_file_paths, dst_path=os.path.abspath(output_file_path), dst_nodata=0)
 
 
 async def process_aggregates(country_code: str, sex: Optional[str] = None, age_group: Optional[str] = None, year="2020", download_path=None, force_reprocessing: bool=False, session=None):
@@ -521,8 +525,8 @@ async def process_aggregates(country_code: str, sex: Optional[str] = None, age_g
     else:
         country_codes = [country_code]
 
-    async with session.get_blob_service_client(account_name=session.get_account_name()) as blob_service_client:
-        container_client = blob_service_client.get_container_client(container=session.get_stac_container_name())
+    async with get_container_client(account_name=session.get_account_name(),
+                                    container_name=session.get_stac_container_name()) as container_client:
 
         async def __progress__(current, total):
             logging.info("Progress: %s/%s", current, total)
@@ -575,8 +579,7 @@ async def process_aggregates(country_code: str, sex: Optional[str] = None, age_g
                     await asyncio.gather(*tasks)
 
                     output_file = f"{temp_dir}/{output_label}.tif"
-                    with ThreadPoolExecutor() as executor:
-                        executor.submit(create_sum, input_file_paths=local_files, output_file_path=output_file, block_size=(1028, 1028))
+                    await asyncio.to_thread(create_sum, input_file_paths=local_files, output_file_path=output_file)
 
                     # Upload the result
                     blob_path = f"{AZ_ROOT_FILE_PATH}/{DATA_YEAR}/{c_code}/aggregate/{c_code}_{output_label}.tif"
@@ -615,4 +618,81 @@ async def process_aggregates(country_code: str, sex: Optional[str] = None, age_g
 
 
 if __name__ == "__main__":
-    pass
+    import functools
+    import http.server
+    import threading
+    import time
+
+    import numpy as np
+
+    from rapida.az.storage import STORAGE_ROOT_ENV_VAR
+
+    async def legacy_sync_files(file_urls=None, container_client=None, country_code=None, year=DATA_YEAR,
+                                temp_dir=None):
+        """
+        The synchronisation used before sync_files, kept for the benchmark: files are processed in chunks of four,
+        downloaded in 1KB chunks and every chunk waits for its slowest file before the next one starts.
+        """
+        async def process(file_url):
+            file_name = file_url.split("/")[-1]
+            src_path = os.path.join(temp_dir, file_name)
+            cog_path = src_path.replace('.tif', '_cog.tif')
+            async with httpx.AsyncClient() as client:
+                async with client.stream("GET", file_url, timeout=600) as response:
+                    async with aiofiles.open(src_path, "wb") as dst:
+                        async for chunk in response.aiter_bytes(chunk_size=1024):
+                            await dst.write(chunk)
+            await asyncio.to_thread(convert_to_cog, input_file=src_path, output_file=cog_path)
+            await asyncio.to_thread(validate_cog, file_path=cog_path)
+            rel_path = _target_path_(file_name=file_name, country_code=country_code, year=year)
+            blob_client = container_client.get_blob_client(blob=f"{AZ_ROOT_FILE_PATH}/{rel_path}")
+            async with aiofiles.open(cog_path, "rb") as data:
+                await blob_client.upload_blob(await data.read(), overwrite=True)
+            os.remove(src_path)
+            os.remove(cog_path)
+
+        for i in range(0, len(file_urls), 4):
+            await asyncio.gather(*[process(url) for url in file_urls[i:i + 4]])
+
+    # Serve synthetic WorldPop like rasters over HTTP and sync them into the local storage stand-in, once with
+    # the legacy chunked loop and once with the staged pipeline
+    n_files, size = 16, 2048
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.environ[STORAGE_ROOT_ENV_VAR] = os.path.join(work_dir, 'storage')
+        serve_dir = os.path.join(work_dir, 'serve')
+        os.makedirs(serve_dir)
+        file_names = [f"mda_{'fm'[i % 2]}_{5 * (i // 2)}_{DATA_YEAR}_constrained.tif" for i in range(n_files)]
+        data = np.random.default_rng(0).random((size, size), dtype='float32') * 100
+        for file_name in file_names:
+            with gdal.GetDriverByName('GTiff').Create(os.path.join(serve_dir, file_name), size, size, 1,
+                                                      gdal.GDT_Float32) as ds:
+                ds.SetGeoTransform((28., 0.00083, 0, 48., 0, -0.00083))
+                ds.SetProjection('EPSG:4326')
+                ds.GetRasterBand(1).WriteArray(data)
+        total_mb = sum(os.path.getsize(os.path.join(serve_dir, f)) for f in file_names) / 1024 ** 2
+
+        handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=serve_dir)
+        handler.log_message = lambda *args: None
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        file_urls = [f"http://127.0.0.1:{server.server_port}/{f}" for f in file_names]
+
+        async def bench(legacy=False):
+            async with get_container_client(account_name='bench', container_name='legacy' if legacy else 'new') as cc:
+                start = time.perf_counter()
+                if legacy:
+                    await legacy_sync_files(file_urls=file_urls, container_client=cc, country_code='MDA',
+                                              temp_dir=work_dir)
+                else:
+                    stats = await sync_files(file_urls=file_urls, container_client=cc, country_code='MDA',
+                                             temp_dir=work_dir)
+                    assert not stats['failed'], stats['failed']
+                return time.perf_counter() - start
+
+        legacy_time = asyncio.run(bench(legacy=True))
+        new_time = asyncio.run(bench())
+        server.shutdown()
+        print(f'{n_files} files, {total_mb:.1f} MB')
+        print(f'legacy   : {legacy_time:.2f}s {total_mb / legacy_time:.1f} MB/s')
+        print(f'pipeline : {new_time:.2f}s {total_mb / new_time:.1f} MB/s ({legacy_time / new_time:.1f}x)')
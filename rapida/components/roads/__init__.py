@@ -6,6 +6,7 @@ from rapida import constants
 from rapida.core.component import Component
 from rapida.core.variable import Variable
 from rapida.session import Session
+from rapida.stats.store import StatsStore
 from rapida.util.gpd_overlay import run_overlay
 from rapida.util.resolve_url import resolve_geohub_url
 from rapida.util.download_geodata import download_vector
@@ -38,7 +39,9 @@ class RoadsComponent(Component):
                     logger.error(f'variable "{var_name}" is invalid. Valid options are "{", ".join(self.variables)}"')
                     return
 
-        with Session() as ses:
+        project = Project(path=os.getcwd())
+        stats_store = StatsStore(dataset_path=project.geopackage_file_path, layer_name=f'stats.{self.component_name}')
+        with Session() as ses, stats_store:
             variables_data = ses.get_component(self.component_name)
 
             for var_name in variables:
@@ -48,7 +51,7 @@ class RoadsComponent(Component):
                 # create instance
                 v = RoadsVariable(name=var_name, component=self.component_name, **var_data)
                 # assess
-                v(**kwargs)
+                v(stats_store=stats_store, **kwargs)
 
 
 class RoadsVariable(Variable):
@@ -221,10 +224,7 @@ class RoadsVariable(Variable):
         if progress is not None and evaluate_task is not None:
             progress.update(evaluate_task, description=f'[green]Loading layers...')
 
-        if destination_layer in layer_names:
-            polygons_layer = destination_layer
-        else:
-            polygons_layer = constants.POLYGONS_LAYER_NAME
+        polygons_layer = constants.POLYGONS_LAYER_NAME
 
         df_polygon = gpd.read_file(self.local_path, layer=polygons_layer, engine="pyogrio")
         df_line = gpd.read_file(self.local_path, layer=self.component, engine="pyogrio")
@@ -239,25 +239,12 @@ class RoadsVariable(Variable):
             if progress is not None and evaluate_task is not None:
                 progress.update(evaluate_task, description=f'[green]Computing {self.name}.')
 
-            if self.operator == 'density':
-                df_polygon['area'] = df_polygon.geometry.area
-                length_sum = df_line.groupby("polyid")["geometry"].apply(lambda x: sum(x.length))
-                length_sum_df = length_sum.reset_index(name='total_length')
-                length_sum_df.rename(columns={"polyid": "h3id"}, inplace=True)
-
-                # merge with area
-                df_polygon = df_polygon.merge(length_sum_df, on="h3id", how='left')
-
-                df_polygon[self.name] = df_polygon['total_length'] / df_polygon['area']
-                df_polygon.drop(columns=['total_length', 'area'], inplace=True)
-                output_df = df_polygon
-            else:
-                output_df = vector_line_zonal_stats(
-                    df_polygon=df_polygon,
-                    df_line=df_line,
-                    operator=self.operator,
-                    field_name=self.name
-                )
+            output_df = vector_line_zonal_stats(
+                df_polygon=df_polygon,
+                df_line=df_line,
+                operator=self.operator,
+                field_name=self.name
+            )
 
             if progress is not None and evaluate_task is not None:
                 progress.update(evaluate_task, description=f'[green]Computed {self.name}.')
@@ -267,31 +254,14 @@ class RoadsVariable(Variable):
                     progress.update(evaluate_task, description=f'[green]Computing {self.affected_layer}.')
 
                 df_line_affected = gpd.read_file(self.local_path, layer=self.affected_layer, engine="pyogrio")
-                if self.operator == 'density':
-                    df_polygon['area'] = df_polygon.geometry.area
-                    length_sum = df_line_affected.groupby("polyid")["geometry"].apply(lambda x: sum(x.length))
-
-                    length_sum_df = length_sum.reset_index(name='total_length')
-                    length_sum_df.rename(columns={"polyid": "h3id"}, inplace=True)
-
-                    # merge with area
-                    df_polygon = df_polygon.merge(length_sum_df, on="h3id", how='left')
-
-                    df_polygon[self.affected_variable] = df_polygon['total_length'] / df_polygon['area']
-                    # drop columns
-                    df_polygon.drop(columns=['total_length', 'area'], inplace=True)
-                    output_df = df_polygon
-                    # testing purposes
-                    for i, row in output_df.iterrows():
-                        if row[self.affected_variable] > row[self.name]:
-                            raise ValueError(f"affected density cannot be greater than density")
-                else:
-                    output_df = vector_line_zonal_stats(
-                        df_polygon=output_df,
-                        df_line=df_line_affected,
-                        operator=self.operator,
-                        field_name=self.affected_variable
-                    )
+                output_df = vector_line_zonal_stats(
+                    df_polygon=output_df,
+                    df_line=df_line_affected,
+                    operator=self.operator,
+                    field_name=self.affected_variable
+                )
+                if self.operator == 'density' and (output_df[self.affected_variable] > output_df[self.name] * (1 + 1e-9)).any():
+                    raise ValueError(f"affected density cannot be greater than density")
 
                 if progress is not None and evaluate_task is not None:
                     progress.update(evaluate_task, description=f'[green]Computed {self.affected_layer}.')
@@ -302,7 +272,12 @@ class RoadsVariable(Variable):
                     if progress is not None and evaluate_task is not None:
                         progress.update(evaluate_task, description=f'[green]Computed {self.affected_variable}.')
 
-            output_df.to_file(self.local_path, driver='GPKG', layer=destination_layer, mode='w')
+            columns = [c for c in (self.name, self.affected_variable, self.affected_percentage_variable)
+                       if c in output_df.columns]
+            store = kwargs.get('stats_store', None) or StatsStore(dataset_path=self.local_path,
+                                                                  layer_name=destination_layer)
+            with store:
+                store.update(output_df[['h3id'] + columns])
 
             if progress is not None and evaluate_task is not None:
                 progress.update(evaluate_task, description=f'[green]updated variables to {self.local_path} as {destination_layer}')
@@ -1,20 +1,17 @@
 import os
 import logging
 from typing import List
-import geopandas as gpd
 from rich.progress import Progress
-from rapida import constants
 from rapida.core.component import Component
 from rapida.core.variable import Variable
 from rapida.project.project import Project
 from rapida.session import Session
-from rapida.util import geo
 from rapida.util.download_geodata import download_raster
 from rapida.util.resolve_url import resolve_geohub_url
-from rapida.stats.raster_zonal_stats import zst
-from osgeo_utils.gdal_calc import Calc
-from rapida.constants import GTIFF_CREATION_OPTIONS
-from osgeo import gdal, ogr
+from rapida.stats.coverage_index import CoverageIndex
+from rapida.stats.raster_zonal_stats import zonal_table
+from rapida.stats.store import StatsStore
+from osgeo import ogr
 logger = logging.getLogger(__name__)
 
 
@@ -47,24 +44,19 @@ class RwiComponent(Component):
                 if layer_index is not None:
                     ds.DeleteLayer(dst_layer)
 
-            for var_name in variables:
-                var_data = variables_data[var_name]
-                var_data['source'] = resolve_geohub_url(var_data['source'])
+            with StatsStore(dataset_path=geopackage_path, layer_name=dst_layer) as stats_store:
+                for var_name in variables:
+                    var_data = variables_data[var_name]
+                    var_data['source'] = resolve_geohub_url(var_data['source'])
 
-                # create instance
-                v = RwiVariable(name=var_name, component=self.component_name, **var_data)
-                # assess
-                v(**kwargs)
+                    # create instance
+                    v = RwiVariable(name=var_name, component=self.component_name, **var_data)
+                    # assess
+                    v(stats_store=stats_store, **kwargs)
 
 
 class RwiVariable(Variable):
 
-    @property
-    def affected_path(self):
-        path, file_name = os.path.split(self.local_path)
-        fname, ext = os.path.splitext(file_name)
-        return os.path.join(path, f'{fname}_affected{ext}')
-
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -126,23 +118,8 @@ class RwiVariable(Variable):
 
 
 
-    def _compute_affected_(self):
-        project = Project(os.getcwd())
-        if geo.is_raster(self.local_path):
-            if project.raster_mask:
-                affected_local_path = self.affected_path
-                ds = Calc(calc='local_path*mask', outfile=affected_local_path, projectionCheck=True, format='GTiff',
-                          creation_options=GTIFF_CREATION_OPTIONS, quiet=False, overwrite=True,
-                          NoDataValue=None,
-                          local_path=self.local_path, mask=project.raster_mask)
-                ds = None
-                assert os.path.exists(self.affected_path), f'Failed to compute {self.affected_path}'
-                return affected_local_path
-
     def download(self, force=False, **kwargs):
         if force == False and os.path.exists(self.local_path):
-            if not os.path.exists(self.affected_path):
-                self._compute_affected_()
             return self.local_path
 
         logger.info(f'Downloading {self.component}')
@@ -153,34 +130,17 @@ class RwiVariable(Variable):
 
         project = Project(os.getcwd())
         progress = kwargs.pop('progress', None)
-        local_path = os.path.join(project.data_folder, self.component, f'{self.component}_downloaded.tif')
         download_raster(
             src_dataset_path=self.source,
             src_band=1,
-            dst_dataset_path=local_path,
+            dst_dataset_path=self.local_path,
             polygons_dataset_path=project.geopackage_file_path,
             polygons_layer_name=project.polygons_layer_name,
+            target_srs=project.target_srs,
             progress=progress
 
         )
 
-        with gdal.config_options({
-            'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES':'YES',
-            'GDAL_CACHEMAX':'512',
-            'GDAL_NUMTHREADS':'4'
-        }):
-            geo.import_raster(
-                source=local_path, dst=self.local_path, target_srs=project.target_srs,
-                crop_ds=project.geopackage_file_path, crop_layer_name=project.polygons_layer_name,
-                return_handle=False,
-                ## warpOptions come now
-                warpMemoryLimit=1024,
-
-            )
-        if os.path.exists(local_path):
-            os.remove(local_path)
-        self._compute_affected_()
-
 
     def compute(self, force=True, **kwargs):
         assert force, f'invalid force={force}'
@@ -201,12 +161,8 @@ class RwiVariable(Variable):
 
         dst_layer = f'stats.{self.component}'
         project = Project(path=os.getcwd())
-        layers = gpd.list_layers(project.geopackage_file_path)
-        lnames = layers.name.tolist()
-        if dst_layer in lnames:
-            polygons_layer = dst_layer
-        else:
-            polygons_layer = constants.POLYGONS_LAYER_NAME
+        store = kwargs.get('stats_store', None) or StatsStore(dataset_path=project.geopackage_file_path,
+                                                              layer_name=dst_layer)
 
         if self.operator:
             assert os.path.exists(self.local_path), f'{self.local_path} does not exist'
@@ -214,19 +170,17 @@ class RwiVariable(Variable):
             if progress is not None and evaluate_task is not None:
                 progress.update(evaluate_task, description=f'[red] Evaluating variable {self.name} using zonal stats')
 
-            # raster variable, run zonal stats
-            src_rasters = [self.local_path]
-            var_ops = [(self.name, self.operator)]
-
-            if project.raster_mask is not None:
-                affected_local_path = self.affected_path
-                src_rasters.append(affected_local_path)
-                var_ops.append((f'{self.name}_affected', self.operator))
-
-            gdf = zst(src_rasters=src_rasters,
-                      polygon_ds=project.geopackage_file_path,
-                      polygon_layer=polygons_layer, vars_ops=var_ops
-                      )
+            # raster variable, run zonal stats. The affected version is computed from the mask in the same pass
+            coverage_index = CoverageIndex.for_project(project=project, template_raster=self.local_path,
+                                                       progress=progress)
+            df = zonal_table(src_rasters=[self.local_path],
+                             polygon_ds=project.geopackage_file_path,
+                             polygon_layer=project.polygons_layer_name, vars_ops=[(self.name, self.operator)],
+                             coverage_index=coverage_index, mask=project.raster_mask,
+                             workers=kwargs.get('workers')
+                             )
+            if kwargs.get('export_affected', False):
+                self.export_affected(progress=progress)
 
             if progress is not None and evaluate_task is not None:
                 progress.update(evaluate_task, description=f'[red] Evaluated variable {self.name} using zonal stats')
@@ -235,7 +189,8 @@ class RwiVariable(Variable):
                 progress.update(evaluate_task,
                                 description=f'[red] Writing {self.name} to {project.geopackage_file_path}:{dst_layer}')
 
-            gdf.to_file(project.geopackage_file_path, layer=dst_layer, driver="GPKG", overwrite=True)
+            with store:
+                store.update(df)
         else:
             progress.update(evaluate_task,
                             description=f'[red] {self.name} was skipped because of lack of operator definition.')
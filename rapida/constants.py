@@ -8,4 +8,5 @@ DEFAULT_MASK_POLYGONIZATION_SMOOTHING_BUFFER = 100
 GTIFF_CREATION_OPTIONS = dict(TILED='YES', COMPRESS='ZSTD', BIGTIFF='IF_SAFER', BLOCKXSIZE=256,
                                                 BLOCKYSIZE=256)
 POLYGONS_LAYER_NAME = 'polygons'
+POLYGONS_ID_COLUMN = 'h3id'
 MASK_NAME = 'mask'
\ No newline at end of file
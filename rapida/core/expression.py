@@ -0,0 +1,90 @@
+import logging
+from typing import Dict, Iterable, List, Union
+
+from sympy import Symbol
+from sympy.parsing.sympy_parser import parse_expr
+
+logger = logging.getLogger(__name__)
+
+
+class ExpressionGraph:
+    """
+    Dependency graph of the variables of a component.
+
+    A variable whose sources are an expression (ex: "male_total+female_total") depends on other variables.
+    The variables whose sources are a list of files (or that have no sources) are leaves and are materialized
+    as rasters. The graph expands any expression down to the leaves so derived variables can be computed
+    in one fused pass over the leaf rasters without writing the intermediate variables.
+
+    graph = ExpressionGraph(definitions={'total': 'male_total+female_total', 'male_total': 'male_child+male_active', ...})
+    graph.expand('total') # 'female_total + male_active + male_child'
+    """
+
+    def __init__(self, definitions: Dict[str, Union[str, List[str], None]] = None):
+        """
+        :param definitions: dict of variable name: sources
+        """
+        self.definitions = definitions
+        self._parsed_ = dict()
+        self._expanded_ = dict()
+
+    @classmethod
+    def from_component(cls, component_data: dict = None):
+        """
+        Create the graph from the config of a component as returned by Session.get_component()
+        """
+        return cls(definitions={name: data.get('sources') for name, data in component_data.items()})
+
+    def parse(self, name: str = None):
+        if name not in self._parsed_:
+            sources = self.definitions.get(name)
+            expr = None
+            if isinstance(sources, str):
+                try:
+                    expr = parse_expr(sources)
+                except (SyntaxError, TypeError, AttributeError):
+                    logger.debug(f'Sources of {name} are not an expression')
+            self._parsed_[name] = expr
+        return self._parsed_[name]
+
+    def is_leaf(self, name: str = None) -> bool:
+        return self.parse(name) is None
+
+    def dependencies(self, name: str = None) -> List[str]:
+        """
+        Direct dependencies of a variable
+        """
+        expr = self.parse(name)
+        if expr is None:
+            return []
+        return sorted(s.name for s in expr.free_symbols)
+
+    def _expand_(self, name: str = None, path: tuple = ()):
+        assert name not in path, f'Circular dependency {" -> ".join(path + (name,))}'
+        if name not in self._expanded_:
+            expr = self.parse(name)
+            if expr is None:
+                expanded = Symbol(name)
+            else:
+                expanded = expr.xreplace({s: self._expand_(name=s.name, path=path + (name,))
+                                          for s in expr.free_symbols if s.name in self.definitions})
+            self._expanded_[name] = expanded
+        return self._expanded_[name]
+
+    def expand(self, name: str = None) -> str:
+        """
+        Expand the expression of a variable in terms of leaf variables
+
+        :param name: str, variable name
+        :return: str, numpy compatible expression
+        """
+        return str(self._expand_(name=name))
+
+    def leaves(self, names: Iterable[str] = None) -> List[str]:
+        """
+        The leaf variables the variables in names depend on
+        """
+        leaves = set()
+        for name in names:
+            leaves |= {s.name for s in self._expand_(name=name).free_symbols}
+        return sorted(leaves)
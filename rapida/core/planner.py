@@ -0,0 +1,89 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+from graphlib import TopologicalSorter
+from typing import Callable, Dict, Hashable, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+def _init_worker_():
+    # the stages run coroutines through asyncio.run and the worker threads have no event loop
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+class Planner:
+    """
+    Run the stages (download, compute, evaluate...) of the variables of a component as a DAG.
+
+    Every task is identified by a hashable key, ex: ("active_total", "prepare"), and is added once no matter how
+    many other tasks require it, so shared dependencies run exactly once. The tasks run in topological order and
+    the independent ones run concurrently in a thread pool.
+
+    planner = Planner()
+    planner.add(key=('male_total', 'prepare'), func=male_total.prepare)
+    planner.add(key=('male_total', 'evaluate'), func=male_total.evaluate, deps=[('male_total', 'prepare')])
+    planner.run(workers=4)
+    """
+
+    def __init__(self):
+        self.tasks: Dict[Hashable, Callable] = dict()
+        self.deps: Dict[Hashable, set] = dict()
+
+    def __contains__(self, key):
+        return key in self.tasks
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, key: Hashable = None, func: Callable = None, deps: Iterable[Hashable] = ()):
+        """
+        Add a task. Adding a task with the same key again only adds its dependencies
+
+        :param key: hashable task key
+        :param func: callable without arguments
+        :param deps: iterable of task keys that need to complete before this task starts
+        """
+        if key not in self.tasks:
+            self.tasks[key] = func
+            self.deps[key] = set()
+        self.deps[key] |= set(deps)
+
+    def order(self):
+        """
+        A sequential order the tasks can run in
+        """
+        return list(TopologicalSorter(self.deps).static_order())
+
+    def run(self, workers: int = None, progress=None, task=None):
+        """
+        Run all tasks. The first failing task cancels the tasks that did not start yet and its exception is raised
+
+        :param workers: int, number of threads, defaults to the number of CPUs
+        :param progress: rich progress instance
+        :param task: progress task advanced every time a task completes
+        """
+        missing = {d for deps in self.deps.values() for d in deps} - set(self.tasks)
+        assert not missing, f'Tasks {missing} are required but were not added to the plan'
+        sorter = TopologicalSorter(self.deps)
+        sorter.prepare()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count(),
+                                                   initializer=_init_worker_) as executor:
+            running = dict()
+            try:
+                while sorter.is_active():
+                    for key in sorter.get_ready():
+                        logger.debug(f'Running {key}')
+                        running[executor.submit(self.tasks[key])] = key
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        key = running.pop(future)
+                        future.result()
+                        sorter.done(key)
+                        if progress is not None and task is not None:
+                            progress.update(task, advance=1)
+            except BaseException:
+                for future in running:
+                    future.cancel()
+                raise
@@ -12,6 +12,8 @@ from sympy.parsing.sympy_parser import parse_expr
 from rapida.constants import ARROWTYPE2OGRTYPE
 
 from rapida.project.project import Project
+from rapida.util import geo
+from rapida.util.raster_calc import mask_raster
 
 logger = logging.getLogger(__name__)
 gdal.UseExceptions()
@@ -73,6 +75,28 @@ class Variable(BaseModel):
     def __call__(self,  **kwargs):
         pass
 
+    @property
+    def affected_path(self):
+        path, file_name = os.path.split(str(self.local_path))
+        fname, ext = os.path.splitext(file_name)
+        return os.path.join(path, f'{fname}_affected{ext}')
+
+    def export_affected(self, progress=None):
+        """
+        Write the affected version of a raster variable, that is the pixels covered by the project raster mask,
+        into affected_path. The zonal stats compute the affected values straight from the mask so this is only
+        needed to export the affected raster itself.
+
+        :param progress: rich progress instance
+        :return: str, the path to the affected raster or None if the project has no mask
+        """
+        project = Project(path=os.getcwd())
+        if project.raster_mask is None or not geo.is_raster(str(self.local_path)):
+            return
+        logger.debug(f'Exporting affected version of {self.name} to {self.affected_path}')
+        return mask_raster(src_path=str(self.local_path), mask_path=project.raster_mask, dst_path=self.affected_path,
+                           progress=progress)
+
     def interpolate_template(self, template=None, **kwargs):
         """
         Interpolate values from kwargs into template
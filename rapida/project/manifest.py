@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import posixpath
+import threading
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.fileshare import ShareDirectoryClient
+
+from rapida.az.transfer import file_md5
+from rapida.util.pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = 'rapida.manifest.json'
+SYNC_PARALLEL = 4  # default number of files transferred at the same time
+
+
+def file_entry(path: str = None, md5: str = None) -> dict:
+    """
+    The manifest entry of a local file
+
+    :param path: str, the path to the file
+    :param md5: str, the hex MD5 of the file if already known
+    :return: dict with size, mtime and md5 keys
+    """
+    st = os.stat(path)
+    return dict(size=st.st_size, mtime=st.st_mtime, md5=md5 or file_md5(path).hex())
+
+
+def build_manifest(folder: str = None, previous: dict = None) -> dict:
+    """
+    Describe every file in a folder. The MD5 of a file is taken from the previous manifest if the size and the
+    modification time of the file did not change, so only the new and the altered files are hashed
+
+    :param folder: str, the folder
+    :param previous: dict, optional previous manifest of the same folder
+    :return: dict of relative path (with / separators): dict(size, mtime, md5)
+    """
+    previous = previous or {}
+    manifest = dict()
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, folder).replace(os.path.sep, '/')
+            if rel_path == MANIFEST_FILE_NAME or name.endswith('.part'):
+                continue
+            st = os.stat(path)
+            known = previous.get(rel_path)
+            if known and known['size'] == st.st_size and known['mtime'] == st.st_mtime:
+                manifest[rel_path] = dict(known)
+            else:
+                manifest[rel_path] = file_entry(path)
+    return manifest
+
+
+def read_manifest(folder: str = None) -> dict:
+    """
+    Read the manifest stored in a folder
+
+    :return: dict, the manifest or an empty dict if the folder has no manifest
+    """
+    path = os.path.join(folder, MANIFEST_FILE_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as src:
+        return json.load(src)
+
+
+def write_manifest(folder: str = None, manifest: dict = None) -> str:
+    path = os.path.join(folder, MANIFEST_FILE_NAME)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as dst:
+        json.dump(manifest, dst, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def diff_manifests(src: dict = None, dst: dict = None):
+    """
+    Compare the manifest of a source with the manifest of a destination
+
+    :return: tuple (list of the paths new or different in src, list of the paths present only in dst)
+    """
+    changed = [p for p, e in src.items() if p not in dst or (dst[p]['size'], dst[p]['md5']) != (e['size'], e['md5'])]
+    deleted = [p for p in dst if p not in src]
+    return sorted(changed), sorted(deleted)
+
+
+def read_remote_manifest(dir_client: ShareDirectoryClient = None):
+    """
+    Read the manifest stored in a file share directory
+
+    :return: dict, the manifest or None if the directory has no manifest
+    """
+    try:
+        data = dir_client.get_file_client(MANIFEST_FILE_NAME).download_file().readall()
+    except ResourceNotFoundError:
+        return
+    return json.loads(data)
+
+
+def list_remote_files(dir_client: ShareDirectoryClient = None, prefix: str = ''):
+    """
+    List recursively the files in a file share directory. Used for the projects uploaded without a manifest
+
+    :return: dict of relative path: dict(size)
+    """
+    files = dict()
+    for item in dir_client.list_directories_and_files():
+        rel_path = posixpath.join(prefix, item.name) if prefix else item.name
+        if item.is_directory:
+            files.update(list_remote_files(dir_client=dir_client.get_subdirectory_client(item.name),
+                                           prefix=rel_path))
+        elif item.name != MANIFEST_FILE_NAME:
+            files[rel_path] = dict(size=item.size, md5=None)
+    return files
+
+
+def _run_(job=None, jobs=None, parallel=None, description=None, progress=None):
+    task = None
+    if progress is not None:
+        task = progress.add_task(description=description, total=len(jobs))
+    try:
+        pipeline = Pipeline(job=job, jobs=jobs, workers=parallel, results_arg=None, fail_fast=True,
+                            id_prop_name='rel_path', progress=progress, task=task)
+        return [result for result in pipeline]
+    finally:
+        if progress is not None and task is not None:
+            progress.remove_task(task)
+
+
+def upload_folder(folder: str = None, dir_client: ShareDirectoryClient = None, overwrite: bool = False,
+                  parallel: int = SYNC_PARALLEL, max_concurrency: int = 4, progress=None):
+    """
+    Synchronize a local folder to a file share directory. The manifest of the folder is compared with the
+    manifest stored in the directory and only the new and the changed files are uploaded, `parallel` at a time.
+    When overwrite is True the files removed locally are removed remotely as well. The manifest is uploaded last
+    so an interrupted upload is resumed by the next one.
+
+    :param folder: str, local folder
+    :param dir_client: ShareDirectoryClient, the destination directory
+    :param overwrite: bool, if False and a file that differs exists remotely FileExistsError is raised
+    :param parallel: int, number of files uploaded at the same time
+    :param max_concurrency: int, the number of threads used by the azure api to upload one file
+    :param progress: rich progress instance
+    :return: list of the uploaded relative paths
+    """
+    local = build_manifest(folder=folder, previous=read_manifest(folder=folder))
+    write_manifest(folder=folder, manifest=local)
+    remote = read_remote_manifest(dir_client=dir_client)
+    if remote is None:
+        remote = dict()
+        if dir_client.exists():
+            if not overwrite:
+                raise FileExistsError(f'{dir_client.url} already exists. Set overwrite=True to overwrite')
+            remote = list_remote_files(dir_client=dir_client)
+    changed, deleted = diff_manifests(src=local, dst=remote)
+    existing = [p for p in changed if p in remote]
+    if existing and not overwrite:
+        raise FileExistsError(f'{posixpath.join(dir_client.url, existing[0])} already exists. '
+                              f'Set overwrite=True to overwrite')
+    logger.info(f'{len(changed)} out of {len(local)} files changed since the last upload')
+
+    folders = {''}
+    for rel_path in changed:
+        parent = posixpath.dirname(rel_path)
+        while parent not in folders:
+            folders.add(parent)
+            parent = posixpath.dirname(parent)
+    for rel_dir in sorted(folders, key=lambda d: d.count('/') if d else -1):
+        dc = dir_client.get_subdirectory_client(rel_dir) if rel_dir else dir_client
+        try:
+            dc.create_directory()
+        except ResourceExistsError:
+            pass
+
+    def upload_file(rel_path=None):
+        with open(os.path.join(folder, *rel_path.split('/')), 'rb') as src:
+            dir_client.get_file_client(rel_path).upload_file(src, length=local[rel_path]['size'],
+                                                             max_concurrency=max_concurrency)
+        return rel_path
+
+    uploaded = _run_(job=upload_file, jobs=[dict(rel_path=p) for p in changed], parallel=parallel,
+                     description='[blue]Uploading project files', progress=progress)
+    if overwrite:
+        for rel_path in deleted:
+            dir_client.get_file_client(rel_path).delete_file()
+            logger.debug(f'Deleted {rel_path}')
+    dir_client.get_file_client(MANIFEST_FILE_NAME).upload_file(json.dumps(local, indent=1, sort_keys=True))
+    return uploaded
+
+
+def download_folder(dir_client: ShareDirectoryClient = None, folder: str = None, overwrite: bool = False,
+                    parallel: int = SYNC_PARALLEL, max_concurrency: int = 4, progress=None):
+    """
+    Synchronize a file share directory to a local folder. The manifest stored in the directory is compared
+    with the manifest of the folder and only the new and the changed files are downloaded, `parallel` at a time.
+    The directories uploaded without a manifest are listed and compared by size.
+
+    :param dir_client: ShareDirectoryClient, the source directory
+    :param folder: str, local folder
+    :param overwrite: bool, if False and a file that differs exists locally FileExistsError is raised
+    :param parallel: int, number of files downloaded at the same time
+    :param max_concurrency: int, the number of threads used by the azure api to download one file
+    :param progress: rich progress instance
+    :return: list of the downloaded relative paths
+    """
+    os.makedirs(folder, exist_ok=True)
+    remote = read_remote_manifest(dir_client=dir_client)
+    has_manifest = remote is not None
+    if not has_manifest:
+        remote = list_remote_files(dir_client=dir_client)
+    local = build_manifest(folder=folder, previous=read_manifest(folder=folder))
+    if has_manifest:
+        changed, _ = diff_manifests(src=remote, dst=local)
+    else:
+        changed = sorted(p for p, e in remote.items() if p not in local or local[p]['size'] != e['size'])
+    existing = [p for p in changed if p in local]
+    if existing and not overwrite:
+        raise FileExistsError(f'{os.path.join(folder, existing[0])} already exists. Set overwrite=True to overwrite')
+    logger.info(f'{len(changed)} out of {len(remote)} files changed since the last download')
+    lock = threading.Lock()
+
+    def download_file(rel_path=None):
+        dst_path = os.path.join(folder, *rel_path.split('/'))
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        part_path = f'{dst_path}.part'
+        stream = dir_client.get_file_client(rel_path).download_file(max_concurrency=max_concurrency)
+        with open(part_path, 'wb') as dst:
+            stream.readinto(dst)
+        os.replace(part_path, dst_path)
+        entry = file_entry(dst_path, md5=remote[rel_path].get('md5'))
+        with lock:
+            local[rel_path] = entry
+        return rel_path
+
+    downloaded = _run_(job=download_file, jobs=[dict(rel_path=p) for p in changed], parallel=parallel,
+                       description='[blue]Downloading project files', progress=progress)
+    write_manifest(folder=folder, manifest=local)
+    return downloaded
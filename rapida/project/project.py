@@ -20,9 +20,12 @@ from azure.storage.fileshare import ShareClient, ShareDirectoryClient
 from rapida import constants
 from rapida.admin.osm import fetch_admin
 from rapida.az.blobstorage import check_blob_exists, delete_blob
+from rapida.az.storage import get_share_client
+from rapida.project.manifest import upload_folder, SYNC_PARALLEL
 from rapida.session import Session
 from rapida.util import geo
 from rapida.util.dataset2pmtiles import dataset2pmtiles
+from rapida.util.point_in_polygon import PointInPolygon
 
 logger = logging.getLogger(__name__)
 gdal.UseExceptions()
@@ -112,43 +115,16 @@ class Project:
                     target_crs = pCRS.from_user_input(self.projection)
                     with io.BytesIO(json.dumps(admin0_polygons, indent=2).encode('utf-8') ) as a0l_bio:
                         a0_gdf = geopandas.read_file(a0l_bio).to_crs(crs=target_crs)
-                    centroids = gdf.copy()
-                    centroids["geometry"] = gdf.centroid
-
-                    joined = geopandas.sjoin(centroids, a0_gdf, how="left", predicate="within")
-                    joined['geometry'] = gdf['geometry']
-
-                    if joined['iso3'].isna().any():
-                        # Step 2: Separate matched and unmatched points
-                        unmatched_points = joined[joined['index_right'].isna()].copy()
-
-                        matched_points = joined.dropna(subset=['index_right']).copy()
-
-                        # Step 3: Define the function to compute the average of the three closest neighbors
-                        def get_nearest_avg(point_geom):
-                            # Compute distances from this point to all matched points
-                            matched_points["distance"] = matched_points.geometry.distance(point_geom)
-
-                            # Select the three nearest neighbors
-                            nearest_neighbors = matched_points.nsmallest(3, "distance")
-
-                            # Return the average value of the attribute
-                            return nearest_neighbors["iso3"].mode()
-
-                        # Step 4: Apply the function to all unmatched points
-                        unmatched_points["iso3"] = unmatched_points.geometry.apply(get_nearest_avg)
-
-                        # Step 5: Merge the results back into the main DataFrame
-                        for col in unmatched_points.columns:
-                            joined.loc[unmatched_points.index, col] = unmatched_points[col]
+                    centroids = gdf.centroid
+                    # the polygons whose centroid falls outside all countries (coast, borders) get the nearest one
+                    countries = PointInPolygon(polygons=a0_gdf.geometry.to_numpy())
+                    country_idx = countries(x=centroids.x.to_numpy(), y=centroids.y.to_numpy(), nearest=True)
+                    joined = gdf.copy()
+                    joined['iso3'] = a0_gdf['iso3'].to_numpy()[country_idx]
 
                     self.countries = tuple(sorted(set(joined['iso3'])))
                     cols = joined.columns.tolist()
 
-                    for col_name in ('index_right', 'index_left'):
-                        if col_name in cols:
-                            joined.drop(columns=[col_name], inplace=True)
-
                     joined.to_file(filename=self.geopackage_file_path, driver='GPKG', engine='pyogrio', mode='w', layer=self.polygons_layer_name,
                                  promote_to_multi=True, index=False)
                     gdf = joined
@@ -281,6 +257,13 @@ class Project:
     def data_folder(self):
         return os.path.join(self.path, self.data_folder_name)
 
+    def coverage_index_path(self, grid_hash: str = None):
+        """
+        The path of the coverage index of the project polygons over the pixel grid identified by grid_hash
+        """
+        name, _ = os.path.splitext(self.geopackage_file_name)
+        return os.path.join(self.data_folder, f'{name}.{grid_hash}.coverage.npz')
+
     @property
     def config_file(self):
         return os.path.join(self.path, self.config_file_name)
@@ -321,44 +304,23 @@ class Project:
             json.dump(data, cfgf, indent=4)
 
 
-    def upload(self, progress=None, overwrite=False, max_concurrency=8):
+    def upload(self, progress=None, overwrite=False, max_concurrency=8, parallel=SYNC_PARALLEL):
         """
-        Uploads a folder representing a rapida propject to the Azure account and file share set through rapida init
+        Uploads a folder representing a rapida propject to the Azure account and file share set through rapida init.
+        Only the files that changed since the last upload are transferred (see rapida.project.manifest)
 
-        :param project_folder: str, the full path to the project folder
         :param progress: optional, instance of rich progress to report upload status
         :param overwrite: bool, default = false, whether the files in the project located remotely should be overwritten
-        :param max_concurrency: int, the number of threads to use in low level azure api when uploading
         in case they already exists
-        :return: None
+        :param max_concurrency: int, the number of threads to use in low level azure api when uploading
+        :param parallel: int, the number of files uploaded at the same time
+        :return: list of the uploaded files relative to the project folder
         """
-        with Session() as session:
-            account_name = session.get_account_name()
-            share_name = session.get_file_share_name()
-            account_url = f'https://{account_name}.file.core.windows.net'
-            project_name = self._cfg_["name"]
-            project_folder = self.path
-            with ShareClient(account_url=account_url, share_name=share_name,
-                             credential=session.get_credential(), token_intent='backup') as sc:
-                with sc.get_directory_client(project_name) as project_dir_client:
-                    for root, dirs, files in os.walk(project_folder):
-                        directory_name = os.path.relpath(root, project_folder)
-                        dc = project_dir_client.get_subdirectory_client(directory_name=directory_name)
-                        if not dc.exists():
-                            dc.create_directory()
-                        for name in files:
-                            src_path = os.path.join(root, name)
-                            sfc = dc.get_file_client(name)
-                            if sfc.exists() and not overwrite:
-                                raise FileExistsError(f'{sfc.url} already exists. Set overwrite=True to overwrite')
-                            size = os.path.getsize(src_path)
-                            with open(src_path, 'rb') as src:
-                                if progress:
-                                    with progress.wrap_file(src, total=size, description=f'Uploading {name} ', ) as up:
-                                        dc.upload_file(name, up, max_concurrency=max_concurrency)
-                                        up.progress.remove_task(up.task)
-                                else:
-                                    dc.upload_file(name, src_path, max_concurrency=max_concurrency)
+        project_name = self._cfg_["name"]
+        with get_share_client() as sc:
+            with sc.get_directory_client(project_name) as project_dir_client:
+                return upload_folder(folder=self.path, dir_client=project_dir_client, overwrite=overwrite,
+                                     parallel=parallel, max_concurrency=max_concurrency, progress=progress)
 
 
     def delete(self, no_input=False):
@@ -426,29 +388,25 @@ class Project:
                         del self._cfg_["publish_info"]
                         self.save(load_default=False)
 
-        with Session() as session:
-            share_name = session.get_file_share_name()
-            account_url = session.get_file_share_account_url()
-            with ShareClient(account_url=account_url, share_name=share_name,
-                             credential=session.get_credential(), token_intent='backup') as sc:
-                # check if the project exists in Azure File Share
-                target_project = None
-                logger.info(f"Searching for the project '{project_name}' in Azure...")
-
-                for entry in sc.list_directories_and_files(name_starts_with=project_name):
-                    if entry.is_directory:
-                        if entry.name == project_name:
-                            target_project = entry.name
-
-                if target_project is None:
-                    logger.warning(f'Project: {project_name} not found in Azure.')
+        with get_share_client() as sc:
+            # check if the project exists in Azure File Share
+            target_project = None
+            logger.info(f"Searching for the project '{project_name}' in Azure...")
+
+            for entry in sc.list_directories_and_files(name_starts_with=project_name):
+                if entry.is_directory:
+                    if entry.name == project_name:
+                        target_project = entry.name
+
+            if target_project is None:
+                logger.warning(f'Project: {project_name} not found in Azure.')
+            else:
+                if no_input or click.confirm(f"Project: {project_name} was found. Yes to continue deleting it, or No/Enter to exit. ",
+                                 default=False):
+                    delete_directory_recursive(sc, target_project)
+                    logger.info(f'Successfully deleted the project from Azure: {project_name}.')
                 else:
-                    if no_input or click.confirm(f"Project: {project_name} was found. Yes to continue deleting it, or No/Enter to exit. ",
-                                     default=False):
-                        delete_directory_recursive(sc, target_project)
-                        logger.info(f'Successfully deleted the project from Azure: {project_name}.')
-                    else:
-                        logger.info(f'Cancelled to delete the project from Azure: {project_name}.')
+                    logger.info(f'Cancelled to delete the project from Azure: {project_name}.')
 
         if no_input or click.confirm(
                 f'Do want to continue deleting {self.name} located in {self.path} locally?',
@@ -0,0 +1,332 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+from exactextract import exact_extract
+from osgeo import gdal
+
+from rapida import constants
+
+logger = logging.getLogger(__name__)
+gdal.UseExceptions()
+
+COVERAGE_INDEX_VERSION = 1
+INDEX_OPERATIONS = 'sum', 'mean', 'count', 'min', 'max'
+
+
+def grid_signature(raster_path: str = None) -> dict:
+    """
+    Describe the pixel grid of a raster
+
+    :param raster_path: str, path to raster
+    :return: dict with geotransform, size and projection of the raster
+    """
+    with gdal.OpenEx(raster_path, gdal.OF_RASTER | gdal.OF_READONLY) as ds:
+        return dict(
+            geotransform=[round(e, 6) for e in ds.GetGeoTransform()],
+            size=[ds.RasterXSize, ds.RasterYSize],
+            projection=ds.GetProjection(),
+        )
+
+
+def grid_hash(grid: dict = None) -> str:
+    """
+    A short hash of a grid signature used to name the coverage index files, one per grid
+    """
+    return hashlib.sha1(json.dumps(grid, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def layer_signature(polygon_ds: str = None, polygon_layer: str = None) -> str:
+    """
+    Compute a cheap signature of a polygon layer that changes every time the layer is rewritten.
+    It combines the GeoPackage last_change timestamp with the feature count and extent of the layer.
+
+    :param polygon_ds: str, path to the vector dataset
+    :param polygon_layer: str, layer name
+    :return: str, hex digest
+    """
+    with gdal.OpenEx(polygon_ds, gdal.OF_VECTOR | gdal.OF_READONLY) as ds:
+        lyr = ds.GetLayerByName(polygon_layer)
+        assert lyr is not None, f'Layer {polygon_layer} does not exist in {polygon_ds}'
+        parts = [polygon_layer, lyr.GetFeatureCount(), [round(e, 6) for e in lyr.GetExtent()]]
+        if ds.GetDriver().ShortName == 'GPKG':
+            sql = f"SELECT last_change FROM gpkg_contents WHERE table_name = '{polygon_layer}'"
+            with ds.ExecuteSQL(sql) as res:
+                for feat in res:
+                    parts.append(feat.GetField(0))
+        else:
+            parts.append(os.path.getmtime(polygon_ds))
+    return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+class CoverageIndex:
+    """
+    Sparse polygon x pixel coverage weights of a polygon layer over a pixel grid.
+
+    Every project raster is warped onto the same grid, so the fraction of every pixel covered by every
+    polygon is the same for all raster variables. The weights are computed once with exactextract and
+    persisted next to the GeoPackage. Zonal sum/mean/count become a sparse matrix-vector product per raster
+    and min/max a grouped reduction over the covered pixels.
+
+    The non zero weights are stored in coordinate format sorted by pixel (cell) so the rasters can be
+    streamed by block rows and only the pixels covered by the polygons are ever looked up.
+    """
+
+    _lock_ = threading.Lock()  # the variables of a component are evaluated concurrently
+
+    def __init__(self, keys: np.ndarray = None, rows: np.ndarray = None, cells: np.ndarray = None,
+                 weights: np.ndarray = None, grid: dict = None, signature: str = None, key: str = None):
+        self.keys = keys
+        self.rows = rows
+        self.cells = cells
+        self.weights = weights
+        self.grid = grid
+        self.signature = signature
+        self.key = key
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nnz(self):
+        return len(self.cells)
+
+    @classmethod
+    def build(cls, polygon_ds: str = None, polygon_layer: str = None, template_raster: str = None,
+              key: str = constants.POLYGONS_ID_COLUMN, progress=None):
+        """
+        Compute the coverage weights of polygon_layer over the grid of template_raster
+
+        :param polygon_ds: str, path to the vector dataset
+        :param polygon_layer: str, layer name
+        :param template_raster: str, path to a raster defining the grid
+        :param key: str, the polygon column the rows of the index are keyed by
+        :param progress: rich progress instance
+        :return: CoverageIndex
+        """
+        logger.debug(f'Building coverage index for {polygon_ds}:{polygon_layer} over {template_raster}')
+        signature = layer_signature(polygon_ds=polygon_ds, polygon_layer=polygon_layer)
+        task = None
+        progress_callback = None
+        if progress is not None:
+            task = progress.add_task(description=f'Building coverage index for {polygon_layer}', total=100)
+            def progress_callback(completed, message, progress=progress, task=task):
+                progress.update(task, completed=int(completed * 100))
+        with gdal.OpenEx(polygon_ds, gdal.OF_VECTOR | gdal.OF_READONLY) as ds:
+            lyr = ds.GetLayerByName(polygon_layer)
+            df = exact_extract(template_raster, lyr, ops=['cell_id', 'coverage'], include_cols=[key],
+                               output='pandas', progress=progress_callback or False)
+        if progress is not None:
+            progress.remove_task(task)
+
+        counts = df['cell_id'].map(len).to_numpy()
+        rows = np.repeat(np.arange(len(df), dtype='i4'), counts)
+        cells = np.concatenate(df['cell_id'].tolist()).astype('i8') if counts.sum() else np.empty(0, 'i8')
+        weights = np.concatenate(df['coverage'].tolist()).astype('f4') if counts.sum() else np.empty(0, 'f4')
+        order = np.argsort(cells, kind='stable')
+        keys = df[key].to_numpy()
+        if keys.dtype == object:
+            keys = keys.astype(str)
+        return cls(keys=keys, rows=rows[order], cells=cells[order], weights=weights[order],
+                   grid=grid_signature(template_raster), signature=signature, key=key)
+
+    def save(self, path: str = None):
+        meta = dict(version=COVERAGE_INDEX_VERSION, grid=self.grid, signature=self.signature, key=self.key)
+        tmp_path = f'{path}.tmp.npz'
+        np.savez_compressed(tmp_path, keys=self.keys, rows=self.rows, cells=self.cells, weights=self.weights,
+                            meta=np.array(json.dumps(meta)))
+        os.replace(tmp_path, path)
+        logger.debug(f'Saved coverage index with {self.nnz} weights to {path}')
+
+    @staticmethod
+    def read_meta(path: str = None) -> dict:
+        """
+        Read the metadata (version, grid, signature and key) of a persisted index without loading the weights
+        """
+        with np.load(path) as npz:
+            return json.loads(str(npz['meta']))
+
+    @classmethod
+    def load(cls, path: str = None):
+        with np.load(path) as npz:
+            meta = json.loads(str(npz['meta']))
+            if meta.get('version') != COVERAGE_INDEX_VERSION:
+                return None
+            return cls(keys=npz['keys'], rows=npz['rows'], cells=npz['cells'], weights=npz['weights'],
+                       grid=meta['grid'], signature=meta['signature'], key=meta['key'])
+
+    def covers(self, raster_path: str = None) -> bool:
+        """
+        Check the raster was warped onto the grid this index was computed for
+        """
+        return grid_signature(raster_path) == self.grid
+
+    @classmethod
+    def for_project(cls, project=None, template_raster: str = None, progress=None):
+        """
+        Load the coverage index of the project polygons or (re)build it when the polygons layer or
+        the grid have changed since it was persisted
+
+        :param project: rapida Project instance
+        :param template_raster: str, path to a raster aligned to the project grid
+        :param progress: rich progress instance
+        :return: CoverageIndex
+        """
+        with cls._lock_:
+            return cls._for_project_(project=project, template_raster=template_raster, progress=progress)
+
+    @classmethod
+    def _for_project_(cls, project=None, template_raster: str = None, progress=None):
+        path = project.coverage_index_path(grid_hash=grid_hash(grid_signature(template_raster)))
+        polygon_ds = project.geopackage_file_path
+        polygon_layer = project.polygons_layer_name
+        signature = layer_signature(polygon_ds=polygon_ds, polygon_layer=polygon_layer)
+        if os.path.exists(path):
+            try:
+                index = cls.load(path)
+                if index is not None and index.covers(template_raster) and index.signature == signature:
+                    return index
+                logger.info(f'Coverage index {path} is out of date and will be rebuilt')
+            except Exception as e:
+                logger.info(f'Failed to load coverage index {path}: {e}. It will be rebuilt')
+        index = cls.build(polygon_ds=polygon_ds, polygon_layer=polygon_layer, template_raster=template_raster,
+                          progress=progress)
+        index.save(path)
+        cls.prune(pattern=project.coverage_index_path(grid_hash='*'), signature=signature)
+        return index
+
+    @classmethod
+    def prune(cls, pattern: str = None, signature: str = None):
+        """
+        Remove the persisted indices that were computed for an older version of the polygons layer or in an
+        older format. The indices of the other grids are kept as long as they are up to date
+
+        :param pattern: str, glob pattern matching the index files of a project
+        :param signature: str, the current signature of the polygons layer
+        """
+        for path in glob.glob(pattern):
+            try:
+                meta = cls.read_meta(path)
+                stale = meta.get('version') != COVERAGE_INDEX_VERSION or meta.get('signature') != signature
+            except Exception as e:
+                logger.debug(f'Failed to read coverage index {path}: {e}')
+                stale = True
+            if stale:
+                logger.debug(f'Removing stale coverage index {path}')
+                os.remove(path)
+
+    def reduce(self, raster_path: str = None, mask_path: str = None):
+        """
+        Stream a raster by block rows and compute for every polygon the coverage weighted sum of the valid pixel
+        values, the covered area (count) of the valid pixels and the min/max of the valid covered pixels.
+
+        When a mask is supplied the same statistics are computed also over the valid pixels that are covered by
+        the mask (valid and non zero mask pixels) in the same read of the raster.
+
+        :param raster_path: str, path to a raster aligned to the index grid
+        :param mask_path: str, optional path to a mask raster aligned to the index grid
+        :return: tuple of dicts (stats, masked stats) with sum, count, min and max numpy arrays. The masked stats
+        are None if no mask was supplied
+        """
+        n = len(self.keys)
+
+        def empty():
+            return dict(sum=np.zeros(n, dtype='f8'), count=np.zeros(n, dtype='f8'),
+                        min=np.full(n, np.inf), max=np.full(n, -np.inf))
+
+        def accumulate(stats, rows, weights, values):
+            stats['sum'] += np.bincount(rows, weights=weights * values, minlength=n)
+            stats['count'] += np.bincount(rows, weights=weights, minlength=n)
+            np.minimum.at(stats['min'], rows, values)
+            np.maximum.at(stats['max'], rows, values)
+
+        stats = empty()
+        masked = empty() if mask_path is not None else None
+        mask_ds = mask_band = mask_nodata = None
+        if mask_path is not None:
+            mask_ds = gdal.OpenEx(mask_path, gdal.OF_RASTER | gdal.OF_READONLY)
+            mask_band = mask_ds.GetRasterBand(1)
+            mask_nodata = mask_band.GetNoDataValue()
+        try:
+            with gdal.OpenEx(raster_path, gdal.OF_RASTER | gdal.OF_READONLY) as ds:
+                band = ds.GetRasterBand(1)
+                nodata = band.GetNoDataValue()
+                width, height = ds.RasterXSize, ds.RasterYSize
+                _, block_ysize = band.GetBlockSize()
+                for yoff in range(0, height, block_ysize):
+                    ysize = min(block_ysize, height - yoff)
+                    start, end = np.searchsorted(self.cells, (yoff * width, (yoff + ysize) * width))
+                    if start == end:
+                        continue
+                    cells = self.cells[start:end] - yoff * width
+                    data = band.ReadAsArray(0, yoff, width, ysize).ravel()
+                    values = data[cells].astype('f8')
+                    valid = ~np.isnan(values)
+                    if nodata is not None:
+                        valid &= values != nodata
+                    rows = self.rows[start:end][valid]
+                    weights = self.weights[start:end][valid]
+                    values = values[valid]
+                    accumulate(stats, rows, weights, values)
+                    if mask_band is not None:
+                        mask = mask_band.ReadAsArray(0, yoff, width, ysize).ravel()[cells][valid]
+                        covered = mask != 0
+                        if mask_nodata is not None:
+                            covered &= mask != mask_nodata
+                        accumulate(masked, rows[covered], weights[covered], values[covered])
+        finally:
+            mask_ds = None
+        for e in (stats, masked):
+            if e is not None:
+                empty_rows = e['count'] == 0
+                e['min'][empty_rows] = np.nan
+                e['max'][empty_rows] = np.nan
+        return stats, masked
+
+    def zonal_table(self, src_rasters: Iterable[str] = None, vars_ops: Iterable[tuple] = None,
+                    mask: str = None, affected_suffix: str = '_affected') -> pd.DataFrame:
+        """
+        Compute sum/mean/count/min/max zonal statistics from the coverage weights.
+        Has the same semantics as raster_zonal_stats.zonal_table
+
+        :param src_rasters: iterable of raster paths aligned to the index grid
+        :param vars_ops: iterable of (var_name, operation) with same length as src_rasters
+        :param mask: str, optional path to a mask raster aligned to the index grid. If supplied, every variable
+        is also computed over the masked pixels into a {var_name}{affected_suffix} column
+        :param affected_suffix: str
+        :return: pandas DataFrame indexed by the key of the index
+        """
+        data = dict()
+
+        def add(var_name, operation, stats):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                stats['mean'] = np.where(stats['count'] > 0, stats['sum'] / stats['count'], np.nan)
+            if isinstance(operation, str):
+                data[var_name] = stats[operation]
+            else:
+                for op in operation:
+                    data[f'{var_name}_{op}'] = stats[op]
+
+        for src_raster, (var_name, operation) in zip(src_rasters, vars_ops):
+            stats, masked = self.reduce(raster_path=src_raster, mask_path=mask)
+            add(var_name, operation, stats)
+            if masked is not None:
+                add(f'{var_name}{affected_suffix}', operation, masked)
+        return pd.DataFrame(data, index=pd.Index(self.keys, name=self.key))
+
+    @staticmethod
+    def supports(vars_ops: Iterable[tuple] = None) -> bool:
+        """
+        Check if all operations can be computed through the index
+        """
+        for _, operation in vars_ops:
+            ops = [operation] if isinstance(operation, str) else operation
+            if not all(op in INDEX_OPERATIONS for op in ops):
+                return False
+        return True
@@ -1,20 +1,30 @@
 import io
 import os.path
 import logging
+import tempfile
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import pandas as pd
 import pyarrow as pa
+import pyogrio
 import geopandas
-from exactextract import exact_extract
+from exactextract import exact_extract, Operation
+from exactextract.raster import GDALRasterSource
 from typing import Iterable
 from geopandas import GeoDataFrame
-from osgeo import gdal, ogr, osr
-from pygments.lexer import combined
+from osgeo import gdal, osr
 
+from rapida import constants
 from rapida.util.proj_are_equal import proj_are_equal
-from osgeo_utils.gdal_calc import Calc
-import pandas as pd
+from rapida.util.raster_calc import mask_raster, sum_rasters, warp_to_grid
+
 logger = logging.getLogger(__name__)
 gdal.UseExceptions()
 
+# exactextract operations used to compute the stats over the pixels covered by a mask
+WEIGHTED_OPERATIONS = {'sum': 'weighted_sum', 'mean': 'weighted_mean'}
+
 
 def geoarrow_schema_adapter(schema: pa.Schema, geom_field_name=None) -> pa.Schema:
     """
@@ -44,88 +54,22 @@ def geoarrow_schema_adapter(schema: pa.Schema, geom_field_name=None) -> pa.Schem
     return geoarrow_schema
 
 def calc(src_rasters:Iterable[str]=None, dst_raster=None, overwrite=False):
-    assert dst_raster not in ('', None), f'Invalid dst_raster={dst_raster}'
-    assert os.path.isabs(dst_raster), f'{dst_raster} is not an absolute path'
-    target_srs = None
-    files_to_sum = list()
-    for n, src_raster in enumerate(src_rasters):
-        prep_src_raster = None
-        with gdal.OpenEx(src_raster) as src_rds:
-            src_rast_srs = src_rds.GetSpatialRef()
-            assert src_rast_srs is not None, f'Could not fetch SRS for {src_raster}'
-            target_srs = src_rast_srs
-            srs_are_equal = proj_are_equal(src_srs=target_srs, dst_srs=src_rast_srs)
-            if not srs_are_equal:
-                _, ext = os.path.splitext(src_raster)
-                _, raster_fname = os.path.split(src_raster)
-                prep_src_raster = f'/vsimem/{raster_fname.replace(ext, ".vrt")}'
-                logger.info(f'Creating {prep_src_raster} VRT for {src_raster}')
-                gdal.Warp(prep_src_raster, src_raster, format='VRT', dstSRS=target_srs,
-                          creationOptions={'BLOCKXSIZE': 256, 'BLOCKYSIZE': 256})
-            band = src_rds.GetRasterBand(1)
-            block_size_x, block_size_y = band.GetBlockSize()
-            # Get raster size
-            width = src_rds.RasterXSize  # Number of columns
-            height = src_rds.RasterYSize  # Number of rows
-
-            intrs = set((height, width)).intersection((block_size_y, block_size_x))
-            if intrs:
-                _, ext = os.path.splitext(src_raster)
-                _, raster_fname = os.path.split(src_raster)
-                prep_src_raster = f'/vsimem/{raster_fname.replace(ext, ".vrt")}'
-                logger.info(f'Creating {prep_src_raster} VRT for {src_raster}')
-                gdal.Warp(prep_src_raster, src_raster, format='VRT',
-                          creationOptions={'BLOCKXSIZE': 256, 'BLOCKYSIZE': 256})
-            if prep_src_raster is None:
-                prep_src_raster = src_raster
-            files_to_sum.append(prep_src_raster)
-
-    creation_options = 'TILED=YES COMPRESS=ZSTD BIGTIFF=IF_SAFER BLOCKXSIZE=256 BLOCKYSIZE=256 PREDICTOR=2'
-    ds = Calc(calc='sum(a,axis=0)', a=files_to_sum, outfile=dst_raster, projectionCheck=True, format='GTiff',
-              creation_options=creation_options.split(' '), quiet=True, overwrite=overwrite)
+    sumup(src_rasters=src_rasters, dst_raster=dst_raster, overwrite=overwrite)
 
 
 def sumup(src_rasters:Iterable[str]=None, dst_raster=None, overwrite=False) -> str:
+    """
+    Sum aligned rasters into dst_raster. The nodata pixels are treated as zero and the output is nodata only
+    where all the inputs are nodata.
+
+    :param src_rasters: iterable of raster paths sharing the same grid
+    :param dst_raster: str, absolute path to the output GeoTiff
+    :param overwrite: bool, overwrite dst_raster if it exists
+    :return: dst_raster
+    """
     assert dst_raster not in ('', None), f'Invalid dst_raster={dst_raster}'
     assert os.path.isabs(dst_raster), f'{dst_raster} is not an absolute path'
-    target_srs = None
-    files_to_sum = list()
-    for n, src_raster in enumerate(src_rasters):
-        prep_src_raster = None
-        with gdal.OpenEx(src_raster) as src_rds:
-            src_rast_srs = src_rds.GetSpatialRef()
-            assert src_rast_srs is not None, f'Could not fetch SRS for {src_raster}'
-            target_srs = src_rast_srs
-            srs_are_equal = proj_are_equal(src_srs=target_srs, dst_srs=src_rast_srs)
-            if not srs_are_equal:
-                _, ext = os.path.splitext(src_raster)
-                _, raster_fname = os.path.split(src_raster)
-                prep_src_raster = f'/vsimem/{raster_fname.replace(ext, ".vrt")}'
-                logger.info(f'Creating {prep_src_raster} VRT for {src_raster}')
-                gdal.Warp(prep_src_raster, src_raster, format='VRT', dstSRS=target_srs,
-                          creationOptions={'BLOCKXSIZE': 256, 'BLOCKYSIZE': 256})
-            band = src_rds.GetRasterBand(1)
-            block_size_x, block_size_y = band.GetBlockSize()
-            # Get raster size
-            width = src_rds.RasterXSize  # Number of columns
-            height = src_rds.RasterYSize  # Number of rows
-
-            intrs = set((height,width)).intersection((block_size_y,block_size_x))
-            if intrs:
-                _, ext = os.path.splitext(src_raster)
-                _, raster_fname = os.path.split(src_raster)
-                prep_src_raster = f'/vsimem/{raster_fname.replace(ext, ".vrt")}'
-                logger.info(f'Creating {prep_src_raster} VRT for {src_raster}')
-                gdal.Warp(prep_src_raster, src_raster, format='VRT',
-                          creationOptions={'BLOCKXSIZE': 256, 'BLOCKYSIZE': 256})
-            if prep_src_raster is None:
-                prep_src_raster = src_raster
-            files_to_sum.append(prep_src_raster)
-    creation_options = 'TILED=YES COMPRESS=ZSTD BIGTIFF=IF_SAFER BLOCKXSIZE=256 BLOCKYSIZE=256 PREDICTOR=2'
-    ds = Calc(calc='sum(a,axis=0)', a=files_to_sum, outfile=dst_raster, projectionCheck=True, format='GTiff',
-         creation_options=creation_options.split(' '), quiet=True, overwrite=overwrite)
-    ds = None
-    return dst_raster
+    return sum_rasters(src_rasters=src_rasters, dst_path=dst_raster, overwrite=overwrite)
 
 def zonal_stats(src_rasters:Iterable[str] = None, polygon_ds=None, polygon_layer=None,
                 vars_ops:Iterable[tuple[str, str]]=None, target_proj='ESRI:54009') -> GeoDataFrame:
@@ -217,44 +161,303 @@ def zonal_stats(src_rasters:Iterable[str] = None, polygon_ds=None, polygon_layer
 
         return combined_results
 
-def zst(src_rasters:Iterable[str] = None, polygon_ds=None, polygon_layer=None,
-                vars_ops:Iterable[tuple[str, str]]=None, progress=None):
+def _prepare_operations_(src_rasters:Iterable[str]=None, vars_ops:Iterable[tuple]=None, poly_srs=None,
+                         mask=None, affected_suffix='_affected'):
+    """
+    Translate the (raster, (var_name, operation)) pairs into exactextract operations.
+
+    Every raster is opened once as a named raster source and every operation gets an explicit
+    output field name so all (raster, op) pairs can be evaluated in one exactextract sweep.
+
+    :param src_rasters: iterable of raster paths
+    :param vars_ops: iterable of (var_name, operation) with same length as src_rasters. The operation can be a
+    single exactextract stat (sum, mean, count, frac...) in which case the output column is var_name or an
+    iterable of stats in which case the output columns are named {var_name}_{op}
+    :param poly_srs: osr.SpatialReference of the polygons
+    :param mask: str, optional path to a mask raster aligned to src_rasters. If supplied every operation is also
+    computed as a weighted operation using the mask as weights (0 for the pixels outside the mask) into
+    {var_name}{affected_suffix} columns. Only the operations in WEIGHTED_OPERATIONS are supported
+    :param affected_suffix: str
+    :return: tuple(list of raster sources, list of operations, list of output columns)
+    """
+    rasters = list()
+    operations = list()
+    columns = list()
+    weights = GDALRasterSource(mask, band_idx=1, name='mask') if mask is not None else None
+    for src_raster, (var_name, operation) in zip(src_rasters, vars_ops):
+        with gdal.OpenEx(src_raster, gdal.OF_RASTER | gdal.OF_READONLY) as srcds:
+            src_srs = srcds.GetSpatialRef()
+            assert proj_are_equal(src_srs=src_srs, dst_srs=poly_srs), f'{src_raster}  features wrong projection'
+        rsrc = GDALRasterSource(src_raster, band_idx=1, name=var_name)
+        rasters.append(rsrc)
+        ops = [operation] if isinstance(operation, str) else list(operation)
+        for op in ops:
+            column = var_name if isinstance(operation, str) else f'{var_name}_{op}'
+            operations.append(Operation(op, column, rsrc, None, {}))
+            columns.append(column)
+        if weights is not None:
+            affected_var_name = f'{var_name}{affected_suffix}'
+            for op in ops:
+                column = affected_var_name if isinstance(operation, str) else f'{affected_var_name}_{op}'
+                operations.append(Operation(WEIGHTED_OPERATIONS[op], column, rsrc, weights, {'default_weight': '0'}))
+                columns.append(column)
+    return rasters, operations, columns
+
+
+def _output_columns_(vars_ops:Iterable[tuple]=None, mask=None, affected_suffix='_affected'):
+    """
+    The names of the columns computed for vars_ops, in the same order as _prepare_operations_
+    """
+    columns = list()
+    for var_name, operation in vars_ops:
+        names = [var_name] + ([f'{var_name}{affected_suffix}'] if mask is not None else [])
+        for name in names:
+            if isinstance(operation, str):
+                columns.append(name)
+            else:
+                columns.extend(f'{name}_{op}' for op in operation)
+    return columns
+
+
+def _zonal_shard_(src_rasters:Iterable[str] = None, vars_ops:Iterable[tuple]=None, geometries=None, keys=None,
+                  crs_wkt=None, key=None, max_cells_in_memory=None, mask=None,
+                  affected_suffix='_affected') -> pd.DataFrame:
+    """
+    Compute zonal stats for one shard of polygons. Runs inside a worker process so all the arguments are
+    plain picklable values (paths, WKB geometries and keys).
+    """
+    gdal.UseExceptions()
+    poly_srs = osr.SpatialReference()
+    poly_srs.ImportFromWkt(crs_wkt)
+    gdf = GeoDataFrame({key: keys}, geometry=geopandas.GeoSeries.from_wkb(geometries, crs=crs_wkt))
+    rasters, operations, columns = _prepare_operations_(src_rasters=src_rasters, vars_ops=vars_ops,
+                                                        poly_srs=poly_srs, mask=mask,
+                                                        affected_suffix=affected_suffix)
+    df = exact_extract(rasters, gdf, ops=operations, include_cols=[key], output='pandas',
+                       max_cells_in_memory=max_cells_in_memory)
+    return df.set_index(key)[columns]
+
+
+def partitioned_zonal_table(src_rasters:Iterable[str] = None, polygon_ds=None, polygon_layer=None,
+                            vars_ops:Iterable[tuple]=None, key=constants.POLYGONS_ID_COLUMN, workers=None,
+                            shard_size=5000, max_cells_in_memory=10_000_000, mask=None,
+                            affected_suffix='_affected', progress=None) -> pd.DataFrame:
+    """
+    Compute zonal statistics in parallel over spatially compact shards of the polygons layer.
+
+    The polygons are sorted along a Hilbert curve and split in contiguous shards of shard_size features so
+    every shard covers a compact area and exactextract reads only a few raster windows per shard.
+    Every shard is processed in a separate process with at most max_cells_in_memory raster cells loaded at
+    once. The results are merged back in the order of the polygons layer so the output does not depend on the
+    order the shards complete.
+
+    :param src_rasters: iterable of strings representing paths to the raster files
+    :param polygon_ds: str, path to the vector dataset
+    :param polygon_layer: str, the name of the layer in polygon_ds
+    :param vars_ops: iterable of (var_name, operation) with same length as src_rasters
+    :param key: str, the name of the column used to key the results
+    :param workers: int, number of worker processes, defaults to the number of CPUs
+    :param shard_size: int, max number of polygons per shard
+    :param max_cells_in_memory: int, max number of raster cells a worker loads at once
+    :param mask: str, optional path to a mask raster aligned to src_rasters, see zonal_table
+    :param affected_suffix: str, see zonal_table
+    :param progress: rich progress instance
+    :return: pandas DataFrame indexed by key
+    """
+    src_rasters = list(src_rasters)
+    vars_ops = list(vars_ops)
+    workers = workers or os.cpu_count()
+
+    gdf = geopandas.read_file(polygon_ds, layer=polygon_layer,
+                              columns=[key] if key in pyogrio.read_info(polygon_ds, layer=polygon_layer)['fields'] else [])
+    if key not in gdf.columns:
+        gdf[key] = range(len(gdf))
+    if len(gdf) == 0:
+        return pd.DataFrame(columns=_output_columns_(vars_ops=vars_ops, mask=mask, affected_suffix=affected_suffix),
+                            index=pd.Index(gdf[key], name=key), dtype='f8')
+    crs_wkt = gdf.crs.to_wkt()
+    order = gdf.geometry.hilbert_distance().argsort(kind='stable').to_numpy()
+    nshards = max(workers, -(-len(gdf) // shard_size))
+    shards = [e for e in np.array_split(order, nshards) if len(e)]
+
+    task = None
+    if progress is not None:
+        task = progress.add_task(description=f"Running zonalstats in {len(shards)} shards with {workers} workers",
+                                 total=len(shards))
+    results = dict()
+    mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+        futures = dict()
+        for n, shard in enumerate(shards):
+            part = gdf.iloc[shard]
+            future = executor.submit(_zonal_shard_, src_rasters=src_rasters, vars_ops=vars_ops,
+                                     geometries=part.geometry.to_wkb().to_numpy(), keys=part[key].to_numpy(),
+                                     crs_wkt=crs_wkt, key=key, max_cells_in_memory=max_cells_in_memory,
+                                     mask=mask, affected_suffix=affected_suffix)
+            futures[future] = n
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+                if progress is not None:
+                    progress.update(task, advance=1)
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            if progress is not None:
+                progress.remove_task(task)
+
+    df = pd.concat([results[n] for n in range(len(shards))])
+    return df.reindex(gdf[key].to_numpy())
+
+
+def zonal_table(src_rasters:Iterable[str] = None, polygon_ds=None, polygon_layer=None,
+                vars_ops:Iterable[tuple]=None, key=constants.POLYGONS_ID_COLUMN, coverage_index=None,
+                mask=None, affected_suffix='_affected', workers=None, progress=None) -> pd.DataFrame:
+    """
+    Compute zonal statistics for several rasters and several operations in a single pass over the polygons.
 
+    The polygon coverage is computed once per feature and all (raster, op) pairs are evaluated in the same sweep.
+    The result is keyed by the key column (h3id) of the polygons layer. If the layer does not feature the
+    key column the result is indexed by the position of the features in the layer.
+
+    :param src_rasters: iterable of strings representing paths to the raster files
+    :param polygon_ds: str, path to the vector dataset
+    :param polygon_layer: str, the name of the layer in polygon_ds
+    :param vars_ops: iterable of (var_name, operation) with same length as src_rasters
+    :param key: str, the name of the column used to key the results
+    :param coverage_index: optional CoverageIndex. When all operations are supported by the index
+    (sum, mean, count, min, max) and all rasters are aligned to its grid, the stats are computed from the
+    persisted coverage weights instead
+    :param mask: str, optional path to a mask raster (ex: project.raster_mask). When supplied every variable is
+    also computed over the pixels covered by the mask (valid and non zero mask pixels) into a
+    {var_name}{affected_suffix} column, in the same read of the rasters. The mask is warped on the fly if it
+    is not aligned to the rasters
+    :param affected_suffix: str, suffix of the columns computed over the mask
+    :param workers: int, when larger than 1 the stats are computed in parallel over shards of the polygons,
+    see partitioned_zonal_table
+    :param progress: rich progress instance
+    :return: pandas DataFrame indexed by key
+    """
+    src_rasters = list(src_rasters)
+    vars_ops = list(vars_ops)
+    assert len(src_rasters) == len(vars_ops), f'src_rasters and vars_ops need to have the same length'
+
+    aligned_mask = None
+    if mask is not None:
+        # the rasters evaluated together share the same grid
+        aligned_mask = warp_to_grid(src_path=mask, template_path=src_rasters[0])
+    try:
+        if (coverage_index is not None and coverage_index.key == key and coverage_index.supports(vars_ops) and
+                all(coverage_index.covers(r) for r in src_rasters)):
+            logger.debug(f'Computing zonal stats for {", ".join([e[0] for e in vars_ops])} using the coverage index')
+            return coverage_index.zonal_table(src_rasters=src_rasters, vars_ops=vars_ops, mask=aligned_mask,
+                                              affected_suffix=affected_suffix)
+
+        if aligned_mask is not None and not _weighted_(vars_ops):
+            # there is no weighted flavour of these operations in exactextract so the masked rasters
+            # are materialized temporarily
+            with tempfile.TemporaryDirectory() as temp_dir:
+                masked_rasters = list()
+                masked_vars_ops = list()
+                for src_raster, (var_name, operation) in zip(src_rasters, vars_ops):
+                    masked_raster = os.path.join(temp_dir, f'{var_name}{affected_suffix}.tif')
+                    masked_rasters.append(mask_raster(src_path=src_raster, mask_path=aligned_mask,
+                                                      dst_path=masked_raster))
+                    masked_vars_ops.append((f'{var_name}{affected_suffix}', operation))
+                return zonal_table(src_rasters=src_rasters + masked_rasters, polygon_ds=polygon_ds,
+                                   polygon_layer=polygon_layer, vars_ops=vars_ops + masked_vars_ops, key=key,
+                                   workers=workers, progress=progress)
+
+        if workers is not None and workers > 1:
+            return partitioned_zonal_table(src_rasters=src_rasters, polygon_ds=polygon_ds,
+                                           polygon_layer=polygon_layer, vars_ops=vars_ops, key=key,
+                                           workers=workers, mask=aligned_mask, affected_suffix=affected_suffix,
+                                           progress=progress)
+        return _zonal_table_(src_rasters=src_rasters, polygon_ds=polygon_ds, polygon_layer=polygon_layer,
+                             vars_ops=vars_ops, key=key, mask=aligned_mask, affected_suffix=affected_suffix,
+                             progress=progress)
+    finally:
+        if aligned_mask is not None and aligned_mask != mask:
+            os.remove(aligned_mask)
+
+
+def _weighted_(vars_ops:Iterable[tuple]=None) -> bool:
+    """
+    Check all operations have a weighted flavour in exactextract
+    """
+    for _, operation in vars_ops:
+        ops = [operation] if isinstance(operation, str) else operation
+        if not all(op in WEIGHTED_OPERATIONS for op in ops):
+            return False
+    return True
+
+
+def _zonal_table_(src_rasters:Iterable[str] = None, polygon_ds=None, polygon_layer=None,
+                  vars_ops:Iterable[tuple]=None, key=constants.POLYGONS_ID_COLUMN, mask=None,
+                  affected_suffix='_affected', progress=None) -> pd.DataFrame:
+    """
+    Compute the zonal statistics with one exactextract call in the current process, see zonal_table
+    """
 
     with gdal.OpenEx(polygon_ds, gdal.OF_READONLY|gdal.OF_VECTOR) as polyds:
         poly_lyr = polyds.GetLayerByName(polygon_layer)
+        assert poly_lyr is not None, f'Layer {polygon_layer} does not exist in {polygon_ds}'
         poly_srs = poly_lyr.GetSpatialRef()
-        extracted_data = {}
+        lyr_defn = poly_lyr.GetLayerDefn()
+        field_names = [lyr_defn.GetFieldDefn(i).GetName() for i in range(lyr_defn.GetFieldCount())]
+        include_cols = [key] if key in field_names else None
 
-        for n, src_raster in enumerate(src_rasters):
+        rasters, operations, columns = _prepare_operations_(src_rasters=src_rasters, vars_ops=vars_ops,
+                                                            poly_srs=poly_srs, mask=mask,
+                                                            affected_suffix=affected_suffix)
+        task = None
+        if progress is not None:
+            var_names = ", ".join([e[0] for e in vars_ops])
+            task = progress.add_task(description=f"Running zonalstats for {var_names}", total=100)
 
+        def progress_callback(completed, message):
+            progress.update(task, completed=int(completed * 100))
 
-            with gdal.OpenEx(src_raster, gdal.OF_RASTER|gdal.OF_READONLY) as srcds:
-                src_srs = srcds.GetSpatialRef()
-                assert proj_are_equal(src_srs=src_srs, dst_srs=poly_srs), f'{src_raster}  features wrong projection'
-                var_name, operation = vars_ops[n]
-                progress_callback = None
-                if progress is not None:
-                    task = progress.add_task(description=f"Running zonalstats/{operation} for {var_name}")
-                    def progress_callback(completed, message, progress=progress, task=task):
-                        if progress is not None and task is not None:
-                            progress.update(task, completed=int(completed * 100))
-                df = exact_extract(src_raster, poly_lyr, ops=[operation], include_geom=not n, output='pandas', progress=progress_callback or False)
-                df.rename(columns={operation: var_name}, inplace=True)
-                if n == 0:
-                    df['tempid'] = range(1, len(df) + 1)
-                    extracted_data['tempid'] = df['tempid']
-                    extracted_data['geometry'] = df['geometry']
+        df = exact_extract(rasters, poly_lyr, ops=operations, include_cols=include_cols, output='pandas',
+                           progress=progress_callback if progress is not None else False)
+        if progress is not None:
+            progress.remove_task(task)
 
-                extracted_data[var_name] = df[var_name]
-            if progress is not None:
-                progress.remove_task(task)
-        combined = pd.concat(extracted_data, axis=1)
-        combined.drop(columns='tempid', inplace=True)
-        egdf = geopandas.read_file(polygon_ds, layer=polygon_layer)
-        for e in vars_ops:
-            vname = e[0]
-            if vname in egdf.columns.tolist():
-                egdf.drop(columns=[vname], inplace=True)
-        combined = egdf.merge(combined, on='geometry', how='inner')
-        return combined
\ No newline at end of file
+    if include_cols:
+        df.set_index(key, inplace=True)
+    return df[columns]
+
+
+def zst(src_rasters:Iterable[str] = None, polygon_ds=None, polygon_layer=None,
+                vars_ops:Iterable[tuple]=None, key=constants.POLYGONS_ID_COLUMN, coverage_index=None,
+                mask=None, affected_suffix='_affected', workers=None, progress=None) -> GeoDataFrame:
+    """
+    Compute zonal statistics and attach them to the polygons they were computed for.
+
+    The polygons layer is read once by exactextract and once by geopandas and the results are joined
+    on the key column (h3id) or on feature order when the layer does not feature the key column.
+    Existing columns with the same name as the computed variables are replaced.
+
+    :param src_rasters: iterable of strings representing paths to the raster files
+    :param polygon_ds: str, path to the vector dataset
+    :param polygon_layer: str, the name of the layer in polygon_ds
+    :param vars_ops: iterable of (var_name, operation) with same length as src_rasters
+    :param key: str, the name of the column used to join the results to the polygons
+    :param coverage_index: optional CoverageIndex, see zonal_table
+    :param mask: str, optional path to a mask raster, see zonal_table
+    :param affected_suffix: str, see zonal_table
+    :param workers: int, number of processes used to compute the stats, see zonal_table
+    :param progress: rich progress instance
+    :return: GeoDataFrame
+    """
+    stats = zonal_table(src_rasters=src_rasters, polygon_ds=polygon_ds, polygon_layer=polygon_layer,
+                        vars_ops=vars_ops, key=key, coverage_index=coverage_index, mask=mask,
+                        affected_suffix=affected_suffix, workers=workers, progress=progress)
+    egdf = geopandas.read_file(polygon_ds, layer=polygon_layer)
+    egdf.drop(columns=[c for c in stats.columns if c in egdf.columns], inplace=True)
+    if key in egdf.columns:
+        return egdf.merge(stats, left_on=key, right_index=True, how='left')
+    assert len(egdf) == len(stats), f'Could not align zonal stats with {polygon_ds}:{polygon_layer}'
+    return pd.concat([egdf, stats.reset_index(drop=True)], axis=1)
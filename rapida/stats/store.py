@@ -0,0 +1,184 @@
+import logging
+import threading
+from typing import Iterable
+
+import pandas as pd
+import pyarrow as pa
+import pyogrio
+from osgeo import gdal, ogr
+
+from rapida import constants
+
+logger = logging.getLogger(__name__)
+gdal.UseExceptions()
+
+
+class StatsStore:
+    """
+    Column store for the stats.<component> layers.
+
+    The stats layer is created once as a copy of the polygons layer and afterwards only the attribute
+    columns computed by the variables are added or replaced. Columns are buffered in memory, keyed by h3id,
+    and written in one transaction when the outermost context exits, so all variables of a component
+    are written at once and the geometries are never rewritten.
+
+    with StatsStore(dataset_path=project.geopackage_file_path, layer_name='stats.population') as store:
+        store.update(df) # df is keyed by h3id
+        store.read(columns=['male_total'])
+
+    Nested contexts (the component opens the store and passes it to its variables) flush only once.
+    """
+
+    def __init__(self, dataset_path: str = None, layer_name: str = None, key: str = constants.POLYGONS_ID_COLUMN,
+                 template_layer: str = constants.POLYGONS_LAYER_NAME):
+        self.dataset_path = dataset_path
+        self.layer_name = layer_name
+        self.key = key
+        self.template_layer = template_layer
+        self.pending = None
+        self._depth_ = 0
+        self._lock_ = threading.RLock()
+
+    def __enter__(self):
+        with self._lock_:
+            self._depth_ += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._lock_:
+            self._depth_ -= 1
+            if self._depth_ == 0 and exc_type is None:
+                self.flush()
+
+    def _keyed_(self, df: pd.DataFrame = None) -> pd.DataFrame:
+        if df.index.name != self.key:
+            assert self.key in df.columns, f'The dataframe needs to feature a "{self.key}" column or index'
+            df = df.set_index(self.key)
+        if 'geometry' in df.columns:
+            df = df.drop(columns=['geometry'])
+        return df
+
+    def update(self, df: pd.DataFrame = None):
+        """
+        Add or replace columns. The columns are written to the layer when the store is flushed
+
+        :param df: pandas DataFrame featuring the key as column or index
+        """
+        df = self._keyed_(df)
+        with self._lock_:
+            if self.pending is None:
+                self.pending = df.copy()
+            else:
+                replaced = [c for c in df.columns if c in self.pending.columns]
+                self.pending = self.pending.drop(columns=replaced).join(df, how='outer')
+
+    def read(self, columns: Iterable[str] = None) -> pd.DataFrame:
+        """
+        Read columns from the store. Pending (not flushed) columns take precedence over the ones in the layer.
+
+        :param columns: iterable of column names
+        :return: pandas DataFrame indexed by key
+        """
+        columns = list(columns)
+        with self._lock_:
+            pending = self.pending
+            in_memory = [c for c in columns if pending is not None and c in pending.columns]
+            on_disk = [c for c in columns if c not in in_memory]
+            layer_name = self.layer_name if self.layer_name in self.layers() else self.template_layer
+            df = pyogrio.read_dataframe(self.dataset_path, layer=layer_name, columns=[self.key] + on_disk,
+                                        read_geometry=False).set_index(self.key)
+            for c in in_memory:
+                df[c] = pending[c]
+        return df[columns]
+
+    def layers(self):
+        return pyogrio.list_layers(self.dataset_path)[:, 0].tolist()
+
+    def flush(self):
+        """
+        Upsert the pending columns into the stats layer in one transaction
+        """
+        with self._lock_:
+            if self.pending is None or len(self.pending.columns) == 0:
+                return
+            upsert_columns(dataset_path=self.dataset_path, layer_name=self.layer_name, df=self.pending,
+                           key=self.key, template_layer=self.template_layer)
+            self.pending = None
+
+
+def ogr_field_defn(field: pa.Field = None) -> ogr.FieldDefn:
+    """
+    Create the OGR field definition of an arrow field
+
+    :param field: pyarrow Field
+    :return: ogr.FieldDefn
+    """
+    field_type = field.type
+    if pa.types.is_string(field_type) or pa.types.is_large_string(field_type):
+        return ogr.FieldDefn(field.name, ogr.OFTString)
+    if pa.types.is_boolean(field_type):
+        defn = ogr.FieldDefn(field.name, ogr.OFTInteger)
+        defn.SetSubType(ogr.OFSTBoolean)
+        return defn
+    if pa.types.is_integer(field_type):
+        return ogr.FieldDefn(field.name, ogr.OFTInteger64)
+    if pa.types.is_floating(field_type):
+        return ogr.FieldDefn(field.name, ogr.OFTReal)
+    raise ValueError(f'Column "{field.name}" has the unsupported type {field.type}')
+
+
+def upsert_columns(dataset_path: str = None, layer_name: str = None, df: pd.DataFrame = None,
+                   key: str = constants.POLYGONS_ID_COLUMN, template_layer: str = constants.POLYGONS_LAYER_NAME):
+    """
+    Add or replace attribute columns of a GeoPackage layer keyed by key column.
+    If the layer does not exist it is created as a copy of the template_layer.
+
+    The values are first written to a temporary attribute table and then transferred with
+    one UPDATE statement so the whole operation runs in a single transaction.
+
+    :param dataset_path: str, path to the GeoPackage
+    :param layer_name: str, the layer to update
+    :param df: pandas DataFrame indexed by key
+    :param key: str, key column
+    :param template_layer: str, the layer used to create layer_name if it does not exist
+    """
+    tmp_layer_name = f'_{layer_name.replace(".", "_")}_upsert_'
+    table = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+    columns = [c for c in table.column_names if c != key]
+    # the types are checked before the dataset is modified
+    field_defns = [ogr_field_defn(field) for field in table.schema]
+    logger.debug(f'Writing columns "{", ".join(columns)}" to {dataset_path}:{layer_name}')
+
+    with gdal.OpenEx(dataset_path, gdal.OF_VECTOR | gdal.OF_UPDATE) as ds:
+        lyr = ds.GetLayerByName(layer_name)
+        if lyr is None:
+            src_lyr = ds.GetLayerByName(template_layer)
+            assert src_lyr is not None, f'Layer {template_layer} does not exist in {dataset_path}'
+            lyr = ds.CopyLayer(src_lyr, layer_name)
+        if ds.GetLayerByName(tmp_layer_name) is not None:
+            ds.DeleteLayer(tmp_layer_name)
+
+        ds.StartTransaction()
+        try:
+            defn = lyr.GetLayerDefn()
+            existing = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+            tmp_lyr = ds.CreateLayer(tmp_layer_name, geom_type=ogr.wkbNone)
+            for field_defn in field_defns:
+                tmp_lyr.CreateField(field_defn)
+                if field_defn.GetName() != key and field_defn.GetName() not in existing:
+                    lyr.CreateField(field_defn)
+            for batch in table.to_batches():
+                tmp_lyr.WritePyArrow(batch)
+            ds.ExecuteSQL(f'CREATE INDEX "{tmp_layer_name}_key" ON "{tmp_layer_name}" ("{key}")')
+            assignments = ', '.join(
+                [f'"{c}" = (SELECT t."{c}" FROM "{tmp_layer_name}" t WHERE t."{key}" = "{layer_name}"."{key}")'
+                 for c in columns]
+            )
+            ds.ExecuteSQL(f'UPDATE "{layer_name}" SET {assignments}')
+            ds.CommitTransaction()
+        except Exception:
+            ds.RollbackTransaction()
+            raise
+        finally:
+            if ds.GetLayerByName(tmp_layer_name) is not None:
+                ds.DeleteLayer(tmp_layer_name)
@@ -0,0 +1,264 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import stat
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+DATASET_CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.rapida', 'cache')
+DATASET_CACHE_ENV_VAR = 'RAPIDA_CACHE_GB'  # max size of the cache in GB, the cache is disabled when not set or 0
+DATASET_CACHE_DEFAULT_GB = 50
+FICLONE = 0x40049409  # linux ioctl creating a copy on write clone (reflink) of a file
+HTTP_TIMEOUT = 30  # seconds
+
+
+def link_file(src_path: str = None, dst_path: str = None) -> str:
+    """
+    Materialize src_path at dst_path without copying the data when possible. A reflink (copy on write clone) is
+    tried first, then a hard link and last a plain copy when the two paths are on different file systems
+
+    :return: str, the method used, one of reflink, hardlink or copy
+    """
+    tmp_path = f'{dst_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    method = None
+    try:
+        with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        method = 'reflink'
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(src_path, tmp_path)
+            method = 'hardlink'
+        except OSError:
+            shutil.copyfile(src_path, tmp_path)
+            method = 'copy'
+    os.replace(tmp_path, dst_path)
+    return method
+
+
+def source_etag(source: str = None):
+    """
+    A string identifying the version of a source dataset: the ETag (or Last-Modified and length) of a remote
+    file or the size and modification time of a local one
+
+    :param source: str, http(s) URL with or without the /vsicurl/ prefix or local path
+    :return: str or None if the version can not be established
+    """
+    if source.startswith('/vsicurl/'):
+        source = source[len('/vsicurl/'):]
+    if source.startswith(('http://', 'https://')):
+        try:
+            response = httpx.head(source, follow_redirects=True, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.debug(f'Failed to fetch the ETag of {source}: {e}')
+            return
+        etag = response.headers.get('etag')
+        if etag is None and 'last-modified' in response.headers:
+            etag = f'{response.headers["last-modified"]}|{response.headers.get("content-length")}'
+        return etag
+    if os.path.isfile(source):
+        st = os.stat(source)
+        return f'{st.st_size}|{st.st_mtime_ns}'
+
+
+class DatasetCache:
+    """
+    Machine wide, size bounded, least recently used cache of the source datasets downloaded by the projects.
+
+    A dataset is keyed by its source (blob or URL without the query string), the ETag of the source and an
+    optional crop signature describing the transformation applied to the source (polygons, projection,
+    resolution), so different projects covering the same area share one copy and a source that changed is
+    never served from the cache. The cached files are materialized into the projects as reflinks or hard links.
+    A file added as a reflink or a copy is private to the cache and becomes read only; a file added as a hard link
+    shares its inode with the project file and is left writable, so the project output is not made read only.
+
+        cache = get_dataset_cache()
+        if not cache.get(source=url, etag=etag, dst_path=path):
+            download(url, path)
+            cache.put(source=url, etag=etag, path=path)
+    """
+
+    def __init__(self, folder: str = DATASET_CACHE_FOLDER, max_bytes: int = DATASET_CACHE_DEFAULT_GB * 2 ** 30):
+        """
+        :param folder: str, the folder where the cache is stored
+        :param max_bytes: int, the max size in bytes of the cached datasets
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(folder, 'datasets'), exist_ok=True)
+        self._lock_ = threading.RLock()
+        self._db_ = sqlite3.connect(os.path.join(folder, 'index.sqlite'), check_same_thread=False,
+                                    isolation_level=None, timeout=60)
+        with self._lock_:
+            self._db_.execute('PRAGMA journal_mode=WAL')
+            self._db_.execute('CREATE TABLE IF NOT EXISTS datasets (key TEXT PRIMARY KEY, source TEXT, etag TEXT, '
+                              'crop TEXT, name TEXT, size INTEGER, created REAL, accessed REAL, hits INTEGER)')
+            self._db_.execute('CREATE INDEX IF NOT EXISTS datasets_accessed ON datasets(accessed)')
+
+    @staticmethod
+    def _source_key_(source: str = None):
+        if source.startswith('/vsicurl/'):
+            source = source[len('/vsicurl/'):]
+        parts = urlsplit(source)
+        if parts.scheme in ('http', 'https'):
+            return f'{parts.scheme}://{parts.netloc}{parts.path}'
+        return source
+
+    def _key_(self, source: str = None, etag: str = None, crop: str = None):
+        return hashlib.sha1(f'{self._source_key_(source)}|{etag}|{crop}'.encode('utf-8')).hexdigest()
+
+    def _path_(self, key: str = None, name: str = None):
+        return os.path.join(self.folder, 'datasets', key[:2], f'{key}{os.path.splitext(name)[-1]}')
+
+    def get(self, source: str = None, etag: str = None, crop: str = None, dst_path: str = None):
+        """
+        Materialize a cached dataset at dst_path
+
+        :param source: str, the blob path or URL of the source dataset
+        :param etag: str, the version of the source dataset
+        :param crop: str, optional signature of the transformation applied to the source
+        :param dst_path: str, local path
+        :return: dst_path or None if the dataset is not cached
+        """
+        key = self._key_(source=source, etag=etag, crop=crop)
+        with self._lock_:
+            row = self._db_.execute('SELECT name FROM datasets WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return
+            path = self._path_(key=key, name=row[0])
+            if not os.path.exists(path):
+                self._db_.execute('DELETE FROM datasets WHERE key=?', (key,))
+                return
+            self._db_.execute('UPDATE datasets SET accessed=?, hits=hits+1 WHERE key=?', (time.time(), key))
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        method = link_file(src_path=path, dst_path=dst_path)
+        logger.debug(f'{dst_path} was served from the cache ({method})')
+        return dst_path
+
+    def put(self, source: str = None, etag: str = None, crop: str = None, path: str = None):
+        """
+        Add a local dataset to the cache. The cached file becomes read only unless it is a hard link of path
+
+        :param source: str, the blob path or URL of the source dataset
+        :param etag: str, the version of the source dataset
+        :param crop: str, optional signature of the transformation applied to the source
+        :param path: str, local path of the dataset
+        :return: str, the path of the cached file
+        """
+        key = self._key_(source=source, etag=etag, crop=crop)
+        name = os.path.basename(path)
+        cached_path = self._path_(key=key, name=name)
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        method = link_file(src_path=path, dst_path=cached_path)
+        if method == 'copy':
+            logger.info(f'{path} was copied into the cache at {self.folder}, which is on another file system')
+        if method != 'hardlink':
+            mode = stat.S_IMODE(os.stat(cached_path).st_mode)
+            os.chmod(cached_path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        now = time.time()
+        with self._lock_:
+            self._db_.execute('INSERT OR REPLACE INTO datasets VALUES(?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                              (key, self._source_key_(source), etag, crop, name, os.path.getsize(cached_path),
+                               now, now))
+            self.evict()
+        logger.debug(f'{path} was added to the cache')
+        return cached_path
+
+    def _remove_(self, key: str = None, name: str = None):
+        try:
+            os.remove(self._path_(key=key, name=name))
+        except FileNotFoundError:
+            pass
+        self._db_.execute('DELETE FROM datasets WHERE key=?', (key,))
+
+    def evict(self, max_bytes: int = None):
+        """
+        Remove the least recently used datasets until the cache fits in max_bytes
+
+        :param max_bytes: int, defaults to the max size of the cache
+        :return: int, the number of removed datasets
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        removed = 0
+        with self._lock_:
+            total = self.size()
+            for key, name, size in self._db_.execute(
+                    'SELECT key, name, size FROM datasets ORDER BY accessed').fetchall():
+                if total <= max_bytes:
+                    break
+                self._remove_(key=key, name=name)
+                total -= size
+                removed += 1
+        return removed
+
+    def prune(self, older_than: float = None, max_bytes: int = None):
+        """
+        Remove the datasets that were not used in the last older_than seconds and/or the least recently used
+        datasets above max_bytes
+
+        :return: int, the number of removed datasets
+        """
+        removed = 0
+        with self._lock_:
+            if older_than is not None:
+                for key, name in self._db_.execute('SELECT key, name FROM datasets WHERE accessed<?',
+                                                   (time.time() - older_than,)).fetchall():
+                    self._remove_(key=key, name=name)
+                    removed += 1
+            removed += self.evict(max_bytes=max_bytes)
+        return removed
+
+    def size(self):
+        """
+        The size in bytes of the cached datasets
+        """
+        with self._lock_:
+            return self._db_.execute('SELECT COALESCE(SUM(size), 0) FROM datasets').fetchone()[0]
+
+    def entries(self):
+        """
+        The cached datasets, most recently used first
+
+        :return: list of dicts with source, etag, crop, name, size, created, accessed and hits keys
+        """
+        with self._lock_:
+            rows = self._db_.execute('SELECT source, etag, crop, name, size, created, accessed, hits FROM datasets '
+                                     'ORDER BY accessed DESC').fetchall()
+        columns = 'source', 'etag', 'crop', 'name', 'size', 'created', 'accessed', 'hits'
+        return [dict(zip(columns, row)) for row in rows]
+
+    def clear(self):
+        with self._lock_:
+            for key, name in self._db_.execute('SELECT key, name FROM datasets').fetchall():
+                self._remove_(key=key, name=name)
+
+
+_cache_ = None
+_cache_lock_ = threading.Lock()
+
+
+def get_dataset_cache():
+    """
+    The machine wide dataset cache or None if it is disabled. The cache is enabled by setting the RAPIDA_CACHE_GB
+    environment variable to its max size in GB
+    """
+    global _cache_
+    max_gb = float(os.environ.get(DATASET_CACHE_ENV_VAR, 0) or 0)
+    if max_gb <= 0:
+        return
+    with _cache_lock_:
+        if _cache_ is None:
+            _cache_ = DatasetCache(folder=DATASET_CACHE_FOLDER, max_bytes=int(max_gb * 2 ** 30))
+        return _cache_
@@ -1,33 +1,29 @@
-import concurrent.futures
+import hashlib
 import logging
-import random
+import math
+import os
 import time
-from collections import deque
-import concurrent.futures
 import threading
 import numpy
 import pyarrow as pa
+import pyarrow.compute as pc
 import shapely
 from osgeo import gdal, ogr, osr
 from pyogrio import read_info
 from pyproj import Transformer
 from rich.progress import Progress
 from shapely import wkb
-import rasterio
-from rasterio.windows import from_bounds, Window
 from rapida.util.proj_are_equal import proj_are_equal
 from rapida import constants
-from shapely.ops import transform
 from rapida.constants import ARROWTYPE2OGRTYPE
-from rapida.util.downloader import downloader
-from rapida.util.worker import worker
-from rapida.util.read_bbox import stream, read_rasterio_window
-from rapida.util.generator_length import generator_length
+from rapida.util.dataset_cache import get_dataset_cache, source_etag
+from rapida.util.http_cache import vsicurl
+from rapida.util.pipeline import Pipeline
+from rapida.util.query_planner import cluster_polygons
+from rapida.util.read_bbox import read_bbox, stream, stream_cluster
 from rich.progress import TimeElapsedColumn
 import typing
 from rapida.util.gen_blocks_bbox import gen_blocks_bbox
-from rasterio.crs import CRS
-from rasterio.warp import transform_bounds
 
 logger = logging.getLogger(__name__)
 gdal.UseExceptions()
@@ -52,17 +48,100 @@ PYTHON2OGR = {
 }
 
 
+class WrittenFids:
+    """
+    The FIDs of the features already written to a layer, kept as a sorted numpy array. The FIDs of a batch are
+    looked up with a binary search and the new ones are merged in, so the check runs on whole columns and no
+    Python object is created per feature.
+    """
+
+    def __init__(self):
+        self.fids = numpy.empty(0, dtype='i8')
+
+    def __len__(self):
+        return self.fids.size
+
+    def seen(self, fids: numpy.ndarray = None) -> numpy.ndarray:
+        """
+        :param fids: int array of FIDs
+        :return: bool array, True for the FIDs already written
+        """
+        if not self.fids.size:
+            return numpy.zeros(len(fids), dtype=bool)
+        pos = numpy.searchsorted(self.fids, fids).clip(max=self.fids.size - 1)
+        return self.fids[pos] == fids
+
+    def add(self, fids: numpy.ndarray = None):
+        """
+        :param fids: int array of FIDs not written before
+        """
+        merged = numpy.concatenate((self.fids, numpy.unique(fids)))
+        # the stable sort of two sorted runs is a linear merge
+        merged.sort(kind='stable')
+        self.fids = merged
+
+
+def ingest_batch(batch: pa.RecordBatch = None, written_fids: WrittenFids = None, transformer: Transformer = None,
+                 geom_column: str = 'wkb_geometry', fid_column: str = 'OGC_FID'):
+    """
+    Prepare an Arrow batch streamed from a remote layer to be written with WritePyArrow. The batch is processed
+    column wise: the features with empty or invalid geometries or whose FID was already written are dropped and
+    the geometries are reprojected with a vectorized transformer. The FIDs of the returned batch are added to
+    written_fids.
+
+    :param batch: pyarrow RecordBatch as streamed by pyogrio
+    :param written_fids: WrittenFids instance, updated in place, or None
+    :param transformer: pyproj Transformer (always_xy=True) or None if no reprojection is needed
+    :param geom_column: str, the name of the WKB geometry column
+    :param fid_column: str, the name of the FID column
+    :return: tuple (batch, fids) the filtered batch and the FIDs it contains
+    """
+    geoms = batch.column(geom_column)
+    keep = pc.fill_null(pc.greater(pc.binary_length(geoms), 0), False)
+    has_fid = fid_column in batch.schema.names
+    if has_fid and written_fids:
+        seen = written_fids.seen(batch.column(fid_column).to_numpy(zero_copy_only=False))
+        keep = pc.and_(keep, pa.array(~seen))
+    batch = batch.filter(keep)
+    shapely_geoms = shapely.from_wkb(batch.column(geom_column).to_numpy(zero_copy_only=False), on_invalid='ignore')
+    valid = ~shapely.is_missing(shapely_geoms)
+    if not valid.all():
+        logger.error(f'Failed to parse {(~valid).sum()} geometries')
+        batch = batch.filter(pa.array(valid))
+        shapely_geoms = shapely_geoms[valid]
+    if transformer is not None:
+        shapely_geoms = shapely.transform(shapely_geoms, lambda xy: numpy.column_stack(transformer.transform(xy[:, 0], xy[:, 1])))
+    index = batch.schema.get_field_index(geom_column)
+    batch = batch.set_column(index, geom_column, pa.array(shapely.to_wkb(shapely_geoms), type=pa.binary()))
+    fids = batch.column(fid_column) if has_fid else None
+    if fids is not None and written_fids is not None:
+        written_fids.add(fids.to_numpy(zero_copy_only=False))
+    return batch, fids
+
+
+def _feature_density_(layer: ogr.Layer = None):
+    """
+    The average number of features per unit of area of a layer, read from the header for FlatGeobuf
+    """
+    nfeatures = layer.GetFeatureCount(force=0)
+    minx, maxx, miny, maxy = layer.GetExtent(force=0)
+    area = (maxx - minx) * (maxy - miny)
+    if nfeatures < 0 or area <= 0:
+        return
+    return nfeatures / area
+
+
 def download_vector(
         src_dataset_url=None,src_layer_name=None,
         dst_dataset_path=None,dst_layer_name=None, dst_srs=None, dst_layer_mode=None,
         mask_polygons:typing.Dict[str,shapely.lib.Geometry]=None, add_polyid=False,
-        batch_size=5000,NWORKERS=4,progress=None,
+        batch_size=5000,NWORKERS=4,progress=None, coalesce=True
 
 ):
     """
     Download a remote vector dataset locally in a parallel manner using polygons as  a spatial mask. Uses PyArrow streaming.
 
-    :param src_dataset_url: str, URL to the dataset to download. The dataset needs to be in a format that can be read by OGR and also in a cloud optimized format such as FlatGeobuf or PMTiles. The URL should start with `/vsicurl/` prefix, if not, the funciton will add the prefix to proceed.
+    :param src_dataset_url: str, URL to the dataset to download. The dataset needs to be in a format that can be read by OGR and also in a cloud optimized format such as FlatGeobuf or PMTiles. The URL should start with `/vsicurl/` prefix, if not, the funciton will add the prefix to proceed. The reads go through the local HTTP range cache when it is enabled (see rapida.util.http_cache).
     :param: src_layer_name, str or int, default=0, the layer to be  read
     :param dst_dataset_path: str, local OGR dataset
     :param dst_layer_name: str, the name of src_layer in the dst_dataset that will be read
@@ -73,6 +152,9 @@ def download_vector(
     :param batch_size: int, max number of features to download in one batch
     :param NWORKERS: int, default=4, number of
     :param progress:
+    :param coalesce: bool, default=True, if True the mask polygons are grouped into clusters sized by the
+    expected feature density and every cluster is streamed with one bbox query. The features are assigned to
+    the polygons locally. This avoids reading the same remote pages over and over for adjacent polygons
     :return:
     """
     assert src_dataset_url not in ('', None), f'src_dataset_url={src_dataset_url} is invalid'
@@ -95,7 +177,7 @@ def download_vector(
         return _destination_layer_
 
 
-    written_features = set()
+    written_fids = WrittenFids()
     total_task = None
     if progress:
         cols = progress.columns
@@ -103,8 +185,7 @@ def download_vector(
     try:
         stop = None
         with gdal.OpenEx(dst_dataset_path, gdal.OF_VECTOR | gdal.OF_UPDATE) as dst_ds:
-            if not src_dataset_url.startswith('/vsicurl/'):
-                src_dataset_url = f"/vsicurl/{src_dataset_url}"
+            src_dataset_url = vsicurl(src_dataset_url)
             with gdal.OpenEx(src_dataset_url, gdal.OF_VECTOR | gdal.OF_READONLY) as src_ds:
                 if isinstance(src_layer_name, int) or src_layer_name is None:
                     layer_index = src_layer_name if src_layer_name is not None else 0
@@ -149,12 +230,28 @@ def download_vector(
 
 
                 stop = threading.Event()
-                jobs = deque()
-                results = deque()
-                with concurrent.futures.ThreadPoolExecutor(max_workers=NWORKERS) as executor:
-
-                    if progress is None:
-                        progress = Progress()
+                jobs = list()
+                if progress is None:
+                    progress = Progress()
+                if coalesce:
+                    job_func, id_prop_name = stream_cluster, 'cluster_id'
+                    clusters = cluster_polygons(polygons=mask_polygons, density=_feature_density_(src_layer))
+                    logger.info(f'{len(mask_polygons)} polygons were coalesced into {len(clusters)} queries')
+                    for cluster_id, (bbox, poly_ids) in enumerate(clusters):
+                        job = dict(
+                            src_path=src_dataset_url,
+                            src_layer=src_layer.GetName(),
+                            bbox=bbox,
+                            polygons={poly_id: mask_polygons[poly_id] for poly_id in poly_ids},
+                            batch_size=batch_size,
+                            signal_event=stop,
+                            cluster_id=f'cluster::{cluster_id}',
+                            progress=progress,
+                            add_polyid=add_polyid
+                        )
+                        jobs.append(job)
+                else:
+                    job_func, id_prop_name = stream, 'polygon_id'
                     for poly_id, polygon in mask_polygons.items():
                         job = dict(
                             src_path=src_dataset_url,
@@ -164,84 +261,36 @@ def download_vector(
                             signal_event=stop,
                             polygon_id=poly_id,
                             progress=progress,
-                            results=results,
                             add_polyid=add_polyid
                         )
                         jobs.append(job)
 
-                    ndownloaded = 0
-                    njobs = len(jobs)
-                    total_task = progress.add_task(
-                        description=f'[red]Downloading data covering {njobs} polygons', total=njobs)
-                    nworkers = njobs if njobs < NWORKERS else NWORKERS
-
-                    futures = [executor.submit(worker, job=stream, jobs=jobs, task=total_task,stop=stop, id_prop_name='polygon_id') for i in range(nworkers)]
-                    while True:
-                        try:
-                            try:
-                                polygon_id, batch = results.pop()
-                                new_geometries = []
-                                mask = numpy.zeros(batch.num_rows, dtype=bool)
-                                for i, record in enumerate(batch.to_pylist()):
-                                    geom = record.get("wkb_geometry", None)
-                                    fid = record.get("OGC_FID", None)
-                                    if geom is None or len(geom) == 0:
-                                        logger.debug("Empty geometry")
-                                        mask[i] = True
-                                        continue
-
-                                    if fid in written_features:
-                                        mask[i] = True
-                                        continue
-                                    else:
-                                        try:
-                                            shapely_geom = wkb.loads(geom)
-                                        except Exception as se:
-                                            logger.error(f'Failed to parse {geom}.')
-                                            mask[i] = True
-                                            continue
-                                        if will_reproject:
-                                            reprojected_geom = transform(transformer.transform, shapely_geom)
-                                            geom_wkb = reprojected_geom.wkb
-                                        else:
-                                            geom_wkb = shapely_geom.wkb
-                                        written_features.add(fid)
-                                        new_geometries.append(geom_wkb)
-
-                                if mask[mask].size > 0:
-                                    batch = batch.filter(~mask)
-
-                                batch = batch.drop_columns(['wkb_geometry'])
-                                batch = batch.append_column('wkb_geometry', pa.array(new_geometries))
-                                if batch.num_rows == 0:
-                                    logger.debug('Skipping empty batch')
-                                    continue
-
-                                batch = batch.rename_columns({"wkb_geometry": "geometry", 'OGC_FID':'SRC_FID'})
-
-                                try:
-                                    destination_layer.WritePyArrow(batch)
-                                    destination_layer.SyncToDisk()
-                                except Exception as e:
-                                    logger.info(
-                                        f'writing batch with {batch.num_rows} rows from {polygon_id} failed with error {e} and will be ignored')
-                                # keep the number of worker processed to prevent going into infinite loop
-                                ndownloaded += 1
-
-                            except IndexError as ie:
-                                done = [f.done() for f in futures]
-                                if len(mask_polygons) == 0 or all(done) or (ndownloaded == len(mask_polygons) and len(mask_polygons) > 0): # questionable if last cond is really needed
-                                    break
-                                s = random.random()  # this one is necessary for ^C/KeyboardInterrupt
-                                time.sleep(s)
-                                continue
-
-
-                        except KeyboardInterrupt:
-                            logger.info(f'Cancelling download. Please wait/allow for a graceful shutdown and cleanup')
-                            stop.set()
-                            raise
+                njobs = len(jobs)
+                total_task = progress.add_task(
+                    description=f'[red]Downloading data covering {len(mask_polygons)} polygons in {njobs} queries', total=njobs)
+                pipeline = Pipeline(job=job_func, jobs=jobs, workers=NWORKERS, stop=stop, id_prop_name=id_prop_name,
+                                    progress=progress, task=total_task)
+                for polygon_id, batch in pipeline:
+                    batch, fids = ingest_batch(batch=batch, written_fids=written_fids,
+                                               transformer=transformer if will_reproject else None)
+                    if batch.num_rows == 0:
+                        logger.debug('Skipping empty batch')
+                        continue
+
+                    batch = batch.rename_columns({"wkb_geometry": "geometry", 'OGC_FID':'SRC_FID'})
 
+                    try:
+                        destination_layer.WritePyArrow(batch)
+                    except Exception as e:
+                        logger.info(
+                            f'writing batch with {batch.num_rows} rows from {polygon_id} failed with error {e} and will be ignored')
+                destination_layer.SyncToDisk()
+
+    except KeyboardInterrupt:
+        logger.info(f'Cancelling download. Please wait/allow for a graceful shutdown and cleanup')
+        if stop is not None:
+            stop.set()
+        raise
     except Exception as e:
         logger.error(f'Error downloading {src_dataset_url} with error {e}')
         raise
@@ -280,7 +329,7 @@ def download_geodata_by_admin(dataset_url, geopackage_path=None, batch_size=5000
     src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
     ndownloaded = 0
     failed = []
-    written_geometries = set()
+    written_geometries = WrittenFids()
     try:
         with gdal.OpenEx(geopackage_path, gdal.OF_VECTOR | gdal.OF_UPDATE) as project_dataset:
             admin_layer = project_dataset.GetLayerByName('polygons')
@@ -297,115 +346,76 @@ def download_geodata_by_admin(dataset_url, geopackage_path=None, batch_size=5000
 
             all_features = [e for e in admin_layer]
             stop = threading.Event()
-            jobs = deque()
-            results = deque()
-            with concurrent.futures.ThreadPoolExecutor(max_workers=NWORKERS) as executor:
-                if progress is None:
-                    progress = Progress()
+            jobs = list()
+            if progress is None:
+                progress = Progress()
+
+            for feature in all_features:
+                au_geom = feature.GetGeometryRef()
+                au_geom.Transform(tr)
+                au_poly = shapely.wkb.loads(bytes(au_geom.ExportToIsoWkb()))
+                # props = feature.items()
+
+                job = dict(
+                    src_path=dataset_url,
+                    mask=au_poly,
+                    batch_size=batch_size,
+                    signal_event=stop,
+                    name=feature.GetFID(),
+                    progress=progress
+                )
+                jobs.append(job)
+            njobs = len(jobs)
+            total_task = progress.add_task(
+                description=f'[red]Going to download data covering  {njobs} admin units', total=njobs)
+            nfields = destination_layer.GetLayerDefn().GetFieldCount()
+            pipeline = Pipeline(job=read_bbox, jobs=jobs, workers=NWORKERS, results_arg=None, stop=stop,
+                                id_prop_name='name')
+            try:
+                for au_name, meta, batches in pipeline:
+                    try:
+                        if batches is None:
+                            logger.debug(f'{au_name} was processed')
+                            raise meta
+                        for batch in batches:
+                            batch, fids = ingest_batch(batch=batch, written_fids=written_geometries,
+                                                       transformer=transformer)
+
+                            if nfields == 0:
+                                logger.info('Creating fields')
+                                for name in batch.schema.names:
+                                    if 'wkb' in name or 'geometry' in name: continue
+                                    field = batch.schema.field(name)
+                                    field_type = ARROWTYPE2OGRTYPE[field.type]
+                                    if destination_layer.GetLayerDefn().GetFieldIndex(name) == -1:
+                                        destination_layer.CreateField(ogr.FieldDefn(name, field_type))
+
+                                nfields = destination_layer.GetLayerDefn().GetFieldCount()
+                                destination_layer.SyncToDisk()
+
+                            if batch.num_rows == 0:
+                                logger.info('skipping batch')
+                                continue
 
-                for feature in all_features:
-                    au_geom = feature.GetGeometryRef()
-                    au_geom.Transform(tr)
-                    au_poly = shapely.wkb.loads(bytes(au_geom.ExportToIsoWkb()))
-                    # props = feature.items()
-
-                    job = dict(
-                        src_path=dataset_url,
-                        mask=au_poly,
-                        batch_size=batch_size,
-                        signal_event=stop,
-                        name=feature.GetFID(),
-                        progress=progress
-                    )
-                    jobs.append(job)
-                njobs = len(jobs)
-                total_task = progress.add_task(
-                    description=f'[red]Going to download data covering  {njobs} admin units', total=njobs)
-                nworkers = njobs if njobs < NWORKERS else NWORKERS
-                [executor.submit(downloader, jobs, results, stop) for i in range(nworkers)]
-                nfields = destination_layer.GetLayerDefn().GetFieldCount()
+                            batch = batch.rename_columns({"wkb_geometry": "geometry"})
+
+                            try:
+                                destination_layer.WritePyArrow(batch)
+                            except Exception as e:
+
+                                logger.info(
+                                    f'writing batch with {batch.num_rows} rows from {au_name} failed with error {e} and will be ignored')
 
-                while True:
-                    try:
-                        try:
-                            au_name, meta, batches = results.pop()
-
-                            if batches is None:
-                                logger.debug(f'{au_name} was processed')
-                                raise meta
-                            for batch in batches:
-                                new_geometries = []
-                                mask = numpy.zeros(batch.num_rows, dtype=bool)
-                                for i, record in enumerate(batch.to_pylist()):
-                                    geom = record.get("wkb_geometry", None)
-                                    fid = record.get("OGC_FID", None)
-                                    if geom is None:
-                                        print("Empty geometry")
-                                        continue
-
-                                    if fid in written_geometries:
-                                        mask[i] = True
-                                    else:
-                                        shapely_geom = wkb.loads(geom)
-                                        reprojected_geom = transform(transformer.transform, shapely_geom)
-                                        geom_wkb = reprojected_geom.wkb
-                                        written_geometries.add(fid)
-                                        new_geometries.append(geom_wkb)
-                                if mask[mask].size > 0:
-                                    batch = batch.filter(~mask)
-
-                                batch = batch.drop_columns(['wkb_geometry'])
-                                batch = batch.append_column('wkb_geometry', pa.array(new_geometries))
-
-                                if nfields == 0:
-                                    logger.info('Creating fields')
-                                    for name in batch.schema.names:
-                                        if 'wkb' in name or 'geometry' in name: continue
-                                        field = batch.schema.field(name)
-                                        field_type = ARROWTYPE2OGRTYPE[field.type]
-                                        if destination_layer.GetLayerDefn().GetFieldIndex(name) == -1:
-                                            destination_layer.CreateField(ogr.FieldDefn(name, field_type))
-
-                                    nfields = destination_layer.GetLayerDefn().GetFieldCount()
-                                    destination_layer.SyncToDisk()
-
-                                if batch.num_rows == 0:
-                                    logger.info('skipping batch')
-                                    continue
-
-                                batch = batch.rename_columns({"wkb_geometry": "geometry"})
-
-                                try:
-                                    destination_layer.WritePyArrow(batch)
-                                except Exception as e:
-
-                                    logger.info(
-                                        f'writing batch with {batch.num_rows} rows from {au_name} failed with error {e} and will be ignored')
-
-                            destination_layer.SyncToDisk()
-                            ndownloaded += 1
-                            progress.update(total_task,
-                                            description=f'[red]Downloaded geo file from {ndownloaded} out of {njobs} admin units',
-                                            advance=1)
-
-                        except IndexError as ie:
-                            if not jobs and (progress.finished or ndownloaded == len(all_features)):
-                                stop.set()
-                                break
-                            s = random.random()  # this one is necessary for ^C/KeyboardInterrupt
-                            time.sleep(s)
-                            continue
-                    #
                     except Exception as e:
                         failed.append(f'Downloading {au_name} failed: {e.__class__.__name__}("{e}")')
-                        ndownloaded += 1
-                        progress.update(total_task,
-                                        description=f'[red]Downloaded geospatial data from {ndownloaded} out of {njobs} admin units',
-                                        advance=1)
-                    except KeyboardInterrupt:
-                        logger.info(f'Cancelling download. Please wait/allow for a graceful shutdown')
-                        stop.set()
-                        break
+                    ndownloaded += 1
+                    progress.update(total_task,
+                                    description=f'[red]Downloaded geo file from {ndownloaded} out of {njobs} admin units',
+                                    advance=1)
+                destination_layer.SyncToDisk()
+            except KeyboardInterrupt:
+                logger.info(f'Cancelling download. Please wait/allow for a graceful shutdown')
+                stop.set()
 
         if failed:
             for msg in failed:
@@ -414,119 +424,242 @@ def download_geodata_by_admin(dataset_url, geopackage_path=None, batch_size=5000
         logger.error(f'Error downloading {dataset_url} with error {e}')
 
 
+def _warp_block_(handles=None, opened=None, src_dataset_path=None, src_band=1, polygons_dataset_path=None,
+                 polygons_layer_name=None, dst_geotransform=None, dst_srs=None, block=None, block_id=None,
+                 resample_alg='near', fill_value=0, signal_event=None):
+    """
+    Warp one block of the destination grid from the source raster and set the pixels outside of the polygons
+    to fill_value. The source and the polygons are opened once per worker thread, kept in handles
+    (a threading.local instance) and registered in opened so they can be closed at the end.
+    Returns None if the block does not intersect the polygons, in which case nothing is read from the source
+
+    :return: tuple (block, data) or None
+    """
+    if signal_event is not None and signal_event.is_set():
+        return
+    thread_handles = getattr(handles, 'datasets', None)
+    if thread_handles is None:
+        src_ds = gdal.OpenEx(src_dataset_path, gdal.OF_RASTER | gdal.OF_READONLY)
+        poly_ds = gdal.OpenEx(polygons_dataset_path, gdal.OF_VECTOR | gdal.OF_READONLY)
+        thread_handles = handles.datasets = src_ds, poly_ds
+        opened.append(thread_handles)
+    src_ds, poly_ds = thread_handles
+    col_start, row_start, col_size, row_size = block
+    ox, xres, _, oy, _, yres = dst_geotransform
+    minx, maxy = ox + col_start * xres, oy + row_start * yres
+    maxx, miny = minx + col_size * xres, maxy + row_size * yres
+    layer = poly_ds.GetLayerByName(polygons_layer_name)
+    poly_srs = layer.GetSpatialRef().Clone()
+    poly_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if proj_are_equal(src_srs=poly_srs, dst_srs=dst_srs):
+        layer.SetSpatialFilterRect(minx, miny, maxx, maxy)
+    else:
+        # the block bounds are in dst_srs and the filter needs to be in the SRS of the polygons
+        layer.SetSpatialFilterRect(*osr.CoordinateTransformation(dst_srs, poly_srs).TransformBounds(
+            minx, miny, maxx, maxy, 21))
+    try:
+        if layer.GetFeatureCount() == 0:
+            return
+        block_gt = (minx, xres, 0, maxy, 0, yres)
+        with gdal.config_options({'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES'}):
+            warped = gdal.Warp('', src_ds, format='MEM', outputBounds=(minx, miny, maxx, maxy), width=col_size,
+                               height=row_size, dstSRS=dst_srs, srcBands=[src_band], resampleAlg=resample_alg)
+        data = warped.GetRasterBand(1).ReadAsArray()
+        mask_ds = gdal.GetDriverByName('MEM').Create('', col_size, row_size, 1, gdal.GDT_Byte)
+        mask_ds.SetGeoTransform(block_gt)
+        mask_ds.SetSpatialRef(dst_srs)
+        gdal.RasterizeLayer(mask_ds, [1], layer, burn_values=[1])
+        data[mask_ds.GetRasterBand(1).ReadAsArray() == 0] = fill_value
+        return block, data
+    finally:
+        layer.SetSpatialFilter(None)
+
+
+def _crop_signature_(polygons_dataset_path=None, polygons_layer_name=None, target_srs=None, **params):
+    """
+    A digest of the polygons, projection and parameters a raster is cropped and warped with, used to tell apart
+    the cached versions of the same source
+    """
+    digest = hashlib.sha1()
+    with gdal.OpenEx(polygons_dataset_path, gdal.OF_VECTOR | gdal.OF_READONLY) as poly_ds:
+        lyr = poly_ds.GetLayerByName(polygons_layer_name)
+        for feat in lyr:
+            geom = feat.GetGeometryRef()
+            if geom is not None:
+                digest.update(geom.ExportToIsoWkb())
+    digest.update(target_srs.ExportToWkt().encode('utf-8'))
+    digest.update(repr(sorted(params.items())).encode('utf-8'))
+    return digest.hexdigest()
+
+
 def download_raster( src_dataset_path=None, src_band=1,
                     dst_dataset_path=None, dst_band=1,
-                    polygons_dataset_path=None, polygons_layer_name=None,
-                    horizontal_chunk_size=256, vertical_chunk_size=256, workers=4, progress=None
+                    polygons_dataset_path=None, polygons_layer_name=None, target_srs=None,
+                    x_res: int = constants.DEFAULT_MASK_RESOLUTION_METERS,
+                    y_res: int = constants.DEFAULT_MASK_RESOLUTION_METERS, resample_alg='near',
+                    horizontal_chunk_size=512, vertical_chunk_size=512, workers=4, progress=None
                    ):
+    """
+    Download a remote raster straight onto the project grid in one streaming pass.
+
+    The destination grid covers the extent of the polygons layer at x_res/y_res resolution with pixels aligned
+    to the resolution (like gdalwarp -tap) in target_srs. It is split into blocks that are warped in parallel;
+    every worker thread opens the remote source once and only the blocks that intersect the polygons are read.
+    The pixels outside the polygons are set to nodata, like a cutline warp would do. The output is kept in the
+    machine wide dataset cache (see rapida.util.dataset_cache) keyed by the source, its ETag and the crop, so
+    another project covering the same polygons gets it without reading the source again.
+
+    :param src_dataset_path: str, URL or path to the source raster
+    :param src_band: int, the source band
+    :param dst_dataset_path: str, path to the output GeoTiff
+    :param dst_band: int, the band of the output GeoTiff the data is written to
+    :param polygons_dataset_path: str, path to the vector dataset holding the polygons
+    :param polygons_layer_name: str, name of the polygons layer
+    :param target_srs: osr.SpatialReference, the projection of the output, defaults to the projection of the
+    polygons layer
+    :param x_res: horizontal resolution in target_srs units
+    :param y_res: vertical resolution in target_srs units
+    :param resample_alg: str, GDAL resampling algorithm
+    :param horizontal_chunk_size: int, the width in pixels of a block
+    :param vertical_chunk_size: int, the height in pixels of a block
+    :param workers: int, number of threads
+    :param progress: rich progress instance
+    :return: str, dst_dataset_path
+    """
 
+    source = src_dataset_path
+    if src_dataset_path.startswith(('http://', 'https://', '/vsicurl/')):
+        src_dataset_path = vsicurl(src_dataset_path)
     with gdal.OpenEx(polygons_dataset_path, gdal.OF_VECTOR|gdal.OF_READONLY) as poly_ds:
         lyr = poly_ds.GetLayerByName(polygons_layer_name)
         minx, maxx, miny, maxy = lyr.GetExtent(force=True)
-        dst_srs = lyr.GetSpatialRef()
-        dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
-        dst_crs = f"{dst_srs.GetAuthorityName(None)}:{dst_srs.GetAuthorityCode(None)}"
-        if not src_dataset_path.startswith('/vsicurl'):
-            src_dataset_path = f'/vsicurl/{src_dataset_path}'
-        #with gdal.OpenEx(src_dataset_path, gdal.OF_READONLY | gdal.OF_RASTER) as src_ds:
-        with rasterio.open(src_dataset_path, mode='r') as src_ds:
-            src_srs = osr.SpatialReference()
-            src_srs.ImportFromWkt(src_ds.crs.to_wkt())
-            #src_srs = src_ds.GetSpatialRef()
-            src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
-            should_reproject = not proj_are_equal(src_srs=src_srs, dst_srs=dst_srs)
-            if should_reproject:
-                bounds = transform_bounds(src_crs=CRS.from_wkt(dst_srs.ExportToWkt()),
-                                          dst_crs=src_ds.crs,
-                                          left=minx,bottom=miny,right=maxx, top=maxy, )
-
-            else:
-                bounds = minx, miny, maxx, maxy
-
-            win = rasterio.windows.from_bounds(*bounds,transform=src_ds.transform)
-            #print(src_ds.profile)
-            row_slice, col_slice = win.toslices()
-            src_ds.RasterXSize = src_ds.width
-            src_ds.RasterYSize = src_ds.height
-            blocks = gen_blocks_bbox(ds=src_ds,blockxsize=horizontal_chunk_size, blockysize=vertical_chunk_size,
-                                     xminc=col_slice.start,yminr=row_slice.start,
-                                     xmaxc=col_slice.stop, ymaxr=row_slice.stop)
-
-            nblocks, blocks = generator_length(blocks)
-
-            block_dict = {}
-            stop_event = threading.Event()
-            jobs = deque()
-            results = deque()
-            workers = nblocks if workers > nblocks else workers
-            profile = src_ds.meta.copy()
-            profile['width'] = abs(col_slice.start-col_slice.stop)
-            profile['height'] = abs(row_slice.start-row_slice.stop)
-            profile.update(constants.GTIFF_CREATION_OPTIONS)
-            profile['transform'] = rasterio.transform.from_bounds(*bounds,profile['width'], profile['height'])
-
-            with rasterio.open(dst_dataset_path, mode='w+', **profile) as dst_ds:
-
-                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-
-                    if progress:
-                        total_task = progress.add_task(
-                            description=f'[red]Going to download data in {nblocks} blocks/chunks',
-                            total=nblocks)
-                    for block_id, block in enumerate(blocks):
-                        win_id = f'window_{block_id}'
-                        job = dict(
-                            src_ds_path=src_dataset_path,
-                            src_band=src_band,
-                            window=Window(*block),
-                            window_id=win_id,
-                            results=results,
-                            progress=progress
-
-                        )
-                        jobs.append(job)
-                        block_dict[win_id] = block
-
-                    futures = [
-                        executor.submit(worker, job=read_rasterio_window, jobs=jobs, stop=stop_event, task=total_task,
-                                        id_prop_name='window_id') for i in range(workers)]
-
-                    while True:
-                        try:
-                            try:
-                                win_id, data = results.pop()
-                                block = block_dict[win_id]
-                                col_start, row_start, col_size, row_size = block
-                                write_win = Window(
-                                    col_off=col_start-col_slice.start,
-                                    row_off = row_start-row_slice.start,
-                                    width=col_size,
-                                    height=row_size
-                                )
-
-                                dst_ds.write(data,dst_band, window=write_win)
-                                try:
-                                    pass # write here to dst raster
-                                except Exception as e:
-                                    logger.error(
-                                        f'Failed to write  block id {block_id} because {e}. Skipping')
-
-                            except IndexError as ie:
-                                done = [f.done() for f in futures]
-                                if nblocks == 0 or all(done):
-                                    stop_event.set()
-
-                                    if progress and total_task is not None:
-                                        progress.remove_task(total_task)
-
-                                    break
-                                s = random.random()  # this one is necessary for ^C/KeyboardInterrupt
-                                time.sleep(s)
-                                continue
-                        except KeyboardInterrupt:
-                            logger.info(f'Cancelling. Please wait/allow for a graceful shutdown')
-                            stop_event.set()
-                            raise
-
-
-
+        poly_srs = lyr.GetSpatialRef()
+    poly_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if target_srs is None:
+        target_srs = poly_srs
+
+    cache = get_dataset_cache()
+    etag = source_etag(source) if cache is not None else None
+    if etag is not None:
+        crop = _crop_signature_(polygons_dataset_path=polygons_dataset_path, polygons_layer_name=polygons_layer_name,
+                                target_srs=target_srs, src_band=src_band, dst_band=dst_band, x_res=x_res,
+                                y_res=y_res, resample_alg=resample_alg)
+        if cache.get(source=source, etag=etag, crop=crop, dst_path=dst_dataset_path):
+            logger.info(f'{source} was served from the cache')
+            return dst_dataset_path
+    if not proj_are_equal(src_srs=poly_srs, dst_srs=target_srs):
+        minx, miny, maxx, maxy = osr.CoordinateTransformation(poly_srs, target_srs).TransformBounds(
+            minx, miny, maxx, maxy, 21)
+    # align the grid to the resolution
+    minx, maxx = math.floor(minx / x_res) * x_res, math.ceil(maxx / x_res) * x_res
+    miny, maxy = math.floor(miny / y_res) * y_res, math.ceil(maxy / y_res) * y_res
+    width, height = int(round((maxx - minx) / x_res)), int(round((maxy - miny) / y_res))
+    dst_geotransform = (minx, x_res, 0, maxy, 0, -y_res)
+
+    with gdal.OpenEx(src_dataset_path, gdal.OF_RASTER | gdal.OF_READONLY) as src_ds:
+        src_rband = src_ds.GetRasterBand(src_band)
+        data_type = src_rband.DataType
+        nodata = src_rband.GetNoDataValue()
+    fill_value = nodata if nodata is not None else 0
+
+    if os.path.exists(dst_dataset_path):
+        os.remove(dst_dataset_path)  # could be a read only link to the cache
+    creation_options = dict(constants.GTIFF_CREATION_OPTIONS)
+    with gdal.GetDriverByName('GTiff').Create(dst_dataset_path, width, height, dst_band, data_type,
+                                              options=[f'{k}={v}' for k, v in creation_options.items()]) as dst_ds:
+        dst_ds.SetGeoTransform(dst_geotransform)
+        dst_ds.SetSpatialRef(target_srs)
+        band = dst_ds.GetRasterBand(dst_band)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        band.Fill(fill_value)
+
+        blocks = gen_blocks_bbox(ds=dst_ds, blockxsize=horizontal_chunk_size, blockysize=vertical_chunk_size,
+                                 xminc=0, yminr=0, xmaxc=width, ymaxr=height)
+        stop_event = threading.Event()
+        handles = threading.local()
+        opened = list()
+        jobs = [dict(handles=handles, opened=opened, src_dataset_path=src_dataset_path, src_band=src_band,
+                     polygons_dataset_path=polygons_dataset_path, polygons_layer_name=polygons_layer_name,
+                     dst_geotransform=dst_geotransform, dst_srs=target_srs, block=block, block_id=block_id,
+                     resample_alg=resample_alg, fill_value=fill_value, signal_event=stop_event)
+                for block_id, block in enumerate(blocks)]
+        total_task = None
+        if progress:
+            total_task = progress.add_task(
+                description=f'[red]Going to download data in {len(jobs)} blocks/chunks',
+                total=len(jobs))
+        pipeline = Pipeline(job=_warp_block_, jobs=jobs, workers=workers, results_arg=None, stop=stop_event,
+                            fail_fast=True, id_prop_name='block_id', progress=progress, task=total_task)
+        try:
+            for result in pipeline:
+                if result is None:
+                    continue
+                (col_start, row_start, _, _), data = result
+                band.WriteArray(data, col_start, row_start)
+        except KeyboardInterrupt:
+            logger.info(f'Cancelling. Please wait/allow for a graceful shutdown')
+            raise
+        finally:
+            for src_ds, poly_ds in opened:
+                src_ds.Close()
+                poly_ds.Close()
+            if progress and total_task is not None:
+                progress.remove_task(total_task)
+    if etag is not None:
+        cache.put(source=source, etag=etag, crop=crop, path=dst_dataset_path)
+    return dst_dataset_path
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pyogrio import open_arrow
+    from shapely.ops import transform
+
+    logging.basicConfig(level=logging.INFO)
+
+    def legacy_ingest(batch=None, written=None, transformer=None):
+        new_geometries = []
+        mask = numpy.zeros(batch.num_rows, dtype=bool)
+        for i, record in enumerate(batch.to_pylist()):
+            geom = record.get('wkb_geometry', None)
+            fid = record.get('OGC_FID', None)
+            if not geom or fid in written:
+                mask[i] = True
+                continue
+            new_geometries.append(transform(transformer.transform, wkb.loads(geom)).wkb)
+            written.add(fid)
+        batch = batch.filter(~mask).drop_columns(['wkb_geometry'])
+        return batch.append_column('wkb_geometry', pa.array(new_geometries))
+
+    nfeatures = 200000
+    batch_size = 5000
+    rng = numpy.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        src_path = os.path.join(temp_dir, 'buildings.fgb')
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        with ogr.GetDriverByName('FlatGeobuf').CreateDataSource(src_path) as ds:
+            lyr = ds.CreateLayer('buildings', srs=srs, geom_type=ogr.wkbPolygon)
+            lyr.CreateField(ogr.FieldDefn('height', ogr.OFTReal))
+            centers = rng.uniform((30., -2.), (35., 2.), size=(nfeatures, 2))
+            boxes = shapely.box(centers[:, 0], centers[:, 1], centers[:, 0] + 1e-4, centers[:, 1] + 1e-4)
+            schema = pa.schema([pa.field('height', pa.float64()),
+                                pa.field('wkb_geometry', pa.binary(), metadata={'ARROW:extension:name': 'ogc.wkb'})])
+            table = pa.table([pa.array(rng.uniform(3, 30, nfeatures)), pa.array(shapely.to_wkb(boxes))], schema=schema)
+            lyr.WritePyArrow(table.to_batches()[0])
+        transformer = Transformer.from_crs('EPSG:4326', 'ESRI:54009', always_xy=True)
+        with open_arrow(src_path, use_pyarrow=True, batch_size=batch_size, return_fids=True) as (meta, reader):
+            batches = list(reader)
+        for name, func in ('per record', legacy_ingest), ('columnar', ingest_batch):
+            start = time.time()
+            written = set() if func is legacy_ingest else WrittenFids()
+            nrows = 0
+            for batch in batches:
+                if func is legacy_ingest:
+                    out = legacy_ingest(batch=batch, written=written, transformer=transformer)
+                else:
+                    out, fids = ingest_batch(batch=batch, written_fids=written, transformer=transformer)
+                nrows += out.num_rows
+            elapsed = time.time() - start
+            logger.info(f'{name}: ingested {nrows} features in {elapsed:.2f}s ({nrows / elapsed:.0f} features/s)')
@@ -1,25 +1,24 @@
 def gen_blocks_bbox(ds=None,blockxsize=None, blockysize=None, xminc=None, yminr=None, xmaxc=None, ymaxr=None ):
     """
     Generate reading block for gdal ReadAsArray limited by a bbox
+
+    The blocks follow the blockxsize x blockysize grid of the dataset and are clipped to the
+    [xminc, xmaxc) columns and [yminr, ymaxr) rows. Every block is (col_start, row_start, col_size, row_size)
     """
 
 
     width = ds.RasterXSize
-    height = ds.RasterXSize
-    wi = list(range(0, width, blockxsize))
-    if width % blockxsize != 0:
-        wi += [width]
-    hi = list(range(0, height, blockysize))
-    if height % blockysize != 0:
-        hi += [height]
+    height = ds.RasterYSize
+    wi = list(range(0, width, blockxsize)) + [width]
+    hi = list(range(0, height, blockysize)) + [height]
     for col_start, col_end in zip(wi[:-1], wi[1:]):
-        col_size = col_end - col_start
-        if  xminc > col_end or xmaxc < col_start:continue
+        if  xminc >= col_end or xmaxc <= col_start:continue
         if col_start < xminc:col_start = xminc
-        if col_start+col_size>xmaxc:col_size=xmaxc-col_start
+        if col_end > xmaxc:col_end = xmaxc
+        col_size = col_end - col_start
         for row_start, row_end in zip(hi[:-1], hi[1:]):
-            if yminr > row_end or ymaxr < row_start :continue
+            if yminr >= row_end or ymaxr <= row_start :continue
             if row_start<yminr:row_start=yminr
+            if row_end > ymaxr:row_end = ymaxr
             row_size = row_end - row_start
-            if row_start+row_size>ymaxr:row_size= ymaxr-row_start
-            yield col_start, row_start, col_size, row_size
\ No newline at end of file
+            yield col_start, row_start, col_size, row_size
@@ -0,0 +1,408 @@
+import hashlib
+import http.server
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote, unquote, urlsplit
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+HTTP_CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.rapida', 'http_cache')
+HTTP_CACHE_ENV_VAR = 'RAPIDA_HTTP_CACHE_GB'  # max size of the cache in GB, the cache is disabled when not set or 0
+HTTP_CACHE_OFFLINE_ENV_VAR = 'RAPIDA_HTTP_CACHE_OFFLINE'  # serve only from the cache, never reach the origin
+HTTP_TIMEOUT = 60  # seconds
+HTTP_CACHE_CHUNK_SIZE = 256 * 2 ** 10  # bytes, the remote files are cached in aligned chunks of this size
+
+
+class RangeCache:
+    """
+    Size bounded, on disk, least recently used cache of HTTP byte ranges.
+
+    A range is keyed by the URL (without the query string, which usually holds expiring SAS tokens), the ETag of
+    the remote file and the byte range itself so a remote file that changed is never served from the cache.
+    The ranges are stored as files and indexed in a SQLite database that also keeps the metadata (ETag, length)
+    of the remote files, so the cache can be used offline, and the hit/miss statistics across runs.
+    """
+
+    def __init__(self, folder: str = HTTP_CACHE_FOLDER, max_bytes: int = 10 * 2 ** 30):
+        """
+        :param folder: str, the folder where the cache is stored
+        :param max_bytes: int, the max size in bytes of the cached ranges
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(folder, 'ranges'), exist_ok=True)
+        self._lock_ = threading.RLock()
+        self._db_ = sqlite3.connect(os.path.join(folder, 'index.sqlite'), check_same_thread=False,
+                                    isolation_level=None)
+        with self._lock_:
+            self._db_.execute('PRAGMA journal_mode=WAL')
+            self._db_.execute('CREATE TABLE IF NOT EXISTS ranges (key TEXT PRIMARY KEY, url TEXT, etag TEXT, '
+                              'start INTEGER, end INTEGER, size INTEGER, accessed REAL)')
+            self._db_.execute('CREATE INDEX IF NOT EXISTS ranges_accessed ON ranges(accessed)')
+            self._db_.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, etag TEXT, length INTEGER, '
+                              'headers TEXT)')
+            self._db_.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+
+    @staticmethod
+    def _url_key_(url: str = None):
+        parts = urlsplit(url)
+        return f'{parts.scheme}://{parts.netloc}{parts.path}'
+
+    def _key_(self, url: str = None, etag: str = None, start: int = None, end: int = None):
+        return hashlib.sha1(f'{self._url_key_(url)}|{etag}|{start}-{end}'.encode('utf-8')).hexdigest()
+
+    def _path_(self, key: str = None):
+        return os.path.join(self.folder, 'ranges', key[:2], key)
+
+    def _count_(self, name: str = None, value: int = 1):
+        self._db_.execute('INSERT INTO stats(name, value) VALUES(?, ?) '
+                          'ON CONFLICT(name) DO UPDATE SET value=value+excluded.value', (name, value))
+
+    def get(self, url: str = None, etag: str = None, start: int = None, end: int = None):
+        """
+        Fetch a cached range
+
+        :return: bytes or None if the range is not cached
+        """
+        key = self._key_(url=url, etag=etag, start=start, end=end)
+        with self._lock_:
+            row = self._db_.execute('SELECT size FROM ranges WHERE key=?', (key,)).fetchone()
+            data = None
+            if row is not None:
+                try:
+                    with open(self._path_(key), 'rb') as src:
+                        data = src.read()
+                except OSError:
+                    self._db_.execute('DELETE FROM ranges WHERE key=?', (key,))
+            if data is None:
+                self._count_('misses')
+                return
+            self._db_.execute('UPDATE ranges SET accessed=? WHERE key=?', (time.time(), key))
+            self._count_('hits')
+            self._count_('hit_bytes', len(data))
+            return data
+
+    def put(self, url: str = None, etag: str = None, start: int = None, end: int = None, data: bytes = None):
+        """
+        Cache a range and evict the least recently used ranges if the cache grew larger than max_bytes
+        """
+        key = self._key_(url=url, etag=etag, start=start, end=end)
+        path = self._path_(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as dst:
+            dst.write(data)
+        os.replace(tmp_path, path)
+        with self._lock_:
+            self._db_.execute('INSERT OR REPLACE INTO ranges VALUES(?, ?, ?, ?, ?, ?, ?)',
+                              (key, self._url_key_(url), etag, start, end, len(data), time.time()))
+            self._count_('miss_bytes', len(data))
+            self.evict()
+
+    def evict(self):
+        with self._lock_:
+            total = self.size()
+            if total <= self.max_bytes:
+                return
+            for key, size in self._db_.execute('SELECT key, size FROM ranges ORDER BY accessed').fetchall():
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(self._path_(key))
+                except FileNotFoundError:
+                    pass
+                self._db_.execute('DELETE FROM ranges WHERE key=?', (key,))
+                self._count_('evictions')
+                total -= size
+
+    def size(self):
+        """
+        The size in bytes of the cached ranges
+        """
+        with self._lock_:
+            return self._db_.execute('SELECT COALESCE(SUM(size), 0) FROM ranges').fetchone()[0]
+
+    def get_url_info(self, url: str = None):
+        """
+        The last known metadata of a remote file
+
+        :return: dict with etag, length and headers keys or None
+        """
+        with self._lock_:
+            row = self._db_.execute('SELECT etag, length, headers FROM urls WHERE url=?',
+                                    (self._url_key_(url),)).fetchone()
+        if row is not None:
+            etag, length, headers = row
+            return dict(etag=etag, length=length, headers=json.loads(headers))
+
+    def set_url_info(self, url: str = None, etag: str = None, length: int = None, headers: dict = None):
+        with self._lock_:
+            self._db_.execute('INSERT OR REPLACE INTO urls VALUES(?, ?, ?, ?)',
+                              (self._url_key_(url), etag, length, json.dumps(headers or {})))
+
+    def stats(self):
+        """
+        The hit/miss statistics collected across runs
+
+        :return: dict
+        """
+        with self._lock_:
+            stats = dict(self._db_.execute('SELECT name, value FROM stats').fetchall())
+            nranges = self._db_.execute('SELECT COUNT(*) FROM ranges').fetchone()[0]
+        stats.update(ranges=nranges, size=self.size(), max_size=self.max_bytes)
+        for name in ('hits', 'misses', 'hit_bytes', 'miss_bytes', 'evictions'):
+            stats.setdefault(name, 0)
+        return stats
+
+    def clear(self):
+        with self._lock_:
+            for key, in self._db_.execute('SELECT key FROM ranges').fetchall():
+                try:
+                    os.remove(self._path_(key))
+                except FileNotFoundError:
+                    pass
+            self._db_.execute('DELETE FROM ranges')
+            self._db_.execute('DELETE FROM urls')
+            self._db_.execute('DELETE FROM stats')
+
+
+class _ProxyHandler_(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _reply_(self, status=None, headers=None, body=b'', head=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _serve_(self, head=False):
+        proxy = self.server.proxy
+        url = unquote(self.path.lstrip('/'))
+        if not proxy.serves(url):
+            logger.debug(f'Refusing to proxy {url}, it was not registered')
+            return self._reply_(status=403, head=head)
+        try:
+            info = proxy.url_info(url)
+        except Exception as e:
+            logger.debug(f'Failed to fetch the metadata of {url}: {e}')
+            return self._reply_(status=504, head=head)
+        if info is None:
+            return self._reply_(status=404, head=head)
+        headers = {'Accept-Ranges': 'bytes', **info['headers']}
+        if info['etag']:
+            headers['ETag'] = info['etag']
+        byte_range = self.headers.get('Range')
+        if head or not byte_range:
+            if head:
+                self.send_response(200)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(info['length']))
+                self.end_headers()
+                return
+            byte_range = f'bytes=0-{info["length"] - 1}'
+        start, end = byte_range.split('=', 1)[1].split(',')[0].split('-')
+        start = int(start)
+        end = min(int(end) if end else info['length'] - 1, info['length'] - 1)
+        try:
+            data = proxy.fetch(url=url, etag=info['etag'], start=start, end=end, length=info['length'])
+        except Exception as e:
+            logger.debug(f'Failed to fetch {byte_range} from {url}: {e}')
+            return self._reply_(status=504)
+        headers['Content-Range'] = f'bytes {start}-{end}/{info["length"]}'
+        self._reply_(status=206, headers=headers, body=data)
+
+    def do_HEAD(self):
+        self._serve_(head=True)
+
+    def do_GET(self):
+        self._serve_()
+
+
+class CachingProxy:
+    """
+    Local HTTP server that serves the byte ranges GDAL requests over /vsicurl/ from a RangeCache and fetches
+    only the missing ranges from the origin.
+
+    The remote files are cached in chunks of chunk_size bytes aligned to the start of the file, so the reads that
+    overlap or are adjacent but do not start at the same offset are still served from the cache.
+    The remote URL is passed quoted in the path of the proxy URL, see `url`. Only the remote URLs registered
+    through `url` are served, the proxy refuses to fetch any other URL. The ETag of every remote file is
+    validated once per proxy (process) with a HEAD request. When the origin can not be reached, or in offline
+    mode, the last known ETag is used so a warm cache works fully offline.
+
+        proxy = CachingProxy(cache=RangeCache()).start()
+        gdal.OpenEx(f'/vsicurl/{proxy.url("https://host/file.fgb")}')
+    """
+
+    def __init__(self, cache: RangeCache = None, offline: bool = False, timeout: float = HTTP_TIMEOUT,
+                 chunk_size: int = HTTP_CACHE_CHUNK_SIZE):
+        """
+        :param cache: RangeCache instance
+        :param offline: bool, if True the origin is never contacted
+        :param timeout: float, timeout in seconds of the requests to the origin
+        :param chunk_size: int, the size in bytes of the cached chunks
+        """
+        self.cache = cache
+        self.offline = offline
+        self.chunk_size = chunk_size
+        self.client = httpx.Client(follow_redirects=True, timeout=timeout)
+        self._infos_ = dict()
+        self._registered_ = set()
+        self._lock_ = threading.Lock()
+        self.server = None
+
+    def start(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _ProxyHandler_)
+        self.server.daemon_threads = True
+        self.server.proxy = self
+        threading.Thread(target=self.server.serve_forever, name='http-cache-proxy', daemon=True).start()
+        logger.debug(f'HTTP range cache proxy listening on {self.server.server_address}')
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.client.close()
+
+    def url(self, remote_url: str = None):
+        """
+        Register remote_url and return the URL of the proxy that serves it
+        """
+        with self._lock_:
+            self._registered_.add(remote_url)
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/{quote(remote_url, safe="")}'
+
+    def serves(self, url: str = None) -> bool:
+        """
+        Check url was registered through `url`
+        """
+        with self._lock_:
+            return url in self._registered_
+
+    def url_info(self, url: str = None):
+        """
+        The ETag, length and relevant headers of the remote file, validated against the origin once
+        """
+        with self._lock_:
+            if url in self._infos_:
+                return self._infos_[url]
+        info = None
+        if not self.offline:
+            try:
+                response = self.client.head(url)
+                response.raise_for_status()
+                headers = {name: response.headers[name] for name in ('Content-Type', 'Last-Modified')
+                           if name in response.headers}
+                info = dict(etag=response.headers.get('ETag') or response.headers.get('Last-Modified'),
+                            length=int(response.headers['Content-Length']), headers=headers)
+                self.cache.set_url_info(url=url, **info)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code == 404:
+                    return
+                logger.debug(f'Failed to validate {url}: {e}. Using the cached metadata')
+            except httpx.TransportError as e:
+                logger.debug(f'Failed to validate {url}: {e}. Using the cached metadata')
+        if info is None:
+            info = self.cache.get_url_info(url=url)
+            if info is None:
+                raise ConnectionError(f'{url} is not cached and the origin can not be reached')
+        with self._lock_:
+            self._infos_[url] = info
+        return info
+
+    def _chunk_end_(self, chunk: int = None, length: int = None):
+        end = (chunk + 1) * self.chunk_size - 1
+        return end if length is None else min(end, length - 1)
+
+    def fetch(self, url: str = None, etag: str = None, start: int = None, end: int = None, length: int = None):
+        """
+        Fetch a byte range from the cached chunks. The missing chunks are fetched from the origin, one request
+        for every run of consecutive missing chunks
+
+        :param url: str, the remote URL
+        :param etag: str, the ETag of the remote file
+        :param start: int, the first byte
+        :param end: int, the last byte (inclusive)
+        :param length: int, the size of the remote file
+        :return: bytes
+        """
+        first, last = start // self.chunk_size, end // self.chunk_size
+        chunks = dict()
+        runs = list()
+        for chunk in range(first, last + 1):
+            data = self.cache.get(url=url, etag=etag, start=chunk * self.chunk_size,
+                                  end=self._chunk_end_(chunk=chunk, length=length))
+            if data is not None:
+                chunks[chunk] = data
+            elif runs and runs[-1][-1] == chunk - 1:
+                runs[-1].append(chunk)
+            else:
+                runs.append([chunk])
+        if runs and self.offline:
+            raise ConnectionError(f'Range {start}-{end} of {url} is not cached')
+        for run in runs:
+            run_start, run_end = run[0] * self.chunk_size, self._chunk_end_(chunk=run[-1], length=length)
+            response = self.client.get(url, headers={'Range': f'bytes={run_start}-{run_end}'})
+            response.raise_for_status()
+            data = response.content
+            if response.status_code == 200:  # the origin ignored the range
+                data = data[run_start:run_end + 1]
+            for chunk in run:
+                offset = (chunk - run[0]) * self.chunk_size
+                chunks[chunk] = data[offset:offset + self.chunk_size]
+                self.cache.put(url=url, etag=etag, start=chunk * self.chunk_size,
+                               end=self._chunk_end_(chunk=chunk, length=length), data=chunks[chunk])
+        offset = first * self.chunk_size
+        return b''.join(chunks[chunk] for chunk in range(first, last + 1))[start - offset:end - offset + 1]
+
+
+_proxy_ = None
+_proxy_lock_ = threading.Lock()
+
+
+def get_proxy():
+    """
+    The process wide caching proxy, started on first use, or None if the HTTP range cache is disabled.
+    The cache is enabled by setting the RAPIDA_HTTP_CACHE_GB environment variable to its max size in GB
+    """
+    global _proxy_
+    max_gb = float(os.environ.get(HTTP_CACHE_ENV_VAR, 0) or 0)
+    if max_gb <= 0:
+        return
+    with _proxy_lock_:
+        if _proxy_ is None:
+            offline = os.environ.get(HTTP_CACHE_OFFLINE_ENV_VAR, '').lower() in ('1', 'yes', 'true')
+            cache = RangeCache(folder=HTTP_CACHE_FOLDER, max_bytes=int(max_gb * 2 ** 30))
+            _proxy_ = CachingProxy(cache=cache, offline=offline).start()
+        return _proxy_
+
+
+def vsicurl(url: str = None):
+    """
+    The GDAL /vsicurl/ path of a remote URL, routed through the local HTTP range cache when it is enabled
+
+    :param url: str, http(s) URL with or without the /vsicurl/ prefix
+    :return: str
+    """
+    if url.startswith('/vsicurl/'):
+        url = url[len('/vsicurl/'):]
+    proxy = get_proxy()
+    if proxy is not None and url.startswith(('http://', 'https://')):
+        url = proxy.url(url)
+    return f'/vsicurl/{url}'
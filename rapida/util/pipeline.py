@@ -0,0 +1,194 @@
+import logging
+import queue
+import threading
+import traceback
+import typing
+from io import StringIO
+
+logger = logging.getLogger(__name__)
+
+_DONE_ = object()  # sentinel put by every worker when it runs out of jobs
+_POLL_INTERVAL_ = .2  # seconds, how often blocked threads check for cancellation
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a producer when the pipeline was stopped while it was blocked on the full sink
+    """
+    pass
+
+
+class _Failure_:
+    def __init__(self, job_id=None, error: Exception = None):
+        self.job_id = job_id
+        self.error = error
+
+
+class Sink:
+    """
+    Bounded results container handed to the producers. It exposes the same `append` method like the
+    collections.deque the producers used before so the jobs are unchanged, but `append` blocks while the sink is
+    full. A slow consumer (writer) slows down the producers instead of letting the results pile up in memory.
+    """
+
+    def __init__(self, maxsize: int = 0, stop: threading.Event = None):
+        self._queue_ = queue.Queue(maxsize=maxsize)
+        self._stop_ = stop
+
+    def append(self, item=None):
+        while True:
+            if self._stop_.is_set():
+                raise Cancelled('The pipeline was stopped')
+            try:
+                self._queue_.put(item, timeout=_POLL_INTERVAL_)
+                return
+            except queue.Full:
+                continue
+
+    def get(self):
+        return self._queue_.get(timeout=_POLL_INTERVAL_)
+
+    def qsize(self):
+        return self._queue_.qsize()
+
+    def drain(self):
+        while True:
+            try:
+                self._queue_.get_nowait()
+            except queue.Empty:
+                break
+
+
+class Pipeline:
+    """
+    Run jobs in a pool of producer threads and consume their results in the calling thread.
+
+    The results travel through a bounded Sink so the memory is bounded by `maxsize` results no matter how slow
+    the consumer is. Every worker puts a sentinel in the sink when it runs out of jobs so the consumer knows
+    exactly when all results were delivered, without polling or counting. A failing job is logged and recorded
+    in `failed`, or, when `fail_fast` is True, cancels the pipeline and its exception is raised in the consumer.
+    Ctrl-C (or closing the iterator) in the consumer sets the stop event and the producers give up as soon
+    as they check it.
+
+    The usage pattern is
+
+        pipeline = Pipeline(job=stream, jobs=jobs, workers=4, maxsize=16)
+        for polygon_id, batch in pipeline:
+            #process geoms (filter, reproject, etc)
+            #write data to disk
+            destination_layer.WritePyArrow(batch)
+        for job_id, error in pipeline.failed:
+            ...
+
+    """
+
+    def __init__(self, job: typing.Callable = None, jobs: typing.Iterable[dict] = None, workers: int = 4,
+                 maxsize: int = None, results_arg: typing.Optional[str] = 'results', fail_fast: bool = False,
+                 stop: threading.Event = None, id_prop_name: str = None, progress=None, task=None):
+        """
+        :param job: callable called with every item from jobs as kwargs
+        :param jobs: iterable of dicts, the kwargs of every job
+        :param workers: int, the number of producer threads
+        :param maxsize: int, the max number of results held in the sink, defaults to 4 x workers
+        :param results_arg: str, the name of the kwarg the sink is passed in to the job, the job calls
+        `append` on it for every result. If None, the value returned by the job is the result
+        :param fail_fast: bool, if True the first failing job cancels the pipeline
+        :param stop: threading.Event, used to stop the producers. The jobs can receive it as well to stop early
+        :param id_prop_name: str, the name of the kwarg used to identify a job in logs and in `failed`
+        :param progress: rich progress instance
+        :param task: the id of the rich progress task advanced every time a job finishes
+        """
+        self.job = job
+        self.jobs = list(jobs)
+        self.workers = max(1, min(workers, len(self.jobs))) if self.jobs else 0
+        self.results_arg = results_arg
+        self.fail_fast = fail_fast
+        self.stop = stop or threading.Event()
+        self.id_prop_name = id_prop_name
+        self.progress = progress
+        self.task = task
+        self.sink = Sink(maxsize=maxsize or 4 * max(self.workers, 1), stop=self.stop)
+        self.failed = list()
+        self._pending_ = queue.SimpleQueue()
+        for job_kwargs in self.jobs:
+            self._pending_.put(job_kwargs)
+        self._threads_ = list()
+
+    def _put_(self, item=None):
+        try:
+            self.sink.append(item)
+        except Cancelled:
+            pass
+
+    def _work_(self):
+        logger.debug(f'starting pipeline worker thread {threading.current_thread().name}')
+        try:
+            while not self.stop.is_set():
+                try:
+                    job_kwargs = self._pending_.get_nowait()
+                except queue.Empty:
+                    break
+                job_id = job_kwargs.get(self.id_prop_name or '')
+                try:
+                    logger.debug(f'Starting job {job_id}')
+                    if self.results_arg is None:
+                        self.sink.append(self.job(**job_kwargs))
+                    else:
+                        self.job(**dict(job_kwargs, **{self.results_arg: self.sink}))
+                    logger.debug(f'Finished job {job_id}')
+                except Cancelled:
+                    break
+                except Exception as e:
+                    with StringIO() as eio:
+                        traceback.print_exception(e, file=eio)
+                        logger.error(f'Failed to handle data over {job_id}')
+                        logger.error(eio.getvalue())
+                    self._put_(_Failure_(job_id=job_id, error=e))
+                    if self.fail_fast:
+                        break
+                finally:
+                    if self.progress is not None and self.task is not None:
+                        self.progress.update(self.task, advance=1)
+        finally:
+            self._put_(_DONE_)
+            logger.debug(f'No more jobs. Pipeline worker {threading.current_thread().name} is finishing.')
+
+    def cancel(self):
+        """
+        Stop the producers and wait for them to finish
+        """
+        self.stop.set()
+        for t in self._threads_:
+            while t.is_alive():
+                self.sink.drain()
+                t.join(timeout=_POLL_INTERVAL_)
+
+    def __iter__(self):
+        self._threads_ = [threading.Thread(target=self._work_, name=f'pipeline-{i}', daemon=True)
+                          for i in range(self.workers)]
+        for t in self._threads_:
+            t.start()
+        finished = 0
+        try:
+            while finished < self.workers:
+                try:
+                    item = self.sink.get()
+                except queue.Empty:
+                    if self.stop.is_set() and not any(t.is_alive() for t in self._threads_):
+                        # stopped from outside, the sentinels of the cancelled workers could not be delivered
+                        break
+                    continue
+                if item is _DONE_:
+                    finished += 1
+                elif isinstance(item, _Failure_):
+                    self.failed.append((item.job_id, item.error))
+                    if self.fail_fast:
+                        raise item.error
+                else:
+                    yield item
+        except KeyboardInterrupt:
+            logger.info(f'Cancelling. Please wait/allow for a graceful shutdown')
+            raise
+        finally:
+            if finished < self.workers:  # interrupted, failed or closed early by the consumer
+                self.cancel()
@@ -0,0 +1,149 @@
+"""
+Assign points (building centroids, polygon centroids, etc.) to the polygon that contains them.
+
+Two paths are available:
+    the polygons are H3 cells: the cells of the points are computed in bulk and looked up in the sorted ids of the
+    polygon cells, no geometry is involved
+    arbitrary polygons: a STRtree of the points is bulk queried with the prepared polygons
+"""
+import logging
+import typing
+
+import h3.api.basic_int as h3
+import numpy as np
+import shapely
+
+try:
+    from h3ronpy.vector import coordinates_to_cells
+except ImportError:
+    coordinates_to_cells = None
+
+logger = logging.getLogger(__name__)
+
+NO_POLYGON = -1
+# the points are assigned in chunks to bound the memory used by their geometries
+POINTS_CHUNK_SIZE = 1_000_000
+
+
+class PointInPolygon:
+    """
+    Find the index of the polygon containing every point, NO_POLYGON (-1) for the points outside all polygons.
+
+        pip = PointInPolygon(polygons=polygons_gdf.geometry.to_numpy())
+        idx = pip(x=centroids.x.to_numpy(), y=centroids.y.to_numpy())
+        polygons_gdf['h3id'].to_numpy()[idx[idx != NO_POLYGON]]
+
+    When the polygons are the cells of an H3 grid pass their ids as h3_cells instead. The points have to be
+    geographic (x=longitude, y=latitude) in this case.
+    """
+
+    def __init__(self, polygons: np.ndarray = None, h3_cells: typing.Sequence[int] = None):
+        """
+        :param polygons: array of shapely polygons
+        :param h3_cells: sequence of H3 cell ids (int) of the same resolution, used instead of polygons
+        """
+        assert (polygons is None) != (h3_cells is None), 'Either polygons or h3_cells is required'
+        self.polygons = polygons
+        self.tree = None
+        self.cells = None
+        if h3_cells is not None:
+            cells = np.asarray(h3_cells, dtype='u8')
+            self.resolution = h3.get_resolution(int(cells[0])) if cells.size else 0
+            # every cell of a resolution has the resolution in the same bits of its id
+            assert ((cells >> 52) & 0xF == self.resolution).all(), 'The H3 cells need to have the same resolution'
+            # the cells are sorted once and the cells of the points are looked up with a binary search
+            self.order = np.argsort(cells, kind='stable')
+            self.cells = cells[self.order]
+        else:
+            shapely.prepare(polygons)
+            self.tree = shapely.STRtree(polygons)
+
+    def __len__(self):
+        return len(self.cells) if self.cells is not None else len(self.polygons)
+
+    def _point_cells_(self, x: np.ndarray = None, y: np.ndarray = None) -> np.ndarray:
+        if coordinates_to_cells is not None:
+            return np.asarray(coordinates_to_cells(y, x, self.resolution), dtype='u8')
+        # h3 computes one cell per call, h3ronpy is the vectorized and much faster alternative
+        return np.frompyfunc(h3.latlng_to_cell, 3, 1)(y, x, self.resolution).astype('u8')
+
+    def _h3_(self, x: np.ndarray = None, y: np.ndarray = None) -> np.ndarray:
+        located = np.full(len(x), NO_POLYGON, dtype='i8')
+        if not self.cells.size:
+            return located
+        valid = np.isfinite(x) & np.isfinite(y)
+        for start in range(0, len(x), POINTS_CHUNK_SIZE):
+            chunk = np.flatnonzero(valid[start:start + POINTS_CHUNK_SIZE]) + start
+            point_cells = self._point_cells_(x=x[chunk], y=y[chunk])
+            pos = np.searchsorted(self.cells, point_cells).clip(max=self.cells.size - 1)
+            found = self.cells[pos] == point_cells
+            located[chunk[found]] = self.order[pos[found]]
+        return located
+
+    def _strtree_(self, x: np.ndarray = None, y: np.ndarray = None, nearest: bool = False) -> np.ndarray:
+        located = np.full(len(x), NO_POLYGON, dtype='i8')
+        for start in range(0, len(x), POINTS_CHUNK_SIZE):
+            points = shapely.points(x[start:start + POINTS_CHUNK_SIZE], y[start:start + POINTS_CHUNK_SIZE])
+            # the tree is built over the points and queried with the prepared polygons, the same "point within
+            # polygon" relation but a few times faster than querying a tree of polygons with every point
+            poly_idx, point_idx = shapely.STRtree(points).query(self.polygons, predicate='contains')
+            # a point inside overlapping polygons is assigned to only one of them
+            located[start + point_idx] = poly_idx
+            if nearest:
+                outside = np.flatnonzero(located[start:start + len(points)] == NO_POLYGON)
+                if outside.size:
+                    point_idx, poly_idx = self.tree.query_nearest(points[outside], all_matches=False)
+                    located[start + outside[point_idx]] = poly_idx
+        return located
+
+    def __call__(self, x: np.ndarray = None, y: np.ndarray = None, nearest: bool = False) -> np.ndarray:
+        """
+        :param x: array of point x coordinates (longitudes for H3 cells)
+        :param y: array of point y coordinates (latitudes for H3 cells)
+        :param nearest: bool, if True the points outside all polygons are assigned to the nearest polygon.
+        Only for polygons
+        :return: int32 array with the index of the polygon containing every point or NO_POLYGON
+        """
+        x = np.asarray(x, dtype='f8')
+        y = np.asarray(y, dtype='f8')
+        assert x.shape == y.shape, 'x and y need to have the same shape'
+        if self.cells is not None:
+            assert not nearest, 'nearest is not supported for H3 cells'
+            located = self._h3_(x=x, y=y)
+        else:
+            located = self._strtree_(x=x, y=y, nearest=nearest)
+        return located.astype('i4')
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    import geopandas as gpd
+
+    logging.basicConfig(level=logging.INFO)
+
+    npoints = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10_000_000
+    rng = np.random.default_rng(0)
+    # a resolution 7 H3 grid over a 1 x 1 degree area
+    cells = np.array(sorted(h3.geo_to_cells(shapely.box(30, 0, 31, 1), res=7)), dtype='i8')
+    polygons = np.array([shapely.Polygon([(lng, lat) for lat, lng in h3.cell_to_boundary(int(c))]) for c in cells])
+    x = rng.uniform(29.9, 31.1, npoints)
+    y = rng.uniform(-.1, 1.1, npoints)
+    logger.info(f'Assigning {npoints} points to {len(cells)} polygons')
+
+    start = time.time()
+    points_gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs='EPSG:4326')
+    polygons_gdf = gpd.GeoDataFrame(geometry=polygons, crs='EPSG:4326')
+    joined = gpd.sjoin(points_gdf, polygons_gdf, how='left', predicate='within')
+    joined = joined[~joined.index.duplicated()]
+    expected = joined['index_right'].fillna(NO_POLYGON).to_numpy().astype('i4')
+    logger.info(f'geopandas sjoin: {time.time() - start:.2f}s')
+
+    for name, kwargs in ('strtree', dict(polygons=polygons)), ('h3', dict(h3_cells=cells)):
+        start = time.time()
+        located = PointInPolygon(**kwargs)(x=x, y=y)
+        elapsed = time.time() - start
+        # the points on the shared border of two cells can go either way
+        agreement = (located == expected).mean()
+        logger.info(f'{name}: {elapsed:.2f}s ({npoints / elapsed:.0f} points/s), {agreement:.5%} agree with sjoin')
@@ -0,0 +1,98 @@
+import logging
+import typing
+
+import numpy
+import pyarrow as pa
+import shapely
+
+logger = logging.getLogger(__name__)
+
+MAX_FEATURES_PER_QUERY = 50000  # expected number of features streamed by one query
+MAX_BBOX_WASTE = 4.  # max ratio between the area of the bbox of a cluster and the area of its polygons
+
+
+def cluster_polygons(polygons: typing.Dict[typing.Any, shapely.Geometry] = None, density: float = None,
+                     max_features: int = MAX_FEATURES_PER_QUERY, max_waste: float = MAX_BBOX_WASTE):
+    """
+    Group the mask polygons of a download into clusters whose bounding box is queried with one request.
+
+    Adjacent polygons (ex: H3 cells) make heavily overlapping bbox queries that read the same index nodes and
+    feature pages of a remote FlatGeobuf. The polygons are split recursively along the longer axis of their
+    bounding box (at the median centroid) until a cluster is expected to hold at most max_features features
+    (density x bbox area) and its bbox is not much larger than the polygons themselves, so sparse polygons
+    are not merged into one huge query.
+
+    :param polygons: dict of polygon id: shapely polygon in the projection of the remote layer
+    :param density: float, the expected number of features per unit of area. If None only the bbox waste
+    is used to size the clusters
+    :param max_features: int, max expected number of features in one cluster
+    :param max_waste: float, max ratio between the area of the bbox of a cluster and the area of its polygons
+    :return: list of (bbox, ids) tuples, bbox being (minx, miny, maxx, maxy) and ids the list of the ids of
+    the polygons in the cluster
+    """
+    ids = list(polygons)
+    if not ids:
+        return []
+    geoms = numpy.array(list(polygons.values()), dtype=object)
+    bounds = shapely.bounds(geoms)
+    areas = shapely.area(geoms)
+    cx = (bounds[:, 0] + bounds[:, 2]) / 2
+    cy = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    clusters = list()
+    stack = [numpy.arange(len(ids))]
+    while stack:
+        idx = stack.pop()
+        minx, miny = bounds[idx, 0].min(), bounds[idx, 1].min()
+        maxx, maxy = bounds[idx, 2].max(), bounds[idx, 3].max()
+        bbox_area = (maxx - minx) * (maxy - miny)
+        expected = (density or 0) * bbox_area
+        covered = areas[idx].sum()
+        if len(idx) == 1 or (expected <= max_features and bbox_area <= max_waste * covered):
+            clusters.append(((minx, miny, maxx, maxy), [ids[i] for i in idx]))
+            continue
+        axis = cx if maxx - minx >= maxy - miny else cy
+        order = idx[numpy.argsort(axis[idx], kind='stable')]
+        half = len(order) // 2
+        stack.extend((order[half:], order[:half]))
+    return clusters
+
+
+class PolygonAssigner:
+    """
+    Assign the features streamed over the bbox of a cluster to the polygons of the cluster locally.
+
+    It exposes an `append` method so it can be passed as `results` to rapida.util.read_bbox.stream. Every
+    streamed batch is reduced to the features that intersect at least one polygon of the cluster, like a
+    mask query would return, optionally tagged with the id of the (first) polygon they intersect, and is
+    forwarded to the real results container.
+    """
+
+    def __init__(self, polygons: typing.Dict[typing.Any, shapely.Geometry] = None, results=None,
+                 add_polyid: bool = False, geom_column: str = 'wkb_geometry'):
+        """
+        :param polygons: dict of polygon id: shapely polygon in the projection of the remote layer
+        :param results: container with an append method the assigned batches are forwarded to
+        :param add_polyid: bool, if True a polyid column with the id of the polygon is added to the batches
+        :param geom_column: str, the name of the WKB geometry column
+        """
+        self.ids = numpy.array(list(polygons), dtype=object)
+        self.tree = shapely.STRtree(list(polygons.values()))
+        self.results = results
+        self.add_polyid = add_polyid
+        self.geom_column = geom_column
+
+    def append(self, item=None):
+        cluster_id, batch = item
+        geoms = shapely.from_wkb(batch.column(self.geom_column).to_numpy(zero_copy_only=False), on_invalid='ignore')
+        feature_idx, polygon_idx = self.tree.query(geoms, predicate='intersects')
+        first = numpy.full(len(geoms), len(self.ids), dtype=numpy.int64)
+        numpy.minimum.at(first, feature_idx, polygon_idx)
+        keep = first < len(self.ids)
+        if not keep.all():
+            batch = batch.filter(pa.array(keep))
+        if batch.num_rows == 0:
+            return
+        if self.add_polyid:
+            batch = batch.append_column('polyid', pa.array(self.ids[first[keep]].tolist()))
+        self.results.append((cluster_id, batch))
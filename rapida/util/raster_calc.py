@@ -0,0 +1,288 @@
+import concurrent.futures
+import logging
+import os
+import tempfile
+import threading
+from typing import Dict, Iterable
+
+import numpy as np
+from osgeo import gdal, gdal_array
+
+from rapida import constants
+
+logger = logging.getLogger(__name__)
+gdal.UseExceptions()
+
+NODATA_POLICIES = 'propagate', 'zero'
+# max number of pixels of one source read in one window
+MAX_WINDOW_PIXELS = 2 ** 22
+
+
+def _windows_(width: int = None, height: int = None, block_xsize: int = 256, block_ysize: int = 256):
+    """
+    Split a raster in windows made of full output block rows. Very wide rasters are split
+    horizontally as well so a window never exceeds MAX_WINDOW_PIXELS.
+    """
+    xstep = width
+    if width * block_ysize > MAX_WINDOW_PIXELS:
+        xstep = max(block_xsize, (MAX_WINDOW_PIXELS // block_ysize) // block_xsize * block_xsize)
+    for yoff in range(0, height, block_ysize):
+        for xoff in range(0, width, xstep):
+            yield xoff, yoff, min(xstep, width - xoff), min(block_ysize, height - yoff)
+
+
+def calc(expression: str = None, sources: Dict[str, str] = None, dst_path: str = None, dtype: str = 'float32',
+         dst_nodata: float = None, nodata_policy: str = 'propagate', namespace: dict = None, workers: int = None,
+         creation_options: dict = None, overwrite: bool = True, progress=None) -> str:
+    """
+    Evaluate a numpy expression over aligned rasters and write the result into a tiled ZSTD compressed GeoTiff.
+
+    The sources are streamed window by window (rows of output blocks) and the windows are processed in a thread
+    pool. GDAL releases the GIL while reading and decompressing so the threads run in parallel. Every thread opens
+    its own handles to the sources and reuses its read buffers.
+
+    :param expression: str, numpy expression using the keys of sources as variable names, ex: "a+b*2"
+    :param sources: dict of name: raster path. All rasters need to share the same grid
+    :param dst_path: str, path to the output GeoTiff
+    :param dtype: str, numpy dtype of the output
+    :param dst_nodata: number, output nodata value, defaults to the nodata value of the first source or to nan
+    for float output
+    :param nodata_policy: str, "propagate" to set the output to nodata where any source is nodata or "zero" to
+    treat the nodata pixels as zero and set the output to nodata only where all sources are nodata
+    :param namespace: dict, additional names (scalars, functions) the expression can use
+    :param workers: int, number of threads, defaults to the number of CPUs
+    :param creation_options: dict, GTiff creation options overriding the default ones
+    :param overwrite: bool, overwrite dst_path if it exists
+    :param progress: rich progress instance
+    :return: dst_path
+    """
+    return calc_many(expressions={dst_path: expression}, sources=sources, dtype=dtype, dst_nodata=dst_nodata,
+                     nodata_policy=nodata_policy, namespace=namespace, workers=workers,
+                     creation_options=creation_options, overwrite=overwrite, progress=progress)[0]
+
+
+def calc_many(expressions: Dict[str, str] = None, sources: Dict[str, str] = None, dtype: str = 'float32',
+              dst_nodata: float = None, nodata_policy: str = 'propagate', namespace: dict = None,
+              workers: int = None, creation_options: dict = None, overwrite: bool = True, progress=None) -> list:
+    """
+    Same as calc but writes several outputs, one per expression, in one pass over the sources.
+
+    :param expressions: dict of dst_path: expression
+    :return: list of written paths
+    """
+    assert expressions, f'Invalid expressions={expressions}'
+    assert sources, f'Invalid sources={sources}'
+    assert nodata_policy in NODATA_POLICIES, f'Invalid nodata_policy={nodata_policy}. Valid values are {NODATA_POLICIES}'
+    for dst_path in expressions:
+        assert os.path.isabs(dst_path), f'{dst_path} is not an absolute path'
+        if os.path.exists(dst_path):
+            assert overwrite, f'{dst_path} exists. Use overwrite=True to replace it'
+            os.remove(dst_path)
+    codes = {dst_path: compile(expr, '<calc>', 'eval') for dst_path, expr in expressions.items()}
+    names = list(sources)
+
+    # grid and nodata of the sources
+    nodata = dict()
+    with gdal.OpenEx(sources[names[0]], gdal.OF_RASTER | gdal.OF_READONLY) as ref_ds:
+        width, height = ref_ds.RasterXSize, ref_ds.RasterYSize
+        geotransform = ref_ds.GetGeoTransform()
+        projection = ref_ds.GetProjection()
+    for name, src_path in sources.items():
+        with gdal.OpenEx(src_path, gdal.OF_RASTER | gdal.OF_READONLY) as src_ds:
+            assert (src_ds.RasterXSize, src_ds.RasterYSize) == (width, height), \
+                f'{src_path} is not aligned with {sources[names[0]]}'
+            assert np.allclose(src_ds.GetGeoTransform(), geotransform), \
+                f'{src_path} is not aligned with {sources[names[0]]}'
+            nodata[name] = src_ds.GetRasterBand(1).GetNoDataValue()
+
+    np_dtype = np.dtype(dtype)
+    if dst_nodata is None:
+        dst_nodata = nodata[names[0]]
+    if dst_nodata is None and np_dtype.kind == 'f':
+        dst_nodata = np.nan
+    co = dict(constants.GTIFF_CREATION_OPTIONS)
+    co.update(COMPRESS='ZSTD', PREDICTOR=3 if np_dtype.kind == 'f' else 2)
+    co.update(creation_options or {})
+    block_xsize, block_ysize = int(co['BLOCKXSIZE']), int(co['BLOCKYSIZE'])
+
+    driver = gdal.GetDriverByName('GTiff')
+    dst_datasets = dict()
+    for dst_path in expressions:
+        dst_ds = driver.Create(dst_path, width, height, 1, gdal_array.NumericTypeCodeToGDALTypeCode(np_dtype),
+                               options=[f'{k}={v}' for k, v in co.items()])
+        dst_ds.SetGeoTransform(geotransform)
+        dst_ds.SetProjection(projection)
+        if dst_nodata is not None:
+            dst_ds.GetRasterBand(1).SetNoDataValue(float(dst_nodata))
+        dst_datasets[dst_path] = dst_ds
+
+    local = threading.local()
+    write_lock = threading.Lock()
+    namespace = dict(namespace or {}, np=np, __builtins__={})
+
+    def process(window):
+        xoff, yoff, xsize, ysize = window
+        if not hasattr(local, 'bands'):
+            local.datasets = [gdal.OpenEx(sources[n], gdal.OF_RASTER | gdal.OF_READONLY) for n in names]
+            local.bands = [ds.GetRasterBand(1) for ds in local.datasets]
+            local.buffers = dict()
+        arrays = dict()
+        invalid = None
+        for name, band in zip(names, local.bands):
+            buf = local.buffers.get((name, xsize, ysize))
+            data = band.ReadAsArray(xoff, yoff, xsize, ysize, buf_obj=buf)
+            local.buffers[(name, xsize, ysize)] = data
+            src_nodata = nodata[name]
+            if src_nodata is not None:
+                is_nodata = np.isnan(data) if np.isnan(src_nodata) else data == src_nodata
+                if nodata_policy == 'zero':
+                    data = np.where(is_nodata, 0, data)
+                    invalid = is_nodata if invalid is None else invalid & is_nodata
+                else:
+                    invalid = is_nodata if invalid is None else invalid | is_nodata
+            elif nodata_policy == 'zero':
+                invalid = np.zeros((ysize, xsize), dtype=bool)
+            arrays[name] = data
+        results = dict()
+        with np.errstate(all='ignore'):
+            for dst_path, code in codes.items():
+                result = np.asarray(eval(code, namespace, arrays), dtype=np_dtype)
+                if result.shape != (ysize, xsize):
+                    result = np.broadcast_to(result, (ysize, xsize)).copy()
+                if dst_nodata is not None:
+                    if invalid is not None:
+                        result[invalid] = dst_nodata
+                    if np_dtype.kind == 'f':
+                        result[~np.isfinite(result)] = dst_nodata
+                results[dst_path] = result
+        with write_lock:
+            for dst_path, result in results.items():
+                dst_datasets[dst_path].GetRasterBand(1).WriteArray(result, xoff, yoff)
+
+    windows = list(_windows_(width=width, height=height, block_xsize=block_xsize, block_ysize=block_ysize))
+    task = None
+    if progress is not None:
+        task = progress.add_task(description=f'Computing {", ".join(expressions.values())}', total=len(windows))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            futures = [executor.submit(process, window) for window in windows]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    if progress is not None:
+                        progress.update(task, advance=1)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        for dst_ds in dst_datasets.values():
+            dst_ds.FlushCache()
+        dst_datasets = None
+        if progress is not None:
+            progress.remove_task(task)
+    return list(expressions)
+
+
+def sum_rasters(src_rasters: Iterable[str] = None, dst_path: str = None, dtype: str = 'float32',
+                dst_nodata: float = None, workers: int = None, overwrite: bool = True, progress=None) -> str:
+    """
+    Sum aligned rasters treating the nodata pixels as zero. The output is nodata only where all
+    the inputs are nodata.
+
+    :param src_rasters: iterable of raster paths sharing the same grid
+    :param dst_path: str, path to the output GeoTiff
+    :return: dst_path
+    """
+    sources = {f'r{i}': src for i, src in enumerate(src_rasters)}
+    return calc(expression='+'.join(sources), sources=sources, dst_path=dst_path, dtype=dtype,
+                dst_nodata=dst_nodata, nodata_policy='zero', workers=workers, overwrite=overwrite,
+                progress=progress)
+
+
+
+def warp_to_grid(src_path: str = None, template_path: str = None, resample_alg: str = 'near') -> str:
+    """
+    Make a raster readable on the grid of another raster without writing any pixels.
+
+    :param src_path: str, path to the raster to align
+    :param template_path: str, path to the raster defining the grid
+    :param resample_alg: str, GDAL resampling algorithm
+    :return: src_path if it already shares the grid of template_path, otherwise the path to a temporary
+    VRT file warping src_path onto the grid. The caller is responsible to remove the VRT file
+    """
+    with gdal.OpenEx(template_path, gdal.OF_RASTER | gdal.OF_READONLY) as template_ds:
+        width, height = template_ds.RasterXSize, template_ds.RasterYSize
+        geotransform = template_ds.GetGeoTransform()
+        projection = template_ds.GetProjection()
+    with gdal.OpenEx(src_path, gdal.OF_RASTER | gdal.OF_READONLY) as src_ds:
+        if (src_ds.RasterXSize, src_ds.RasterYSize) == (width, height) and \
+                np.allclose(src_ds.GetGeoTransform(), geotransform):
+            return src_path
+    # a file and not /vsimem so the VRT can also be opened from worker processes
+    fd, vrt_path = tempfile.mkstemp(suffix='.vrt', prefix=f'{os.path.splitext(os.path.basename(src_path))[0]}_')
+    os.close(fd)
+    bounds = geotransform[0], geotransform[3] + height * geotransform[5], \
+        geotransform[0] + width * geotransform[1], geotransform[3]
+    logger.debug(f'Warping {src_path} onto the grid of {template_path} in {vrt_path}')
+    ds = gdal.Warp(vrt_path, src_path, format='VRT', outputBounds=bounds, width=width, height=height,
+                   dstSRS=projection, resampleAlg=resample_alg)
+    ds = None
+    return vrt_path
+
+
+def mask_raster(src_path: str = None, mask_path: str = None, dst_path: str = None, workers: int = None,
+                progress=None) -> str:
+    """
+    Write the pixels of src_path covered by mask_path (valid and non zero mask pixels) into dst_path.
+    The other pixels are set to the nodata value of src_path.
+
+    :param src_path: str, path to the source raster
+    :param mask_path: str, path to the mask raster. It is warped on the fly if it is not aligned to src_path
+    :param dst_path: str, path to the output GeoTiff
+    :return: dst_path
+    """
+    with gdal.OpenEx(src_path, gdal.OF_RASTER | gdal.OF_READONLY) as src_ds:
+        band = src_ds.GetRasterBand(1)
+        dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+        dst_nodata = band.GetNoDataValue()
+    if dst_nodata is None:
+        dst_nodata = np.nan if dtype.kind == 'f' else 0
+    aligned_mask = warp_to_grid(src_path=mask_path, template_path=src_path)
+    try:
+        return calc(expression='np.where(mask > 0, src, dst_nodata)',
+                    sources=dict(src=src_path, mask=aligned_mask), dst_path=dst_path, dtype=dtype.name,
+                    dst_nodata=dst_nodata, namespace=dict(dst_nodata=dst_nodata), workers=workers,
+                    progress=progress)
+    finally:
+        if aligned_mask != mask_path:
+            os.remove(aligned_mask)
+
+
+if __name__ == '__main__':
+    import time
+
+    logging.basicConfig(level=logging.INFO)
+
+    size = 8192
+    nrasters = 4
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        src_rasters = list()
+        for i in range(nrasters):
+            src_path = os.path.join(temp_dir, f'src{i}.tif')
+            with gdal.GetDriverByName('GTiff').Create(src_path, size, size, 1, gdal.GDT_Float32,
+                                                      options=['TILED=YES', 'COMPRESS=ZSTD']) as ds:
+                ds.SetGeoTransform((0, 100, 0, 0, 0, -100))
+                band = ds.GetRasterBand(1)
+                band.SetNoDataValue(-99999)
+                for yoff in range(0, size, 1024):
+                    band.WriteArray(rng.random((1024, size), dtype='float32'), 0, yoff)
+            src_rasters.append(src_path)
+        input_mb = nrasters * size * size * 4 / 2 ** 20
+        for workers in (1, os.cpu_count()):
+            start = time.time()
+            sum_rasters(src_rasters=src_rasters, dst_path=os.path.join(temp_dir, 'sum.tif'), workers=workers)
+            elapsed = time.time() - start
+            logger.info(f'Summed {nrasters} {size}x{size} float32 rasters with {workers} threads in '
+                        f'{elapsed:.2f}s ({input_mb / elapsed:.1f} MB/s)')
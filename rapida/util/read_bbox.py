@@ -1,8 +1,8 @@
 import datetime
 import logging
 import time
-import rasterio
 from pyogrio import open_arrow
+from rapida.util.query_planner import PolygonAssigner
 logger = logging.getLogger(__name__)
 
 
@@ -55,7 +55,7 @@ def stream(src_path=None, src_layer=0, bbox=None, mask=None, batch_size=None,
     :param polygon_id: the name assigned to the mask/bbox, used for logging purposes
     :param ntries: int=3, how many times should the stream be restarted in case an error is encountered
     :param progress:instance of  roch progress bar
-    :param results: instance of collections.deque used to place the downloaded features into the main thread
+    :param results: a container with an append method (rapida.util.pipeline.Sink) used to place the downloaded features into the main thread
     :param add_polyid, bool=False, if True the OGC_FID column from pyarrow GDAL API representing the FID
                       is added into the returned table. The expectation is the called has ensurted this column exists in the
                       layer where the table is going to be written
@@ -107,27 +107,20 @@ def stream(src_path=None, src_layer=0, bbox=None, mask=None, batch_size=None,
             progress.remove_task(task)
 
 
-def read_rasterio_window(src_ds_path=None, src_band=1, window=None, window_id=None, progress=None, results=None, entries=3):
-    task = None
-    try:
-        for attempt in range(entries):
-            logger.debug(f'Attempt no {attempt} at {window_id} {window}')
-            try:
-                if progress:
-                    task = progress.add_task(description=f'[green]Downloading data in {window_id}...', start=False,
-                                             total=None )
-                with rasterio.open(src_ds_path) as src:
-                    data = src.read(src_band, window=window)
-                    results.append((window_id, data))
-
-                return window_id
-            except Exception as e:
+def stream_cluster(src_path=None, src_layer=0, bbox=None, polygons=None, batch_size=None,
+                   signal_event=None, cluster_id=None, ntries=3, progress=None, results=None, add_polyid=False):
+    """
+    Stream the features covering a cluster of polygons (see rapida.util.query_planner.cluster_polygons) with one
+    bbox query and assign them locally to the polygons of the cluster
 
-                if attempt < entries-1:
-                    time.sleep(1)
-                    continue
-                else:
-                    raise e
-    finally:
-        if progress is not None and task is not None:
-            progress.remove_task(task)
\ No newline at end of file
+    :param bbox: iterable of 4 floats (left, bottom, right top), the bbox of the cluster
+    :param polygons: dict of polygon id: shapely polygon in the same projection like src_layer
+    :param cluster_id: the name of the cluster, used for logging purposes
+    :param add_polyid: bool=False, if True the id of the polygon every feature intersects is added as a polyid column
+    The other args are the same like in stream
+    :return: str, the name of the cluster
+    """
+    assigner = PolygonAssigner(polygons=polygons, results=results, add_polyid=add_polyid)
+    return stream(src_path=src_path, src_layer=src_layer, bbox=bbox, batch_size=batch_size,
+                  signal_event=signal_event, polygon_id=cluster_id, ntries=ntries, progress=progress,
+                  results=assigner, add_polyid=False)
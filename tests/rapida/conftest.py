@@ -0,0 +1,87 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+WIDTH, HEIGHT = 40, 30
+GEOTRANSFORM = (0., 100., 0., 3000., 0., -100.)
+NODATA = -1.
+# h3id: polygon, the boxes are aligned to the pixels so their stats can be computed with numpy
+POLYGONS = {
+    'aligned_0': 'POLYGON ((0 0, 1000 0, 1000 1000, 0 1000, 0 0))',
+    'aligned_1': 'POLYGON ((1500 1200, 3500 1200, 3500 2800, 1500 2800, 1500 1200))',
+    'triangle': 'POLYGON ((550 1530, 3910 130, 3910 2870, 550 1530))',
+    'outside': 'POLYGON ((10000 10000, 11000 10000, 11000 11000, 10000 11000, 10000 10000))',
+}
+
+
+def pixels(wkt=None):
+    """
+    The row and column slices of the pixels covered by an aligned box
+    """
+    from shapely import wkt as shapely_wkt
+    xmin, ymin, xmax, ymax = shapely_wkt.loads(wkt).bounds
+    x0, dx, _, y0, _, dy = GEOTRANSFORM
+    return slice(int((ymax - y0) / dy), int((ymin - y0) / dy)), slice(int((xmin - x0) / dx), int((xmax - x0) / dx))
+
+
+def write_raster(path=None, data=None, nodata=NODATA, geotransform=GEOTRANSFORM):
+    from osgeo import gdal, gdal_array, osr
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    height, width = data.shape
+    with gdal.GetDriverByName('GTiff').Create(path, width, height, 1,
+                                              gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype)) as ds:
+        ds.SetGeoTransform(geotransform)
+        ds.SetSpatialRef(srs)
+        band = ds.GetRasterBand(1)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        band.WriteArray(data)
+    return path
+
+
+def write_polygons(path=None, polygons=None):
+    from osgeo import ogr, osr
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    with ogr.GetDriverByName('GPKG').CreateDataSource(path) as ds:
+        lyr = ds.CreateLayer('polygons', srs=srs, geom_type=ogr.wkbPolygon)
+        lyr.CreateField(ogr.FieldDefn('h3id', ogr.OFTString))
+        for h3id, wkt in polygons.items():
+            feature = ogr.Feature(lyr.GetLayerDefn())
+            feature.SetField('h3id', h3id)
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+            lyr.CreateFeature(feature)
+    return path
+
+
+@pytest.fixture
+def zonal(tmp_path):
+    """
+    Two rasters with nodata pixels, a mask and a polygons layer keyed by h3id on the same grid
+    """
+    np = pytest.importorskip('numpy')
+    pytest.importorskip('shapely')
+    pytest.importorskip('osgeo')
+    rng = np.random.default_rng(0)
+    arrays = dict()
+    for name in ('a', 'b'):
+        data = rng.uniform(0, 100, (HEIGHT, WIDTH)).astype('f4')
+        data[rng.random((HEIGHT, WIDTH)) < .1] = NODATA
+        arrays[name] = data
+    mask = (rng.random((HEIGHT, WIDTH)) < .5).astype('u1')
+    return SimpleNamespace(
+        folder=str(tmp_path),
+        nodata=NODATA,
+        polygons=POLYGONS,
+        pixels=pixels,
+        write_raster=write_raster,
+        write_polygons=write_polygons,
+        arrays=arrays,
+        mask=mask,
+        rasters={name: write_raster(path=os.path.join(tmp_path, f'{name}.tif'), data=data)
+                 for name, data in arrays.items()},
+        mask_path=write_raster(path=os.path.join(tmp_path, 'mask.tif'), data=mask, nodata=None),
+        polygons_path=write_polygons(path=os.path.join(tmp_path, 'project.gpkg'), polygons=POLYGONS),
+    )
@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip('numpy')
+gpd = pytest.importorskip('geopandas')
+shapely = pytest.importorskip('shapely')
+pyogrio = pytest.importorskip('pyogrio')
+pytest.importorskip('osgeo')
+
+from rapida.components import buildings
+from rapida.components.buildings import BuildingsVariable
+
+KEYS = np.array(['a', 'b', 'c', 'd'])
+# a 2 x 2 grid of 10 x 10 cells, d gets no buildings
+POLYGONS = shapely.box([0, 10, 0, 10], [0, 0, 10, 10], [10, 20, 10, 20], [10, 10, 20, 20])
+
+
+@pytest.fixture
+def project(tmp_path):
+    """
+    A project GeoPackage with the polygons and buildings layers without polygon id, like the ones downloaded
+    before the sidecar, and the cell of every building
+    """
+    rng = np.random.default_rng(0)
+    n = 400
+    x, y = rng.uniform(0, 9.5, n) + rng.choice([0, 10], n), rng.uniform(0, 9.5, n)
+    # a few buildings in c
+    x[:10], y[:10] = rng.uniform(0, 9, 10), rng.uniform(10, 19, 10)
+    geoms = shapely.box(x, y, x + .5, y + .5)
+    cells = (x >= 10).astype('i8') + 2 * (y >= 10)
+    affected = rng.random(n) < .3
+    path = str(tmp_path / 'project.gpkg')
+    pyogrio.write_dataframe(gpd.GeoDataFrame({'h3id': KEYS}, geometry=POLYGONS, crs='ESRI:54009'), path,
+                            layer='polygons')
+    pyogrio.write_dataframe(gpd.GeoDataFrame(geometry=geoms, crs='ESRI:54009'), path, layer='buildings')
+    pyogrio.write_dataframe(gpd.GeoDataFrame(geometry=geoms[affected], crs='ESRI:54009'), path,
+                            layer='buildings.affected')
+    return SimpleNamespace(path=path, cells=cells, areas=shapely.area(geoms), affected=affected)
+
+
+@pytest.mark.parametrize('name', ['nbuildings', 'buildings_area'])
+@pytest.mark.parametrize('raster_mask', [None, 'mask.tif'])
+def test_aggregate_layers_without_polygon_ids(project, monkeypatch, name, raster_mask):
+    monkeypatch.setattr(buildings, 'Project', lambda *args, **kwargs: SimpleNamespace(raster_mask=raster_mask))
+    variable = SimpleNamespace(name=name, component='buildings')
+    var_gdf = BuildingsVariable._aggregate_layers_(variable, dataset_path=project.path, layer_name='buildings')
+
+    weights = None if name == 'nbuildings' else project.areas
+    expected = np.bincount(project.cells, weights=weights, minlength=4)
+    affected = project.affected
+    expected_affected = np.bincount(project.cells[affected], weights=None if weights is None else weights[affected],
+                                    minlength=4)
+    has_buildings = np.bincount(project.cells, minlength=4) > 0
+    if raster_mask is not None:
+        has_buildings &= np.bincount(project.cells[affected], minlength=4) > 0
+    assert var_gdf['polyid'].tolist() == KEYS[has_buildings].tolist() == ['a', 'b', 'c']
+    np.testing.assert_allclose(var_gdf[name].to_numpy(), expected[has_buildings])
+    if raster_mask is None:
+        assert var_gdf.columns.tolist() == ['polyid', name]
+    else:
+        np.testing.assert_allclose(var_gdf[f'{name}_affected'].to_numpy(), expected_affected[has_buildings])
+        np.testing.assert_allclose(var_gdf[f'{name}_affected_percentage'].to_numpy(),
+                                   expected_affected[has_buildings] / expected[has_buildings] * 100)
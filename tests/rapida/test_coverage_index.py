@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('exactextract')
+pytest.importorskip('osgeo')
+
+from rapida.stats.coverage_index import CoverageIndex, grid_hash, grid_signature
+from rapida.stats.raster_zonal_stats import zonal_table
+
+
+class Project:
+    """
+    The attributes of a rapida Project the coverage index uses
+    """
+
+    def __init__(self, folder=None, geopackage_file_path=None):
+        self.folder = folder
+        self.geopackage_file_path = geopackage_file_path
+        self.polygons_layer_name = 'polygons'
+
+    def coverage_index_path(self, grid_hash=None):
+        return os.path.join(self.folder, f'project.{grid_hash}.coverage.npz')
+
+
+def test_reduce_matches_numpy(zonal):
+    index = CoverageIndex.build(polygon_ds=zonal.polygons_path, polygon_layer='polygons',
+                                template_raster=zonal.rasters['a'])
+    assert sorted(index.keys) == sorted(zonal.polygons)
+    assert (np.diff(index.cells) >= 0).all()
+    stats, masked = index.reduce(raster_path=zonal.rasters['a'], mask_path=zonal.mask_path)
+    data = zonal.arrays['a']
+    for h3id in ('aligned_0', 'aligned_1'):
+        row = index.keys.tolist().index(h3id)
+        rows, cols = zonal.pixels(zonal.polygons[h3id])
+        values = data[rows, cols]
+        for result, covered in (stats, values != zonal.nodata), \
+                (masked, (values != zonal.nodata) & (zonal.mask[rows, cols] != 0)):
+            expected = values[covered].astype('f8')
+            np.testing.assert_allclose(result['sum'][row], expected.sum(), rtol=1e-6)
+            np.testing.assert_allclose(result['count'][row], covered.sum(), rtol=1e-6)
+            assert result['min'][row] == expected.min() and result['max'][row] == expected.max()
+    row = index.keys.tolist().index('outside')
+    assert stats['sum'][row] == 0 and stats['count'][row] == 0 and np.isnan(stats['min'][row])
+
+
+def test_zonal_table_matches_exactextract(zonal):
+    index = CoverageIndex.build(polygon_ds=zonal.polygons_path, polygon_layer='polygons',
+                                template_raster=zonal.rasters['a'])
+    kwargs = dict(src_rasters=[zonal.rasters['a'], zonal.rasters['b']], polygon_ds=zonal.polygons_path,
+                  polygon_layer='polygons', vars_ops=[('a', 'sum'), ('b', ['mean', 'count'])],
+                  mask=zonal.mask_path)
+    expected = zonal_table(**kwargs)
+    indexed = index.zonal_table(src_rasters=kwargs['src_rasters'], vars_ops=kwargs['vars_ops'],
+                                mask=zonal.mask_path)
+    assert indexed.columns.tolist() == ['a', 'a_affected', 'b_mean', 'b_count', 'b_affected_mean',
+                                        'b_affected_count']
+    indexed = indexed.loc[expected.index]
+    # the persisted weights are float32
+    for column in expected.columns:
+        np.testing.assert_allclose(indexed[column].to_numpy(), expected[column].to_numpy(), rtol=1e-5)
+
+
+def test_one_index_per_grid_and_stale_indices_are_pruned(zonal, monkeypatch):
+    from osgeo import ogr
+    project = Project(folder=zonal.folder, geopackage_file_path=zonal.polygons_path)
+    coarse = zonal.write_raster(path=os.path.join(zonal.folder, 'coarse.tif'),
+                                data=zonal.arrays['a'][::2, ::2].copy(), geotransform=(0., 200., 0., 3000., 0., -200.))
+    fine_path = project.coverage_index_path(grid_hash=grid_hash(grid_signature(zonal.rasters['a'])))
+    coarse_path = project.coverage_index_path(grid_hash=grid_hash(grid_signature(coarse)))
+    assert fine_path != coarse_path
+
+    CoverageIndex.for_project(project=project, template_raster=zonal.rasters['a'])
+    CoverageIndex.for_project(project=project, template_raster=coarse)
+    assert os.path.exists(fine_path) and os.path.exists(coarse_path)
+
+    # the indices of both grids are up to date and are loaded instead of rebuilt
+    def build(*args, **kwargs):
+        raise AssertionError('The coverage index was rebuilt')
+    monkeypatch.setattr(CoverageIndex, 'build', build)
+    for raster in zonal.rasters['a'], coarse:
+        assert CoverageIndex.for_project(project=project, template_raster=raster).covers(raster)
+    monkeypatch.undo()
+
+    with ogr.Open(zonal.polygons_path, 1) as ds:
+        lyr = ds.GetLayerByName('polygons')
+        feature = ogr.Feature(lyr.GetLayerDefn())
+        feature.SetField('h3id', 'new')
+        feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((0 0, 500 0, 500 500, 0 0))'))
+        lyr.CreateFeature(feature)
+    index = CoverageIndex.for_project(project=project, template_raster=zonal.rasters['a'])
+    assert 'new' in index.keys.tolist()
+    assert os.path.exists(fine_path) and not os.path.exists(coarse_path)
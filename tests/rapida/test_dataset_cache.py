@@ -0,0 +1,88 @@
+import os
+import stat
+import time
+
+import pytest
+
+pytest.importorskip('httpx')
+
+from rapida.util import dataset_cache
+from rapida.util.dataset_cache import DatasetCache
+
+
+def write(path=None, data=None):
+    with open(path, 'wb') as dst:
+        dst.write(data)
+    return str(path)
+
+
+def read(path=None):
+    with open(path, 'rb') as src:
+        return src.read()
+
+
+def test_get_serves_same_source_version_and_crop(tmp_path):
+    cache = DatasetCache(folder=str(tmp_path / 'cache'))
+    src_path = write(tmp_path / 'a.tif', b'a' * 100)
+    url = 'https://example.com/data/a.tif'
+    cached_path = cache.put(source=f'{url}?sig=1', etag='v1', crop='c1', path=src_path)
+    # the project file stays writable, the cached file is read only unless it is a hard link of the project file
+    assert os.stat(src_path).st_mode & stat.S_IWUSR
+    assert os.path.samefile(cached_path, src_path) or not os.stat(cached_path).st_mode & stat.S_IWUSR
+
+    dst_path = str(tmp_path / 'project' / 'a.tif')
+    os.makedirs(os.path.dirname(dst_path))
+    assert cache.get(source=f'/vsicurl/{url}?sig=2', etag='v1', crop='c1', dst_path=dst_path) == dst_path
+    assert read(dst_path) == b'a' * 100
+    assert cache.get(source=url, etag='v2', crop='c1', dst_path=dst_path) is None
+    assert cache.get(source=url, etag='v1', crop='c2', dst_path=dst_path) is None
+    assert cache.entries()[0]['hits'] == 1
+
+
+def test_lru_eviction_and_prune(tmp_path):
+    cache = DatasetCache(folder=str(tmp_path / 'cache'), max_bytes=250)
+    for name in 'abc':
+        cache.put(source=name, etag='v1', path=write(tmp_path / f'{name}.tif', name.encode() * 100))
+        time.sleep(.01)
+    assert [e['source'] for e in cache.entries()] == ['c', 'b']
+    assert cache.size() == 200
+
+    assert cache.get(source='b', etag='v1', dst_path=str(tmp_path / 'b2.tif'))
+    assert cache.prune(max_bytes=100) == 1
+    assert [e['source'] for e in cache.entries()] == ['b']
+    assert cache.prune(older_than=0) == 1
+    assert cache.size() == 0
+    # the datasets linked into the projects survive
+    assert read(tmp_path / 'b2.tif') == b'b' * 100
+
+
+def test_the_cache_is_opt_in(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset_cache, 'DATASET_CACHE_FOLDER', str(tmp_path / 'cache'))
+    monkeypatch.setattr(dataset_cache, '_cache_', None)
+    monkeypatch.delenv(dataset_cache.DATASET_CACHE_ENV_VAR, raising=False)
+    assert dataset_cache.get_dataset_cache() is None
+    monkeypatch.setenv(dataset_cache.DATASET_CACHE_ENV_VAR, '0')
+    assert dataset_cache.get_dataset_cache() is None
+    assert not os.path.exists(tmp_path / 'cache')
+    monkeypatch.setenv(dataset_cache.DATASET_CACHE_ENV_VAR, '2')
+    cache = dataset_cache.get_dataset_cache()
+    assert cache.folder == str(tmp_path / 'cache') and cache.max_bytes == 2 * 2 ** 30
+
+
+@pytest.mark.parametrize('method', ['hardlink', 'copy'])
+def test_only_private_files_become_read_only(tmp_path, monkeypatch, method):
+    def no_reflink(*args):
+        raise OSError('reflinks are not supported')
+
+    def no_link(*args):
+        raise OSError('cross-device link')
+
+    monkeypatch.setattr(dataset_cache.fcntl, 'ioctl', no_reflink)
+    if method == 'copy':
+        monkeypatch.setattr(dataset_cache.os, 'link', no_link)
+    cache = DatasetCache(folder=str(tmp_path / 'cache'))
+    src_path = write(tmp_path / 'a.tif', b'a' * 100)
+    cached_path = cache.put(source='a', etag='v1', path=src_path)
+    assert os.stat(src_path).st_mode & stat.S_IWUSR
+    assert os.path.samefile(cached_path, src_path) == (method == 'hardlink')
+    assert bool(os.stat(cached_path).st_mode & stat.S_IWUSR) == (method == 'hardlink')
@@ -0,0 +1,55 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pa = pytest.importorskip('pyarrow')
+shapely = pytest.importorskip('shapely')
+pyproj = pytest.importorskip('pyproj')
+pytest.importorskip('pyogrio')
+pytest.importorskip('osgeo')
+
+from rapida.util.download_geodata import WrittenFids, ingest_batch
+
+
+def make_batch(fids=None, geoms=None):
+    return pa.RecordBatch.from_arrays(
+        [pa.array(fids, type=pa.int64()), pa.array([float(fid) for fid in fids]), pa.array(geoms, type=pa.binary())],
+        names=['OGC_FID', 'height', 'wkb_geometry']
+    )
+
+
+def test_written_fids():
+    written = WrittenFids()
+    assert not written and written.seen(np.array([1, 2])).tolist() == [False, False]
+    written.add(np.array([7, 3, 3]))
+    written.add(np.array([5, 1]))
+    assert written.fids.tolist() == [1, 3, 5, 7]
+    assert written.seen(np.array([0, 1, 4, 7, 8])).tolist() == [False, True, False, True, False]
+
+
+def test_ingest_batch_drops_written_fids_and_missing_geometries():
+    point = shapely.to_wkb(shapely.Point(1, 1))
+    written = WrittenFids()
+    batch, fids = ingest_batch(batch=make_batch(fids=[1, 2, 3, 4, 5], geoms=[point, None, b'', b'\x01\x02', point]),
+                               written_fids=written)
+    # the null, empty and invalid geometries are dropped and their FIDs are not recorded
+    assert fids.to_pylist() == [1, 5] and batch['height'].to_pylist() == [1., 5.]
+    assert written.fids.tolist() == [1, 5]
+
+    # FIDs written by a previous batch (an adjacent query) are dropped
+    batch, fids = ingest_batch(batch=make_batch(fids=[5, 2, 1, 6], geoms=[point] * 4), written_fids=written)
+    assert fids.to_pylist() == [2, 6] and batch['height'].to_pylist() == [2., 6.]
+    assert written.fids.tolist() == [1, 2, 5, 6]
+
+    batch, fids = ingest_batch(batch=make_batch(fids=[6, 1], geoms=[point] * 2), written_fids=written)
+    assert batch.num_rows == 0 and len(written) == 4
+
+
+def test_ingest_batch_reprojects():
+    transformer = pyproj.Transformer.from_crs('EPSG:4326', 'EPSG:3857', always_xy=True)
+    polygon = shapely.box(30, -1, 30.01, -0.99)
+    batch, fids = ingest_batch(batch=make_batch(fids=[1, 2], geoms=[shapely.to_wkb(polygon), None]),
+                               transformer=transformer)
+    assert fids.to_pylist() == [1]
+    reprojected = shapely.from_wkb(batch['wkb_geometry'].to_numpy(zero_copy_only=False))[0]
+    xs, ys = transformer.transform(*shapely.get_coordinates(polygon).T)
+    np.testing.assert_allclose(shapely.get_coordinates(reprojected), np.column_stack((xs, ys)))
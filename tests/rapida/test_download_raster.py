@@ -0,0 +1,112 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from rapida.util.gen_blocks_bbox import gen_blocks_bbox
+
+
+@pytest.mark.parametrize('width, height, bbox', [
+    (300, 130, (10, 5, 290, 120)),
+    (130, 300, (0, 0, 130, 300)),
+    (256, 64, (3, 1, 200, 63)),
+])
+def test_gen_blocks_bbox_covers_bbox_of_non_square_rasters(width, height, bbox):
+    xminc, yminr, xmaxc, ymaxr = bbox
+    covered = set()
+    for col_start, row_start, col_size, row_size in gen_blocks_bbox(ds=SimpleNamespace(RasterXSize=width,
+                                                                                        RasterYSize=height),
+                                                                    blockxsize=64, blockysize=48, xminc=xminc,
+                                                                    yminr=yminr, xmaxc=xmaxc, ymaxr=ymaxr):
+        assert col_size > 0 and row_size > 0
+        pixels = {(c, r) for c in range(col_start, col_start + col_size) for r in range(row_start, row_start + row_size)}
+        assert not covered & pixels
+        covered |= pixels
+    assert covered == {(c, r) for c in range(xminc, xmaxc) for r in range(yminr, ymaxr)}
+
+
+@pytest.fixture(scope='module')
+def synthetic(tmp_path_factory):
+    pytest.importorskip('pyogrio')
+    np = pytest.importorskip('numpy')
+    gdal = pytest.importorskip('osgeo.gdal')
+    from osgeo import ogr, osr
+    gdal.UseExceptions()
+    folder = tmp_path_factory.mktemp('download_raster')
+    src_path = os.path.join(folder, 'src.tif')
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    width, height = 173, 61  # non square
+    with gdal.GetDriverByName('GTiff').Create(src_path, width, height, 1, gdal.GDT_Float32) as ds:
+        ds.SetGeoTransform((10., .01, 0, 1., 0, -.01))
+        ds.SetSpatialRef(wgs84)
+        band = ds.GetRasterBand(1)
+        band.SetNoDataValue(-1)
+        band.WriteArray(np.arange(width * height, dtype='float32').reshape(height, width))
+    target_srs = osr.SpatialReference()
+    target_srs.ImportFromEPSG(3857)
+    target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    polygons_path = os.path.join(folder, 'polygons.gpkg')
+    with ogr.GetDriverByName('GPKG').CreateDataSource(polygons_path) as ds:
+        lyr = ds.CreateLayer('polygons', srs=target_srs, geom_type=ogr.wkbPolygon)
+        for wkt in ('POLYGON ((1115000 20000, 1180000 20000, 1180000 90000, 1115000 90000, 1115000 20000))',
+                    'POLYGON ((1200000 -40000, 1290000 -40000, 1250000 60000, 1200000 -40000))'):
+            f = ogr.Feature(lyr.GetLayerDefn())
+            f.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+            lyr.CreateFeature(f)
+    return SimpleNamespace(folder=folder, src_path=src_path, polygons_path=polygons_path, target_srs=target_srs)
+
+
+def test_download_raster_matches_warp_with_cutline(synthetic):
+    import numpy as np
+    from osgeo import gdal
+    from rapida.util import geo
+    from rapida.util.download_geodata import download_raster
+
+    dst_path = os.path.join(synthetic.folder, 'streamed.tif')
+    download_raster(src_dataset_path=synthetic.src_path, dst_dataset_path=dst_path,
+                    polygons_dataset_path=synthetic.polygons_path, polygons_layer_name='polygons',
+                    target_srs=synthetic.target_srs, horizontal_chunk_size=64, vertical_chunk_size=32, workers=3)
+    ref_path = os.path.join(synthetic.folder, 'reference.tif')
+    geo.import_raster(source=synthetic.src_path, dst=ref_path, target_srs=synthetic.target_srs,
+                      crop_ds=synthetic.polygons_path, crop_layer_name='polygons', errorThreshold=0)
+
+    with gdal.Open(dst_path) as streamed, gdal.Open(ref_path) as reference:
+        assert (streamed.RasterXSize, streamed.RasterYSize) == (reference.RasterXSize, reference.RasterYSize)
+        assert streamed.RasterXSize != streamed.RasterYSize
+        np.testing.assert_allclose(streamed.GetGeoTransform(), reference.GetGeoTransform())
+        assert streamed.GetRasterBand(1).GetNoDataValue() == -1
+        a = streamed.GetRasterBand(1).ReadAsArray()
+        b = reference.GetRasterBand(1).ReadAsArray()
+        b[b == reference.GetRasterBand(1).GetNoDataValue()] = -1
+        assert (a != -1).sum() > 0
+        assert (a == b).mean() > .99
+
+
+def test_download_raster_into_another_srs_than_the_polygons(synthetic):
+    import numpy as np
+    from osgeo import gdal, osr
+    from rapida.util import geo
+    from rapida.util.download_geodata import download_raster
+
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    dst_path = os.path.join(synthetic.folder, 'streamed_wgs84.tif')
+    # the polygons are in EPSG:3857 so the blocks need to be filtered with bounds transformed to the polygons SRS
+    download_raster(src_dataset_path=synthetic.src_path, dst_dataset_path=dst_path,
+                    polygons_dataset_path=synthetic.polygons_path, polygons_layer_name='polygons',
+                    target_srs=wgs84, x_res=.01, y_res=.01, horizontal_chunk_size=16, vertical_chunk_size=16,
+                    workers=3)
+    ref_path = os.path.join(synthetic.folder, 'reference_wgs84.tif')
+    geo.import_raster(source=synthetic.src_path, dst=ref_path, target_srs=wgs84, x_res=.01, y_res=.01,
+                      crop_ds=synthetic.polygons_path, crop_layer_name='polygons', errorThreshold=0)
+
+    with gdal.Open(dst_path) as streamed, gdal.Open(ref_path) as reference:
+        a = streamed.GetRasterBand(1).ReadAsArray()
+        b = reference.GetRasterBand(1).ReadAsArray()
+        nvalid = (a != -1).sum()
+        nexpected = (b != reference.GetRasterBand(1).GetNoDataValue()).sum()
+        assert nvalid > 0
+        assert abs(nvalid - nexpected) <= .05 * nexpected
+        assert np.isin(a[a != -1], np.arange(173 * 61)).all()
@@ -0,0 +1,50 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('sympy')
+
+from rapida.core.expression import ExpressionGraph
+
+DEFINITIONS = {
+    'male_child': ['m_0', 'm_1'],
+    'male_active': ['m_15', 'm_20'],
+    'female_child': ['f_0', 'f_1'],
+    'female_active': None,
+    'male_total': 'male_child+male_active',
+    'female_total': 'female_child+female_active',
+    'total': 'male_total+female_total',
+    'dependency': '(male_child+female_child)/(male_active+female_active)',
+}
+
+
+def test_dependencies_and_leaves():
+    graph = ExpressionGraph(definitions=DEFINITIONS)
+    assert graph.is_leaf('male_child') and graph.is_leaf('female_active')
+    assert not graph.is_leaf('total')
+    assert graph.dependencies('total') == ['female_total', 'male_total']
+    assert graph.dependencies('male_child') == []
+    assert graph.leaves(['total']) == ['female_active', 'female_child', 'male_active', 'male_child']
+    assert graph.leaves(['male_total', 'male_child']) == ['male_active', 'male_child']
+
+
+def test_fused_expression_matches_stepwise_evaluation():
+    graph = ExpressionGraph(definitions=DEFINITIONS)
+    rng = np.random.default_rng(0)
+    leaves = {name: rng.uniform(1, 100, (8, 8)) for name in graph.leaves(DEFINITIONS)}
+    namespace = dict(__builtins__={})
+
+    # every derived variable materialized from its direct dependencies, like before the fusion
+    stepwise = dict(leaves)
+    for name in ('male_total', 'female_total', 'total', 'dependency'):
+        stepwise[name] = eval(DEFINITIONS[name], namespace, stepwise)
+
+    for name in ('male_total', 'female_total', 'total', 'dependency'):
+        expanded = graph.expand(name)
+        assert set(graph.leaves([name])) <= set(leaves)
+        np.testing.assert_allclose(eval(expanded, namespace, dict(leaves)), stepwise[name])
+
+
+def test_circular_dependency():
+    graph = ExpressionGraph(definitions={'a': 'b+1', 'b': 'c*2', 'c': 'a-1'})
+    with pytest.raises(AssertionError, match='Circular dependency'):
+        graph.expand('a')
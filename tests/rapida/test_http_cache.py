@@ -0,0 +1,124 @@
+import http.server
+import os
+import threading
+
+import pytest
+
+httpx = pytest.importorskip('httpx')
+
+from rapida.util.http_cache import CachingProxy, RangeCache
+
+CHUNK_SIZE = 1000
+
+
+class Origin(http.server.BaseHTTPRequestHandler):
+    """
+    A minimal origin server supporting HEAD and single byte range GET requests, recording the requests
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _headers_(self, status=None, length=None):
+        self.send_response(status)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.server.requests.append(('HEAD', None))
+        self._headers_(status=200, length=len(self.server.data))
+
+    def do_GET(self):
+        data = self.server.data
+        byte_range = self.headers.get('Range')
+        self.server.requests.append(('GET', byte_range))
+        start, end = byte_range.split('=')[1].split('-')
+        body = data[int(start):int(end) + 1]
+        self._headers_(status=206, length=len(body))
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def origin():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Origin)
+    server.data = os.urandom(10_500)
+    server.requests = list()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    server.url = f'http://{host}:{port}/buildings.fgb?sig=secret'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(url=None, start=None, end=None):
+    response = httpx.get(url, headers={'Range': f'bytes={start}-{end}'})
+    return response.status_code, response.content
+
+
+def test_hit_miss_and_etag(tmp_path):
+    cache = RangeCache(folder=str(tmp_path))
+    url = 'https://example.com/buildings.fgb'
+    assert cache.get(url=url, etag='v1', start=0, end=9) is None
+    cache.put(url=url, etag='v1', start=0, end=9, data=b'0123456789')
+    # the query string (SAS token) is not part of the key
+    assert cache.get(url=f'{url}?sig=1', etag='v1', start=0, end=9) == b'0123456789'
+    assert cache.get(url=url, etag='v2', start=0, end=9) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_bytes'], stats['size']) == (1, 2, 10, 10)
+
+
+def test_lru_eviction(tmp_path):
+    cache = RangeCache(folder=str(tmp_path), max_bytes=30)
+    url = 'https://example.com/buildings.fgb'
+    for i in range(3):
+        cache.put(url=url, etag='v1', start=i * 10, end=i * 10 + 9, data=bytes(10))
+    assert cache.get(url=url, etag='v1', start=0, end=9) is not None  # the first range is now the most recent
+    cache.put(url=url, etag='v1', start=30, end=39, data=bytes(10))
+    assert cache.size() == 30 and cache.stats()['evictions'] == 1
+    assert cache.get(url=url, etag='v1', start=10, end=19) is None
+    assert cache.get(url=url, etag='v1', start=0, end=9) is not None
+
+
+def test_proxy_round_trip_with_aligned_chunks(tmp_path, origin):
+    proxy = CachingProxy(cache=RangeCache(folder=str(tmp_path)), chunk_size=CHUNK_SIZE).start()
+    try:
+        url = proxy.url(origin.url)
+        assert get(url=url, start=1500, end=3499) == (206, origin.data[1500:3500])
+        # chunks 1 to 3 were fetched in one request
+        assert [r for r in origin.requests if r[0] == 'GET'] == [('GET', 'bytes=1000-3999')]
+
+        origin.requests.clear()
+        # overlapping reads that do not start at the same offset are served from the cached chunks
+        assert get(url=url, start=1000, end=1999) == (206, origin.data[1000:2000])
+        assert get(url=url, start=2500, end=3999) == (206, origin.data[2500:4000])
+        assert origin.requests == []
+
+        # only the missing chunks are fetched, the last one is shorter than chunk_size
+        assert get(url=url, start=3900, end=10_499) == (206, origin.data[3900:])
+        assert origin.requests == [('GET', 'bytes=4000-10499')]
+        assert httpx.head(url).headers['Content-Length'] == str(len(origin.data))
+    finally:
+        proxy.stop()
+
+    offline = CachingProxy(cache=proxy.cache, offline=True, chunk_size=CHUNK_SIZE).start()
+    try:
+        url = offline.url(origin.url)
+        assert get(url=url, start=1200, end=5000) == (206, origin.data[1200:5001])
+        assert get(url=url, start=0, end=10)[0] == 504
+    finally:
+        offline.stop()
+
+
+def test_proxy_refuses_unregistered_urls(tmp_path, origin):
+    proxy = CachingProxy(cache=RangeCache(folder=str(tmp_path)), chunk_size=CHUNK_SIZE).start()
+    try:
+        registered = proxy.url(origin.url)
+        unregistered = registered.replace('buildings.fgb', 'other.fgb')
+        assert get(url=unregistered, start=0, end=10)[0] == 403
+        assert httpx.head(unregistered).status_code == 403
+        assert origin.requests == []
+    finally:
+        proxy.stop()
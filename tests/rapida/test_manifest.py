@@ -0,0 +1,142 @@
+import os
+import posixpath
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('azure.storage.fileshare')
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+from rapida.project.manifest import MANIFEST_FILE_NAME, build_manifest, diff_manifests, download_folder, \
+    read_manifest, upload_folder
+
+
+class FakeShare:
+
+    def __init__(self):
+        self.files = dict()
+        self.dirs = set()
+        self.uploads = list()
+        self.downloads = list()
+
+
+class FakeDownloader:
+
+    def __init__(self, data=None):
+        self.data = data
+
+    def readall(self):
+        return self.data
+
+    def readinto(self, stream):
+        stream.write(self.data)
+        return len(self.data)
+
+
+class FakeFileClient:
+
+    def __init__(self, share=None, path=None):
+        self.share = share
+        self.path = path
+
+    def upload_file(self, data, length=None, max_concurrency=None):
+        data = data.read() if hasattr(data, 'read') else data
+        self.share.files[self.path] = data.encode() if isinstance(data, str) else data
+        self.share.uploads.append(self.path)
+
+    def download_file(self, max_concurrency=None):
+        if self.path not in self.share.files:
+            raise ResourceNotFoundError('not found')
+        self.share.downloads.append(self.path)
+        return FakeDownloader(self.share.files[self.path])
+
+    def delete_file(self):
+        del self.share.files[self.path]
+
+
+class FakeDirectoryClient:
+
+    def __init__(self, share=None, path=None):
+        self.share = share
+        self.path = path
+        self.url = f'https://fake/{path}'
+
+    def _join_(self, name):
+        return posixpath.join(self.path, name)
+
+    def exists(self):
+        return self.path in self.share.dirs
+
+    def create_directory(self):
+        if self.path in self.share.dirs:
+            raise ResourceExistsError('exists')
+        self.share.dirs.add(self.path)
+
+    def get_subdirectory_client(self, name):
+        return FakeDirectoryClient(share=self.share, path=self._join_(name))
+
+    def get_file_client(self, name):
+        return FakeFileClient(share=self.share, path=self._join_(name))
+
+    def list_directories_and_files(self):
+        prefix = f'{self.path}/'
+        children = dict()
+        for path, data in self.share.files.items():
+            if path.startswith(prefix):
+                name, *rest = path[len(prefix):].split('/')
+                children[name] = SimpleNamespace(name=name, is_directory=bool(rest), size=len(data))
+        return list(children.values())
+
+
+def write(folder=None, rel_path=None, data=None):
+    path = os.path.join(folder, *rel_path.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as dst:
+        dst.write(data)
+
+
+def test_manifest_reuses_hashes_and_detects_changes(tmp_path):
+    write(tmp_path, 'a.txt', b'a')
+    write(tmp_path, 'data/b.tif', b'b' * 10)
+    manifest = build_manifest(folder=str(tmp_path))
+    assert sorted(manifest) == ['a.txt', 'data/b.tif']
+    previous = {p: dict(e, md5='stale') for p, e in manifest.items()}
+    assert all(e['md5'] == 'stale' for e in build_manifest(folder=str(tmp_path), previous=previous).values())
+
+    write(tmp_path, 'a.txt', b'A')
+    changed = build_manifest(folder=str(tmp_path), previous=manifest)
+    assert diff_manifests(src=changed, dst=manifest) == (['a.txt'], [])
+    del changed['data/b.tif']
+    assert diff_manifests(src=changed, dst=manifest) == (['a.txt'], ['data/b.tif'])
+
+
+def test_sync_transfers_only_changed_files(tmp_path):
+    share = FakeShare()
+    project = str(tmp_path / 'project')
+    for i in range(10):
+        write(project, f'data/{i}.tif', os.urandom(100))
+    write(project, 'rapida.json', b'{}')
+    dir_client = FakeDirectoryClient(share=share, path='project')
+
+    assert len(upload_folder(folder=project, dir_client=dir_client, parallel=3)) == 11
+    assert 'project/data' in share.dirs and f'project/{MANIFEST_FILE_NAME}' in share.files
+
+    share.uploads.clear()
+    write(project, 'data/3.tif', b'changed')
+    with pytest.raises(FileExistsError):
+        upload_folder(folder=project, dir_client=dir_client)
+    assert upload_folder(folder=project, dir_client=dir_client, overwrite=True) == ['data/3.tif']
+    assert share.uploads == ['project/data/3.tif', f'project/{MANIFEST_FILE_NAME}']
+
+    copy = str(tmp_path / 'copy')
+    assert len(download_folder(dir_client=dir_client, folder=copy, parallel=4)) == 11
+    assert sorted(read_manifest(folder=copy)) == sorted(read_manifest(folder=project))
+    with open(os.path.join(copy, 'data', '3.tif'), 'rb') as src:
+        assert src.read() == b'changed'
+
+    write(project, 'data/5.tif', b'changed too')
+    upload_folder(folder=project, dir_client=dir_client, overwrite=True)
+    share.downloads.clear()
+    assert download_folder(dir_client=dir_client, folder=copy, overwrite=True) == ['data/5.tif']
+    assert share.downloads == [f'project/{MANIFEST_FILE_NAME}', 'project/data/5.tif']
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+from rapida.util.pipeline import Pipeline
+
+
+def produce(n=None, results=None, counter=None):
+    for i in range(n):
+        results.append(i)
+        with counter['lock']:
+            counter['produced'] += 1
+
+
+def test_bounded_memory_with_slow_sink():
+    maxsize = 4
+    counter = dict(produced=0, lock=threading.Lock())
+    jobs = [dict(n=50, counter=counter) for _ in range(4)]
+    consumed = 0
+    max_in_flight = 0
+    for _ in Pipeline(job=produce, jobs=jobs, workers=4, maxsize=maxsize):
+        consumed += 1
+        time.sleep(.002)  # slow writer
+        with counter['lock']:
+            max_in_flight = max(max_in_flight, counter['produced'] - consumed)
+    assert consumed == 200
+    # every producer can hold at most one result it already put while the counter was not yet updated
+    assert max_in_flight <= maxsize + len(jobs)
+
+
+def test_returned_results_and_completion():
+    jobs = [dict(x=i, name=i) for i in range(20)]
+    pipeline = Pipeline(job=lambda x=None, name=None: x * x, jobs=jobs, workers=3, results_arg=None)
+    assert sorted(pipeline) == [i * i for i in range(20)]
+    assert pipeline.failed == []
+
+
+def fail_on_odd(x=None, results=None):
+    if x % 2:
+        raise ValueError(f'odd {x}')
+    results.append(x)
+
+
+def test_errors_are_collected():
+    pipeline = Pipeline(job=fail_on_odd, jobs=[dict(x=i) for i in range(10)], workers=2, id_prop_name='x')
+    assert sorted(pipeline) == [0, 2, 4, 6, 8]
+    assert sorted(job_id for job_id, _ in pipeline.failed) == [1, 3, 5, 7, 9]
+
+
+def test_fail_fast_raises_and_stops_producers():
+    stop = threading.Event()
+    pipeline = Pipeline(job=fail_on_odd, jobs=[dict(x=i) for i in range(1, 100)], workers=2, fail_fast=True,
+                        stop=stop)
+    with pytest.raises(ValueError):
+        list(pipeline)
+    assert stop.is_set()
+    assert not any(t.is_alive() for t in pipeline._threads_)
+
+
+def endless(results=None, signal_event=None):
+    while not signal_event.is_set():
+        results.append(1)
+
+
+def test_closing_the_consumer_cancels_blocked_producers():
+    stop = threading.Event()
+    pipeline = Pipeline(job=endless, jobs=[dict(signal_event=stop) for _ in range(3)], workers=3, maxsize=2,
+                        stop=stop)
+    iterator = iter(pipeline)
+    for _ in range(10):
+        next(iterator)
+    iterator.close()
+    assert stop.is_set()
+    assert not any(t.is_alive() for t in pipeline._threads_)
+
+
+def test_stopping_while_iterating_ends_the_iteration():
+    stop = threading.Event()
+    pipeline = Pipeline(job=endless, jobs=[dict(signal_event=stop) for _ in range(3)], workers=3, maxsize=2,
+                        stop=stop)
+    consumed = list()
+
+    def consume():
+        for item in pipeline:
+            consumed.append(item)
+            if len(consumed) == 10:
+                stop.set()
+
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    consumer.join(timeout=5)
+    assert not consumer.is_alive(), 'The pipeline hangs after it was stopped'
+    assert len(consumed) >= 10
+    assert not any(t.is_alive() for t in pipeline._threads_)
+
+
+def test_no_jobs():
+    assert list(Pipeline(job=produce, jobs=[])) == []
@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from rapida.core.planner import Planner
+
+
+def test_shared_dependencies_run_once_in_order():
+    ran = list()
+    lock = threading.Lock()
+
+    def task(key):
+        def run():
+            with lock:
+                ran.append(key)
+        return run
+
+    planner = Planner()
+    # two variables requiring the same prepared leaf
+    for name in ('male_total', 'female_total'):
+        planner.add(key=('leaf', 'prepare'), func=task(('leaf', 'prepare')))
+        planner.add(key=(name, 'compute'), func=task((name, 'compute')), deps=[('leaf', 'prepare')])
+        planner.add(key=(name, 'evaluate'), func=task((name, 'evaluate')), deps=[(name, 'compute')])
+    planner.add(key=('total', 'evaluate'), func=task(('total', 'evaluate')),
+                deps=[('male_total', 'compute'), ('female_total', 'compute')])
+    assert len(planner) == 6 and ('leaf', 'prepare') in planner
+
+    planner.run(workers=4)
+    assert sorted(ran) == sorted(planner.tasks)
+    for key, deps in planner.deps.items():
+        assert all(ran.index(dep) < ran.index(key) for dep in deps)
+    order = planner.order()
+    assert order[0] == ('leaf', 'prepare') and len(order) == 6
+
+
+def test_independent_tasks_run_concurrently():
+    active = dict(now=0, max=0)
+    lock = threading.Lock()
+
+    def run():
+        with lock:
+            active['now'] += 1
+            active['max'] = max(active['max'], active['now'])
+        time.sleep(.05)
+        with lock:
+            active['now'] -= 1
+
+    planner = Planner()
+    for i in range(4):
+        planner.add(key=i, func=run)
+    planner.run(workers=4)
+    assert active['max'] == 4
+
+
+def test_failure_cancels_dependent_tasks():
+    ran = list()
+
+    def fail():
+        raise ValueError('download failed')
+
+    planner = Planner()
+    planner.add(key='download', func=fail)
+    planner.add(key='evaluate', func=lambda: ran.append('evaluate'), deps=['download'])
+    with pytest.raises(ValueError, match='download failed'):
+        planner.run(workers=2)
+    assert ran == []
+
+
+def test_missing_dependency():
+    planner = Planner()
+    planner.add(key='evaluate', func=lambda: None, deps=['compute'])
+    with pytest.raises(AssertionError):
+        planner.run(workers=1)
@@ -0,0 +1,33 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+shapely = pytest.importorskip('shapely')
+
+from rapida.util.point_in_polygon import NO_POLYGON, PointInPolygon
+
+
+def test_polygons():
+    polygons = np.array([shapely.box(0, 0, 1, 1), shapely.box(1, 0, 2, 1), shapely.box(5, 5, 6, 6)])
+    pip = PointInPolygon(polygons=polygons)
+    x, y = np.array([.5, 1.5, 5.5, 3.]), np.array([.5, .5, 5.5, 3.])
+    located = pip(x=x, y=y)
+    assert located.dtype == np.int32
+    assert located.tolist() == [0, 1, 2, NO_POLYGON]
+    assert pip(x=x, y=y, nearest=True).tolist() == [0, 1, 2, 1]
+
+
+def test_h3_cells_match_polygons():
+    h3 = pytest.importorskip('h3.api.basic_int')
+    cells = np.array(sorted(h3.geo_to_cells(shapely.box(30, 0, 30.2, .2), res=7)), dtype='i8')
+    polygons = np.array([shapely.Polygon([(lng, lat) for lat, lng in h3.cell_to_boundary(int(c))])
+                         for c in cells])
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(29.9, 30.3, 10_000), rng.uniform(-.1, .3, 10_000)
+    x[0] = np.nan
+    # the cells do not need to be sorted
+    shuffled = rng.permutation(len(cells))
+    by_cells = PointInPolygon(h3_cells=cells[shuffled])(x=x, y=y)
+    by_polygons = PointInPolygon(polygons=polygons[shuffled])(x=x, y=y)
+    assert by_cells[0] == NO_POLYGON
+    assert (by_cells == NO_POLYGON).any() and (by_cells != NO_POLYGON).any()
+    assert (by_cells == by_polygons).mean() > .999
@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('pycountry')
+pytest.importorskip('osgeo')
+
+from rapida.components.population import pop_coefficient
+
+SERIES = {2000: 1000, 2010: 1200, 2020: 1500}
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    """
+    The pop_coefficient module with the cache and the snapshot in tmp_path and a fake World Bank API
+    """
+    api = SimpleNamespace(calls=list(), offline=False)
+
+    def fetch_population(country_code=None):
+        api.calls.append(country_code)
+        if api.offline:
+            raise ConnectionError('The World Bank API can not be reached')
+        time.sleep(.1)
+        return dict(SERIES)
+
+    monkeypatch.setattr(pop_coefficient, 'POP_CACHE_PATH', str(tmp_path / 'cache' / 'worldbank_population.json'))
+    monkeypatch.setattr(pop_coefficient, 'POP_SNAPSHOT_PATH', str(tmp_path / 'snapshot.json'))
+    monkeypatch.setattr(pop_coefficient, 'fetch_population', fetch_population)
+    pop_coefficient.population_series.cache_clear()
+    yield api
+    pop_coefficient.population_series.cache_clear()
+
+
+def write_entry(path=None, country_code=None, fetched=None, series=None):
+    entry = pop_coefficient._make_entry_(series)
+    entry['fetched'] = fetched
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({country_code: entry}, f)
+
+
+def test_fetched_once_and_cached_on_disk(api):
+    series, growth_rate = pop_coefficient.population_series(country_code='KEN')
+    assert series == SERIES and growth_rate > 0 and api.calls == ['KEN']
+    pop_coefficient.population_series.cache_clear()
+    assert pop_coefficient.population_series(country_code='KEN') == (series, growth_rate)
+    assert api.calls == ['KEN']
+
+
+def test_expired_entries_are_fetched_again(api):
+    path = pop_coefficient.POP_CACHE_PATH
+    pop_coefficient.population_series(country_code='KEN')
+    write_entry(path=path, country_code='KEN', fetched=time.time() - pop_coefficient.POP_CACHE_TTL - 1,
+                series={2000: 1, 2020: 2})
+    pop_coefficient.population_series.cache_clear()
+    series, _ = pop_coefficient.population_series(country_code='KEN')
+    assert series == SERIES and api.calls == ['KEN', 'KEN']
+    with open(path, encoding='utf-8') as f:
+        assert time.time() - json.load(f)['KEN']['fetched'] < 60
+
+
+def test_offline_fallback(api):
+    api.offline = True
+    expired = {2000: 1, 2020: 2}
+    os.makedirs(os.path.dirname(pop_coefficient.POP_CACHE_PATH))
+    write_entry(path=pop_coefficient.POP_CACHE_PATH, country_code='KEN',
+                fetched=time.time() - pop_coefficient.POP_CACHE_TTL - 1, series=expired)
+    write_entry(path=pop_coefficient.POP_SNAPSHOT_PATH, country_code='UGA', fetched=0, series=SERIES)
+    # the expired cache entry and the snapshot are used when the API can not be reached
+    assert pop_coefficient.population_series(country_code='KEN')[0] == expired
+    assert pop_coefficient.population_series(country_code='UGA')[0] == SERIES
+    # a country neither cached nor in the snapshot can not be estimated
+    with pytest.raises(ConnectionError):
+        pop_coefficient.population_series(country_code='TZA')
+    with pytest.raises(AssertionError):
+        pop_coefficient.population_series(country_code='XXX')
+
+
+def test_concurrent_misses_fetch_once(api):
+    barrier = threading.Barrier(4)
+    results = list()
+
+    def worker():
+        barrier.wait()
+        results.append(pop_coefficient.population_series(country_code='KEN'))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert api.calls == ['KEN']
+    assert len(results) == 4 and all(r == results[0] for r in results)
@@ -0,0 +1,125 @@
+import http.server
+import logging
+import os
+import threading
+
+import pytest
+
+shapely = pytest.importorskip('shapely')
+pytest.importorskip('pyogrio')
+osgeo = pytest.importorskip('osgeo')
+
+import numpy as np
+from osgeo import ogr, osr
+from pyogrio import open_arrow
+
+from rapida.util.query_planner import cluster_polygons
+from rapida.util.read_bbox import stream_cluster
+
+logger = logging.getLogger(__name__)
+
+
+def grid(n=None, size=1.):
+    return {f'{i}_{j}': shapely.box(i * size, j * size, (i + 1) * size, (j + 1) * size)
+            for i in range(n) for j in range(n)}
+
+
+def test_cluster_polygons_covers_every_polygon_once():
+    polygons = grid(n=16)
+    clusters = cluster_polygons(polygons=polygons, density=100, max_features=2000)
+    ids = [i for _, cluster_ids in clusters for i in cluster_ids]
+    assert sorted(ids) == sorted(polygons)
+    assert 1 < len(clusters) < len(polygons)
+    for bbox, cluster_ids in clusters:
+        assert shapely.box(*bbox).covers(shapely.union_all([polygons[i] for i in cluster_ids]))
+        assert len(cluster_ids) == 1 or shapely.box(*bbox).area * 100 <= 2000
+
+
+def test_sparse_polygons_are_not_merged():
+    polygons = {'a': shapely.box(0, 0, 1, 1), 'b': shapely.box(100, 100, 101, 101)}
+    assert len(cluster_polygons(polygons=polygons, density=None)) == 2
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+
+    def _send_(self, head=False):
+        data = self.server.data
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            start, end = byte_range.split('=')[1].split('-')
+            start = int(start)
+            end = min(int(end) if end else len(data) - 1, len(data) - 1)
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+            with self.server.lock:
+                self.server.stats[self.path.split('/')[1]]['requests'] += 1
+                self.server.stats[self.path.split('/')[1]]['bytes'] += len(body)
+
+    def do_HEAD(self):
+        self._send_(head=True)
+
+    def do_GET(self):
+        self._send_()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def fgb_server(tmp_path_factory):
+    path = os.path.join(tmp_path_factory.mktemp('fgb'), 'features.fgb')
+    rng = np.random.default_rng(0)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    with ogr.GetDriverByName('FlatGeobuf').CreateDataSource(path) as ds:
+        lyr = ds.CreateLayer('features', srs=srs, geom_type=ogr.wkbPolygon)
+        for x, y in rng.uniform(0, 8, size=(20000, 2)):
+            f = ogr.Feature(lyr.GetLayerDefn())
+            f.SetGeometry(ogr.CreateGeometryFromWkb(shapely.box(x, y, x + .01, y + .01).wkb))
+            lyr.CreateFeature(f)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    with open(path, 'rb') as src:
+        server.data = src.read()
+    server.lock = threading.Lock()
+    server.stats = {name: dict(requests=0, bytes=0) for name in ('single', 'coalesced')}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def test_coalesced_queries_read_less(fgb_server):
+    host, port = fgb_server.server_address
+    polygons = grid(n=8)
+
+    single = set()
+    for polygon in polygons.values():
+        with open_arrow(f'/vsicurl/http://{host}:{port}/single/features.fgb', mask=polygon, use_pyarrow=True,
+                        return_fids=True) as (meta, reader):
+            for batch in reader:
+                single |= set(batch.column('OGC_FID').to_pylist())
+
+    results = list()
+    for i, (bbox, ids) in enumerate(cluster_polygons(polygons=polygons, density=20000 / 64)):
+        stream_cluster(src_path=f'/vsicurl/http://{host}:{port}/coalesced/features.fgb', bbox=bbox,
+                       polygons={pid: polygons[pid] for pid in ids}, batch_size=5000, signal_event=threading.Event(),
+                       cluster_id=i, results=results, add_polyid=True)
+    coalesced = set()
+    for _, batch in results:
+        coalesced |= set(batch.column('OGC_FID').to_pylist())
+        assert set(batch.column('polyid').to_pylist()) <= set(polygons)
+
+    assert coalesced == single
+    stats = fgb_server.stats
+    logger.info(f'single polygon queries: {stats["single"]}, coalesced queries: {stats["coalesced"]}')
+    assert stats['coalesced']['requests'] < stats['single']['requests']
+    assert stats['coalesced']['bytes'] < stats['single']['bytes']
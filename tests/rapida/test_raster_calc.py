@@ -0,0 +1,104 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+gdal = pytest.importorskip('osgeo.gdal')
+
+from rapida.util.raster_calc import MAX_WINDOW_PIXELS, _windows_, calc, calc_many, mask_raster, sum_rasters
+
+WIDTH, HEIGHT = 300, 200  # not a multiple of the block size
+NODATA = -1.
+BLOCKS = dict(BLOCKXSIZE=64, BLOCKYSIZE=64)
+
+
+def write(path=None, data=None, nodata=NODATA):
+    with gdal.GetDriverByName('GTiff').Create(path, WIDTH, HEIGHT, 1, gdal.GDT_Float32) as ds:
+        ds.SetGeoTransform((0, 100, 0, 0, 0, -100))
+        band = ds.GetRasterBand(1)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        band.WriteArray(data)
+    return path
+
+
+def read(path=None):
+    with gdal.Open(path) as ds:
+        band = ds.GetRasterBand(1)
+        return band.ReadAsArray(), band.GetNoDataValue()
+
+
+@pytest.fixture
+def sources(tmp_path):
+    rng = np.random.default_rng(0)
+    a = rng.uniform(0, 10, (HEIGHT, WIDTH)).astype('f4')
+    b = rng.uniform(0, 10, (HEIGHT, WIDTH)).astype('f4')
+    a[rng.random((HEIGHT, WIDTH)) < .2] = NODATA
+    b[rng.random((HEIGHT, WIDTH)) < .2] = NODATA
+    b[0, :10] = 0
+    return dict(a=write(path=str(tmp_path / 'a.tif'), data=a), b=write(path=str(tmp_path / 'b.tif'), data=b)), a, b
+
+
+def test_windows_cover_the_raster():
+    covered = np.zeros((HEIGHT, WIDTH), dtype='i4')
+    for xoff, yoff, xsize, ysize in _windows_(width=WIDTH, height=HEIGHT, block_xsize=64, block_ysize=64):
+        covered[yoff:yoff + ysize, xoff:xoff + xsize] += 1
+    assert (covered == 1).all()
+    wide = list(_windows_(width=MAX_WINDOW_PIXELS, height=512, block_xsize=256, block_ysize=256))
+    assert max(xsize * ysize for _, _, xsize, ysize in wide) <= MAX_WINDOW_PIXELS
+
+
+def test_propagate_nodata(tmp_path, sources):
+    paths, a, b = sources
+    dst_path = calc(expression='a/b+1', sources=paths, dst_path=str(tmp_path / 'out.tif'),
+                    creation_options=BLOCKS, workers=3)
+    out, nodata = read(dst_path)
+    assert nodata == NODATA
+    invalid = (a == NODATA) | (b == NODATA)
+    with np.errstate(all='ignore'):
+        expected = np.where(invalid, NODATA, a / b + 1)
+    # a division by zero is not finite and becomes nodata too
+    expected[~np.isfinite(expected)] = NODATA
+    np.testing.assert_allclose(out, expected, rtol=1e-6)
+
+
+def test_zero_nodata(tmp_path, sources):
+    paths, a, b = sources
+    out, nodata = read(calc(expression='a+b', sources=paths, dst_path=str(tmp_path / 'out.tif'),
+                            nodata_policy='zero', creation_options=BLOCKS))
+    expected = np.where(a == NODATA, 0, a) + np.where(b == NODATA, 0, b)
+    expected[(a == NODATA) & (b == NODATA)] = NODATA
+    np.testing.assert_allclose(out, expected, rtol=1e-6)
+    np.testing.assert_array_equal(read(sum_rasters(src_rasters=[paths['a'], paths['b']],
+                                                   dst_path=str(tmp_path / 'sum.tif')))[0], out)
+
+
+def test_source_without_nodata(tmp_path, sources):
+    paths, a, _ = sources
+    c = np.full((HEIGHT, WIDTH), 2, dtype='f4')
+    paths = dict(a=paths['a'], c=write(path=str(tmp_path / 'c.tif'), data=c, nodata=None))
+    out, _ = read(calc(expression='a*c', sources=paths, dst_path=str(tmp_path / 'propagate.tif')))
+    np.testing.assert_allclose(out, np.where(a == NODATA, NODATA, a * 2))
+    # with the zero policy the output is never nodata because c is valid everywhere
+    out, _ = read(calc(expression='a*c', sources=paths, dst_path=str(tmp_path / 'zero.tif'), nodata_policy='zero'))
+    np.testing.assert_allclose(out, np.where(a == NODATA, 0, a * 2))
+
+
+def test_calc_many_and_mask(tmp_path, sources):
+    paths, a, b = sources
+    sum_path, max_path = str(tmp_path / 'sum.tif'), str(tmp_path / 'max.tif')
+    calc_many(expressions={sum_path: 'a+b', max_path: 'np.maximum(a, b)'}, sources=paths, creation_options=BLOCKS)
+    invalid = (a == NODATA) | (b == NODATA)
+    np.testing.assert_allclose(read(sum_path)[0], np.where(invalid, NODATA, a + b), rtol=1e-6)
+    np.testing.assert_allclose(read(max_path)[0], np.where(invalid, NODATA, np.maximum(a, b)))
+
+    mask = np.zeros((HEIGHT, WIDTH), dtype='f4')
+    mask[50:150, 100:250] = 1
+    mask_path = write(path=str(tmp_path / 'mask.tif'), data=mask, nodata=None)
+    out, nodata = read(mask_raster(src_path=paths['a'], mask_path=mask_path, dst_path=str(tmp_path / 'masked.tif')))
+    assert nodata == NODATA
+    np.testing.assert_array_equal(out, np.where(mask > 0, a, NODATA))
+
+
+def test_invalid_policy(tmp_path, sources):
+    paths, _, _ = sources
+    with pytest.raises(AssertionError):
+        calc(expression='a+b', sources=paths, dst_path=str(tmp_path / 'out.tif'), nodata_policy='ignore')
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+gpd = pytest.importorskip('geopandas')
+shapely = pytest.importorskip('shapely')
+pyogrio = pytest.importorskip('pyogrio')
+rasterio = pytest.importorskip('rasterio')
+pytest.importorskip('pyarrow')
+pytest.importorskip('osgeo')
+
+from rasterio.transform import from_origin
+
+from rapida.components.buildings.sidecar import build_sidecar, sidecar_aggregates, sidecar_is_valid, sidecar_path
+
+KEYS = np.array(['a', 'b', 'c', 'd'])
+SIZE = 1000  # the buildings and the mask cover a SIZE x SIZE square
+PIXEL_SIZE = 100
+
+
+@pytest.fixture
+def buildings(tmp_path):
+    """
+    A GeoPackage with a buildings layer whose polyid references the KEYS (except d) and an unknown polygon
+    """
+    rng = np.random.default_rng(0)
+    n = 300
+    x, y = rng.uniform(0, SIZE - 20, n), rng.uniform(0, SIZE - 20, n)
+    sizes = rng.uniform(2, 20, n)
+    gdf = gpd.GeoDataFrame({'polyid': rng.choice(['a', 'b', 'c', 'unknown'], n)},
+                           geometry=shapely.box(x, y, x + sizes, y + sizes), crs='EPSG:3857')
+    path = str(tmp_path / 'project.gpkg')
+    pyogrio.write_dataframe(gdf, path, layer='buildings')
+    return path, gdf
+
+
+@pytest.fixture
+def mask_path(tmp_path):
+    rng = np.random.default_rng(1)
+    mask = (rng.random((SIZE // PIXEL_SIZE, SIZE // PIXEL_SIZE)) < .5).astype('u1')
+    path = str(tmp_path / 'mask.tif')
+    with rasterio.open(path, 'w', driver='GTiff', width=mask.shape[1], height=mask.shape[0], count=1, dtype='uint8',
+                       crs='EPSG:3857', transform=from_origin(0, SIZE, PIXEL_SIZE, PIXEL_SIZE)) as ds:
+        ds.write(mask, 1)
+    return path, mask
+
+
+def brute_force(gdf=None, mask=None):
+    """
+    The number and the area of the buildings of every key, looping over the buildings
+    """
+    expected = {key: dict(count=0, area=0., affected_count=0, affected_area=0.) for key in KEYS}
+    for polyid, geom in zip(gdf['polyid'], gdf.geometry):
+        if polyid not in expected:
+            continue
+        expected[polyid]['count'] += 1
+        expected[polyid]['area'] += geom.area
+        centroid = geom.centroid
+        if mask is not None and mask[int((SIZE - centroid.y) // PIXEL_SIZE), int(centroid.x // PIXEL_SIZE)] == 1:
+            expected[polyid]['affected_count'] += 1
+            expected[polyid]['affected_area'] += geom.area
+    return expected
+
+
+def test_aggregates_match_brute_force(buildings, mask_path):
+    path, gdf = buildings
+    mask_ds_path, mask = mask_path
+    assert not sidecar_is_valid(dataset_path=path, layer_name='buildings')
+    sidecar = build_sidecar(dataset_path=path, layer_name='buildings', batch_size=64)
+    assert sidecar == sidecar_path(dataset_path=path, layer_name='buildings')
+    assert os.path.dirname(sidecar) == os.path.dirname(path)
+    assert sidecar_is_valid(dataset_path=path, layer_name='buildings')
+
+    aggregates = sidecar_aggregates(path=sidecar, keys=KEYS, batch_size=50)
+    assert aggregates.index.tolist() == KEYS.tolist() and aggregates.columns.tolist() == ['count', 'area']
+    expected = brute_force(gdf=gdf)
+    for key in KEYS:
+        assert aggregates.loc[key, 'count'] == expected[key]['count']
+        assert aggregates.loc[key, 'area'] == pytest.approx(expected[key]['area'])
+    assert aggregates.loc['d', 'count'] == 0
+
+    masked = sidecar_aggregates(path=sidecar, keys=KEYS, mask_path=mask_ds_path, batch_size=50)
+    expected = brute_force(gdf=gdf, mask=mask)
+    for key in KEYS:
+        for column in 'count', 'area', 'affected_count', 'affected_area':
+            assert masked.loc[key, column] == pytest.approx(expected[key][column])
+    assert 0 < masked['affected_count'].sum() < masked['count'].sum()
+
+
+def test_changed_layers_invalidate_the_sidecar(buildings):
+    path, gdf = buildings
+    build_sidecar(dataset_path=path, layer_name='buildings')
+    assert sidecar_is_valid(dataset_path=path, layer_name='buildings')
+
+    # one more building
+    pyogrio.write_dataframe(gdf.iloc[:1], path, layer='buildings', append=True)
+    assert not sidecar_is_valid(dataset_path=path, layer_name='buildings')
+    build_sidecar(dataset_path=path, layer_name='buildings')
+    assert sidecar_is_valid(dataset_path=path, layer_name='buildings')
+    assert sidecar_aggregates(path=sidecar_path(dataset_path=path, layer_name='buildings'),
+                              keys=KEYS)['count'].sum() == (gdf['polyid'] != 'unknown').sum() + 1
+
+    # the same number of buildings in another CRS
+    pyogrio.write_dataframe(gdf.to_crs('EPSG:4326'), path, layer='buildings')
+    pyogrio.write_dataframe(gdf.iloc[:1].to_crs('EPSG:4326'), path, layer='buildings', append=True)
+    assert not sidecar_is_valid(dataset_path=path, layer_name='buildings')
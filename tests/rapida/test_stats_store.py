@@ -0,0 +1,92 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+pa = pytest.importorskip('pyarrow')
+pyogrio = pytest.importorskip('pyogrio')
+pytest.importorskip('osgeo')
+
+from osgeo import gdal, ogr, osr
+
+from rapida.stats.store import StatsStore, ogr_field_defn, upsert_columns
+
+KEYS = [f'8{i:014x}' for i in range(10)]
+
+
+@pytest.fixture
+def geopackage(tmp_path):
+    gdal.UseExceptions()
+    path = str(tmp_path / 'project.gpkg')
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    with ogr.GetDriverByName('GPKG').CreateDataSource(path) as ds:
+        lyr = ds.CreateLayer('polygons', srs=srs, geom_type=ogr.wkbPolygon)
+        lyr.CreateField(ogr.FieldDefn('h3id', ogr.OFTString))
+        for i, key in enumerate(KEYS):
+            feature = ogr.Feature(lyr.GetLayerDefn())
+            feature.SetField('h3id', key)
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(f'POLYGON (({i} 0, {i + 1} 0, {i + 1} 1, {i} 1, {i} 0))'))
+            lyr.CreateFeature(feature)
+    return path
+
+
+def test_upsert_columns_creates_and_replaces(geopackage):
+    df = pd.DataFrame({'population': [float(i) for i in range(10)]}, index=pd.Index(KEYS, name='h3id'))
+    upsert_columns(dataset_path=geopackage, layer_name='stats.population', df=df)
+    stats = pyogrio.read_dataframe(geopackage, layer='stats.population')
+    polygons = pyogrio.read_dataframe(geopackage, layer='polygons')
+    assert stats['h3id'].tolist() == KEYS
+    assert stats['population'].tolist() == df['population'].tolist()
+    assert stats.geometry.equals(polygons.geometry)
+
+    # only some rows, in another order: the column is replaced and the missing rows are NULL
+    update = pd.DataFrame({'population': [100., 300.], 'children': [1., 3.]},
+                          index=pd.Index([KEYS[3], KEYS[1]], name='h3id'))
+    upsert_columns(dataset_path=geopackage, layer_name='stats.population', df=update)
+    stats = pyogrio.read_dataframe(geopackage, layer='stats.population', read_geometry=False).set_index('h3id')
+    assert stats.loc[KEYS[1], 'population'] == 300. and stats.loc[KEYS[3], 'population'] == 100.
+    assert stats.loc[KEYS[3], 'children'] == 1.
+    assert stats.drop(index=[KEYS[1], KEYS[3]])['population'].isna().all()
+    assert '_stats_population_upsert_' not in pyogrio.list_layers(geopackage)[:, 0]
+
+
+def test_store_buffers_until_the_outermost_context_exits(geopackage):
+    store = StatsStore(dataset_path=geopackage, layer_name='stats.rwi')
+    with store:
+        with store:
+            store.update(pd.DataFrame({'h3id': KEYS, 'rwi': [.5] * 10}))
+        # the nested context does not flush
+        assert 'stats.rwi' not in pyogrio.list_layers(geopackage)[:, 0]
+        store.update(pd.DataFrame({'rwi': [.1] * 10, 'rwi_affected': [.2] * 10}, index=pd.Index(KEYS, name='h3id')))
+        assert store.read(columns=['rwi', 'rwi_affected'])['rwi'].tolist() == [.1] * 10
+    stats = StatsStore(dataset_path=geopackage, layer_name='stats.rwi').read(columns=['rwi', 'rwi_affected'])
+    assert stats.index.tolist() == KEYS
+    assert stats['rwi'].tolist() == [.1] * 10 and stats['rwi_affected'].tolist() == [.2] * 10
+    assert store.pending is None
+
+
+def test_upsert_columns_with_large_string_keys_and_typed_columns(geopackage):
+    keys = pd.Index(pd.array(KEYS, dtype=pd.ArrowDtype(pa.large_string())), name='h3id')
+    df = pd.DataFrame({'flooded': [i % 2 == 0 for i in range(10)], 'share': [i / 10 for i in range(10)],
+                       'roads': list(range(10))}, index=keys)
+    df = df.astype({'share': 'float32', 'roads': 'int8'})
+    upsert_columns(dataset_path=geopackage, layer_name='stats.roads', df=df)
+    with ogr.Open(geopackage) as ds:
+        defn = ds.GetLayerByName('stats.roads').GetLayerDefn()
+        field = defn.GetFieldDefn(defn.GetFieldIndex('flooded'))
+        assert (field.GetType(), field.GetSubType()) == (ogr.OFTInteger, ogr.OFSTBoolean)
+        assert defn.GetFieldDefn(defn.GetFieldIndex('share')).GetType() == ogr.OFTReal
+        assert defn.GetFieldDefn(defn.GetFieldIndex('roads')).GetType() == ogr.OFTInteger64
+    stats = pyogrio.read_dataframe(geopackage, layer='stats.roads', read_geometry=False).set_index('h3id')
+    assert stats.index.tolist() == KEYS
+    assert stats['flooded'].tolist() == df['flooded'].tolist()
+    assert stats['roads'].tolist() == list(range(10))
+    assert stats['share'].tolist() == pytest.approx([i / 10 for i in range(10)])
+
+
+def test_unsupported_column_types_raise(geopackage):
+    with pytest.raises(ValueError, match='unsupported type'):
+        ogr_field_defn(pa.field('when', pa.timestamp('s')))
+    df = pd.DataFrame({'when': pd.to_datetime(['2024-01-01'] * 10)}, index=pd.Index(KEYS, name='h3id'))
+    with pytest.raises(ValueError):
+        upsert_columns(dataset_path=geopackage, layer_name='stats.when', df=df)
+    assert 'stats.when' not in pyogrio.list_layers(geopackage)[:, 0]
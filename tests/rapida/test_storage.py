@@ -0,0 +1,70 @@
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip('azure.storage.blob')
+pytest.importorskip('azure.storage.fileshare')
+
+from rapida.az.storage import STORAGE_ROOT_ENV_VAR, Storage, get_container_client, get_share_client, parse_az_path
+from rapida.az.transfer import TransferEngine
+from rapida.project.manifest import download_folder, upload_folder
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    monkeypatch.setenv(STORAGE_ROOT_ENV_VAR, str(tmp_path / 'mirror'))
+    return tmp_path / 'mirror'
+
+
+def test_parse_az_path():
+    assert parse_az_path('az:undpgeohub:stacdata/worldpop/2020/MDA/MDA_total.tif') == \
+           ('undpgeohub', 'stacdata', 'worldpop/2020/MDA/MDA_total.tif')
+
+
+def test_local_storage_operations(root):
+    async def run():
+        async with Storage(account_name='account', container_name='container') as storage:
+            assert not await storage.exists('a/b.bin')
+            await storage.write('a/b.bin', data=bytes(range(100)))
+            await storage.write('a/c.txt', data='text')
+            assert await storage.list(prefix='a/') == ['a/b.bin', 'a/c.txt']
+            assert (await storage.stat('a/b.bin')).size == 100
+            assert await storage.read('a/b.bin', offset=10, length=5) == bytes(range(10, 15))
+            assert await storage.read('a/c.txt') == b'text'
+            assert await storage.delete('a/c.txt') and not await storage.delete('a/c.txt')
+            return await storage.list()
+
+    assert asyncio.run(run()) == ['a/b.bin']
+    assert os.path.isfile(root / 'blob' / 'account' / 'container' / 'a' / 'b.bin')
+
+
+def test_transfer_engine_on_local_storage(root, tmp_path):
+    data = os.urandom(1000)
+    src_path = tmp_path / 'src.bin'
+    src_path.write_bytes(data)
+
+    async def run():
+        engine = TransferEngine(block_size=128)
+        async with get_container_client(account_name='account', container_name='container') as cc:
+            await engine.upload(src_path=str(src_path), blob_client=cc.get_blob_client('x/src.bin'))
+            downloaded, failed = await engine.download_many(
+                transfers=[(cc.get_blob_client('x/src.bin'), str(tmp_path / 'dst.bin'))])
+            return downloaded, failed
+
+    downloaded, failed = asyncio.run(run())
+    assert not failed and (tmp_path / 'dst.bin').read_bytes() == data
+
+
+def test_project_sync_on_local_share(root, tmp_path):
+    project = tmp_path / 'project'
+    (project / 'data').mkdir(parents=True)
+    (project / 'rapida.json').write_text('{}')
+    (project / 'data' / 'a.tif').write_bytes(b'a' * 10)
+    with get_share_client(account_name='account', share_name='share') as sc:
+        with sc.get_directory_client('project') as dc:
+            assert sorted(upload_folder(folder=str(project), dir_client=dc)) == ['data/a.tif', 'rapida.json']
+        assert [e.name for e in sc.list_directories_and_files()] == ['project']
+        with sc.get_directory_client('project') as dc:
+            download_folder(dir_client=dc, folder=str(tmp_path / 'copy'))
+    assert (tmp_path / 'copy' / 'data' / 'a.tif').read_bytes() == b'a' * 10
@@ -0,0 +1,131 @@
+import math
+import struct
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('osgeo')
+
+from rapida.components.buildings.tile_planner import index_cells, level_bounds, makespan, parse_fgb_header, \
+    plan_work_units
+
+BBOX = (0., 0., 100., 100.)
+NODE_SIZE = 16
+BATCH_SIZE = 1000
+TARGET_BATCHES = 16
+WORKERS = 4
+REQUEST_OVERHEAD = 2000  # the cost of a request in features
+
+
+def clustered_points(n=200_000, seed=0):
+    """
+    A few dense "cities" with most of the points and a sparse countryside
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform(10, 90, size=(5, 2))
+    ncity = int(n * .9)
+    city = centres[rng.integers(0, len(centres), ncity)] + rng.normal(0, 1.5, size=(ncity, 2))
+    countryside = rng.uniform(0, 100, size=(n - ncity, 2))
+    return np.clip(np.concatenate([city, countryside]), 0, 99.999)
+
+
+def packed_index(points=None, node_size=NODE_SIZE):
+    """
+    The nodes of a packed R-tree over the points like the ones stored in a FlatGeobuf file
+    """
+    q = (points / 100 * 65535).astype('u8')
+    code = np.zeros(len(points), dtype='u8')
+    for bit in range(16):
+        code |= ((q[:, 0] >> bit) & 1) << (2 * bit) | ((q[:, 1] >> bit) & 1) << (2 * bit + 1)
+    points = points[np.argsort(code)]
+    levels = level_bounds(num_items=len(points), node_size=node_size)
+    nodes = np.zeros(levels[0][1], dtype=[('bounds', '<f8', 4), ('offset', '<u8')])
+    level_nodes = np.concatenate([points, points], axis=1)
+    for start, end in levels:
+        nodes['bounds'][start:end] = level_nodes
+        parents = np.arange(0, len(level_nodes), node_size)
+        level_nodes = np.stack([
+            np.minimum.reduceat(level_nodes[:, 0], parents),
+            np.minimum.reduceat(level_nodes[:, 1], parents),
+            np.maximum.reduceat(level_nodes[:, 2], parents),
+            np.maximum.reduceat(level_nodes[:, 3], parents),
+        ], axis=1)
+    return nodes.tobytes(), points
+
+
+def count_in(points=None, bbox=None):
+    xmin, ymin, xmax, ymax = bbox
+    return int(((points[:, 0] >= xmin) & (points[:, 0] < xmax) & (points[:, 1] >= ymin) &
+                (points[:, 1] < ymax)).sum())
+
+
+def zoom_heuristic_units(points=None):
+    """
+    Equally sized tiles whose area would hold TARGET_BATCHES batches at the average density, like the zoom level
+    heuristic the planner replaced
+    """
+    density = len(points) / ((BBOX[2] - BBOX[0]) * (BBOX[3] - BBOX[1]))
+    side = math.sqrt(BATCH_SIZE * TARGET_BATCHES / density)
+    n = math.ceil((BBOX[2] - BBOX[0]) / side)
+    return [(BBOX[0] + i * side, BBOX[1] + j * side, BBOX[0] + (i + 1) * side, BBOX[1] + (j + 1) * side)
+            for j in range(n) for i in range(n)]
+
+
+def test_parse_fgb_header():
+    # a Header table with features_count (field 8) and index_node_size (field 9) only
+    vtable = struct.pack('<12H', 24, 16, 0, 0, 0, 0, 0, 0, 0, 0, 4, 12)
+    table = struct.pack('<iQH', len(vtable), 123456, 64) + b'\x00\x00'
+    buf = struct.pack('<I', 4 + len(vtable)) + vtable + table
+    assert parse_fgb_header(buf) == dict(features_count=123456, index_node_size=64)
+
+
+def test_index_cells_cover_all_features():
+    index, points = packed_index(points=clustered_points(n=10_000))
+    for level in (0, 1, 2):
+        cell_bounds, cell_counts = index_cells(index=index, num_items=len(points), node_size=NODE_SIZE, level=level)
+        assert cell_counts.sum() == len(points)
+        assert len(cell_counts) == math.ceil(len(points) / NODE_SIZE ** level)
+    start = NODE_SIZE ** 2
+    assert cell_bounds[1].tolist() == [points[start:2 * start, 0].min(), points[start:2 * start, 1].min(),
+                                       points[start:2 * start, 0].max(), points[start:2 * start, 1].max()]
+
+
+def test_planned_units_are_balanced_and_finish_earlier():
+    index, points = packed_index(points=clustered_points())
+    cell_bounds, cell_counts = index_cells(index=index, num_items=len(points), node_size=NODE_SIZE, level=2)
+    target = BATCH_SIZE * TARGET_BATCHES
+    units = plan_work_units(cell_bounds=cell_bounds, cell_counts=cell_counts, bbox=BBOX, target_features=target)
+
+    planned = [count_in(points=points, bbox=bbox) for bbox, _ in units]
+    assert sum(planned) == len(points)
+    assert max(planned) <= 2 * target
+
+    tiled = [count_in(points=points, bbox=bbox) for bbox in zoom_heuristic_units(points=points)]
+    tiled = [n for n in tiled if n]
+    assert sum(tiled) == len(points)
+    assert max(tiled) > 4 * target
+
+    planned_makespan = makespan(costs=[REQUEST_OVERHEAD + n for n in planned], workers=WORKERS)
+    tiled_makespan = makespan(costs=[REQUEST_OVERHEAD + n for n in tiled], workers=WORKERS)
+    assert planned_makespan < tiled_makespan
+    # the last worker finishes close to the ideal, evenly shared, time
+    ideal = sum(REQUEST_OVERHEAD + n for n in planned) / WORKERS
+    assert planned_makespan <= 1.2 * ideal
+
+
+def test_read_fgb_index_cells(tmp_path):
+    from osgeo import ogr
+    from rapida.components.buildings.tile_planner import read_fgb_index_cells
+
+    points = clustered_points(n=5000)
+    src_path = str(tmp_path / 'buildings.fgb')
+    with ogr.GetDriverByName('FlatGeobuf').CreateDataSource(src_path) as ds:
+        lyr = ds.CreateLayer('buildings', geom_type=ogr.wkbPoint, options=['SPATIAL_INDEX=YES'])
+        for x, y in points:
+            feature = ogr.Feature(lyr.GetLayerDefn())
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(f'POINT ({x} {y})'))
+            lyr.CreateFeature(feature)
+    cell_bounds, cell_counts = read_fgb_index_cells(src_path=src_path, max_nodes=64)
+    assert len(cell_counts) <= 64 and cell_counts.sum() == len(points)
+    assert cell_bounds[:, :2].min(axis=0).tolist() == points.min(axis=0).tolist()
+    assert cell_bounds[:, 2:].max(axis=0).tolist() == points.max(axis=0).tolist()
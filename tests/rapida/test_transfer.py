@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import os
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('azure.storage.blob')
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobType
+
+from rapida.az.transfer import TransferEngine
+
+
+class FakeContainer:
+    """
+    In memory container recording the requests the blob clients make
+    """
+
+    def __init__(self):
+        self.blobs = dict()
+        self.kwargs = dict()  # the extra kwargs of the last upload of every blob
+        self.requests = list()
+        self.active = 0
+        self.max_active = 0
+        self.fail_after = None  # fail the range downloads after this many were served
+
+    def get_blob_client(self, blob=None):
+        return FakeBlobClient(container=self, blob_name=blob)
+
+
+class FakeStream:
+
+    def __init__(self, data=None):
+        self.data = data
+
+    async def readall(self):
+        return self.data
+
+
+class FakeBlobClient:
+
+    def __init__(self, container=None, blob_name=None):
+        self.container = container
+        self.blob_name = blob_name
+        self.staged = dict()
+
+    async def get_blob_properties(self):
+        self.container.requests.append(('properties', self.blob_name))
+        if self.blob_name not in self.container.blobs:
+            raise ResourceNotFoundError('not found')
+        data, md5 = self.container.blobs[self.blob_name]
+        return SimpleNamespace(name=self.blob_name, size=len(data), etag=hashlib.sha1(data).hexdigest(),
+                               content_settings=SimpleNamespace(content_md5=md5))
+
+    async def download_blob(self, offset=None, length=None):
+        container = self.container
+        downloads = sum(1 for r in container.requests if r[0] == 'download')
+        if container.fail_after is not None and downloads >= container.fail_after:
+            raise ConnectionError('connection reset')
+        container.requests.append(('download', self.blob_name, offset, length))
+        container.active += 1
+        container.max_active = max(container.max_active, container.active)
+        await asyncio.sleep(.01)
+        container.active -= 1
+        data, _ = container.blobs[self.blob_name]
+        return FakeStream(data[offset:offset + length])
+
+    async def upload_blob(self, data=None, overwrite=None, content_settings=None, **kwargs):
+        self.container.requests.append(('upload', self.blob_name))
+        self.container.kwargs[self.blob_name] = kwargs
+        self.container.blobs[self.blob_name] = data.read(), content_settings.content_md5
+
+    async def stage_block(self, block_id=None, data=None, length=None):
+        self.container.requests.append(('stage', self.blob_name, block_id))
+        self.staged[block_id] = data
+
+    async def commit_block_list(self, block_list, content_settings=None, **kwargs):
+        self.container.requests.append(('commit', self.blob_name))
+        self.container.kwargs[self.blob_name] = kwargs
+        self.container.blobs[self.blob_name] = b''.join(self.staged[b] for b in block_list), \
+            content_settings.content_md5
+
+
+def put(container=None, name=None, data=None, md5=True):
+    container.blobs[name] = data, bytearray(hashlib.md5(data).digest()) if md5 else None
+
+
+def requests(container=None, kind=None):
+    return [r for r in container.requests if r[0] == kind]
+
+
+def test_download_in_ranges_and_skip_when_up_to_date(tmp_path):
+    container = FakeContainer()
+    data = os.urandom(1000)
+    put(container=container, name='a.bin', data=data)
+    engine = TransferEngine(block_size=128, block_concurrency=3)
+    dst_path = str(tmp_path / 'a.bin')
+    asyncio.run(engine.download(blob_client=container.get_blob_client('a.bin'), dst_path=dst_path))
+    with open(dst_path, 'rb') as src:
+        assert src.read() == data
+    assert len(requests(container, 'download')) == 8
+    assert container.max_active == 3
+    assert not os.path.exists(f'{dst_path}.part')
+
+    container.requests.clear()
+    asyncio.run(engine.download(blob_client=container.get_blob_client('a.bin'), dst_path=dst_path))
+    assert container.requests == [('properties', 'a.bin')]
+
+
+def test_interrupted_download_resumes(tmp_path):
+    container = FakeContainer()
+    data = os.urandom(1000)
+    put(container=container, name='a.bin', data=data)
+    engine = TransferEngine(block_size=100, block_concurrency=1)
+    dst_path = str(tmp_path / 'a.bin')
+    container.fail_after = 4
+    with pytest.raises(ConnectionError):
+        asyncio.run(engine.download(blob_client=container.get_blob_client('a.bin'), dst_path=dst_path))
+    assert not os.path.exists(dst_path) and os.path.exists(f'{dst_path}.part')
+
+    container.fail_after = None
+    container.requests.clear()
+    asyncio.run(engine.download(blob_client=container.get_blob_client('a.bin'), dst_path=dst_path))
+    with open(dst_path, 'rb') as src:
+        assert src.read() == data
+    assert sorted(r[2] for r in requests(container, 'download')) == list(range(400, 1000, 100))
+
+
+def test_missing_blob(tmp_path):
+    container = FakeContainer()
+    with pytest.raises(ValueError):
+        asyncio.run(TransferEngine().download(blob_client=container.get_blob_client('missing.bin'),
+                                              dst_path=str(tmp_path / 'missing.bin')))
+
+
+def test_upload_in_blocks_and_skip_when_up_to_date(tmp_path):
+    container = FakeContainer()
+    data = os.urandom(1000)
+    src_path = str(tmp_path / 'a.bin')
+    with open(src_path, 'wb') as dst:
+        dst.write(data)
+    engine = TransferEngine(block_size=300)
+    asyncio.run(engine.upload(src_path=src_path, blob_client=container.get_blob_client('a.bin')))
+    assert container.blobs['a.bin'] == (data, bytearray(hashlib.md5(data).digest()))
+    assert len(requests(container, 'stage')) == 4 and len(requests(container, 'commit')) == 1
+
+    container.requests.clear()
+    asyncio.run(engine.upload(src_path=src_path, blob_client=container.get_blob_client('a.bin')))
+    assert container.requests == [('properties', 'a.bin')]
+
+    small_path = str(tmp_path / 'small.bin')
+    with open(small_path, 'wb') as dst:
+        dst.write(data[:100])
+    asyncio.run(engine.upload(src_path=small_path, blob_client=container.get_blob_client('small.bin')))
+    assert container.blobs['small.bin'][0] == data[:100]
+    assert requests(container, 'upload') == [('upload', 'small.bin')]
+
+
+def test_download_many_sliding_window(tmp_path):
+    container = FakeContainer()
+    for i in range(12):
+        put(container=container, name=f'{i}.bin', data=os.urandom(50 + i), md5=i % 2 == 0)
+    engine = TransferEngine(window=5, block_size=1000)
+    transfers = [(container.get_blob_client(f'{i}.bin'), str(tmp_path / f'{i}.bin')) for i in range(12)]
+    transfers.append((container.get_blob_client('missing.bin'), str(tmp_path / 'missing.bin')))
+    downloaded, failed = asyncio.run(engine.download_many(transfers=transfers))
+    assert sorted(downloaded) == sorted(dst_path for _, dst_path in transfers[:-1])
+    assert [args[0].blob_name for args, _ in failed] == ['missing.bin']
+    assert container.max_active == 5
+    for i in range(12):
+        with open(tmp_path / f'{i}.bin', 'rb') as src:
+            assert src.read() == container.blobs[f'{i}.bin'][0]
+
+
+def test_upload_does_not_overwrite(tmp_path):
+    container = FakeContainer()
+    put(container=container, name='a.bin', data=b'old')
+    put(container=container, name='small.bin', data=b'old')
+    data = os.urandom(1000)
+    src_path = str(tmp_path / 'a.bin')
+    with open(src_path, 'wb') as dst:
+        dst.write(data)
+    engine = TransferEngine(block_size=300)
+    # staged blocks and one shot upload
+    for name, block_size in ('a.bin', 300), ('small.bin', 2000):
+        with pytest.raises(ResourceExistsError):
+            asyncio.run(TransferEngine(block_size=block_size).upload(
+                src_path=src_path, blob_client=container.get_blob_client(name), overwrite=False))
+        assert container.blobs[name][0] == b'old'
+    assert not requests(container, 'stage') and not requests(container, 'upload')
+
+    asyncio.run(engine.upload(src_path=src_path, blob_client=container.get_blob_client('a.bin'), overwrite=True))
+    assert container.blobs['a.bin'][0] == data
+    # an up to date blob is not an error
+    asyncio.run(engine.upload(src_path=src_path, blob_client=container.get_blob_client('a.bin'), overwrite=False))
+
+
+def test_upload_blob_type_and_kwargs(tmp_path):
+    container = FakeContainer()
+    data = os.urandom(1000)
+    src_path = str(tmp_path / 'a.bin')
+    with open(src_path, 'wb') as dst:
+        dst.write(data)
+    engine = TransferEngine(block_size=300)
+    asyncio.run(engine.upload(src_path=src_path, blob_client=container.get_blob_client('append.bin'),
+                              blob_type=BlobType.APPENDBLOB))
+    # append blobs can not be staged, they are uploaded with upload_blob whatever their size
+    assert not requests(container, 'stage')
+    assert requests(container, 'upload') == [('upload', 'append.bin')]
+    assert container.kwargs['append.bin'] == dict(blob_type=BlobType.APPENDBLOB)
+
+    asyncio.run(engine.upload(src_path=src_path, blob_client=container.get_blob_client('block.bin'),
+                              blob_type=BlobType.BLOCKBLOB, metadata=dict(source='test')))
+    assert len(requests(container, 'stage')) == 4
+    assert container.kwargs['block.bin'] == dict(metadata=dict(source='test'))
+    assert container.blobs['block.bin'][0] == data
@@ -0,0 +1,90 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+shapely = pytest.importorskip('shapely')
+gpd = pytest.importorskip('geopandas')
+pyogrio = pytest.importorskip('pyogrio')
+
+from rapida.stats.vector_zonal_stats import clipped_line_lengths, line_zonal_stats, polygon_aggregates, \
+    vector_line_zonal_stats
+
+# a 2 x 2 grid of 10 x 10 cells
+POLYGONS = shapely.box([0, 10, 0, 10], [0, 0, 10, 10], [10, 20, 10, 20], [10, 10, 20, 20])
+LINES = shapely.linestrings([
+    [(2, 5), (18, 5)],  # crosses from cell 0 into cell 1, 8 in each
+    [(1, 1), (4, 1)],  # inside cell 0
+    [(12, 2), (12, 7)],  # inside cell 1
+    [(11, 9), (13, 9)],  # inside cell 1
+    [(10, 15), (15, 15)],  # inside cell 3, touches cell 2 in one point
+    [(30, 30), (40, 40)],  # outside the grid
+])
+# the clipped lengths of the lines in every cell
+LENGTHS = [[3, 8], [2, 5, 8], [], [5]]
+
+
+def test_clipped_line_lengths():
+    poly_idx, lengths = clipped_line_lengths(polygons=POLYGONS, lines=LINES)
+    assert poly_idx.tolist() == [i for i, cell in enumerate(LENGTHS) for _ in cell]
+    np.testing.assert_allclose(lengths, [length for cell in LENGTHS for length in cell])
+
+
+@pytest.mark.parametrize('operator, expected', [
+    ('sum', [11, 15, 0, 5]),
+    ('count', [2, 3, 0, 1]),
+    ('min', [3, 2, 0, 5]),
+    ('max', [8, 8, 0, 5]),
+    ('mean', [5.5, 5, 0, 5]),
+    ('median', [5.5, 5, 0, 5]),
+    ('density', [.11, .15, 0, .05]),
+])
+def test_line_zonal_stats(operator, expected):
+    np.testing.assert_allclose(line_zonal_stats(polygons=POLYGONS, lines=LINES, operator=operator), expected)
+
+
+def test_vector_line_zonal_stats():
+    df_polygon = gpd.GeoDataFrame({'h3id': list('abcd')}, geometry=POLYGONS, crs='ESRI:54009')
+    df_line = gpd.GeoDataFrame(geometry=LINES, crs='ESRI:54009')
+    df = vector_line_zonal_stats(df_polygon=df_polygon, df_line=df_line, operator='sum', field_name='roads_length')
+    assert df['roads_length'].tolist() == pytest.approx([11, 15, 0, 5])
+    assert 'roads_length' not in df_polygon.columns
+    with pytest.raises(AssertionError):
+        vector_line_zonal_stats(df_polygon=df_polygon, df_line=df_line, operator='std', field_name='roads_std')
+
+
+@pytest.fixture
+def features(tmp_path):
+    """
+    Small squares scattered over the grid and beyond it, with the id of the cell holding their centroid
+    """
+    rng = np.random.default_rng(0)
+    n = 500
+    x, y = rng.uniform(-5, 25, n), rng.uniform(0, 19, n)
+    sizes = rng.uniform(.1, 1, n)
+    geoms = shapely.box(x, y, x + sizes, y + sizes)
+    centroids = shapely.centroid(geoms)
+    cells = np.full(n, -1)
+    for i, polygon in enumerate(POLYGONS):
+        cells[shapely.contains(polygon, centroids)] = i
+    keys = np.array(list('abcd'))
+    gdf = gpd.GeoDataFrame({'polyid': np.where(cells >= 0, keys[cells], 'outside')}, geometry=geoms,
+                           crs='ESRI:54009')
+    path = str(tmp_path / 'features.gpkg')
+    pyogrio.write_dataframe(gdf, path, layer='with_ids')
+    pyogrio.write_dataframe(gdf.drop(columns=['polyid']), path, layer='without_ids')
+    expected_counts = np.bincount(cells[cells >= 0], minlength=4)
+    expected_areas = np.bincount(cells[cells >= 0], weights=shapely.area(geoms)[cells >= 0], minlength=4)
+    return path, keys, expected_counts, expected_areas
+
+
+@pytest.mark.parametrize('layer_name, id_column', [('with_ids', 'polyid'), ('without_ids', None)])
+def test_polygon_aggregates(features, layer_name, id_column):
+    path, keys, expected_counts, expected_areas = features
+    # the ids of the polygons are not in the layer order
+    order = np.array([2, 0, 3, 1])
+    kwargs = dict(dataset_path=path, layer_name=layer_name, keys=keys[order], polygons=POLYGONS[order],
+                  id_column=id_column, batch_size=64)
+    counts, areas = polygon_aggregates(**kwargs)
+    assert counts.dtype == np.int64 and counts.tolist() == expected_counts[order].tolist()
+    np.testing.assert_allclose(areas, expected_areas[order])
+    counts, areas = polygon_aggregates(area=False, **kwargs)
+    assert counts.tolist() == expected_counts[order].tolist() and (areas == 0).all()
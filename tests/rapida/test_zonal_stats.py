@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('exactextract')
+pytest.importorskip('osgeo')
+
+from exactextract import exact_extract
+
+from rapida.stats.raster_zonal_stats import partitioned_zonal_table, zonal_table
+
+ALIGNED = ['aligned_0', 'aligned_1']
+
+
+def numpy_stats(zonal=None, data=None, h3id=None, mask=None):
+    rows, cols = zonal.pixels(zonal.polygons[h3id])
+    values = data[rows, cols]
+    valid = values != zonal.nodata
+    if mask is not None:
+        valid &= mask[rows, cols] != 0
+    values = values[valid].astype('f8')
+    return dict(sum=values.sum(), count=float(valid.sum()), mean=values.mean(), min=values.min(), max=values.max())
+
+
+def test_single_pass_matches_exactextract(zonal):
+    vars_ops = [('a', 'sum'), ('b', ['mean', 'min', 'max', 'count'])]
+    stats = zonal_table(src_rasters=[zonal.rasters['a'], zonal.rasters['b']], polygon_ds=zonal.polygons_path,
+                        polygon_layer='polygons', vars_ops=vars_ops)
+    assert stats.index.name == 'h3id'
+    assert sorted(stats.index) == sorted(zonal.polygons)
+    assert stats.columns.tolist() == ['a', 'b_mean', 'b_min', 'b_max', 'b_count']
+
+    # one exactextract call per raster and operation, like before the single pass
+    for name, ops in ('a', ['sum']), ('b', ['mean', 'min', 'max', 'count']):
+        plain = exact_extract(zonal.rasters[name], zonal.polygons_path, ops=ops, include_cols=['h3id'],
+                              output='pandas').set_index('h3id').reindex(stats.index)
+        for op in ops:
+            column = name if name == 'a' else f'{name}_{op}'
+            np.testing.assert_allclose(stats[column].to_numpy(), plain[op].to_numpy(), rtol=1e-6)
+
+
+def test_aligned_polygons_match_numpy(zonal):
+    stats = zonal_table(src_rasters=[zonal.rasters['a'], zonal.rasters['b']], polygon_ds=zonal.polygons_path,
+                        polygon_layer='polygons', vars_ops=[('a', 'sum'), ('b', ['sum', 'mean'])],
+                        mask=zonal.mask_path)
+    for h3id in ALIGNED:
+        a = numpy_stats(data=zonal.arrays['a'], zonal=zonal, h3id=h3id)
+        b = numpy_stats(data=zonal.arrays['b'], zonal=zonal, h3id=h3id)
+        a_affected = numpy_stats(data=zonal.arrays['a'], zonal=zonal, h3id=h3id, mask=zonal.mask)
+        b_affected = numpy_stats(data=zonal.arrays['b'], zonal=zonal, h3id=h3id, mask=zonal.mask)
+        row = stats.loc[h3id]
+        np.testing.assert_allclose(row['a'], a['sum'], rtol=1e-6)
+        np.testing.assert_allclose([row['b_sum'], row['b_mean']], [b['sum'], b['mean']], rtol=1e-6)
+        np.testing.assert_allclose(row['a_affected'], a_affected['sum'], rtol=1e-6)
+        np.testing.assert_allclose([row['b_affected_sum'], row['b_affected_mean']],
+                                   [b_affected['sum'], b_affected['mean']], rtol=1e-6)
+    assert stats.loc['outside', 'a'] == 0
+
+
+def test_partitioned_matches_single_process(zonal):
+    kwargs = dict(src_rasters=[zonal.rasters['a'], zonal.rasters['b']], polygon_ds=zonal.polygons_path,
+                  polygon_layer='polygons', vars_ops=[('a', 'sum'), ('b', 'mean')])
+    expected = zonal_table(**kwargs)
+    partitioned = zonal_table(workers=2, **kwargs)
+    pd.testing.assert_frame_equal(partitioned.loc[expected.index], expected)
+
+
+def test_partitioned_without_polygons(zonal):
+    empty_path = zonal.write_polygons(path=os.path.join(zonal.folder, 'empty.gpkg'), polygons={})
+    stats = partitioned_zonal_table(src_rasters=[zonal.rasters['a'], zonal.rasters['b']], polygon_ds=empty_path,
+                                    polygon_layer='polygons', vars_ops=[('a', 'sum'), ('b', ['mean', 'max'])],
+                                    workers=2, mask=zonal.mask_path)
+    assert len(stats) == 0 and stats.index.name == 'h3id'
+    assert stats.columns.tolist() == ['a', 'a_affected', 'b_mean', 'b_max', 'b_affected_mean', 'b_affected_max']